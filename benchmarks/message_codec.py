@@ -0,0 +1,88 @@
+"""
+Benchmark message JSON encoding and decoding.
+
+Compares the current codec in :mod:`vumi.message` against the original
+decoder, which tried to parse every string in every object as a timestamp.
+"""
+
+import json
+import sys
+import time
+
+from vumi.message import (
+    TransportUserMessage, TransportEvent, parse_vumi_date, from_json, to_json)
+
+
+def legacy_date_time_decoder(json_object):
+    for key, value in json_object.items():
+        try:
+            json_object[key] = parse_vumi_date(value)
+        except ValueError:
+            continue
+        except TypeError:
+            continue
+    return json_object
+
+
+def legacy_from_json(json_string):
+    return json.loads(json_string, object_hook=legacy_date_time_decoder)
+
+
+def mk_user_message():
+    return TransportUserMessage(
+        to_addr="+27831234567",
+        from_addr="12345",
+        content="Hello, this is a message of moderate length. " * 3,
+        transport_name="sphex",
+        transport_type="sms",
+        transport_metadata={"smpp": {"source_addr_ton": "international"}},
+        helper_metadata={
+            "tag": {"tag": ["pool", "tag"]},
+            "go": {
+                "user_account": "user-1",
+                "conversation_key": "conv-1",
+                "conversation_type": "bulk_message",
+            },
+        })
+
+
+def mk_event(msg):
+    return TransportEvent(
+        event_type="delivery_report",
+        user_message_id=msg["message_id"],
+        delivery_status="delivered",
+        transport_name="sphex",
+        transport_metadata={"smpp": {"message_id": "abc123"}},
+        sent_message_id="abc123")
+
+
+def bench(name, func, arg, loops):
+    start = time.time()
+    for i in xrange(loops):
+        func(arg)
+    total = time.time() - start
+    print "  %-8s %8.2f us/op, %10.0f ops/s" % (
+        name, total * 1e6 / loops, loops / total)
+
+
+def run_bench(loops):
+    msg = mk_user_message()
+    event = mk_event(msg)
+    print "Running %d loops ..." % (loops,)
+    for label, obj in [("TransportUserMessage", msg),
+                       ("TransportEvent", event)]:
+        json_string = obj.to_json()
+        assert legacy_from_json(json_string) == from_json(json_string)
+        print "%s (%d bytes):" % (label, len(json_string))
+        bench("encode", to_json, obj.payload, loops)
+        bench("legacy", legacy_from_json, json_string, loops)
+        bench("decode", from_json, json_string, loops)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args:
+        loops = int(args[0])
+    else:
+        loops = 10000
+    run_bench(loops)
@@ -0,0 +1,84 @@
+"""
+Benchmark message copying and per-message memory overhead.
+
+Compares :meth:`vumi.message.Message.copy` against the original JSON round
+trip copy, and the size of a message object with and without ``__slots__``.
+"""
+
+import sys
+import time
+
+from vumi.message import TransportUserMessage
+
+
+class DictMessage(TransportUserMessage):
+    """
+    A message class with a per-instance attribute dict, as messages had
+    before they used ``__slots__``.
+    """
+
+
+def mk_message(cls=TransportUserMessage):
+    msg = cls(
+        to_addr="+27831234567",
+        from_addr="12345",
+        content="Hello, this is a message of moderate length. " * 3,
+        transport_name="sphex",
+        transport_type="sms",
+        transport_metadata={"smpp": {"source_addr_ton": "international"}},
+        helper_metadata={
+            "tag": {"tag": ["pool", "tag"]},
+            "go": {
+                "user_account": "user-1",
+                "conversation_key": "conv-1",
+                "conversation_type": "bulk_message",
+            },
+        })
+    # Messages usually arrive over AMQP, so decode one like a consumer would.
+    return cls.from_json(msg.to_json())
+
+
+def legacy_copy(msg):
+    return msg.from_json(msg.to_json())
+
+
+def object_overhead(msg):
+    size = sys.getsizeof(msg)
+    if hasattr(msg, '__dict__'):
+        size += sys.getsizeof(msg.__dict__)
+    return size
+
+
+def bench(name, func, msg, loops):
+    start = time.time()
+    for i in xrange(loops):
+        func(msg)
+    total = time.time() - start
+    print "  %-22s %8.2f us/op, %10.0f ops/s" % (
+        name, total * 1e6 / loops, loops / total)
+
+
+def run_bench(loops):
+    print "Object overhead (excluding payload):"
+    print "  with __slots__:    %d bytes" % (object_overhead(mk_message()),)
+    print "  without __slots__: %d bytes" % (
+        object_overhead(mk_message(DictMessage)),)
+
+    print "Running %d loops ..." % (loops,)
+    msg = mk_message()
+    assert msg.copy() == legacy_copy(msg)
+    bench("legacy copy", legacy_copy, msg, loops)
+    bench("copy", lambda m: m.copy(), msg, loops)
+    bench("copy + set endpoint", lambda m: m.copy().set_routing_endpoint(),
+          msg, loops)
+    msg['helper_metadata']
+    bench("copy (exposed fields)", lambda m: m.copy(), msg, loops)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args:
+        loops = int(args[0])
+    else:
+        loops = 10000
+    run_bench(loops)
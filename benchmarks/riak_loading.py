@@ -0,0 +1,94 @@
+"""
+Benchmark loading model instances for a list of keys from Riak.
+
+Compares bunch loading with a JavaScript MapReduce, bunch loading with
+concurrent gets for each bunch, and :meth:`TxRiakManager.load_stream` for a
+range of concurrency limits.
+
+This needs a Riak server on localhost. Pass ``pbc`` to use the protocol
+buffers transport instead of HTTP.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.persist.fields import Unicode
+from vumi.persist.model import Model
+from vumi.persist.txriak_manager import TxRiakManager
+
+
+class BenchModel(Model):
+    bucket = 'bench_model'
+    text = Unicode()
+
+
+def report(name, start, count):
+    total = time.time() - start
+    print "  %-22s %8.3f s, %10.0f objects/s" % (name, total, count / total)
+
+
+@inlineCallbacks
+def bench_bunches(name, manager, keys, use_mapreduce):
+    manager.USE_MAPREDUCE_BUNCH_LOADING = use_mapreduce
+    start = time.time()
+    objs = []
+    for bunch in manager.load_all_bunches(BenchModel, keys):
+        objs.extend((yield bunch))
+    report(name, start, len(objs))
+    assert len(objs) == len(keys)
+
+
+@inlineCallbacks
+def bench_stream(name, manager, keys, concurrency):
+    start = time.time()
+    objs = []
+    yield manager.load_stream(
+        BenchModel, keys, objs.append, concurrency=concurrency)
+    report(name, start, len(objs))
+    assert len(objs) == len(keys)
+
+
+@inlineCallbacks
+def run_bench(count, transport_type):
+    manager = TxRiakManager.from_config({
+        'bucket_prefix': 'vumi_bench.',
+        'transport_type': transport_type,
+    })
+    yield manager.purge_all()
+    print "Storing %d objects ..." % (count,)
+    model = manager.proxy(BenchModel)
+    keys = []
+    for i in xrange(count):
+        obj = yield model(u"item%s" % (i,), text=u"Some text %s" % (i,)).save()
+        keys.append(obj.key)
+
+    print "Loading %d objects in bunches of %d:" % (
+        count, manager.load_bunch_size)
+    yield bench_bunches("mapreduce bunches", manager, keys, True)
+    yield bench_bunches("multi-get bunches", manager, keys, False)
+    for concurrency in [1, 5, 10]:
+        yield bench_stream(
+            "stream (%d in flight)" % (concurrency,), manager, keys,
+            concurrency)
+
+    yield manager.purge_all()
+    yield manager.close_manager()
+    reactor.stop()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    transport_type = 'http'
+    if "pbc" in args:
+        transport_type = 'pbc'
+        args.remove("pbc")
+    if args:
+        count = int(args[0])
+    else:
+        count = 2000
+    reactor.suggestThreadPoolSize(10)
+    reactor.callLater(0, run_bench, count, transport_type)
+    reactor.run()
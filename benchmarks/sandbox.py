@@ -1,5 +1,9 @@
 """
 Benchmark sandbox message processing round trip.
+
+Compares spawning a sandbox process for every message against keeping a
+pool of warm sandbox processes, for messages sent one at a time (latency)
+and all at once (throughput).
 """
 
 import sys
@@ -76,67 +80,96 @@ class Timer(object):
         return min(self.times)
 
 
-@inlineCallbacks
-def run_bench(loops):
-    opts = VumiOptions()
-    opts.postOptions()
-    worker_creator = WorkerCreator(opts.vumi_options)
-
-    app = worker_creator.create_worker_by_class(BenchApp, {
-        "transport_name": "dummy",
-        "javascript": """
-            api.on_inbound_message = function(command) {
-                this.request('outbound.reply_to', {
-                    content: 'reply',
-                    in_reply_to: command.msg.message_id,
-                },
-                function (reply) {
-                    this.done();
-                });
-            };
-        """,
-        "sandbox": {
-            'log': {
-                'cls': 'vumi.application.sandbox.LoggingResource',
-            },
-            'outbound': {
-                'cls': 'vumi.application.sandbox.OutboundResource',
+APP_CONFIG = {
+    "transport_name": "dummy",
+    "javascript": """
+        api.on_inbound_message = function(command) {
+            this.request('outbound.reply_to', {
+                content: 'reply',
+                in_reply_to: command.msg.message_id,
             },
+            function (reply) {
+                this.done();
+            });
+        };
+    """,
+    "sandbox": {
+        'log': {
+            'cls': 'vumi.application.sandbox.LoggingResource',
         },
-    })
+        'outbound': {
+            'cls': 'vumi.application.sandbox.OutboundResource',
+        },
+    },
+}
 
-    transport = worker_creator.create_worker_by_class(BenchTransport, {
-        "transport_name": "dummy",
-    })
 
-    yield transport.startService()
-    log.msg("Waiting for transport ...")
-    yield BenchTransport.WORKER_QUEUE.get()
+def publish_message(transport):
+    transport.publish_message(
+        content="Hi!",
+        to_addr="+1234",
+        from_addr="+5678",
+        transport_type="ussd",
+    )
 
+
+@inlineCallbacks
+def bench_app(worker_creator, transport, name, loops, extra_config):
+    config = APP_CONFIG.copy()
+    config.update(extra_config)
+    app = worker_creator.create_worker_by_class(BenchApp, config)
     yield app.startService()
     log.msg("Waiting for worker ...")
     yield BenchApp.WORKER_QUEUE.get()
 
-    print "Starting %d loops ..." % (loops,)
+    print "%s:" % (name,)
     timer = Timer()
     for i in range(loops):
         with timer:
-            transport.publish_message(
-                content="Hi!",
-                to_addr="+1234",
-                from_addr="+5678",
-                transport_type="ussd",
-            )
+            publish_message(transport)
             reply = yield transport.message_queue.get()
             log.msg("Reply ID: %s" % reply['message_id'])
 
-    print "Total time: %.2f" % timer.total()
-    print "Time per message: %g" % timer.mean()
-    print "  max: %g, min: %g" % (timer.max(), timer.min())
-    print "  loops: %d" % timer.loops()
+    print "  Total time: %.2f" % timer.total()
+    print "  Time per message: %g" % timer.mean()
+    print "    max: %g, min: %g" % (timer.max(), timer.min())
+    print "    loops: %d" % timer.loops()
+
+    # Send all the messages at once to see how many we can get through.
+    start = time.time()
+    for i in range(loops):
+        publish_message(transport)
+    for i in range(loops):
+        yield transport.message_queue.get()
+    total = time.time() - start
+    print "  Throughput: %.1f msgs/s" % (loops / total,)
 
-    yield transport.stopService()
     yield app.stopService()
+
+
+@inlineCallbacks
+def run_bench(loops):
+    opts = VumiOptions()
+    opts.postOptions()
+    worker_creator = WorkerCreator(opts.vumi_options)
+
+    transport = worker_creator.create_worker_by_class(BenchTransport, {
+        "transport_name": "dummy",
+    })
+
+    yield transport.startService()
+    log.msg("Waiting for transport ...")
+    yield BenchTransport.WORKER_QUEUE.get()
+
+    print "Starting %d loops ..." % (loops,)
+    yield bench_app(worker_creator, transport, "Process per message", loops,
+                    {})
+    yield bench_app(worker_creator, transport, "Pooled processes", loops, {
+        "pooled": True,
+        "pool_max_processes": 4,
+    })
+
+    yield transport.stopService()
     reactor.stop()
 
 
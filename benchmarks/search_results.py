@@ -0,0 +1,83 @@
+"""
+Benchmark storing message search results in the message store cache.
+
+Compares :meth:`MessageStoreCache.store_query_results` against the original
+implementation, which looked up and stored each result with its own ZSCORE
+and ZADD round trip, for a range of result set sizes.
+
+By default this uses the fake Redis, which waits ``VUMI_FAKE_REDIS_WAIT``
+seconds (0.002 unless set in the environment) before answering each batch
+of pipelined commands. Pass ``redis`` to use a Redis server on localhost
+instead.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.components.message_store_cache import MessageStoreCache
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+@inlineCallbacks
+def legacy_store_query_results(cache, batch_id, token, keys, direction):
+    result_key = cache.search_result_key(batch_id, token)
+    score_set_key = cache.inbound_key(batch_id)
+    for key in keys:
+        timestamp = yield cache.redis.zscore(score_set_key, key)
+        yield cache.redis.zadd(result_key, **{
+            key.encode('utf-8'): timestamp,
+        })
+    yield cache.redis.expire(result_key, cache.DEFAULT_SEARCH_RESULT_TTL)
+    yield cache.redis.srem(cache.search_token_key(batch_id), token)
+
+
+def store_query_results(cache, batch_id, token, keys, direction):
+    return cache.store_query_results(batch_id, token, keys, direction)
+
+
+@inlineCallbacks
+def bench(name, func, cache, batch_id, keys):
+    token = yield cache.start_query(batch_id, 'inbound', [{'bench': name}])
+    start = time.time()
+    yield func(cache, batch_id, token, keys, 'inbound')
+    total = time.time() - start
+    count = yield cache.count_query_results(batch_id, token)
+    assert count == len(keys)
+    print "  %-8s %8.3f s, %10.0f results/s" % (name, total, count / total)
+
+
+@inlineCallbacks
+def run_bench(sizes, redis_config):
+    redis = yield TxRedisManager.from_config(redis_config)
+    cache = MessageStoreCache(redis)
+    batch_id = 'bench-batch'
+    for size in sizes:
+        yield redis._purge_all()
+        yield cache.batch_start(batch_id, use_counters=False)
+        keys = ['message-%s' % (i,) for i in xrange(size)]
+        yield redis.zadd(cache.inbound_key(batch_id), **dict(
+            (key, 1400000000 + i) for i, key in enumerate(keys)))
+        print "%d results:" % (size,)
+        yield bench("legacy", legacy_store_query_results, cache, batch_id,
+                    keys)
+        yield bench("current", store_query_results, cache, batch_id, keys)
+    yield redis._purge_all()
+    yield redis._close()
+    reactor.stop()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    redis_config = {'FAKE_REDIS': 'yes', 'key_prefix': 'vumi_bench'}
+    if "redis" in args:
+        redis_config = {'key_prefix': 'vumi_bench'}
+        args.remove("redis")
+    if args:
+        sizes = [int(arg) for arg in args]
+    else:
+        sizes = [100, 1000, 2000]
+    reactor.callLater(0, run_bench, sizes, redis_config)
+    reactor.run()
@@ -0,0 +1,131 @@
+"""
+Benchmark framing of SMPP PDU streams.
+
+Compares :class:`vumi.transports.smpp.pdu_utils.PduStreamFramer` against the
+original string buffer, which was extended by concatenation and sliced by
+:func:`vumi.transports.smpp.pdu_utils.chop_pdu_stream` for each PDU, on a
+burst of interleaved deliver_sm and submit_sm_resp PDUs.
+"""
+
+import sys
+import time
+
+from smpp.pdu import unpack_pdu
+from smpp.pdu_builder import DeliverSM, SubmitSMResp
+
+from vumi.transports.smpp.pdu_utils import PduStreamFramer, chop_pdu_stream
+from vumi.transports.smpp.protocol import EsmeTransceiver
+
+
+# A typical TCP segment payload.
+CHUNK_SIZE = 1460
+
+
+class CountingTransceiver(EsmeTransceiver):
+    """
+    A protocol that only frames and decodes PDUs, without the transport,
+    Redis and message processors a real one needs.
+    """
+
+    def __init__(self):
+        self.framer = PduStreamFramer()
+        self.pdus = 0
+
+    def on_pdu(self, pdu):
+        self.pdus += 1
+
+
+def mk_stream(count):
+    pdus = []
+    for i in xrange(1, count + 1):
+        if i % 2:
+            pdus.append(DeliverSM(
+                sequence_number=i, source_addr="27831234567",
+                destination_addr="12345",
+                short_message="Hello, this is a message. " * 4).get_bin())
+        else:
+            pdus.append(SubmitSMResp(
+                sequence_number=i, message_id="msg-%s" % (i,)).get_bin())
+    return ''.join(pdus)
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def legacy_frame(chunks):
+    buf = ''
+    found = 0
+    for chunk in chunks:
+        buf += chunk
+        pdu_found = chop_pdu_stream(buf)
+        while pdu_found is not None:
+            _, buf = pdu_found
+            found += 1
+            pdu_found = chop_pdu_stream(buf)
+    return found
+
+
+def framer_frame(chunks):
+    framer = PduStreamFramer()
+    found = 0
+    for chunk in chunks:
+        framer.feed(chunk)
+        while framer.next_pdu() is not None:
+            found += 1
+    return found
+
+
+def protocol_receive(chunks):
+    protocol = CountingTransceiver()
+    for chunk in chunks:
+        protocol.dataReceived(chunk)
+    return protocol.pdus
+
+
+def legacy_protocol_receive(chunks):
+    found = 0
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        pdu_found = chop_pdu_stream(buf)
+        while pdu_found is not None:
+            data, buf = pdu_found
+            unpack_pdu(data)
+            found += 1
+            pdu_found = chop_pdu_stream(buf)
+    return found
+
+
+def bench(name, func, chunks, count, loops):
+    assert func(chunks) == count
+    start = time.time()
+    for i in xrange(loops):
+        func(chunks)
+    total = time.time() - start
+    print "  %-18s %10.2f ms/burst, %10.0f PDUs/s" % (
+        name, total * 1e3 / loops, loops * count / total)
+
+
+def run_bench(loops):
+    print "Running %d loops ..." % (loops,)
+    for count in [100, 1000, 10000]:
+        data = mk_stream(count)
+        for label, chunks in [("one chunk", [data]),
+                              ("%d byte chunks" % CHUNK_SIZE,
+                               chunked(data, CHUNK_SIZE))]:
+            print "%d PDUs (%d bytes), %s:" % (count, len(data), label)
+            bench("legacy framing", legacy_frame, chunks, count, loops)
+            bench("framer", framer_frame, chunks, count, loops)
+            bench("legacy + decode", legacy_protocol_receive, chunks, count,
+                  loops)
+            bench("protocol", protocol_receive, chunks, count, loops)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args:
+        loops = int(args[0])
+    else:
+        loops = 10
+    run_bench(loops)
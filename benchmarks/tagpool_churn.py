@@ -0,0 +1,90 @@
+"""
+Benchmark tag churn in the tag pool manager.
+
+Acquires and releases tags from a pool as fast as possible, one at a time
+and in batches, using the Lua scripts in :mod:`vumi.components.tagpool` and
+the original sequence of separate Redis commands for each operation.
+
+By default this uses the fake Redis, which can't run scripts, so only the
+separate commands are measured. It waits ``VUMI_FAKE_REDIS_WAIT`` seconds
+(0.002 unless set in the environment) before answering each batch of
+pipelined commands. Pass ``redis`` to use a Redis server on localhost
+instead.
+"""
+
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.components.tagpool import TagpoolManager
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+POOL = u"bench_pool"
+
+
+@inlineCallbacks
+def churn_single(tpm, tags, rounds):
+    for _ in xrange(rounds):
+        acquired = []
+        for _ in tags:
+            tag = yield tpm.acquire_tag(POOL, owner=u"bench")
+            acquired.append(tag)
+        for tag in acquired:
+            yield tpm.release_tag(tag)
+
+
+@inlineCallbacks
+def churn_batch(tpm, tags, rounds):
+    for _ in xrange(rounds):
+        acquired = yield tpm.acquire_tags(POOL, len(tags), owner=u"bench")
+        yield tpm.release_tags(acquired)
+
+
+@inlineCallbacks
+def bench(name, func, tpm, tags, rounds):
+    start = time.time()
+    yield func(tpm, tags, rounds)
+    total = time.time() - start
+    ops = 2 * len(tags) * rounds
+    print "  %-16s %8.3f s, %10.0f acquires+releases/s" % (
+        name, total, ops / total)
+    # Make sure every tag made it back to the pool.
+    free = yield tpm.free_tags(POOL)
+    assert len(free) == len(tags)
+
+
+@inlineCallbacks
+def run_bench(pool_size, rounds, redis_config):
+    redis = yield TxRedisManager.from_config(redis_config)
+    yield redis._purge_all()
+    tpm = TagpoolManager(redis)
+    tags = [(POOL, u"tag%d" % (i,)) for i in xrange(pool_size)]
+    yield tpm.declare_tags(tags)
+
+    print "%d tags, %d rounds:" % (pool_size, rounds)
+    modes = [("commands", False)]
+    if redis.supports_scripting():
+        modes.append(("scripts", True))
+    for label, use_scripts in modes:
+        tpm.use_scripts = use_scripts
+        yield bench(label, churn_single, tpm, tags, rounds)
+        yield bench(label + " (batch)", churn_batch, tpm, tags, rounds)
+
+    yield redis._purge_all()
+    yield redis._close()
+    reactor.stop()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    redis_config = {'FAKE_REDIS': 'yes', 'key_prefix': 'vumi_bench'}
+    if "redis" in args:
+        redis_config = {'key_prefix': 'vumi_bench'}
+        args.remove("redis")
+    pool_size = int(args[0]) if len(args) > 0 else 100
+    rounds = int(args[1]) if len(args) > 1 else 10
+    reactor.callLater(0, run_bench, pool_size, rounds, redis_config)
+    reactor.run()
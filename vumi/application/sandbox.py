@@ -9,6 +9,7 @@ import json
 import pkg_resources
 import logging
 import operator
+from collections import deque
 from uuid import uuid4
 from StringIO import StringIO
 
@@ -18,21 +19,24 @@ from twisted.internet import reactor
 from twisted.internet.protocol import ProcessProtocol
 from twisted.internet.defer import (
     Deferred, inlineCallbacks, maybeDeferred, returnValue, DeferredList,
-    succeed)
+    succeed, fail, gatherResults)
 from twisted.internet.error import ProcessDone
 from twisted.python.failure import Failure
-from twisted.web.client import WebClientContextFactory, Agent
+from twisted.web.client import (
+    WebClientContextFactory, Agent, HTTPConnectionPool)
 
 from OpenSSL.SSL import (
     VERIFY_PEER, VERIFY_FAIL_IF_NO_PEER_CERT, VERIFY_CLIENT_ONCE, VERIFY_NONE,
     SSLv3_METHOD, SSLv23_METHOD, TLSv1_METHOD)
 
-from vumi.config import ConfigText, ConfigInt, ConfigList, ConfigDict
+from vumi.config import (
+    ConfigText, ConfigInt, ConfigBool, ConfigList, ConfigDict)
 from vumi.application.base import ApplicationWorker
+from vumi.blinkenlights.metrics import MetricManager, Metric, Count
 from vumi.message import Message
-from vumi.errors import ConfigError
+from vumi.errors import ConfigError, InvalidMessage, MissingMessageField
 from vumi.persist.txredis_manager import TxRedisManager
-from vumi.utils import load_class_by_string, HttpDataLimitError, to_kwargs
+from vumi.utils import load_class_by_string, HttpDataLimitError
 from vumi import log
 from vumi.application.sandbox_rlimiter import SandboxRlimiter
 
@@ -69,6 +73,44 @@ class SandboxError(Exception):
     """An error occurred inside the sandbox."""
 
 
+class LineBuffer(object):
+    """Splits a stream of data into newline separated lines.
+
+    Only the incomplete line at the end of the data is kept, in a
+    bytearray, and each piece of data is only searched for newlines
+    once. A long line that arrives in many small pieces is therefore
+    built up in place rather than being copied again for each piece.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Add `data` to the buffer and return the lines it completes."""
+        if "\n" not in data:
+            self._buffer.extend(data)
+            return []
+        lines = data.split("\n")
+        rest = lines.pop()
+        if self._buffer:
+            self._buffer.extend(lines[0])
+            lines[0] = str(self._buffer)
+            del self._buffer[:]
+        if rest:
+            self._buffer.extend(rest)
+        return lines
+
+    def flush(self):
+        """Empty the buffer and return the incomplete line in it."""
+        line = str(self._buffer)
+        self.clear()
+        return line
+
+    def clear(self):
+        """Discard any incomplete line in the buffer."""
+        del self._buffer[:]
+
+
 class SandboxProtocol(ProcessProtocol):
     """A protocol for communicating over stdin and stdout with a sandboxed
     process.
@@ -98,11 +140,12 @@ class SandboxProtocol(ProcessProtocol):
         self._done = MultiDeferred()
         self._pending_requests = []
         self.exit_reason = None
+        self.timeout = timeout
         self.timeout_task = reactor.callLater(timeout, self.kill)
         self.recv_limit = recv_limit
         self.recv_bytes = 0
-        self.chunk = ''
-        self.error_chunk = ''
+        self.out_buffer = LineBuffer()
+        self.err_buffer = LineBuffer()
         self.error_lines = []
         api.set_sandbox(self)
 
@@ -142,12 +185,12 @@ class SandboxProtocol(ProcessProtocol):
     def connectionMade(self):
         self._started.callback(self)
 
-    def _process_data(self, chunk, data):
+    def _process_data(self, line_buffer, data):
         if not self.check_recv(len(data)):
-            return ['']  # skip the data if it's too big
-        line_parts = data.split("\n")
-        line_parts[0] = chunk + line_parts[0]
-        return line_parts
+            # skip the data if it's too big
+            line_buffer.clear()
+            return []
+        return line_buffer.feed(data)
 
     def _parse_command(self, line):
         try:
@@ -155,29 +198,26 @@ class SandboxProtocol(ProcessProtocol):
         except Exception, e:
             return SandboxCommand(cmd="unknown", line=line, exception=e)
 
+    def dispatch_command(self, command):
+        d = self.api.dispatch_request(command)
+        self._pending_requests.append(d)
+
     def outReceived(self, data):
-        lines = self._process_data(self.chunk, data)
-        for i in range(len(lines) - 1):
-            d = self.api.dispatch_request(self._parse_command(lines[i]))
-            self._pending_requests.append(d)
-        self.chunk = lines[-1]
+        for line in self._process_data(self.out_buffer, data):
+            self.dispatch_command(self._parse_command(line))
 
     def outConnectionLost(self):
-        if self.chunk:
-            line, self.chunk = self.chunk, ""
-            d = self.api.dispatch_request(self._parse_command(line))
-            self._pending_requests.append(d)
+        line = self.out_buffer.flush()
+        if line:
+            self.dispatch_command(self._parse_command(line))
 
     def errReceived(self, data):
-        lines = self._process_data(self.error_chunk, data)
-        for i in range(len(lines) - 1):
-            self.error_lines.append(lines[i])
-        self.error_chunk = lines[-1]
+        self.error_lines.extend(self._process_data(self.err_buffer, data))
 
     def errConnectionLost(self):
-        if self.error_chunk:
-            self.error_lines.append(self.error_chunk)
-            self.error_chunk = ""
+        line = self.err_buffer.flush()
+        if line:
+            self.error_lines.append(line)
 
     def _process_request_results(self, results):
         for success, result in results:
@@ -207,6 +247,337 @@ class SandboxProtocol(ProcessProtocol):
         requests_done.addCallback(lambda _r: self._done.callback(result))
 
 
+class PooledSandboxProtocol(SandboxProtocol):
+    """A sandbox protocol whose process is kept running and reused for
+    several messages by a :class:`SandboxPool`.
+
+    Once the sandbox has been initialized it is sent a ``pooled``
+    command. From then on it must send a ``done`` command when it has
+    finished processing each message or event instead of exiting.
+
+    The `timeout` and `recv_limit` apply to each message separately.
+    """
+
+    def __init__(self, *args, **kw):
+        SandboxProtocol.__init__(self, *args, **kw)
+        self.messages_processed = 0
+        self.ended = False
+        self._message_d = None
+
+    def start_pooled(self):
+        """Initialize the sandbox and tell it that it is pooled."""
+        self._stop_timeout()
+        self.api.sandbox_init()
+        self.api.sandbox_send(SandboxCommand(cmd="pooled"))
+
+    def process(self, api_callback):
+        """Pass a message or event to the sandbox.
+
+        :param api_callback:
+            Called with the :class:`SandboxApi` to send the message or event
+            to the sandbox.
+
+        :returns:
+            A deferred that fires with ``0`` once the sandbox is done with
+            the message, or with the exit status (or failure) if the
+            process ends first.
+        """
+        self.messages_processed += 1
+        self.recv_bytes = 0
+        self._start_timeout()
+        d = self._message_d = Deferred()
+        api_callback(self.api)
+        return d
+
+    def _start_timeout(self):
+        self._stop_timeout()
+        self.timeout_task = reactor.callLater(self.timeout, self.kill)
+
+    def _stop_timeout(self):
+        if self.timeout_task.active():
+            self.timeout_task.cancel()
+
+    def dispatch_command(self, command):
+        if command['cmd'] == 'done':
+            self._message_done()
+        else:
+            SandboxProtocol.dispatch_command(self, command)
+
+    def _message_done(self):
+        if self._message_d is None:
+            # We aren't processing anything, so there's nothing to finish.
+            return
+        d, self._message_d = self._message_d, None
+        self._stop_timeout()
+        if self.error_lines:
+            self.api.log("\n".join(self.error_lines), logging.ERROR)
+            self.error_lines = []
+        pending_requests, self._pending_requests = self._pending_requests, []
+        requests_done = DeferredList(pending_requests)
+        requests_done.addCallback(self._process_request_results)
+        requests_done.addCallback(
+            lambda _r: self.api.clear_inbound_messages())
+        requests_done.addCallback(lambda _r: d.callback(0))
+
+    def processEnded(self, reason):
+        self.ended = True
+        SandboxProtocol.processEnded(self, reason)
+        if self._message_d is not None:
+            d, self._message_d = self._message_d, None
+            self.done().chainDeferred(d)
+
+
+class SandboxPool(object):
+    """Warm sandbox processes, kept separately for each sandbox id.
+
+    Up to `max_processes` processes are run for each sandbox id, and
+    messages for a sandbox id wait for one of its processes if they are all
+    busy. A process is replaced after it has processed `max_messages`
+    messages, and is stopped after sitting idle for `idle_timeout`
+    seconds. Processes that end for any other reason (such as being killed
+    for exceeding their `timeout` or `recv_limit`, or breaking their
+    rlimits) are replaced when they are next needed. So are idle processes
+    whose sandbox config has changed since they were started, because the
+    sandbox's code and resource config are fixed when it starts.
+    """
+
+    def __init__(self, app_worker, max_processes, max_messages, idle_timeout,
+                 clock=reactor):
+        self.app_worker = app_worker
+        self.max_processes = max_processes
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self._counts = {}
+        self._processes = {}
+        self._idle = {}
+        self._idle_tasks = {}
+        self._waiting = {}
+        self._configs = {}
+
+    def processes(self, sandbox_id):
+        """Return the running processes for `sandbox_id`."""
+        return list(self._processes.get(sandbox_id, ()))
+
+    @inlineCallbacks
+    def process(self, msg_or_event, config, api_callback):
+        """Process a message or event in a pooled sandbox.
+
+        :param api_callback:
+            Called with the sandbox's :class:`SandboxApi` to send the message
+            or event to it.
+
+        :returns:
+            A deferred that fires with ``0`` once the sandbox is done, the
+            exit status if the process ends instead, or ``None`` if it fails.
+        """
+        try:
+            sandbox = yield self.acquire(msg_or_event, config)
+        except SandboxError:
+            log.error()
+            returnValue(None)
+        d = sandbox.process(api_callback)
+        d.addErrback(log.error)
+        status = yield d
+        self.release(sandbox)
+        returnValue(status)
+
+    @inlineCallbacks
+    def acquire(self, msg_or_event, config):
+        """Get an idle process for the sandbox, starting a new one if
+        there's room for it and waiting for one to become free otherwise.
+        """
+        sandbox_id = config.sandbox_id
+        while True:
+            idle = self._idle.get(sandbox_id)
+            if idle:
+                sandbox = idle.pop()
+                self._idle_tasks.pop(sandbox).cancel()
+                if sandbox.ended:
+                    continue
+                if self._configs[sandbox] != config._config_data:
+                    self.retire(sandbox)
+                    continue
+                returnValue(sandbox)
+            if self._counts.get(sandbox_id, 0) < self.max_processes:
+                break
+            d = Deferred()
+            self._waiting.setdefault(sandbox_id, []).append(d)
+            yield d
+        sandbox = yield self._spawn(msg_or_event, config)
+        returnValue(sandbox)
+
+    @inlineCallbacks
+    def _spawn(self, msg_or_event, config):
+        sandbox_id = config.sandbox_id
+        self._counts[sandbox_id] = self._counts.get(sandbox_id, 0) + 1
+        try:
+            sandbox = yield self.app_worker.sandbox_protocol_for_message(
+                msg_or_event, config)
+            sandbox.spawn()
+        except Exception:
+            self._free_slot(sandbox_id)
+            raise
+        self._processes.setdefault(sandbox_id, set()).add(sandbox)
+        self._configs[sandbox] = config._config_data
+        sandbox.done().addBoth(lambda _: self._remove(sandbox))
+        yield sandbox.started()
+        sandbox.start_pooled()
+        returnValue(sandbox)
+
+    def release(self, sandbox):
+        """Return a process to the pool once it is done with a message."""
+        sandbox_id = sandbox.sandbox_id
+        if sandbox not in self._processes.get(sandbox_id, ()):
+            return
+        if sandbox.ended or sandbox.messages_processed >= self.max_messages:
+            self.retire(sandbox)
+            return
+        self._idle.setdefault(sandbox_id, []).append(sandbox)
+        self._idle_tasks[sandbox] = self.clock.callLater(
+            self.idle_timeout, self.retire, sandbox)
+        self._wake(sandbox_id)
+
+    def retire(self, sandbox):
+        """Remove a process from the pool and kill it."""
+        self._remove(sandbox)
+        sandbox.kill()
+
+    def _remove(self, sandbox):
+        sandbox_id = sandbox.sandbox_id
+        processes = self._processes.get(sandbox_id, set())
+        if sandbox not in processes:
+            return
+        processes.remove(sandbox)
+        del self._configs[sandbox]
+        idle_task = self._idle_tasks.pop(sandbox, None)
+        if idle_task is not None:
+            if idle_task.active():
+                idle_task.cancel()
+            self._idle[sandbox_id].remove(sandbox)
+        self._free_slot(sandbox_id)
+
+    def _free_slot(self, sandbox_id):
+        self._counts[sandbox_id] -= 1
+        if self._counts[sandbox_id] == 0 and not self._waiting.get(sandbox_id):
+            for sandboxes in (
+                    self._counts, self._processes, self._idle, self._waiting):
+                sandboxes.pop(sandbox_id, None)
+        else:
+            self._wake(sandbox_id)
+
+    def _wake(self, sandbox_id):
+        waiting = self._waiting.get(sandbox_id)
+        if waiting:
+            waiting.pop(0).callback(None)
+
+    def stop(self):
+        """Kill all the pooled processes.
+
+        :returns: A deferred that fires once they have all ended.
+        """
+        ds = []
+        for processes in self._processes.values():
+            for sandbox in list(processes):
+                ds.append(sandbox.done())
+                self.retire(sandbox)
+        return DeferredList(ds, consumeErrors=True)
+
+
+class SandboxQueueFull(Exception):
+    """Too many messages are already waiting for a sandbox."""
+
+
+class SandboxScheduler(object):
+    """Limit how many sandboxes run at once, both overall and for each
+    sandbox id.
+
+    Work that can't run yet waits in a queue that is served round robin by
+    sandbox id, so one busy sandbox can't hold up all the others. If
+    `max_queued` is set, work that arrives while that many are already
+    waiting is rejected.
+
+    Limits of ``None`` are unbounded.
+    """
+
+    def __init__(self, max_running=None, max_running_per_sandbox=None,
+                 max_queued=None, clock=reactor):
+        self.max_running = max_running
+        self.max_running_per_sandbox = max_running_per_sandbox
+        self.max_queued = max_queued
+        self.clock = clock
+        self.running = 0
+        self.queued = 0
+        self._running_per_sandbox = {}
+        # Waiting work for each sandbox id, and the ids with waiting work in
+        # the order they're served.
+        self._queues = {}
+        self._queue_order = deque()
+
+    def _has_room(self, sandbox_id):
+        if self.max_running is not None and self.running >= self.max_running:
+            return False
+        return (self.max_running_per_sandbox is None or
+                self._running_per_sandbox.get(sandbox_id, 0) <
+                self.max_running_per_sandbox)
+
+    def _start(self, sandbox_id):
+        self.running += 1
+        self._running_per_sandbox[sandbox_id] = (
+            self._running_per_sandbox.get(sandbox_id, 0) + 1)
+
+    def acquire(self, sandbox_id):
+        """Wait for room to run a sandbox for `sandbox_id`.
+
+        :returns:
+            A deferred that fires with the number of seconds we waited once
+            the sandbox may run, or fails with :class:`SandboxQueueFull`.
+            Each successful call must be matched by a call to
+            :meth:`release`.
+        """
+        if self._has_room(sandbox_id):
+            self._start(sandbox_id)
+            return succeed(0)
+        if self.max_queued is not None and self.queued >= self.max_queued:
+            return fail(SandboxQueueFull(
+                "%d messages are already waiting for a sandbox."
+                % (self.queued,)))
+        d = Deferred()
+        if sandbox_id not in self._queues:
+            self._queues[sandbox_id] = deque()
+            self._queue_order.append(sandbox_id)
+        self._queues[sandbox_id].append((d, self.clock.seconds()))
+        self.queued += 1
+        return d
+
+    def release(self, sandbox_id):
+        """Free the room used by a sandbox for `sandbox_id`."""
+        self.running -= 1
+        self._running_per_sandbox[sandbox_id] -= 1
+        if not self._running_per_sandbox[sandbox_id]:
+            del self._running_per_sandbox[sandbox_id]
+        self._run_next()
+
+    def _run_next(self):
+        while self._queue_order:
+            for sandbox_id in self._queue_order:
+                if self._has_room(sandbox_id):
+                    break
+            else:
+                return
+            # Move the sandbox to the back of the line before its work runs.
+            self._queue_order.remove(sandbox_id)
+            queue = self._queues[sandbox_id]
+            d, queued_at = queue.popleft()
+            if queue:
+                self._queue_order.append(sandbox_id)
+            else:
+                del self._queues[sandbox_id]
+            self.queued -= 1
+            self._start(sandbox_id)
+            d.callback(self.clock.seconds() - queued_at)
+
+
 class SandboxResources(object):
     """Class for holding resources common to a set of sandboxes."""
 
@@ -330,8 +701,14 @@ class RedisResource(SandboxResource):
     def check_keys(self, api, key):
         if (yield self.redis.exists(key)):
             returnValue(True)
+        returnValue((yield self._add_keys(api, 1)))
+
+    @inlineCallbacks
+    def _add_keys(self, api, new_keys):
+        if not new_keys:
+            returnValue(True)
         count_key = self._count_key(api.sandbox_id)
-        key_count = yield self.redis.incr(count_key, 1)
+        key_count = yield self.redis.incr(count_key, new_keys)
         if key_count > self.keys_per_user_soft:
             if key_count < self.keys_per_user_hard:
                 api.log('Redis soft limit of %s keys reached for sandbox %s. '
@@ -347,7 +724,7 @@ class RedisResource(SandboxResource):
                             self.keys_per_user_hard,
                             api.sandbox_id),
                         logging.ERROR)
-                yield self.redis.incr(count_key, -1)
+                yield self.redis.incr(count_key, -new_keys)
                 returnValue(False)
         returnValue(True)
 
@@ -500,6 +877,294 @@ class RedisResource(SandboxResource):
             returnValue(self.reply(command, success=False, reason=unicode(e)))
         returnValue(self.reply(command, value=int(value), success=True))
 
+    PIPELINE_COMMANDS = ('get', 'set', 'incr', 'delete')
+
+    def _parse_op(self, api, command):
+        """
+        Turn a ``get``, ``set``, ``incr`` or ``delete`` command into an
+        operation for :meth:`_run_ops`.
+
+        Raises :class:`ValueError` if the command isn't valid.
+        """
+        if not isinstance(command, dict):
+            raise ValueError("pipeline commands must be objects")
+        cmd = command.get('cmd')
+        if cmd not in self.PIPELINE_COMMANDS:
+            raise ValueError("unsupported pipeline command %r" % (cmd,))
+        key = command.get('key')
+        if not isinstance(key, basestring):
+            raise ValueError("key must be a string")
+        op = {'cmd': cmd, 'key': self._sandboxed_key(api.sandbox_id, key)}
+        if cmd == 'set':
+            seconds = command.get('seconds')
+            if not (seconds is None or isinstance(seconds, (int, long))):
+                raise ValueError("seconds must be a number or null")
+            op['value'] = json.dumps(command.get('value'))
+            op['seconds'] = seconds
+        elif cmd == 'incr':
+            op['amount'] = command.get('amount', 1)
+        return op
+
+    @inlineCallbacks
+    def _check_op_keys(self, api, ops):
+        """
+        Check the key limit for a list of operations that will be run in
+        order, counting each key they create once.
+        """
+        keys = list(set(
+            op['key'] for op in ops if op['cmd'] in ('set', 'incr')))
+        exists = yield gatherResults([self.redis.exists(key) for key in keys])
+        key_exists = dict(zip(keys, exists))
+        new_keys = 0
+        for op in ops:
+            if op['key'] not in key_exists or op['cmd'] == 'get':
+                continue
+            if op['cmd'] == 'delete':
+                key_exists[op['key']] = False
+            elif not key_exists[op['key']]:
+                key_exists[op['key']] = True
+                new_keys += 1
+        returnValue((yield self._add_keys(api, new_keys)))
+
+    @inlineCallbacks
+    def _run_ops(self, api, ops):
+        """
+        Run a list of operations unless they would take the sandbox over
+        its key limit.
+
+        All the Redis commands for each step are sent before we wait for
+        any of the replies, so they are pipelined and Redis processes them
+        in order. They aren't run as a transaction, though.
+
+        :returns:
+            A list of result dicts, one for each operation, or ``None`` if
+            the key limit would be exceeded.
+        """
+        if not (yield self._check_op_keys(api, ops)):
+            returnValue(None)
+        results = yield gatherResults([
+            getattr(self, '_run_%s' % (op['cmd'],))(api, op) for op in ops])
+        returnValue(results)
+
+    @inlineCallbacks
+    def _run_get(self, api, op):
+        raw_value = yield self.redis.get(op['key'])
+        value = json.loads(raw_value) if raw_value is not None else None
+        returnValue({'success': True, 'value': value})
+
+    @inlineCallbacks
+    def _run_set(self, api, op):
+        if op['seconds'] is None:
+            yield self.redis.set(op['key'], op['value'])
+        else:
+            yield self.redis.setex(op['key'], op['seconds'], op['value'])
+        returnValue({'success': True})
+
+    @inlineCallbacks
+    def _run_incr(self, api, op):
+        try:
+            value = yield self.redis.incr(op['key'], amount=op['amount'])
+        except Exception, e:
+            returnValue({'success': False, 'reason': unicode(e)})
+        returnValue({'success': True, 'value': int(value)})
+
+    @inlineCallbacks
+    def _run_delete(self, api, op):
+        existed = bool((yield self.redis.delete(op['key'])))
+        if existed:
+            yield self.redis.incr(self._count_key(api.sandbox_id), -1)
+        returnValue({'success': True, 'existed': existed})
+
+    @inlineCallbacks
+    def handle_mget(self, api, command):
+        """
+        Retrieve the values of several keys at once.
+
+        Command fields:
+            - ``keys``: A list of the keys whose values should be retrieved.
+
+        Reply fields:
+            - ``success``: ``true`` if the operation was successful, otherwise
+              ``false``.
+            - ``values``: A list of the values retrieved, in the same order
+              as ``keys``. Keys that don't exist have the value ``null``.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.mget',
+                {keys: ['foo', 'bar']},
+                function(reply) {
+                    api.log_info(
+                        'Values retrieved: ' +
+                        JSON.stringify(reply.values));
+                }
+            );
+        """
+        keys = command.get('keys')
+        if not isinstance(keys, list):
+            returnValue(self.reply_error(command, "keys must be a list"))
+        try:
+            ops = [self._parse_op(api, {'cmd': 'get', 'key': key})
+                   for key in keys]
+        except ValueError, e:
+            returnValue(self.reply_error(command, unicode(e)))
+        results = yield self._run_ops(api, ops)
+        returnValue(self.reply(
+            command, success=True,
+            values=[result['value'] for result in results]))
+
+    @inlineCallbacks
+    def handle_mset(self, api, command):
+        """
+        Set the values of several keys at once.
+
+        Either all of the keys are set or, if that would take the sandbox
+        over its key limit, none of them are.
+
+        Command fields:
+            - ``items``: An object mapping the keys to set to their values.
+              The values may be any JSON serializable objects.
+            - ``seconds``: Lifetime of the keys in seconds. The default
+              ``null`` indicates that the keys should not expire.
+
+        Reply fields:
+            - ``success``: ``true`` if the operation was successful, otherwise
+              ``false``.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.mset',
+                {items: {foo: 1, bar: {x: '42'}}},
+                function(reply) { api.log_info('Values stored: ' +
+                                               reply.success); });
+        """
+        items = command.get('items')
+        if not isinstance(items, dict):
+            returnValue(self.reply_error(command, "items must be an object"))
+        try:
+            ops = [self._parse_op(api, {
+                'cmd': 'set', 'key': key, 'value': value,
+                'seconds': command.get('seconds'),
+            }) for key, value in items.iteritems()]
+        except ValueError, e:
+            returnValue(self.reply_error(command, unicode(e)))
+        results = yield self._run_ops(api, ops)
+        if results is None:
+            returnValue(self._too_many_keys(command))
+        returnValue(self.reply(command, success=True))
+
+    @inlineCallbacks
+    def handle_mincr(self, api, command):
+        """
+        Increment the values of several integer keys at once.
+
+        Either all of the keys are incremented or, if that would take the
+        sandbox over its key limit, none of them are. Keys that do not
+        exist are set to zero before they are incremented.
+
+        Command fields:
+            - ``keys``: A list of the keys to increment.
+            - ``amount``: The integer amount to increment each key by.
+              Defaults to 1.
+
+        Reply fields:
+            - ``success``: ``true`` if all the keys were incremented,
+              otherwise ``false``.
+            - ``values``: A list of the new values of the keys, in the same
+              order as ``keys``. Keys that could not be incremented have the
+              value ``null``.
+            - ``reason``: Why a key could not be incremented, if one
+              couldn't.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.mincr',
+                {keys: ['foo', 'bar'],
+                 amount: 3},
+                function(reply) {
+                    api.log_info('New values: ' +
+                                 JSON.stringify(reply.values));
+                }
+            );
+        """
+        keys = command.get('keys')
+        if not isinstance(keys, list):
+            returnValue(self.reply_error(command, "keys must be a list"))
+        try:
+            ops = [self._parse_op(api, {
+                'cmd': 'incr', 'key': key, 'amount': command.get('amount', 1),
+            }) for key in keys]
+        except ValueError, e:
+            returnValue(self.reply_error(command, unicode(e)))
+        results = yield self._run_ops(api, ops)
+        if results is None:
+            returnValue(self._too_many_keys(command))
+        values = [result.get('value') for result in results]
+        failures = [result for result in results if not result['success']]
+        if failures:
+            returnValue(self.reply(
+                command, success=False, values=values,
+                reason=failures[0]['reason']))
+        returnValue(self.reply(command, success=True, values=values))
+
+    @inlineCallbacks
+    def handle_pipeline(self, api, command):
+        """
+        Run several ``get``, ``set``, ``incr`` and ``delete`` commands
+        together.
+
+        The commands are sent to Redis together and run in order, but
+        commands from other requests may run between them. Either all of
+        the commands are run or, if they would take the sandbox over its key
+        limit, none of them are.
+
+        Command fields:
+            - ``commands``: A list of commands. Each has a ``cmd`` field
+              (one of ``get``, ``set``, ``incr`` or ``delete``) and the
+              same fields as the equivalent single command.
+
+        Reply fields:
+            - ``success``: ``true`` if the commands were run, otherwise
+              ``false``.
+            - ``results``: A list of results, one for each command, with the
+              same fields as the reply to the equivalent single command.
+
+        Example:
+
+        .. code-block:: javascript
+
+            api.request(
+                'kv.pipeline',
+                {commands: [
+                    {cmd: 'incr', key: 'visits'},
+                    {cmd: 'get', key: 'greeting'}]},
+                function(reply) {
+                    api.log_info('Visits: ' + reply.results[0].value);
+                }
+            );
+        """
+        commands = command.get('commands')
+        if not isinstance(commands, list):
+            returnValue(self.reply_error(command, "commands must be a list"))
+        try:
+            ops = [self._parse_op(api, sub_command)
+                   for sub_command in commands]
+        except ValueError, e:
+            returnValue(self.reply_error(command, unicode(e)))
+        results = yield self._run_ops(api, ops)
+        if results is None:
+            returnValue(self._too_many_keys(command))
+        returnValue(self.reply(command, success=True, results=results))
+
 
 class OutboundResource(SandboxResource):
     """
@@ -797,10 +1462,129 @@ def make_context_factory(ssl_method=None, verify_options=None):
         return HttpClientPolicyForHTTPS(ssl_method=ssl_method)
 
 
+class HttpClientConnectionPool(HTTPConnectionPool):
+    """
+    An :class:`HTTPConnectionPool` that keeps count of how many connections
+    to each host were newly made and how many were reused.
+
+    Counts are only kept for the `max_counted_hosts` most recently used
+    hosts, since the hosts may be chosen by sandboxed code.
+
+    :param reactor:
+        The reactor to use.
+    :param bool persistent:
+        Whether to keep connections open between requests.
+    :param int max_persistent_per_host:
+        Maximum number of idle connections kept open to each host.
+    :param float idle_timeout:
+        Number of seconds an idle connection is kept open for.
+    :param connection_callback:
+        If given, called with ``(host, port, reused)`` each time a
+        connection is handed out.
+    :param int max_counted_hosts:
+        Maximum number of hosts to keep connection counts for.
+    """
+
+    def __init__(self, reactor, persistent=True, max_persistent_per_host=2,
+                 idle_timeout=60, connection_callback=None,
+                 max_counted_hosts=100):
+        HTTPConnectionPool.__init__(self, reactor, persistent=persistent)
+        self.maxPersistentPerHost = max_persistent_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        self.connection_callback = connection_callback
+        self.max_counted_hosts = max_counted_hosts
+        self.connection_counts = {}
+        # The counted hosts, least recently used first.
+        self._counted_hosts = deque()
+        self._connection_reused = False
+
+    def getConnection(self, key, endpoint):
+        self._connection_reused = True
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        # Connection keys end with the host and port, see
+        # :meth:`for_context`.
+        self._count_connection(key[-2], key[-1], self._connection_reused)
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self._connection_reused = False
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def _count_connection(self, host, port, reused):
+        counts = self.connection_counts.get((host, port))
+        if counts is None:
+            counts = {'new': 0, 'reused': 0}
+            if len(self.connection_counts) >= self.max_counted_hosts:
+                del self.connection_counts[self._counted_hosts.popleft()]
+            self.connection_counts[(host, port)] = counts
+        else:
+            self._counted_hosts.remove((host, port))
+        self._counted_hosts.append((host, port))
+        counts['reused' if reused else 'new'] += 1
+        if self.connection_callback is not None:
+            self.connection_callback(host, port, reused)
+
+    def for_context(self, context_key):
+        """
+        Return a view of this pool for an agent with its own TLS settings.
+
+        :class:`Agent` only keys connections on the scheme, host and port,
+        so agents with different TLS settings would otherwise be handed each
+        other's connections.
+        """
+        return _ContextConnectionPool(self, context_key)
+
+
+class _ContextConnectionPool(object):
+    """
+    Hands out connections from an :class:`HttpClientConnectionPool` that
+    are only shared with agents using the same `context_key`.
+    """
+
+    def __init__(self, pool, context_key):
+        self.pool = pool
+        self.context_key = context_key
+
+    def getConnection(self, key, endpoint):
+        return self.pool.getConnection((self.context_key,) + key, endpoint)
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+
 class HttpClientResource(SandboxResource):
     """
     Resource that allows making HTTP calls to outside services.
 
+    Configuration options:
+
+    :param int timeout:
+        Number of seconds to wait for a response (default: 30).
+    :param int data_limit:
+        Maximum response size in bytes (default: 128 KB).
+    :param bool persistent_connections:
+        Whether to keep connections open and reuse them for later requests
+        to the same host (default: ``true``). All the sandboxes using this
+        resource share one connection pool.
+    :param int max_persistent_per_host:
+        Maximum number of idle connections kept open to each host
+        (default: 2).
+    :param int connection_idle_timeout:
+        Number of seconds an idle connection is kept open for
+        (default: 60).
+    :param list connection_metrics_hosts:
+        Hosts to publish per-host connection metrics for (default: none).
+
+    If the sandbox worker has a ``metrics_prefix``, the number of new and
+    reused connections is published as
+    ``<resource name>.connections_new`` and
+    ``<resource name>.connections_reused``. For each host listed in
+    ``connection_metrics_hosts``, the connections to that host are also
+    published as ``<resource name>.<host>_<port>.connections_new`` and
+    ``<resource name>.<host>_<port>.connections_reused``. Sandboxed code
+    chooses which hosts to connect to, so per-host metrics aren't published
+    for other hosts.
+
     All command on this resource share a common set of command
     and response fields:
 
@@ -853,6 +1637,8 @@ class HttpClientResource(SandboxResource):
 
     DEFAULT_TIMEOUT = 30  # seconds
     DEFAULT_DATA_LIMIT = 128 * 1024  # 128 KB
+    DEFAULT_MAX_PERSISTENT_PER_HOST = 2
+    DEFAULT_CONNECTION_IDLE_TIMEOUT = 60  # seconds
     agent_class = Agent
     http_client_class = HTTPClient
 
@@ -860,6 +1646,66 @@ class HttpClientResource(SandboxResource):
         self.timeout = self.config.get('timeout', self.DEFAULT_TIMEOUT)
         self.data_limit = self.config.get('data_limit',
                                           self.DEFAULT_DATA_LIMIT)
+        self.pool = HttpClientConnectionPool(
+            reactor,
+            persistent=self.config.get('persistent_connections', True),
+            max_persistent_per_host=self.config.get(
+                'max_persistent_per_host',
+                self.DEFAULT_MAX_PERSISTENT_PER_HOST),
+            idle_timeout=self.config.get(
+                'connection_idle_timeout',
+                self.DEFAULT_CONNECTION_IDLE_TIMEOUT),
+            connection_callback=self._connection_metric)
+        self.connection_metrics_hosts = set(
+            self.config.get('connection_metrics_hosts', []))
+        self._default_context_factory = WebClientContextFactory()
+        self._context_factories = {}
+        self._agents = {}
+
+    def teardown(self):
+        return self.pool.closeCachedConnections()
+
+    def _connection_metric(self, host, port, reused):
+        metrics = self.app_worker.metrics
+        if metrics is None:
+            return
+        suffix = 'connections_%s' % ('reused' if reused else 'new',)
+        names = ['%s.%s' % (self.name, suffix)]
+        if host in self.connection_metrics_hosts:
+            names.append('%s.%s_%s.%s' % (
+                self.name, host.replace('.', '_'), port, suffix))
+        for name in names:
+            if name not in metrics:
+                metrics.register(Count(name))
+            metrics[name].inc()
+
+    def get_context_factory(self, verify_options=None, ssl_method=None):
+        """
+        Return the context factory for the given TLS settings.
+
+        Context factories are built once for each combination of settings
+        and reused for later requests.
+        """
+        key = (verify_options, ssl_method)
+        if key not in self._context_factories:
+            self._context_factories[key] = make_context_factory(
+                verify_options=verify_options, ssl_method=ssl_method)
+        return self._context_factories[key]
+
+    def get_agent(self, context_factory):
+        """
+        Return the agent for the given context factory.
+
+        Agents are cached for each context factory and all of them share
+        this resource's connection pool.
+        """
+        agent = self._agents.get(context_factory)
+        if agent is None:
+            agent = self.agent_class(
+                reactor, contextFactory=context_factory,
+                pool=self.pool.for_context(len(self._agents)))
+            self._agents[context_factory] = agent
+        return agent
 
     def _make_request_from_command(self, method, command):
         url = command.get('url', None)
@@ -892,7 +1738,7 @@ class HttpClientResource(SandboxResource):
         else:
             ssl_method = None
 
-        context_factory = make_context_factory(
+        context_factory = self.get_context_factory(
             verify_options=verify_options, ssl_method=ssl_method)
 
         headers = command.get('headers', None)
@@ -910,8 +1756,8 @@ class HttpClientResource(SandboxResource):
     def _make_request(self, method, url, headers=None, data=None, files=None,
                       timeout=None, context_factory=None,
                       data_limit=None):
-        context_factory = (context_factory if context_factory is not None
-                           else WebClientContextFactory())
+        if context_factory is None:
+            context_factory = self._default_context_factory
 
         if headers is not None:
             headers = dict((k.encode("utf-8"), [x.encode("utf-8") for x in v])
@@ -928,7 +1774,7 @@ class HttpClientResource(SandboxResource):
                      StringIO(base64.b64decode(value['data']))))
                 for key, value in files.iteritems()])
 
-        agent = self.agent_class(reactor, contextFactory=context_factory)
+        agent = self.get_agent(context_factory)
         http_client = self.http_client_class(agent)
 
         d = http_client.request(method, url, headers=headers, data=data,
@@ -1072,6 +1918,9 @@ class SandboxApi(object):
     def get_inbound_message(self, message_id):
         return self._inbound_messages.get(message_id)
 
+    def clear_inbound_messages(self):
+        self._inbound_messages.clear()
+
     def log(self, msg, level):
         if self.logging_resource is None:
             # fallback to vumi.log logging if we don't
@@ -1130,8 +1979,22 @@ class SandboxCommand(Message):
 
     @classmethod
     def from_json(cls, json_string):
-        # We override this to avoid the datetime conversions.
-        return cls(_process_fields=False, **to_kwargs(json.loads(json_string)))
+        # We override this to avoid the datetime conversions. Every line a
+        # sandbox writes is parsed here, so we build the command directly
+        # rather than going through the constructor and only check for the
+        # fields validate_fields() would.
+        payload = json.loads(json_string)
+        if not isinstance(payload, dict):
+            raise InvalidMessage(json_string)
+        for field in ('cmd', 'cmd_id', 'reply'):
+            if field not in payload:
+                raise MissingMessageField(field)
+        cmd = cls.__new__(cls)
+        cmd._payload = payload
+        cmd._shared_fields = None
+        # Nothing else has references to the values we've just decoded.
+        cmd._exposed_fields = None
+        return cmd
 
 
 class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
@@ -1171,6 +2034,37 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
         " these directly using Twisted logging instead.",
         default=None)
     sandbox_id = ConfigText("This is set based on individual messages.")
+    pooled = ConfigBool(
+        "Keep sandbox processes running between messages instead of"
+        " spawning a new process for every message and event. Processes"
+        " are kept separately for each sandbox id. Pooled processes are"
+        " sent a `pooled` command after they are initialized, and must"
+        " then send a `done` command when they have finished with each"
+        " message instead of exiting. The `timeout` and `recv_limit` apply"
+        " to each message.", default=False, static=True)
+    pool_max_processes = ConfigInt(
+        "Maximum number of pooled processes to run for each sandbox id.",
+        default=1, static=True)
+    pool_max_messages = ConfigInt(
+        "Number of messages a pooled process may process before it is"
+        " replaced.", default=100, static=True)
+    pool_idle_timeout = ConfigInt(
+        "Length of time a pooled process may sit idle before it is"
+        " stopped.", default=60, static=True)
+    max_running_sandboxes = ConfigInt(
+        "Maximum number of messages and events to process in sandboxes at"
+        " once. Any more wait in a queue that is shared fairly between"
+        " sandbox ids. Unlimited if not set.", default=None, static=True)
+    max_running_sandboxes_per_id = ConfigInt(
+        "Maximum number of messages and events to process at once for"
+        " each sandbox id. Unlimited if not set.", default=None, static=True)
+    max_queued_sandboxes = ConfigInt(
+        "Maximum number of messages and events that may wait for a"
+        " sandbox. Any that arrive while the queue is full are logged and"
+        " dropped. Unlimited if not set.", default=None, static=True)
+    metrics_prefix = ConfigText(
+        "If set, sandbox queue metrics are published with this prefix.",
+        default=None, static=True)
 
 
 class Sandbox(ApplicationWorker):
@@ -1178,6 +2072,9 @@ class Sandbox(ApplicationWorker):
 
     CONFIG_CLASS = SandboxConfig
 
+    sandbox_pool = None
+    metrics = None
+
     KB, MB = 1024, 1024 * 1024
     DEFAULT_RLIMITS = {
         resource.RLIMIT_CORE: (1 * MB, 1 * MB),
@@ -1209,11 +2106,27 @@ class Sandbox(ApplicationWorker):
                 raise ConfigError("Unknown resource limit key %r" % (key,))
         return rlimits
 
+    @inlineCallbacks
     def setup_application(self):
-        return self.resources.setup_resources()
+        config = self.get_static_config()
+        self.sandbox_scheduler = self.create_sandbox_scheduler(config)
+        if config.pooled:
+            self.sandbox_pool = self.create_sandbox_pool(config)
+        if config.metrics_prefix is not None:
+            self.metrics = yield self.start_publisher(
+                MetricManager, config.metrics_prefix)
+            self.metrics.register(Metric('sandbox_queue.depth'))
+            self.metrics.register(Metric('sandbox_queue.wait_time'))
+            self.metrics.register(Count('sandbox_queue.shed'))
+        yield self.resources.setup_resources()
 
+    @inlineCallbacks
     def teardown_application(self):
-        return self.resources.teardown_resources()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.sandbox_pool is not None:
+            yield self.sandbox_pool.stop()
+        yield self.resources.teardown_resources()
 
     def setup_connectors(self):
         # Set the default event handler so we can handle events from any
@@ -1229,6 +2142,17 @@ class Sandbox(ApplicationWorker):
     def create_sandbox_resources(self, config):
         return SandboxResources(self, config)
 
+    def create_sandbox_scheduler(self, config):
+        return SandboxScheduler(
+            config.max_running_sandboxes,
+            config.max_running_sandboxes_per_id,
+            config.max_queued_sandboxes)
+
+    def create_sandbox_pool(self, config):
+        return SandboxPool(
+            self, config.pool_max_processes, config.pool_max_messages,
+            config.pool_idle_timeout)
+
     def get_executable_and_args(self, config):
         return config.executable, [config.executable] + config.args
 
@@ -1242,7 +2166,11 @@ class Sandbox(ApplicationWorker):
         rlimits = self.get_rlimits(api.config)
         spawn_kwargs = dict(
             args=args, env=api.config.env, path=api.config.path)
-        return SandboxProtocol(
+        if self.sandbox_pool is not None:
+            protocol_class = PooledSandboxProtocol
+        else:
+            protocol_class = SandboxProtocol
+        return protocol_class(
             api.config.sandbox_id, api, executable, spawn_kwargs, rlimits,
             api.config.timeout, api.config.recv_limit)
 
@@ -1280,28 +2208,53 @@ class Sandbox(ApplicationWorker):
         return d
 
     @inlineCallbacks
-    def process_message_in_sandbox(self, msg):
-        config = yield self.get_config(msg)
-        sandbox_protocol = yield self.sandbox_protocol_for_message(msg, config)
-
-        def sandbox_init():
-            sandbox_protocol.api.sandbox_inbound_message(msg)
-
-        status = yield self._process_in_sandbox(sandbox_protocol, sandbox_init)
+    def _schedule_in_sandbox(self, msg_or_event, api_callback):
+        config = yield self.get_config(msg_or_event)
+        sandbox_id = config.sandbox_id
+        if self.metrics is not None:
+            self.metrics['sandbox_queue.depth'].set(
+                self.sandbox_scheduler.queued)
+        try:
+            wait = yield self.sandbox_scheduler.acquire(sandbox_id)
+        except SandboxQueueFull, e:
+            log.warning("Dropping %s %r for sandbox %r. %s" % (
+                msg_or_event['message_type'], msg_or_event['message_id'],
+                sandbox_id, e))
+            if self.metrics is not None:
+                self.metrics['sandbox_queue.shed'].inc()
+            returnValue(None)
+        if self.metrics is not None:
+            self.metrics['sandbox_queue.wait_time'].set(wait)
+        try:
+            status = yield self._run_in_sandbox(
+                msg_or_event, config, api_callback)
+        finally:
+            self.sandbox_scheduler.release(sandbox_id)
         returnValue(status)
 
     @inlineCallbacks
-    def process_event_in_sandbox(self, event):
-        config = yield self.get_config(event)
+    def _run_in_sandbox(self, msg_or_event, config, api_callback):
+        if self.sandbox_pool is not None:
+            status = yield self.sandbox_pool.process(
+                msg_or_event, config, api_callback)
+            returnValue(status)
         sandbox_protocol = yield self.sandbox_protocol_for_message(
-            event, config)
+            msg_or_event, config)
 
         def sandbox_init():
-            sandbox_protocol.api.sandbox_inbound_event(event)
+            api_callback(sandbox_protocol.api)
 
         status = yield self._process_in_sandbox(sandbox_protocol, sandbox_init)
         returnValue(status)
 
+    def process_message_in_sandbox(self, msg):
+        return self._schedule_in_sandbox(
+            msg, lambda api: api.sandbox_inbound_message(msg))
+
+    def process_event_in_sandbox(self, event):
+        return self._schedule_in_sandbox(
+            event, lambda api: api.sandbox_inbound_event(event))
+
     def consume_user_message(self, msg):
         return self.process_message_in_sandbox(msg)
 
@@ -1348,6 +2301,10 @@ class JsSandbox(Sandbox):
     * An extra 'javascript' parameter specifies the javascript to execute.
     * An extra optional 'app_context' parameter specifying a custom
       context for the 'javascript' application to execute with.
+    * If `pooled` is set, the 'javascript' is loaded once for each pooled
+      process and calling `this.done()` finishes the current message
+      without exiting, so any state the application keeps is shared by
+      the messages that process handles.
 
     Example 'javascript' that logs information via the sandbox API
     (provided as 'this' to 'on_inbound_message') and checks that logging
@@ -36,6 +36,28 @@ var SandboxApi = function () {
         self.request('log.info', {msg: msg}, callback);
     };
 
+    // helpers for the batched commands of the key-value store resource
+    // (see vumi.application.sandbox.RedisResource).
+    self.kv_resource = 'kv';
+
+    self.kv_mget = function (keys, callback) {
+        self.request(self.kv_resource + '.mget', {keys: keys}, callback);
+    };
+
+    self.kv_mset = function (items, callback) {
+        self.request(self.kv_resource + '.mset', {items: items}, callback);
+    };
+
+    self.kv_mincr = function (keys, amount, callback) {
+        self.request(self.kv_resource + '.mincr',
+                     {keys: keys, amount: amount}, callback);
+    };
+
+    self.kv_pipeline = function (commands, callback) {
+        self.request(self.kv_resource + '.pipeline',
+                     {commands: commands}, callback);
+    };
+
     self.done = function () {
         self.log_info('Done.', function() {
             self.emitter.emit('done');
@@ -57,6 +79,9 @@ var SandboxRunner = function (api) {
     self.chunk = "";
     self.pending_requests = {};
     self.loaded = false;
+    // pooled sandboxes are reused for several messages, so they signal
+    // when they're done with each one instead of exiting.
+    self.pooled = false;
 
     self.emitter.on('command', function (command) {
         var handler_name = "on_" + command.cmd.replace('.', '_').replace('-', '_');
@@ -89,7 +114,12 @@ var SandboxRunner = function (api) {
     });
 
     self.api.emitter.on('done', function() {
-        self.exit();
+        if (self.pooled) {
+            self.send_command(self.api.populate_command("done", {}));
+        }
+        else {
+            self.exit();
+        }
     });
 
     self.exit = function() {
@@ -134,6 +164,9 @@ var SandboxRunner = function (api) {
                     self.load_code(msg);
                 }
             }
+            else if (msg.cmd == 'pooled') {
+                self.pooled = true;
+            }
             else if (!msg.reply) {
                 self.emitter.emit('command', msg);
             }
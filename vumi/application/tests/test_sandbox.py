@@ -15,15 +15,21 @@ from OpenSSL.SSL import (
     SSLv3_METHOD, SSLv23_METHOD, TLSv1_METHOD)
 
 from twisted.internet.defer import (
-    inlineCallbacks, fail, succeed, DeferredQueue)
+    inlineCallbacks, fail, succeed, DeferredQueue, gatherResults)
 from twisted.internet.error import ProcessTerminated
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
 from twisted.web.http_headers import Headers
 
 from vumi.application.sandbox import (
-    Sandbox, SandboxApi, SandboxCommand, SandboxResources,
+    Sandbox, SandboxApi, SandboxCommand, SandboxResources, SandboxScheduler,
+    SandboxQueueFull, LineBuffer,
     SandboxResource, RedisResource, OutboundResource, JsSandboxResource,
-    LoggingResource, HttpClientResource, JsSandbox, JsFileSandbox,
-    HttpClientContextFactory, HttpClientPolicyForHTTPS, make_context_factory)
+    LoggingResource, HttpClientResource, HttpClientConnectionPool, JsSandbox,
+    JsFileSandbox, HttpClientContextFactory, HttpClientPolicyForHTTPS,
+    make_context_factory)
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.errors import InvalidMessage, MissingMessageField
 from vumi.application.tests.helpers import (
     ApplicationHelper, find_nodejs_or_skip_test)
 from vumi.tests.utils import LogCatcher
@@ -389,6 +395,243 @@ class TestSandbox(SandboxTestCaseBase):
         cmd = SandboxCommand.from_json(json_cmd)
         self.assertEqual(cmd['timestamp'], "2014-07-18 15:00:00.000000")
 
+    def test_sandbox_command_from_json(self):
+        cmd = SandboxCommand(cmd='foo', msg={'a': [1, 2]})
+        parsed = SandboxCommand.from_json(cmd.to_json())
+        self.assertTrue(isinstance(parsed, SandboxCommand))
+        self.assertEqual(parsed, cmd)
+        self.assertEqual(parsed['msg'], {'a': [1, 2]})
+        self.assertEqual(parsed.to_json(), cmd.to_json())
+
+    def test_sandbox_command_from_json_missing_fields(self):
+        self.assertRaises(
+            MissingMessageField, SandboxCommand.from_json,
+            json.dumps({'cmd': 'foo', 'reply': False}))
+        self.assertRaises(
+            InvalidMessage, SandboxCommand.from_json, json.dumps(['foo']))
+
+    def setup_pooled_app(self, python_code=None, **config):
+        if python_code is None:
+            # Log the name of each command we're given and tell the worker
+            # we're done with it.
+            python_code = (
+                "import sys, json\n"
+                "for line in iter(sys.stdin.readline, ''):\n"
+                "    cmd = json.loads(line)\n"
+                "    if cmd['cmd'] not in ('inbound-message',"
+                " 'inbound-event'):\n"
+                "        continue\n"
+                "    for out in [{'cmd': 'log.info', 'msg': cmd['cmd']},\n"
+                "                {'cmd': 'done'}]:\n"
+                "        out.update({'cmd_id': '1', 'reply': False})\n"
+                "        sys.stdout.write(json.dumps(out) + '\\n')\n"
+                "    sys.stdout.flush()\n")
+        config.update({
+            'pooled': True,
+            'sandbox': {
+                'log': {'cls': 'vumi.application.sandbox.LoggingResource'},
+            },
+        })
+        return self.setup_app(python_code, config)
+
+    @inlineCallbacks
+    def test_pooled_reuses_process(self):
+        app = yield self.setup_pooled_app()
+        with LogCatcher() as lc:
+            statuses = yield gatherResults([
+                app.process_message_in_sandbox(
+                    self.app_helper.make_inbound("foo", sandbox_id='sb1')),
+                app.process_event_in_sandbox(
+                    self.app_helper.make_ack(sandbox_id='sb1')),
+            ])
+            msgs = lc.messages()
+        self.assertEqual(statuses, [0, 0])
+        self.assertEqual(msgs, ['inbound-message', 'inbound-event'])
+        [sandbox] = app.sandbox_pool.processes('sb1')
+        self.assertEqual(sandbox.messages_processed, 2)
+        self.assertFalse(sandbox.ended)
+
+    @inlineCallbacks
+    def test_pooled_separate_sandbox_ids(self):
+        app = yield self.setup_pooled_app()
+        yield app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        yield app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb2'))
+        [sandbox1] = app.sandbox_pool.processes('sb1')
+        [sandbox2] = app.sandbox_pool.processes('sb2')
+        self.assertNotEqual(sandbox1.transport.pid, sandbox2.transport.pid)
+        self.assertNotEqual(sandbox1.api, sandbox2.api)
+
+    @inlineCallbacks
+    def test_pooled_max_processes(self):
+        app = yield self.setup_pooled_app(pool_max_processes=2)
+        statuses = yield gatherResults([
+            app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+            for _ in range(3)])
+        self.assertEqual(statuses, [0, 0, 0])
+        sandboxes = app.sandbox_pool.processes('sb1')
+        self.assertEqual(len(sandboxes), 2)
+        self.assertEqual(
+            sum(sandbox.messages_processed for sandbox in sandboxes), 3)
+
+    @inlineCallbacks
+    def test_pooled_max_messages(self):
+        app = yield self.setup_pooled_app(pool_max_messages=2)
+        for _ in range(2):
+            yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        self.assertEqual(app.sandbox_pool.processes('sb1'), [])
+
+        status = yield app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        self.assertEqual(status, 0)
+        [sandbox] = app.sandbox_pool.processes('sb1')
+        self.assertEqual(sandbox.messages_processed, 1)
+
+    @inlineCallbacks
+    def test_pooled_idle_timeout(self):
+        app = yield self.setup_pooled_app(pool_idle_timeout=30)
+        clock = app.sandbox_pool.clock = Clock()
+        yield app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        [sandbox] = app.sandbox_pool.processes('sb1')
+
+        clock.advance(29)
+        self.assertEqual(app.sandbox_pool.processes('sb1'), [sandbox])
+        clock.advance(1)
+        self.assertEqual(app.sandbox_pool.processes('sb1'), [])
+        yield sandbox.done().addErrback(lambda f: f.trap(ProcessTerminated))
+        self.assertTrue(sandbox.ended)
+
+    @inlineCallbacks
+    def test_pooled_process_replaced_after_config_change(self):
+        app = yield self.setup_pooled_app()
+        yield app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        [sandbox1] = app.sandbox_pool.processes('sb1')
+
+        app.config['env'] = {'CONFIG_VERSION': '2'}
+        status = yield app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        self.assertEqual(status, 0)
+        [sandbox2] = app.sandbox_pool.processes('sb1')
+        self.assertNotEqual(sandbox2, sandbox1)
+        self.assertEqual(sandbox2.api.config.env, {'CONFIG_VERSION': '2'})
+        self.assertEqual(sandbox2.messages_processed, 1)
+        yield sandbox1.done().addErrback(lambda f: f.trap(ProcessTerminated))
+        self.assertTrue(sandbox1.ended)
+
+        # Processes are reused again while the config stays the same.
+        yield app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        self.assertEqual(app.sandbox_pool.processes('sb1'), [sandbox2])
+        self.assertEqual(sandbox2.messages_processed, 2)
+
+    @inlineCallbacks
+    def test_pooled_process_replaced_after_recv_limit(self):
+        app = yield self.setup_pooled_app(
+            "import sys\n"
+            "for line in iter(sys.stdin.readline, ''):\n"
+            "    if 'inbound-message' in line:\n"
+            "        sys.stdout.write('a' * 1001)\n"
+            "        sys.stdout.flush()\n",
+            recv_limit=1000)
+        with LogCatcher(log_level=logging.ERROR) as lc:
+            status = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+            msgs = lc.messages()
+        self.assertEqual(status, None)
+        self.assertEqual(msgs[0],
+                         "Sandbox 'sb1' killed for producing too much"
+                         " data on stderr and stdout.")
+        [kill_err] = self.flushLoggedErrors(ProcessTerminated)
+        self.assertTrue('process ended by signal' in str(kill_err.value))
+        self.assertEqual(app.sandbox_pool.processes('sb1'), [])
+
+    @inlineCallbacks
+    def test_pooled_recv_limit_per_message(self):
+        app = yield self.setup_pooled_app(recv_limit=200)
+        for _ in range(5):
+            status = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+            self.assertEqual(status, 0)
+        [sandbox] = app.sandbox_pool.processes('sb1')
+        self.assertEqual(sandbox.messages_processed, 5)
+
+    @inlineCallbacks
+    def test_pooled_process_exits(self):
+        # Sandboxes that don't know about pooling just exit when they're
+        # done, and are replaced for the next message.
+        app = yield self.setup_pooled_app(
+            "import sys\n"
+            "sys.stdin.readline()\n")
+        status = yield app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        self.assertEqual(status, 0)
+        self.assertEqual(app.sandbox_pool.processes('sb1'), [])
+
+    @inlineCallbacks
+    def test_max_running_sandboxes(self):
+        app = yield self.setup_app(
+            "import sys\n"
+            "sys.stdin.readline()\n",
+            {'max_running_sandboxes': 1})
+        d1 = app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        d2 = app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb2'))
+        self.assertEqual(app.sandbox_scheduler.running, 1)
+        self.assertEqual(app.sandbox_scheduler.queued, 1)
+        statuses = yield gatherResults([d1, d2])
+        self.assertEqual(statuses, [0, 0])
+        self.assertEqual(app.sandbox_scheduler.running, 0)
+        self.assertEqual(app.sandbox_scheduler.queued, 0)
+
+    @inlineCallbacks
+    def test_max_queued_sandboxes(self):
+        app = yield self.setup_app(
+            "import sys\n"
+            "sys.stdin.readline()\n",
+            {'max_running_sandboxes': 1, 'max_queued_sandboxes': 0})
+        msg = self.app_helper.make_inbound("foo", sandbox_id='sb1')
+        d = app.process_message_in_sandbox(
+            self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+        with LogCatcher(log_level=logging.WARNING) as lc:
+            status = yield app.process_message_in_sandbox(msg)
+        self.assertEqual(status, None)
+        self.assertEqual(lc.messages(), [
+            "Dropping user_message %r for sandbox 'sb1'. 0 messages are"
+            " already waiting for a sandbox." % (msg['message_id'],)])
+        self.assertEqual((yield d), 0)
+
+    @inlineCallbacks
+    def test_sandbox_queue_metrics(self):
+        app = yield self.setup_app(
+            "import sys\n"
+            "sys.stdin.readline()\n",
+            {'max_running_sandboxes': 1, 'max_queued_sandboxes': 1,
+             'metrics_prefix': 'sandbox.'})
+        clock = app.sandbox_scheduler.clock = Clock()
+        ds = [
+            app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sb1'))
+            for _ in range(3)]
+        clock.advance(2)
+        statuses = yield gatherResults(ds)
+        self.assertEqual(statuses, [0, 0, None])
+
+        app.metrics.publish_metrics()
+        [datapoints] = self.app_helper.get_dispatched_metrics()
+        values = dict((name, [v for _, v in points])
+                      for name, _, points in datapoints)
+        self.assertEqual(values, {
+            'sandbox.sandbox_queue.depth': [0, 0, 1],
+            'sandbox.sandbox_queue.wait_time': [0, 2],
+            'sandbox.sandbox_queue.shed': [1],
+        })
+
 
 class JsSandboxTestMixin(object):
 
@@ -415,6 +658,37 @@ class JsSandboxTestMixin(object):
             'Done.',
         ])
 
+    @inlineCallbacks
+    def test_js_sandboxer_pooled(self):
+        app_js = pkg_resources.resource_filename('vumi.application.tests',
+                                                 'app.js')
+        javascript = file(app_js).read()
+        app = yield self.setup_app(javascript, extra_config={
+            "pooled": True,
+        })
+
+        with LogCatcher() as lc:
+            for _ in range(2):
+                status = yield app.process_message_in_sandbox(
+                    self.app_helper.make_inbound("foo", sandbox_id='sandbox1'))
+                self.assertEqual(status, 0)
+            failures = [log['failure'].value for log in lc.errors]
+            msgs = lc.messages()
+        self.assertEqual(failures, [])
+        self.assertEqual(msgs, [
+            'Starting sandbox ...',
+            'Loading sandboxed code ...',
+            'From init!',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+        ])
+        [sandbox] = app.sandbox_pool.processes('sandbox1')
+        self.assertEqual(sandbox.messages_processed, 2)
+
     @inlineCallbacks
     def test_js_sandboxer_with_app_context(self):
         app_js = pkg_resources.resource_filename('vumi.application.tests',
@@ -507,6 +781,73 @@ class TestJsFileSandbox(SandboxTestCaseBase, JsSandboxTestMixin):
             extra_config=extra_config)
 
 
+class TestSandboxScheduler(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_scheduler(self, **kw):
+        return SandboxScheduler(clock=self.clock, **kw)
+
+    def test_unlimited(self):
+        scheduler = self.mk_scheduler()
+        for _ in range(3):
+            self.assertEqual(
+                self.successResultOf(scheduler.acquire('sb1')), 0)
+        self.assertEqual(scheduler.running, 3)
+        scheduler.release('sb1')
+        self.assertEqual(scheduler.running, 2)
+
+    def test_max_running(self):
+        scheduler = self.mk_scheduler(max_running=1)
+        self.assertEqual(self.successResultOf(scheduler.acquire('sb1')), 0)
+        d = scheduler.acquire('sb2')
+        self.assertNoResult(d)
+        self.assertEqual(scheduler.queued, 1)
+        self.clock.advance(5)
+        scheduler.release('sb1')
+        self.assertEqual(self.successResultOf(d), 5)
+        self.assertEqual(scheduler.running, 1)
+        self.assertEqual(scheduler.queued, 0)
+
+    def test_max_running_per_sandbox(self):
+        scheduler = self.mk_scheduler(max_running=2, max_running_per_sandbox=1)
+        self.successResultOf(scheduler.acquire('sb1'))
+        d = scheduler.acquire('sb1')
+        self.assertNoResult(d)
+        # Other sandboxes don't have to wait behind sb1.
+        self.successResultOf(scheduler.acquire('sb2'))
+        self.assertNoResult(scheduler.acquire('sb3'))
+        scheduler.release('sb2')
+        self.assertNoResult(d)
+        scheduler.release('sb1')
+        self.successResultOf(d)
+
+    def test_round_robin(self):
+        scheduler = self.mk_scheduler(max_running=1)
+        self.successResultOf(scheduler.acquire('sb1'))
+        started = []
+        for sandbox_id in ['sb1', 'sb1', 'sb2']:
+            d = scheduler.acquire(sandbox_id)
+            d.addCallback(lambda _, s=sandbox_id: started.append(s))
+        # sb2 gets a turn before sb1 runs again.
+        scheduler.release('sb1')
+        scheduler.release(started[-1])
+        scheduler.release(started[-1])
+        self.assertEqual(started, ['sb1', 'sb2', 'sb1'])
+
+    def test_max_queued(self):
+        scheduler = self.mk_scheduler(max_running=1, max_queued=1)
+        self.successResultOf(scheduler.acquire('sb1'))
+        d = scheduler.acquire('sb1')
+        f = self.failureResultOf(scheduler.acquire('sb2'), SandboxQueueFull)
+        self.assertEqual(
+            str(f.value), "1 messages are already waiting for a sandbox.")
+        scheduler.release('sb1')
+        self.successResultOf(d)
+        self.assertEqual(scheduler.queued, 0)
+
+
 class DummyAppWorker(object):
 
     class DummyApi(object):
@@ -528,6 +869,7 @@ class DummyAppWorker(object):
 
     sandbox_api_cls = DummyApi
     sandbox_protocol_cls = DummyProtocol
+    metrics = None
 
     def __init__(self):
         self.mock_calls = defaultdict(list)
@@ -546,6 +888,37 @@ class DummyAppWorker(object):
         return mock_method
 
 
+class TestLineBuffer(VumiTestCase):
+
+    def test_feed(self):
+        line_buffer = LineBuffer()
+        self.assertEqual(line_buffer.feed("foo\nbar\n"), ["foo", "bar"])
+        self.assertEqual(line_buffer.feed("\n\nbaz"), ["", ""])
+        self.assertEqual(line_buffer.feed("\n"), ["baz"])
+        self.assertEqual(line_buffer.flush(), "")
+
+    def test_feed_partial_lines(self):
+        line_buffer = LineBuffer()
+        self.assertEqual(line_buffer.feed("f"), [])
+        self.assertEqual(line_buffer.feed("oo"), [])
+        self.assertEqual(line_buffer.feed("\nba"), ["foo"])
+        self.assertEqual(line_buffer.feed("r\nbaz\nqu"), ["bar", "baz"])
+        self.assertEqual(line_buffer.flush(), "qu")
+        self.assertEqual(line_buffer.flush(), "")
+
+    def test_lines_are_strings(self):
+        line_buffer = LineBuffer()
+        [line] = line_buffer.feed('{"cmd": "\xc3\xa9"}\n')
+        self.assertEqual(type(line), str)
+        self.assertEqual(json.loads(line), {"cmd": u"\xe9"})
+
+    def test_clear(self):
+        line_buffer = LineBuffer()
+        self.assertEqual(line_buffer.feed("foo"), [])
+        line_buffer.clear()
+        self.assertEqual(line_buffer.feed("bar\n"), ["bar"])
+
+
 class TestSandboxApi(VumiTestCase):
     def setUp(self):
         self.sent_messages = DeferredQueue()
@@ -816,6 +1189,149 @@ class TestRedisResource(ResourceTestCaseBase):
             'Redis hard limit of 100 keys reached for sandbox test_id. '
             'No more keys can be written.')
 
+    @inlineCallbacks
+    def test_handle_mget(self):
+        yield self.create_metric('foo', json.dumps('bar'))
+        yield self.create_metric('baz', json.dumps({'a': 1}))
+        reply = yield self.dispatch_command(
+            'mget', keys=['foo', 'unknown', 'baz'])
+        self.check_reply(reply, success=True, values=['bar', None, {'a': 1}])
+
+    @inlineCallbacks
+    def test_handle_mget_bad_keys(self):
+        reply = yield self.dispatch_command('mget', keys='foo')
+        self.check_reply(reply, success=False, reason="keys must be a list")
+        reply = yield self.dispatch_command('mget', keys=['foo', None])
+        self.check_reply(reply, success=False, reason="key must be a string")
+
+    @inlineCallbacks
+    def test_handle_mset(self):
+        yield self.create_metric('foo', json.dumps('old'))
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar', 'baz': {'a': 1}})
+        self.check_reply(reply, success=True)
+        yield self.check_metric('foo', json.dumps('bar'), 2)
+        yield self.check_metric('baz', json.dumps({'a': 1}), 2)
+
+    @inlineCallbacks
+    def test_handle_mset_with_expiry(self):
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar'}, seconds=5)
+        self.check_reply(reply, success=True)
+        yield self.check_metric('foo', json.dumps('bar'), 1, seconds=5)
+
+    @inlineCallbacks
+    def test_handle_mset_with_bad_seconds(self):
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'bar'}, seconds='foo')
+        self.check_reply(
+            reply, success=False,
+            reason="seconds must be a number or null")
+        yield self.check_metric('foo', None, None)
+
+    @inlineCallbacks
+    def test_handle_mset_hard_limit_reached(self):
+        yield self.create_metric('foo', 'a', total_count=99)
+        reply = yield self.dispatch_command(
+            'mset', items={'foo': 'b', 'bar': 'b', 'baz': 'b'})
+        self.check_reply(reply, success=False, reason='Too many keys')
+        yield self.check_metric('foo', 'a', 99)
+        yield self.check_metric('bar', None, 99)
+        self.assert_api_log(
+            logging.ERROR,
+            'Redis hard limit of 100 keys reached for sandbox test_id. '
+            'No more keys can be written.'
+        )
+
+    @inlineCallbacks
+    def test_handle_mincr(self):
+        yield self.create_metric('foo', '2')
+        reply = yield self.dispatch_command(
+            'mincr', keys=['foo', 'bar'], amount=3)
+        self.check_reply(reply, success=True, values=[5, 3])
+        yield self.check_metric('foo', '5', 2)
+        yield self.check_metric('bar', '3', 2)
+
+    @inlineCallbacks
+    def test_handle_mincr_default_amount(self):
+        reply = yield self.dispatch_command('mincr', keys=['foo', 'foo'])
+        self.check_reply(reply, success=True, values=[1, 2])
+        yield self.check_metric('foo', '2', 1)
+
+    @inlineCallbacks
+    def test_handle_mincr_existing_non_int(self):
+        yield self.create_metric('foo', 'a')
+        reply = yield self.dispatch_command('mincr', keys=['foo', 'bar'])
+        self.check_reply(reply, success=False, values=[None, 1])
+        self.assertTrue(reply['reason'])
+        yield self.check_metric('foo', 'a', 2)
+        yield self.check_metric('bar', '1', 2)
+
+    @inlineCallbacks
+    def test_handle_mincr_hard_limit_reached(self):
+        yield self.create_metric('foo', 'a', total_count=100)
+        reply = yield self.dispatch_command('mincr', keys=['bar'])
+        self.check_reply(reply, success=False, reason='Too many keys')
+        yield self.check_metric('bar', None, 100)
+
+    @inlineCallbacks
+    def test_handle_pipeline(self):
+        yield self.create_metric('foo', json.dumps('bar'))
+        reply = yield self.dispatch_command('pipeline', commands=[
+            {'cmd': 'get', 'key': 'foo'},
+            {'cmd': 'set', 'key': 'baz', 'value': [1, 2], 'seconds': 5},
+            {'cmd': 'incr', 'key': 'count', 'amount': 2},
+            {'cmd': 'delete', 'key': 'foo'},
+            {'cmd': 'get', 'key': 'foo'},
+        ])
+        self.check_reply(reply, success=True, results=[
+            {'success': True, 'value': 'bar'},
+            {'success': True},
+            {'success': True, 'value': 2},
+            {'success': True, 'existed': True},
+            {'success': True, 'value': None},
+        ])
+        yield self.check_metric('foo', None, 2)
+        yield self.check_metric('baz', json.dumps([1, 2]), 2, seconds=5)
+        yield self.check_metric('count', '2', 2)
+
+    @inlineCallbacks
+    def test_handle_pipeline_counts_keys_in_order(self):
+        yield self.create_metric('foo', json.dumps('bar'))
+        reply = yield self.dispatch_command('pipeline', commands=[
+            {'cmd': 'delete', 'key': 'foo'},
+            {'cmd': 'set', 'key': 'foo', 'value': 1},
+            {'cmd': 'set', 'key': 'new', 'value': 1},
+            {'cmd': 'delete', 'key': 'new'},
+            {'cmd': 'incr', 'key': 'new'},
+            {'cmd': 'incr', 'key': 'new'},
+        ])
+        self.check_reply(reply, success=True)
+        yield self.check_metric('foo', '1', 2)
+        yield self.check_metric('new', '2', 2)
+
+    @inlineCallbacks
+    def test_handle_pipeline_bad_command(self):
+        yield self.create_metric('foo', json.dumps('bar'))
+        reply = yield self.dispatch_command('pipeline', commands=[
+            {'cmd': 'delete', 'key': 'foo'},
+            {'cmd': 'flushall', 'key': 'foo'},
+        ])
+        self.check_reply(
+            reply, success=False,
+            reason="unsupported pipeline command u'flushall'")
+        yield self.check_metric('foo', json.dumps('bar'), 1)
+
+    @inlineCallbacks
+    def test_handle_pipeline_hard_limit_reached(self):
+        yield self.create_metric('foo', 'a', total_count=100)
+        reply = yield self.dispatch_command('pipeline', commands=[
+            {'cmd': 'delete', 'key': 'foo'},
+            {'cmd': 'set', 'key': 'bar', 'value': 1},
+        ])
+        self.check_reply(reply, success=False, reason='Too many keys')
+        yield self.check_metric('foo', 'a', 100)
+
 
 class TestOutboundResource(ResourceTestCaseBase):
 
@@ -1357,3 +1873,203 @@ class TestHttpClientResource(ResourceTestCaseBase):
 
         context_factory = self.get_context_factory()
         self.assertEqual(context_factory.ssl_method, TLSv1_METHOD)
+
+    def test_connection_pool_defaults(self):
+        pool = self.resource.pool
+        self.assertTrue(pool.persistent)
+        self.assertEqual(pool.maxPersistentPerHost, 2)
+        self.assertEqual(pool.cachedConnectionTimeout, 60)
+
+    @inlineCallbacks
+    def test_connection_pool_config(self):
+        yield self.create_resource({
+            'persistent_connections': False,
+            'max_persistent_per_host': 5,
+            'connection_idle_timeout': 10,
+        })
+        pool = self.resource.pool
+        self.assertFalse(pool.persistent)
+        self.assertEqual(pool.maxPersistentPerHost, 5)
+        self.assertEqual(pool.cachedConnectionTimeout, 10)
+
+    @inlineCallbacks
+    def test_agents_and_context_factories_reused(self):
+        self.http_request_succeed("foo")
+        yield self.dispatch_command('get', url='https://www.example.com')
+        agent = self.dummy_client.agent
+        context_factory = self.get_context_factory()
+        self.assertEqual(agent._pool.pool, self.resource.pool)
+
+        yield self.dispatch_command('get', url='https://www.example.com')
+        self.assertEqual(self.dummy_client.agent, agent)
+        self.assertEqual(self.get_context_factory(), context_factory)
+
+        yield self.dispatch_command(
+            'get', url='https://www.example.com',
+            verify_options=['VERIFY_NONE'])
+        self.assertNotEqual(self.dummy_client.agent, agent)
+        self.assertNotEqual(self.get_context_factory(), context_factory)
+        self.assertEqual(self.dummy_client.agent._pool.pool,
+                         self.resource.pool)
+        self.assertNotEqual(self.dummy_client.agent._pool.context_key,
+                            agent._pool.context_key)
+
+    def poll_metric(self, name):
+        return [v for _, v in self.app_worker.metrics[name].poll()]
+
+    def test_connection_metrics(self):
+        self.app_worker.metrics = MetricManager('prefix.')
+        self.resource.pool._count_connection('www.example.com', 443, False)
+        self.resource.pool._count_connection('www.example.com', 443, True)
+        self.resource.pool._count_connection('www.example.org', 443, True)
+        self.assertEqual(
+            self.poll_metric('test_resource.connections_new'), [1.0])
+        self.assertEqual(
+            self.poll_metric('test_resource.connections_reused'), [1.0, 1.0])
+        # We don't publish per-host metrics for hosts that aren't configured.
+        self.assertEqual(
+            sorted(self.app_worker.metrics._metrics_lookup.keys()), [
+                'test_resource.connections_new',
+                'test_resource.connections_reused',
+            ])
+
+    @inlineCallbacks
+    def test_connection_metrics_for_configured_hosts(self):
+        yield self.create_resource({
+            'connection_metrics_hosts': ['www.example.com'],
+        })
+        self.app_worker.metrics = MetricManager('prefix.')
+        self.resource.pool._count_connection('www.example.com', 443, False)
+        self.resource.pool._count_connection('www.example.com', 443, True)
+        self.resource.pool._count_connection('www.example.org', 443, True)
+        self.assertEqual(
+            self.poll_metric(
+                'test_resource.www_example_com_443.connections_new'),
+            [1.0])
+        self.assertEqual(
+            self.poll_metric(
+                'test_resource.www_example_com_443.connections_reused'),
+            [1.0])
+        self.assertEqual(
+            self.poll_metric('test_resource.connections_reused'), [1.0, 1.0])
+        self.assertFalse(
+            'test_resource.www_example_org_443.connections_reused'
+            in self.app_worker.metrics)
+
+    @inlineCallbacks
+    def test_teardown_closes_connections(self):
+        connection = DummyConnection()
+        self.resource.pool._putConnection(('https', 'a', 443), connection)
+        yield self.resource.teardown()
+        self.assertTrue(connection.aborted)
+
+
+class DummyConnection(object):
+
+    state = 'QUIESCENT'
+
+    def __init__(self):
+        self.transport = StringTransport()
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+        return succeed(None)
+
+
+class DummyEndpoint(object):
+
+    def __init__(self):
+        self.connections = []
+
+    def connect(self, factory):
+        connection = DummyConnection()
+        self.connections.append(connection)
+        return succeed(connection)
+
+
+class TestHttpClientConnectionPool(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.endpoint = DummyEndpoint()
+        self.reported = []
+        self.pool = HttpClientConnectionPool(
+            self.clock, idle_timeout=10,
+            connection_callback=lambda *args: self.reported.append(args))
+        # Hand out the pooled connections themselves rather than wrappers
+        # that retry failed requests.
+        self.pool.retryAutomatically = False
+
+    def get_connection(self, pool, key):
+        connection = self.successResultOf(
+            pool.getConnection(key, self.endpoint))
+        # Pretend the request has finished and the connection is idle.
+        pool._putConnection(key, connection)
+
+    def test_defaults(self):
+        pool = HttpClientConnectionPool(self.clock)
+        self.assertTrue(pool.persistent)
+        self.assertEqual(pool.maxPersistentPerHost, 2)
+        self.assertEqual(pool.cachedConnectionTimeout, 60)
+        self.assertEqual(pool.max_counted_hosts, 100)
+
+    def test_counts_new_and_reused_connections(self):
+        key = ('https', 'example.com', 443)
+        self.get_connection(self.pool, key)
+        self.get_connection(self.pool, key)
+        self.get_connection(self.pool, ('http', 'example.org', 80))
+        self.assertEqual(len(self.endpoint.connections), 2)
+        self.assertEqual(self.pool.connection_counts, {
+            ('example.com', 443): {'new': 1, 'reused': 1},
+            ('example.org', 80): {'new': 1, 'reused': 0},
+        })
+        self.assertEqual(self.reported, [
+            ('example.com', 443, False),
+            ('example.com', 443, True),
+            ('example.org', 80, False),
+        ])
+
+    def test_idle_timeout(self):
+        key = ('https', 'example.com', 443)
+        self.get_connection(self.pool, key)
+        self.clock.advance(10)
+        self.get_connection(self.pool, key)
+        self.assertEqual(len(self.endpoint.connections), 2)
+        self.assertEqual(self.pool.connection_counts, {
+            ('example.com', 443): {'new': 2, 'reused': 0},
+        })
+
+    def test_not_persistent(self):
+        pool = HttpClientConnectionPool(self.clock, persistent=False)
+        key = ('https', 'example.com', 443)
+        self.successResultOf(pool.getConnection(key, self.endpoint))
+        self.successResultOf(pool.getConnection(key, self.endpoint))
+        self.assertEqual(pool.connection_counts, {
+            ('example.com', 443): {'new': 2, 'reused': 0},
+        })
+
+    def test_max_counted_hosts(self):
+        pool = HttpClientConnectionPool(self.clock, max_counted_hosts=2)
+        pool.retryAutomatically = False
+        self.get_connection(pool, ('https', 'a.example.com', 443))
+        self.get_connection(pool, ('https', 'b.example.com', 443))
+        self.get_connection(pool, ('https', 'a.example.com', 443))
+        self.get_connection(pool, ('https', 'c.example.com', 443))
+        # The least recently used host is dropped to make room.
+        self.assertEqual(pool.connection_counts, {
+            ('a.example.com', 443): {'new': 1, 'reused': 1},
+            ('c.example.com', 443): {'new': 1, 'reused': 0},
+        })
+
+    def test_for_context(self):
+        key = ('https', 'example.com', 443)
+        self.get_connection(self.pool, (0,) + key)
+        view_0 = self.pool.for_context(0)
+        view_1 = self.pool.for_context(1)
+        self.successResultOf(view_1.getConnection(key, self.endpoint))
+        self.successResultOf(view_0.getConnection(key, self.endpoint))
+        self.assertEqual(len(self.endpoint.connections), 2)
+        self.assertEqual(self.pool.connection_counts, {
+            ('example.com', 443): {'new': 2, 'reused': 1},
+        })
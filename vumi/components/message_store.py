@@ -4,7 +4,6 @@
 """Message store."""
 
 from collections import defaultdict
-from datetime import datetime
 from uuid import uuid4
 import itertools
 import warnings
@@ -13,10 +12,11 @@ from twisted.internet.defer import returnValue
 
 from vumi.message import (
     TransportEvent, TransportUserMessage, parse_vumi_date, format_vumi_date)
-from vumi.persist.model import Model, Manager
+from vumi.persist.model import Model, Manager, IndexPager
 from vumi.persist.fields import (
     VumiMessage, ForeignKey, ManyToMany, ListOf, Tag, Dynamic, Unicode)
 from vumi.persist.txriak_manager import TxRiakManager
+from vumi.utils import gather_results
 from vumi import log
 from vumi.components.message_store_cache import MessageStoreCache
 from vumi.components.message_store_migrators import (
@@ -25,12 +25,18 @@ from vumi.components.message_store_migrators import (
 
 class Batch(Model):
     # key is batch_id
+    # Batches rarely change once they've been created, so we cache them. See
+    # :class:`vumi.persist.model.LoadCache`.
+    CACHE_LOADS = True
     tags = ListOf(Tag())
     metadata = Dynamic(Unicode())
 
 
 class CurrentTag(Model):
     # key is flattened tag
+    # Not cached, since batch_start() and batch_done() in any worker move a
+    # tag to a new batch and a stale copy would file messages against the
+    # old one.
     current_batch = ForeignKey(Batch, null=True)
     tag = Tag()
     metadata = Dynamic(Unicode())
@@ -177,6 +183,139 @@ class ReconKeyManager(object):
         return itertools.chain(self.cache_keys, self.new_keys)
 
 
+class CacheReconciler(object):
+    """
+    Rebuild the cache for a batch from the message store indexes.
+
+    Keys are read from the ``batches_with_timestamps`` indexes a page at a
+    time, with the next page being fetched while the current one is
+    processed, and are added to the cache in bulk. Event counts come from
+    the ``message_with_status`` index terms, so event bodies are never
+    loaded. Up to ``concurrency`` event index queries are run at once.
+
+    Progress is checkpointed in the cache after each page, so a recon that
+    is interrupted can be resumed. A page that was interrupted part of the
+    way through is processed again when resuming. The message and event
+    counters only count keys that weren't already in the cache, so this
+    doesn't count anything twice.
+
+    The time series are rebuilt from the message and event timestamps, for
+    the last :attr:`MessageStoreCache.SERIES_TTL` seconds only. Messages
+    are counted in them whether or not they were already in the cache, so
+    messages added while a recon is running (or pages processed again when
+    resuming) may be counted twice in the time series.
+
+    :param message_store:
+        The :class:`MessageStore` to reconcile.
+    :param str batch_id:
+        The batch to reconcile.
+    :param int concurrency:
+        The maximum number of event index queries to run at once.
+    :param int page_size:
+        The number of message keys per index page. Defaults to
+        :attr:`MessageStore.DEFAULT_MAX_RESULTS`.
+    :param progress_callback:
+        An optional callable that is called with the checkpoint dictionary
+        (see :meth:`MessageStoreCache.get_recon_checkpoint`) after each page.
+    """
+
+    DEFAULT_CONCURRENCY = 10
+
+    def __init__(self, message_store, batch_id, concurrency=None,
+                 page_size=None, progress_callback=None):
+        self.message_store = message_store
+        self.manager = message_store.manager
+        self.cache = message_store.cache
+        self.batch_id = batch_id
+        self.concurrency = concurrency or self.DEFAULT_CONCURRENCY
+        self.page_size = page_size
+        self.progress_callback = progress_callback
+
+    @Manager.calls_manager
+    def reconcile(self, resume=False):
+        """
+        Rebuild the cache.
+
+        If ``resume`` is ``True`` and an earlier recon of this batch was
+        interrupted, it is continued instead of starting from scratch.
+
+        Returns the final checkpoint dictionary.
+        """
+        checkpoint = None
+        if resume:
+            checkpoint = yield self.cache.get_recon_checkpoint(self.batch_id)
+        if checkpoint is None:
+            yield self.cache.clear_batch(self.batch_id)
+            yield self.cache.batch_start(self.batch_id)
+            checkpoint = {
+                'direction': 'outbound',
+                'continuation': None,
+                'outbound': 0,
+                'inbound': 0,
+                'event': 0,
+            }
+            yield self.cache.set_recon_checkpoint(self.batch_id, checkpoint)
+
+        if checkpoint['direction'] == 'outbound':
+            yield self._reconcile_pages(
+                self.message_store.batch_outbound_keys_with_timestamps,
+                self._reconcile_outbound_page, checkpoint)
+            checkpoint.update(direction='inbound', continuation=None)
+            yield self.cache.set_recon_checkpoint(self.batch_id, checkpoint)
+
+        yield self._reconcile_pages(
+            self.message_store.batch_inbound_keys_with_timestamps,
+            self._reconcile_inbound_page, checkpoint)
+        yield self.cache.clear_recon_checkpoint(self.batch_id)
+        returnValue(checkpoint)
+
+    @Manager.calls_manager
+    def _reconcile_pages(self, get_first_page, reconcile_page, checkpoint):
+        pager = IndexPager(get_first_page(
+            self.batch_id, max_results=self.page_size,
+            continuation=checkpoint['continuation']))
+        while True:
+            index_page = yield pager.next_page()
+            if index_page is None:
+                break
+            yield reconcile_page(list(index_page), checkpoint)
+            checkpoint['continuation'] = index_page.continuation
+            yield self.cache.set_recon_checkpoint(self.batch_id, checkpoint)
+            if self.progress_callback is not None:
+                self.progress_callback(dict(checkpoint))
+
+    def _keys_with_timestamps(self, results):
+        return [(key, self.cache.get_timestamp(timestamp))
+                for key, timestamp in results]
+
+    @Manager.calls_manager
+    def _reconcile_inbound_page(self, results, checkpoint):
+        yield self.cache.add_inbound_message_keys(
+            self.batch_id, self._keys_with_timestamps(results))
+        checkpoint['inbound'] += len(results)
+
+    @Manager.calls_manager
+    def _reconcile_outbound_page(self, results, checkpoint):
+        yield self.cache.add_outbound_message_keys(
+            self.batch_id, self._keys_with_timestamps(results))
+        checkpoint['outbound'] += len(results)
+
+        events = []
+        message_keys = [key for key, _timestamp in results]
+        while message_keys:
+            chunk = message_keys[:self.concurrency]
+            message_keys = message_keys[self.concurrency:]
+            chunk_events = yield gather_results(
+                self.message_store.get_event_keys_with_statuses(key)
+                for key in chunk)
+            for message_events in chunk_events:
+                events.extend(
+                    (key, self.cache.get_timestamp(timestamp), status)
+                    for key, timestamp, status in message_events)
+        yield self.cache.add_event_keys_with_statuses(self.batch_id, events)
+        checkpoint['event'] += len(events)
+
+
 class MessageStore(object):
     """Vumi message store.
 
@@ -227,19 +366,34 @@ class MessageStore(object):
 
         returnValue(False)
 
-    @Manager.calls_manager
-    def reconcile_cache(self, batch_id, start_timestamp=None):
+    def reconcile_cache(self, batch_id, start_timestamp=None, resume=False,
+                        concurrency=None, progress_callback=None):
         """
         Rebuild the cache for the given batch.
 
-        The ``start_timestamp`` parameter is used for testing only.
+        This is done by a :class:`CacheReconciler`. If ``resume`` is
+        ``True`` and an earlier recon of this batch was interrupted, it is
+        continued from the last checkpoint instead of starting from scratch.
+
+        The ``start_timestamp`` parameter is deprecated and ignored. Keys
+        added to the cache while the recon is running are never counted
+        twice, so there is no need to know when the recon started.
         """
-        if start_timestamp is None:
-            start_timestamp = format_vumi_date(datetime.utcnow())
-        yield self.cache.clear_batch(batch_id)
-        yield self.cache.batch_start(batch_id)
-        yield self.reconcile_outbound_cache(batch_id, start_timestamp)
-        yield self.reconcile_inbound_cache(batch_id, start_timestamp)
+        if start_timestamp is not None:
+            warnings.warn("reconcile_cache()'s start_timestamp parameter is "
+                          "deprecated and ignored.",
+                          category=DeprecationWarning)
+        reconciler = CacheReconciler(
+            self, batch_id, concurrency=concurrency,
+            progress_callback=progress_callback)
+        return reconciler.reconcile(resume=resume)
+
+    def reconcile_progress(self, batch_id):
+        """
+        Return the progress of an unfinished cache recon for the given batch,
+        or ``None`` if there isn't one.
+        """
+        return self.cache.get_recon_checkpoint(batch_id)
 
     @Manager.calls_manager
     def reconcile_inbound_cache(self, batch_id, start_timestamp):
@@ -250,13 +404,15 @@ class MessageStore(object):
             start_timestamp, self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
         key_count = 0
 
-        index_page = yield self.batch_inbound_keys_with_timestamps(batch_id)
-        while index_page is not None:
-            for key, timestamp in index_page:
+        pager = IndexPager(self.batch_inbound_keys_with_timestamps(batch_id))
+        while True:
+            results = yield pager.next_results()
+            if results is None:
+                break
+            for key, timestamp in results:
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
                     key_count += 1
-            index_page = yield index_page.next_page()
 
         yield self.cache.add_inbound_message_count(batch_id, key_count)
         for key, timestamp in key_manager:
@@ -276,16 +432,18 @@ class MessageStore(object):
         key_count = 0
         status_counts = defaultdict(int)
 
-        index_page = yield self.batch_outbound_keys_with_timestamps(batch_id)
-        while index_page is not None:
-            for key, timestamp in index_page:
+        pager = IndexPager(self.batch_outbound_keys_with_timestamps(batch_id))
+        while True:
+            results = yield pager.next_results()
+            if results is None:
+                break
+            for key, timestamp in results:
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
                     key_count += 1
                     sc = yield self.get_event_counts(old_key[0])
                     for status, count in sc.iteritems():
                         status_counts[status] += count
-            index_page = yield index_page.next_page()
 
         yield self.cache.add_outbound_message_count(batch_id, key_count)
         for status, count in status_counts.iteritems():
@@ -307,16 +465,35 @@ class MessageStore(object):
         """
         status_counts = defaultdict(int)
 
-        index_page = yield self.message_event_keys_with_statuses(message_id)
-        while index_page is not None:
-            for key, _timestamp, status in index_page:
+        pager = IndexPager(self.message_event_keys_with_statuses(message_id))
+        while True:
+            results = yield pager.next_results()
+            if results is None:
+                break
+            for key, _timestamp, status in results:
                 status_counts[status] += 1
                 if status.startswith("delivery_report."):
                     status_counts["delivery_report"] += 1
-            index_page = yield index_page.next_page()
 
         returnValue(status_counts)
 
+    @Manager.calls_manager
+    def get_event_keys_with_statuses(self, message_id):
+        """
+        Get ``(event_key, timestamp, status)`` tuples for all events for a
+        particular message.
+
+        These come from index terms, so the events aren't loaded.
+        """
+        events = []
+        pager = IndexPager(self.message_event_keys_with_statuses(message_id))
+        while True:
+            results = yield pager.next_results()
+            if results is None:
+                break
+            events.extend(results)
+        returnValue(events)
+
     @Manager.calls_manager
     def reconcile_event_cache(self, batch_id, message_id):
         """
@@ -384,6 +561,20 @@ class MessageStore(object):
         msg = yield self.outbound_messages.load(msg_id)
         returnValue(msg.msg if msg is not None else None)
 
+    @Manager.calls_manager
+    def get_outbound_messages(self, msg_ids):
+        """
+        Return the outbound messages for a list of message ids, loaded in
+        bunches.
+
+        Messages that don't exist are left out, and the results may not be
+        in the same order as ``msg_ids``.
+        """
+        msgs = []
+        for bunch in self.outbound_messages.load_all_bunches(list(msg_ids)):
+            msgs.extend(msg.msg for msg in (yield bunch))
+        returnValue(msgs)
+
     @Manager.calls_manager
     def add_event(self, event):
         event_id = event['event_id']
@@ -443,6 +634,20 @@ class MessageStore(object):
         msg = yield self.inbound_messages.load(msg_id)
         returnValue(msg.msg if msg is not None else None)
 
+    @Manager.calls_manager
+    def get_inbound_messages(self, msg_ids):
+        """
+        Return the inbound messages for a list of message ids, loaded in
+        bunches.
+
+        Messages that don't exist are left out, and the results may not be
+        in the same order as ``msg_ids``.
+        """
+        msgs = []
+        for bunch in self.inbound_messages.load_all_bunches(list(msg_ids)):
+            msgs.extend(msg.msg for msg in (yield bunch))
+        returnValue(msgs)
+
     def get_batch(self, batch_id):
         return self.batches.load(batch_id)
 
@@ -589,6 +794,14 @@ class MessageStore(object):
         """
         return self.cache.is_query_in_progress(batch_id, token)
 
+    def get_query_progress(self, batch_id, token):
+        """
+        Return a dictionary containing the ``total`` number of keys found by
+        a search and the number of them that have been ``stored`` so far, or
+        ``None`` if the keys aren't being stored.
+        """
+        return self.cache.get_query_progress(batch_id, token)
+
     def get_inbound_message_keys(self, batch_id, start=0, stop=-1,
                                  with_timestamp=False):
         warnings.warn("get_inbound_message_keys() is deprecated. Use "
@@ -657,7 +870,8 @@ class MessageStore(object):
     @Manager.calls_manager
     def batch_inbound_keys_with_timestamps(self, batch_id, max_results=None,
                                            start=None, end=None,
-                                           with_timestamps=True):
+                                           with_timestamps=True,
+                                           continuation=None):
         """
         Return all inbound message keys with (and ordered by) timestamps.
 
@@ -677,6 +891,10 @@ class MessageStore(object):
             If set to ``False``, only the keys will be returned. The results
             will still be ordered by timestamp, however.
 
+        :param str continuation:
+            Optional continuation token from an earlier page of results, to
+            fetch the page after it.
+
         This method performs a Riak index query.
         """
         if max_results is None:
@@ -684,7 +902,8 @@ class MessageStore(object):
         start_value, end_value = self._start_end_values(batch_id, start, end)
         results = yield self.inbound_messages.index_keys_page(
             'batches_with_timestamps', start_value, end_value,
-            return_terms=with_timestamps, max_results=max_results)
+            return_terms=with_timestamps, max_results=max_results,
+            continuation=continuation)
         if with_timestamps:
             results = KeysWithTimestamps(self, batch_id, results)
         returnValue(results)
@@ -692,7 +911,8 @@ class MessageStore(object):
     @Manager.calls_manager
     def batch_outbound_keys_with_timestamps(self, batch_id, max_results=None,
                                             start=None, end=None,
-                                            with_timestamps=True):
+                                            with_timestamps=True,
+                                            continuation=None):
         """
         Return all outbound message keys with (and ordered by) timestamps.
 
@@ -712,6 +932,10 @@ class MessageStore(object):
             If set to ``False``, only the keys will be returned. The results
             will still be ordered by timestamp, however.
 
+        :param str continuation:
+            Optional continuation token from an earlier page of results, to
+            fetch the page after it.
+
         This method performs a Riak index query.
         """
         if max_results is None:
@@ -719,7 +943,8 @@ class MessageStore(object):
         start_value, end_value = self._start_end_values(batch_id, start, end)
         results = yield self.outbound_messages.index_keys_page(
             'batches_with_timestamps', start_value, end_value,
-            return_terms=with_timestamps, max_results=max_results)
+            return_terms=with_timestamps, max_results=max_results,
+            continuation=continuation)
         if with_timestamps:
             results = KeysWithTimestamps(self, batch_id, results)
         returnValue(results)
@@ -805,9 +1030,17 @@ class MessageStore(object):
             return_terms=True, max_results=max_results)
         returnValue(KeysWithAddresses(self, msg_id, results))
 
+    def _approximate_stats(self, batch_id, direction, start, end):
+        if start is not None:
+            start = self.cache.get_timestamp(start)
+        if end is not None:
+            end = self.cache.get_timestamp(end)
+        return self.cache.get_approximate_stats(
+            batch_id, direction, start, end)
+
     @Manager.calls_manager
     def batch_inbound_stats(self, batch_id, max_results=None,
-                            start=None, end=None):
+                            start=None, end=None, approximate=False):
         """
         Return inbound message stats for the specified time range.
 
@@ -826,27 +1059,35 @@ class MessageStore(object):
         :param str end:
             Optional end timestamp string matching VUMI_DATE_FORMAT.
 
+        :param bool approximate:
+            If ``True`` and the batch uses unique address counters, the
+            stats are served from the cache in constant time and memory,
+            with an approximate unique address count. See
+            :meth:`MessageStoreCache.get_approximate_stats`.
+
         :returns:
             ``dict`` containing 'total' and 'unique_addresses' entries.
 
-        This method performs multiple Riak index queries.
+        Unless approximate stats are available, this method performs
+        multiple Riak index queries.
         """
+        if approximate:
+            stats = yield self._approximate_stats(
+                batch_id, 'inbound', start, end)
+            if stats is not None:
+                returnValue(stats)
+
         total = 0
         unique_addresses = set()
 
-        start_value, end_value = self._start_end_values(batch_id, start, end)
-        if max_results is None:
-            max_results = self.DEFAULT_MAX_RESULTS
-        raw_page = yield self.inbound_messages.index_keys_page(
-            'batches_with_addresses', start_value, end_value,
-            return_terms=True, max_results=max_results)
-        page = KeysWithAddresses(self, batch_id, raw_page)
-
-        while page is not None:
-            results = list(page)
+        pager = IndexPager(self.batch_inbound_keys_with_addresses(
+            batch_id, max_results=max_results, start=start, end=end))
+        while True:
+            results = yield pager.next_results()
+            if results is None:
+                break
             total += len(results)
             unique_addresses.update(addr for key, timestamp, addr in results)
-            page = yield page.next_page()
 
         returnValue({
             "total": total,
@@ -855,7 +1096,7 @@ class MessageStore(object):
 
     @Manager.calls_manager
     def batch_outbound_stats(self, batch_id, max_results=None,
-                             start=None, end=None):
+                             start=None, end=None, approximate=False):
         """
         Return outbound message stats for the specified time range.
 
@@ -874,27 +1115,35 @@ class MessageStore(object):
         :param str end:
             Optional end timestamp string matching VUMI_DATE_FORMAT.
 
+        :param bool approximate:
+            If ``True`` and the batch uses unique address counters, the
+            stats are served from the cache in constant time and memory,
+            with an approximate unique address count. See
+            :meth:`MessageStoreCache.get_approximate_stats`.
+
         :returns:
             ``dict`` containing 'total' and 'unique_addresses' entries.
 
-        This method performs multiple Riak index queries.
+        Unless approximate stats are available, this method performs
+        multiple Riak index queries.
         """
+        if approximate:
+            stats = yield self._approximate_stats(
+                batch_id, 'outbound', start, end)
+            if stats is not None:
+                returnValue(stats)
+
         total = 0
         unique_addresses = set()
 
-        start_value, end_value = self._start_end_values(batch_id, start, end)
-        if max_results is None:
-            max_results = self.DEFAULT_MAX_RESULTS
-        raw_page = yield self.outbound_messages.index_keys_page(
-            'batches_with_addresses', start_value, end_value,
-            return_terms=True, max_results=max_results)
-        page = KeysWithAddresses(self, batch_id, raw_page)
-
-        while page is not None:
-            results = list(page)
+        pager = IndexPager(self.batch_outbound_keys_with_addresses(
+            batch_id, max_results=max_results, start=start, end=end))
+        while True:
+            results = yield pager.next_results()
+            if results is None:
+                break
             total += len(results)
             unique_addresses.update(addr for key, timestamp, addr in results)
-            page = yield page.next_page()
 
         returnValue({
             "total": total,
@@ -943,6 +1192,14 @@ class KeysWithTimestamps(object):
         """
         return self._index_page.has_next_page()
 
+    @property
+    def continuation(self):
+        """
+        The continuation token for the next page of results, or ``None`` if
+        this is the last page.
+        """
+        return self._index_page.continuation
+
     def __iter__(self):
         return (self._format_result(r) for r in self._index_page)
 
@@ -997,6 +1254,14 @@ class KeysWithAddresses(object):
         """
         return self._index_page.has_next_page()
 
+    @property
+    def continuation(self):
+        """
+        The continuation token for the next page of results, or ``None`` if
+        this is the last page.
+        """
+        return self._index_page.continuation
+
     def __iter__(self):
         return (self._format_result(r) for r in self._index_page)
 
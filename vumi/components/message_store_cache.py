@@ -11,6 +11,7 @@ from twisted.internet.defer import returnValue
 from vumi.persist.redis_base import Manager
 from vumi.message import TransportEvent, parse_vumi_date
 from vumi.errors import VumiError
+from vumi.utils import gather_results
 
 
 class MessageStoreCacheException(VumiError):
@@ -34,7 +35,31 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    SEARCH_PROGRESS_KEY = 'search_progress'
+    RECON_KEY = 'recon'
+    SERIES_KEY = 'series'
+    UNIQUE_ADDR_KEY = 'unique_addr'
     TRUNCATE_MESSAGE_KEY_COUNT_AT = 2000
+    # The number of search results looked up and stored at once.
+    SEARCH_RESULT_CHUNK_SIZE = 1000
+    # Time series counts are kept at each of the SERIES_RESOLUTIONS, given
+    # as (bucket_size, slab_size) pairs in seconds, the coarsest last. Each
+    # slab is a hash of bucket counts that expires SERIES_TTL seconds after
+    # its newest bucket was added, so counts older than that are lost.
+    SERIES_RESOLUTIONS = [
+        (1, 300),
+        (60, 60 * 60 * 6),
+        (60 * 60, 60 * 60 * 24),
+    ]
+    SERIES_TTL = 60 * 60 * 24 * 7
+    # Unique addresses are counted with a HyperLogLog for the whole batch
+    # and one per UNIQUE_ADDR_BUCKET_SIZE seconds. The bucket counters
+    # expire along with the time series.
+    UNIQUE_ADDR_BUCKET_SIZE = 3600
+    # How long to remember that a batch doesn't use unique address counters
+    # before checking again, so that batches that don't use them aren't
+    # checked on every message.
+    UNIQUE_ADDR_FLAG_TTL = 60
 
     # Cache search results for 24 hrs
     DEFAULT_SEARCH_RESULT_TTL = 60 * 60 * 24
@@ -43,6 +68,8 @@ class MessageStoreCache(object):
         # Store redis as `manager` as well since @Manager.calls_manager
         # requires it to be named as such.
         self.redis = self.manager = redis
+        # batch_id -> (uses unique address counters, time to check again)
+        self._unique_addr_flags = {}
 
     def key(self, *args):
         return ':'.join([unicode(a) for a in args])
@@ -83,6 +110,21 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def search_progress_key(self, batch_id, token):
+        return self.batch_key(self.SEARCH_PROGRESS_KEY, batch_id, token)
+
+    def recon_key(self, batch_id):
+        return self.batch_key(self.RECON_KEY, batch_id)
+
+    def series_key(self, batch_id, *args):
+        return self.batch_key(self.SERIES_KEY, batch_id, *args)
+
+    def unique_addr_key(self, batch_id, addr_type, bucket=None):
+        if bucket is None:
+            return self.batch_key(self.UNIQUE_ADDR_KEY, batch_id, addr_type)
+        return self.batch_key(
+            self.UNIQUE_ADDR_KEY, batch_id, addr_type, bucket)
+
     def uses_counters(self, batch_id):
         """
         Returns ``True`` if ``batch_id`` has moved to the new system
@@ -106,6 +148,48 @@ class MessageStoreCache(object):
         """
         return self.redis.exists(self.event_count_key(batch_id))
 
+    @Manager.calls_manager
+    def uses_unique_address_counters(self, batch_id):
+        """
+        Returns ``True`` if ``batch_id`` counts unique from_addrs and
+        to_addrs with HyperLogLogs.
+
+        The test for this is to see if the batch's to_addr counter exists.
+        The answer is remembered, so a switch to unique address counters
+        made by another process is only noticed after
+        ``UNIQUE_ADDR_FLAG_TTL`` seconds.
+        """
+        flag = self._unique_addr_flags.get(batch_id)
+        if flag is not None and (flag[0] or flag[1] > self._now()):
+            returnValue(flag[0])
+        uses_counters = yield self.redis.exists(
+            self.unique_addr_key(batch_id, 'to_addr'))
+        self._unique_addr_flags[batch_id] = (
+            bool(uses_counters), self._now() + self.UNIQUE_ADDR_FLAG_TTL)
+        returnValue(bool(uses_counters))
+
+    @Manager.calls_manager
+    def switch_to_unique_address_counters(self, batch_id):
+        """
+        Start counting unique from_addrs and to_addrs for a batch with
+        HyperLogLogs. Only addresses seen after the switch are counted.
+
+        HyperLogLogs need redis-server 2.8.9 and redis-py 2.10 or later.
+        A :class:`MessageStoreCacheException` is raised if they aren't
+        supported.
+
+        This operation is idempotent.
+        """
+        try:
+            yield gather_results([
+                self.redis.pfadd(self.unique_addr_key(batch_id, addr_type))
+                for addr_type in ('from_addr', 'to_addr')])
+        except Exception, e:
+            raise MessageStoreCacheException(
+                "Unique address counters need HyperLogLog support "
+                "(redis-server 2.8.9 and redis-py 2.10 or later): %s" % (e,))
+        self._unique_addr_flags[batch_id] = (True, None)
+
     @Manager.calls_manager
     def switch_to_counters(self, batch_id):
         """
@@ -156,7 +240,8 @@ class MessageStoreCache(object):
         return self._truncate_keys(self.event_key(batch_id), truncate_at)
 
     @Manager.calls_manager
-    def batch_start(self, batch_id, use_counters=True):
+    def batch_start(self, batch_id, use_counters=True,
+                    count_unique_addresses=False):
         """
         Does various setup work in order to be able to accurately
         store cached data for a batch_id.
@@ -169,6 +254,12 @@ class MessageStoreCache(object):
 
             Defaults to ``True``.
 
+        :param bool count_unique_addresses:
+            If ``True`` this batch counts unique from_addrs and to_addrs
+            with HyperLogLogs, see :meth:`count_from_addrs`.
+
+            Defaults to ``False``.
+
 
         This operation idempotent.
         """
@@ -178,6 +269,8 @@ class MessageStoreCache(object):
             yield self.redis.set(self.inbound_count_key(batch_id), 0)
             yield self.redis.set(self.outbound_count_key(batch_id), 0)
             yield self.redis.set(self.event_count_key(batch_id), 0)
+        if count_unique_addresses:
+            yield self.switch_to_unique_address_counters(batch_id)
 
     @Manager.calls_manager
     def init_status(self, batch_id):
@@ -213,6 +306,10 @@ class MessageStoreCache(object):
                 them as messages are received. If your UI depends on your
                 cached values your UI values might be off while the
                 reconciliation is taking place.
+
+                Unique address counters are left alone, since a recon
+                doesn't rebuild them. Time series are removed and rebuilt
+                by a recon, but only for the last ``SERIES_TTL`` seconds.
         """
         yield self.redis.delete(self.inbound_key(batch_id))
         yield self.redis.delete(self.inbound_count_key(batch_id))
@@ -223,6 +320,7 @@ class MessageStoreCache(object):
         yield self.redis.delete(self.status_key(batch_id))
         yield self.redis.delete(self.to_addr_key(batch_id))
         yield self.redis.delete(self.from_addr_key(batch_id))
+        yield self.clear_time_series(batch_id)
         yield self.redis.srem(self.batch_key(), batch_id)
 
     def get_timestamp(self, timestamp):
@@ -239,14 +337,17 @@ class MessageStoreCache(object):
         Add an outbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_outbound_message_key(
+        new_entry = yield self.add_outbound_message_key(
             batch_id, msg['message_id'], timestamp)
+        if new_entry:
+            yield self.increment_time_series(batch_id, 'outbound', timestamp)
         yield self.add_to_addr(batch_id, msg['to_addr'], timestamp)
 
     @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
+        Returns 0 if the key already exists in the set, 1 if it doesn't.
         """
         new_entry = yield self.redis.zadd(self.outbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
@@ -258,6 +359,40 @@ class MessageStoreCache(object):
             if uses_counters:
                 yield self.redis.incr(self.outbound_count_key(batch_id))
                 yield self.truncate_outbound_message_keys(batch_id)
+        returnValue(new_entry)
+
+    @Manager.calls_manager
+    def add_outbound_message_keys(self, batch_id, keys_with_timestamps):
+        """
+        Add several message keys, weighted with their timestamps, to the
+        batch_id. (Used for recon.)
+
+        :param list keys_with_timestamps:
+            A list of ``(message_key, timestamp)`` pairs.
+
+        The timestamps of all the keys are added to the ``outbound`` time
+        series, so keys that were already in the cache are counted again.
+
+        Returns the number of keys that weren't already in the cache.
+        """
+        if not keys_with_timestamps:
+            returnValue(0)
+        new_entries = yield self.redis.zadd(
+            self.outbound_key(batch_id), **dict(
+                (key.encode('utf-8'), timestamp)
+                for key, timestamp in keys_with_timestamps))
+        yield self.add_time_series_timestamps(
+            batch_id, 'outbound',
+            [timestamp for _key, timestamp in keys_with_timestamps])
+        if new_entries:
+            yield self.increment_event_status(batch_id, 'sent', new_entries)
+
+            uses_counters = yield self.uses_counters(batch_id)
+            if uses_counters:
+                yield self.redis.incr(
+                    self.outbound_count_key(batch_id), new_entries)
+                yield self.truncate_outbound_message_keys(batch_id)
+        returnValue(new_entries)
 
     @Manager.calls_manager
     def add_outbound_message_count(self, batch_id, count):
@@ -284,11 +419,62 @@ class MessageStoreCache(object):
         timestamp = self.get_timestamp(event['timestamp'])
         new_entry = yield self.add_event_key(batch_id, event_id, timestamp)
         if new_entry:
-            event_type = event['event_type']
-            yield self.increment_event_status(batch_id, event_type)
-            if event_type == 'delivery_report':
-                yield self.increment_event_status(
-                    batch_id, '%s.%s' % (event_type, event['delivery_status']))
+            statuses = [event['event_type']]
+            if event['event_type'] == 'delivery_report':
+                statuses.append(
+                    'delivery_report.%s' % (event['delivery_status'],))
+            for status in statuses:
+                yield self.increment_event_status(batch_id, status)
+                yield self.increment_time_series(batch_id, status, timestamp)
+
+    @Manager.calls_manager
+    def add_event_keys_with_statuses(self, batch_id, events):
+        """
+        Add several event keys and count their statuses. (Used for recon.)
+
+        :param list events:
+            A list of ``(event_key, timestamp, status)`` tuples, where
+            ``status`` is the event type, or ``delivery_report.<status>``
+            for delivery reports.
+
+        The event keys are added concurrently and only the statuses of keys
+        that weren't already in the cache are counted, both in the status
+        counters and the time series.
+
+        Returns the number of keys that weren't already in the cache.
+        """
+        if not events:
+            returnValue(0)
+        uses_event_counters = yield self.uses_event_counters(batch_id)
+        if not uses_event_counters:
+            # See the HACK comment in add_event_key() below.
+            returnValue(0)
+
+        event_key = self.event_key(batch_id)
+        new_entries = yield gather_results(
+            self.redis.zadd(event_key, **{key.encode('utf-8'): timestamp})
+            for key, timestamp, _status in events)
+
+        status_timestamps = {}
+        for new_entry, (_key, timestamp, status) in zip(new_entries, events):
+            if not new_entry:
+                continue
+            statuses = [status]
+            if status.startswith('delivery_report.'):
+                statuses.append('delivery_report')
+            for status in statuses:
+                status_timestamps.setdefault(status, []).append(timestamp)
+
+        new_count = sum(1 for new_entry in new_entries if new_entry)
+        if new_count:
+            yield gather_results(
+                [self.redis.incr(self.event_count_key(batch_id), new_count)] +
+                [self.increment_event_status(batch_id, status, len(stamps))
+                 for status, stamps in status_timestamps.iteritems()] +
+                [self.add_time_series_timestamps(batch_id, status, stamps)
+                 for status, stamps in status_timestamps.iteritems()])
+            yield self.truncate_event_keys(batch_id)
+        returnValue(new_count)
 
     @Manager.calls_manager
     def add_event_key(self, batch_id, event_key, timestamp):
@@ -337,14 +523,17 @@ class MessageStoreCache(object):
         Add an inbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_inbound_message_key(
+        new_entry = yield self.add_inbound_message_key(
             batch_id, msg['message_id'], timestamp)
+        if new_entry:
+            yield self.increment_time_series(batch_id, 'inbound', timestamp)
         yield self.add_from_addr(batch_id, msg['from_addr'], timestamp)
 
     @Manager.calls_manager
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
-        Add a message key, weighted with the timestamp to the batch_id
+        Add a message key, weighted with the timestamp to the batch_id.
+        Returns 0 if the key already exists in the set, 1 if it doesn't.
         """
         new_entry = yield self.redis.zadd(self.inbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
@@ -355,6 +544,38 @@ class MessageStoreCache(object):
             if uses_counters:
                 yield self.redis.incr(self.inbound_count_key(batch_id))
                 yield self.truncate_inbound_message_keys(batch_id)
+        returnValue(new_entry)
+
+    @Manager.calls_manager
+    def add_inbound_message_keys(self, batch_id, keys_with_timestamps):
+        """
+        Add several message keys, weighted with their timestamps, to the
+        batch_id. (Used for recon.)
+
+        :param list keys_with_timestamps:
+            A list of ``(message_key, timestamp)`` pairs.
+
+        The timestamps of all the keys are added to the ``inbound`` time
+        series, so keys that were already in the cache are counted again.
+
+        Returns the number of keys that weren't already in the cache.
+        """
+        if not keys_with_timestamps:
+            returnValue(0)
+        new_entries = yield self.redis.zadd(
+            self.inbound_key(batch_id), **dict(
+                (key.encode('utf-8'), timestamp)
+                for key, timestamp in keys_with_timestamps))
+        yield self.add_time_series_timestamps(
+            batch_id, 'inbound',
+            [timestamp for _key, timestamp in keys_with_timestamps])
+        if new_entries:
+            uses_counters = yield self.uses_counters(batch_id)
+            if uses_counters:
+                yield self.redis.incr(
+                    self.inbound_count_key(batch_id), new_entries)
+                yield self.truncate_inbound_message_keys(batch_id)
+        returnValue(new_entries)
 
     @Manager.calls_manager
     def add_inbound_message_count(self, batch_id, count):
@@ -365,16 +586,19 @@ class MessageStoreCache(object):
 
     def add_from_addr(self, batch_id, from_addr, timestamp):
         """
-        Add a from_addr to this batch_id, weighted by timestamp. Generally
-        this information is retrieved when `add_inbound_message()` is called.
+        Add a from_addr to this batch_id's unique address counters, if it
+        has them. Generally this information is retrieved when
+        `add_inbound_message()` is called.
         """
-        # NOTE: Disabled because this doesn't scale to large batches.
+        # NOTE: We don't keep the addresses themselves because this doesn't
+        #       scale to large batches.
         #       See https://github.com/praekelt/vumi/issues/877
 
         # return self.redis.zadd(self.from_addr_key(batch_id), **{
         #     from_addr.encode('utf-8'): timestamp,
         # })
-        return
+        return self._add_unique_addr(
+            batch_id, 'from_addr', from_addr, timestamp)
 
     def get_from_addrs(self, batch_id, asc=False):
         """
@@ -387,28 +611,42 @@ class MessageStoreCache(object):
         #                          desc=not asc)
         return []
 
-    def count_from_addrs(self, batch_id):
+    def count_from_addrs(self, batch_id, start=None, end=None):
         """
-        Return the number of from_addrs for this batch_id
+        Return the approximate number of unique from_addrs for this
+        batch_id, or 0 if it doesn't use unique address counters.
+
+        If ``start`` or ``end`` timestamps are given, only addresses seen
+        in the hours from the one containing ``start`` to the one containing
+        ``end`` are counted. ``start`` defaults to the oldest hour we keep
+        and ``end`` to now.
+
+        Unique address counters are only updated as messages are added to
+        the cache. A recon doesn't rebuild them, so they only count
+        addresses seen since the batch switched to them, and the hourly
+        counters only cover the last ``SERIES_TTL`` seconds.
         """
-        # NOTE: Disabled because this doesn't scale to large batches.
+        # NOTE: The exact count is disabled because this doesn't scale to
+        #       large batches.
         #       See https://github.com/praekelt/vumi/issues/877
 
         # return self.redis.zcard(self.from_addr_key(batch_id))
-        return 0
+        return self._count_unique_addrs(batch_id, 'from_addr', start, end)
 
     def add_to_addr(self, batch_id, to_addr, timestamp):
         """
-        Add a to-addr to this batch_id, weighted by timestamp. Generally
-        this information is retrieved when `add_outbound_message()` is called.
+        Add a to-addr to this batch_id's unique address counters, if it has
+        them. Generally this information is retrieved when
+        `add_outbound_message()` is called.
         """
-        # NOTE: Disabled because this doesn't scale to large batches.
+        # NOTE: We don't keep the addresses themselves because this doesn't
+        #       scale to large batches.
         #       See https://github.com/praekelt/vumi/issues/877
 
         # return self.redis.zadd(self.to_addr_key(batch_id), **{
         #     to_addr.encode('utf-8'): timestamp,
         # })
-        return
+        return self._add_unique_addr(batch_id, 'to_addr', to_addr, timestamp)
 
     def get_to_addrs(self, batch_id, asc=False):
         """
@@ -422,15 +660,106 @@ class MessageStoreCache(object):
         #                          desc=not asc)
         return []
 
-    def count_to_addrs(self, batch_id):
+    def count_to_addrs(self, batch_id, start=None, end=None):
         """
-        Return count of the unique to_addrs in this batch.
+        Return the approximate count of the unique to_addrs in this batch,
+        or 0 if it doesn't use unique address counters.
+
+        See :meth:`count_from_addrs` for ``start`` and ``end``.
         """
-        # NOTE: Disabled because this doesn't scale to large batches.
+        # NOTE: The exact count is disabled because this doesn't scale to
+        #       large batches.
         #       See https://github.com/praekelt/vumi/issues/877
 
         # return self.redis.zcard(self.to_addr_key(batch_id))
-        return 0
+        return self._count_unique_addrs(batch_id, 'to_addr', start, end)
+
+    def _addr_bucket(self, timestamp):
+        timestamp = int(timestamp)
+        return timestamp - timestamp % self.UNIQUE_ADDR_BUCKET_SIZE
+
+    def _now(self):
+        return self.get_timestamp(datetime.utcnow())
+
+    @Manager.calls_manager
+    def _add_unique_addr(self, batch_id, addr_type, addr, timestamp):
+        if addr is None:
+            return
+        if not (yield self.uses_unique_address_counters(batch_id)):
+            return
+        addr = addr.encode('utf-8')
+        bucket_key = self.unique_addr_key(
+            batch_id, addr_type, self._addr_bucket(timestamp))
+        yield gather_results([
+            self.redis.pfadd(self.unique_addr_key(batch_id, addr_type), addr),
+            self.redis.pfadd(bucket_key, addr),
+            self.redis.expire(bucket_key, self.SERIES_TTL),
+        ])
+
+    @Manager.calls_manager
+    def _count_unique_addrs(self, batch_id, addr_type, start, end):
+        if not (yield self.uses_unique_address_counters(batch_id)):
+            returnValue(0)
+        if start is None and end is None:
+            keys = [self.unique_addr_key(batch_id, addr_type)]
+        else:
+            if start is None:
+                start = self._now() - self.SERIES_TTL
+            if end is None:
+                end = self._now()
+            keys = [
+                self.unique_addr_key(batch_id, addr_type, bucket)
+                for bucket in range(self._addr_bucket(start), int(end) + 1,
+                                    self.UNIQUE_ADDR_BUCKET_SIZE)]
+            if not keys:
+                returnValue(0)
+        count = yield self.redis.pfcount(*keys)
+        returnValue(count)
+
+    @Manager.calls_manager
+    def get_approximate_stats(self, batch_id, direction, start=None,
+                              end=None):
+        """
+        Return approximate message stats for the ``inbound`` or ``outbound``
+        messages in this batch, in the same form as
+        :meth:`vumi.components.message_store.MessageStore.batch_inbound_stats`.
+
+        ``start`` and ``end`` are optional timestamps. The total comes from
+        the message counters or time series and the unique address count
+        from the unique address counters, so this takes constant memory and
+        time.
+
+        Returns ``None`` if the batch doesn't use unique address counters
+        or the time range starts before the oldest time series data we
+        keep, in which case the exact stats should be used instead.
+
+        A recon doesn't rebuild the unique address counters (see
+        :meth:`count_from_addrs`), so addresses from messages added before
+        the batch switched to them are never included in the unique address
+        count.
+        """
+        if not (yield self.uses_unique_address_counters(batch_id)):
+            returnValue(None)
+        addr_type = {'inbound': 'from_addr', 'outbound': 'to_addr'}[direction]
+        if start is None and end is None:
+            if direction == 'inbound':
+                total = yield self.count_inbound_message_keys(batch_id)
+            else:
+                total = yield self.count_outbound_message_keys(batch_id)
+        else:
+            now = self._now()
+            if start is None or start < now - self.SERIES_TTL:
+                returnValue(None)
+            if end is None:
+                end = now
+            total = yield self.count_time_series(
+                batch_id, direction, start, end)
+        unique_addresses = yield self._count_unique_addrs(
+            batch_id, addr_type, start, end)
+        returnValue({
+            "total": total,
+            "unique_addresses": unique_addresses,
+        })
 
     def get_inbound_message_keys(self, batch_id, start=0, stop=-1, asc=False,
                                  with_timestamp=False):
@@ -523,8 +852,14 @@ class MessageStoreCache(object):
             returnValue(0)
 
         [(latest, timestamp)] = last_seen
-        count = yield self.redis.zcount(
-            self.inbound_key(batch_id), timestamp - sample_time, timestamp)
+        count = yield self.count_time_series(
+            batch_id, 'inbound', timestamp - sample_time, timestamp)
+        if not count:
+            # The latest message is always counted, so this batch's messages
+            # were cached before we kept time series for them.
+            count = yield self.redis.zcount(
+                self.inbound_key(batch_id), timestamp - sample_time,
+                timestamp)
         returnValue(int(count))
 
     @Manager.calls_manager
@@ -543,10 +878,254 @@ class MessageStoreCache(object):
             returnValue(0)
 
         [(latest, timestamp)] = last_seen
-        count = yield self.redis.zcount(
-            self.outbound_key(batch_id), timestamp - sample_time, timestamp)
+        count = yield self.count_time_series(
+            batch_id, 'outbound', timestamp - sample_time, timestamp)
+        if not count:
+            # The latest message is always counted, so this batch's messages
+            # were cached before we kept time series for them.
+            count = yield self.redis.zcount(
+                self.outbound_key(batch_id), timestamp - sample_time,
+                timestamp)
         returnValue(int(count))
 
+    @Manager.calls_manager
+    def get_recon_checkpoint(self, batch_id):
+        """
+        Return the progress of an unfinished cache recon for the given
+        batch_id, or ``None`` if there isn't one.
+
+        The checkpoint is a dictionary containing the ``direction`` being
+        reconciled, the index ``continuation`` to carry on from (``None``
+        to start from the beginning), and counts of the ``outbound``,
+        ``inbound`` and ``event`` keys processed so far.
+        """
+        checkpoint = yield self.redis.hgetall(self.recon_key(batch_id))
+        if not checkpoint:
+            returnValue(None)
+        returnValue({
+            'direction': checkpoint['direction'],
+            'continuation': checkpoint.get('continuation') or None,
+            'outbound': int(checkpoint.get('outbound', 0)),
+            'inbound': int(checkpoint.get('inbound', 0)),
+            'event': int(checkpoint.get('event', 0)),
+        })
+
+    def set_recon_checkpoint(self, batch_id, checkpoint):
+        """
+        Store the progress of a cache recon for the given batch_id. See
+        :meth:`get_recon_checkpoint` for the format of ``checkpoint``.
+        """
+        return self.redis.hmset(self.recon_key(batch_id), {
+            'direction': checkpoint['direction'],
+            'continuation': checkpoint['continuation'] or '',
+            'outbound': checkpoint['outbound'],
+            'inbound': checkpoint['inbound'],
+            'event': checkpoint['event'],
+        })
+
+    def clear_recon_checkpoint(self, batch_id):
+        """
+        Remove the progress of a cache recon for the given batch_id.
+        """
+        return self.redis.delete(self.recon_key(batch_id))
+
+    @Manager.calls_manager
+    def increment_time_series(self, batch_id, series, timestamp, count=1):
+        """
+        Add ``count`` to the time series called ``series`` for the given
+        batch_id, at the second of ``timestamp``.
+
+        The time series kept for each batch are ``inbound`` and
+        ``outbound`` for new messages, and one for each event status (in the
+        same form as :meth:`get_event_status`) for new events. They're
+        removed by :meth:`clear_batch` and rebuilt by a recon.
+
+        Counts are kept per second, minute and hour (see
+        ``SERIES_RESOLUTIONS``) and expire ``SERIES_TTL`` seconds after
+        they were last updated.
+        """
+        yield self._add_series_counts(batch_id, series, {
+            int(timestamp): count,
+        })
+
+    @Manager.calls_manager
+    def add_time_series_timestamps(self, batch_id, series, timestamps):
+        """
+        Count each of ``timestamps`` in the time series called ``series``
+        for the given batch_id. (Used for recon.)
+
+        Timestamps older than ``SERIES_TTL`` seconds are skipped, since
+        their counts would have expired already.
+        """
+        oldest = self._now() - self.SERIES_TTL
+        counts = {}
+        for timestamp in timestamps:
+            if timestamp >= oldest:
+                second = int(timestamp)
+                counts[second] = counts.get(second, 0) + 1
+        yield self._add_series_counts(batch_id, series, counts)
+
+    @Manager.calls_manager
+    def _add_series_counts(self, batch_id, series, counts):
+        if not counts:
+            return
+        bucket_counts = {}
+        for bucket_size, slab_size in self.SERIES_RESOLUTIONS:
+            for second, count in counts.iteritems():
+                bucket = (
+                    bucket_size,
+                    self.series_key(batch_id, series, bucket_size,
+                                    second - second % slab_size),
+                    str(second - second % bucket_size))
+                bucket_counts[bucket] = bucket_counts.get(bucket, 0) + count
+        buckets = bucket_counts.items()
+        totals = yield gather_results(
+            self.redis.hincrby(slab_key, bucket, count)
+            for (_bucket_size, slab_key, bucket), count in buckets)
+
+        # A slab's expiry is only pushed back when a bucket is added to it,
+        # which is enough to keep each bucket for SERIES_TTL seconds and
+        # saves an EXPIRE per count.
+        new_slab_keys = set()
+        new_hour = False
+        for ((bucket_size, slab_key, _), count), total in zip(buckets, totals):
+            if int(total) == count:
+                new_slab_keys.add(slab_key)
+                new_hour = new_hour or (
+                    bucket_size == self.SERIES_RESOLUTIONS[-1][0])
+        if new_slab_keys:
+            yield self._index_series_slabs(batch_id, new_slab_keys, new_hour)
+
+    @Manager.calls_manager
+    def _index_series_slabs(self, batch_id, slab_keys, prune):
+        """
+        Expire the given slabs ``SERIES_TTL`` seconds from now and record
+        them in the batch's slab index (a zset scored by expiry time), so
+        that :meth:`clear_time_series` can find them. If ``prune`` is set,
+        expired slabs are also removed from the index.
+        """
+        index_key = self.series_key(batch_id)
+        expires = self._now() + self.SERIES_TTL
+        calls = [self.redis.expire(slab_key, self.SERIES_TTL)
+                 for slab_key in slab_keys]
+        calls.append(self.redis.zadd(index_key, **dict(
+            (slab_key, expires) for slab_key in slab_keys)))
+        yield gather_results(calls)
+        if prune:
+            expired = yield self.redis.zcount(index_key, '-inf', self._now())
+            if expired:
+                yield self.redis.zremrangebyrank(index_key, 0, expired - 1)
+            # Slabs indexed before the next prune expire at most an hour
+            # after this.
+            yield self.redis.expire(
+                index_key, self.SERIES_TTL + self.SERIES_RESOLUTIONS[-1][0])
+
+    @Manager.calls_manager
+    def clear_time_series(self, batch_id):
+        """
+        Remove all the time series for the given batch_id.
+        """
+        index_key = self.series_key(batch_id)
+        slab_keys = yield self.redis.zrange(index_key, 0, -1)
+        yield gather_results(
+            self.redis.delete(slab_key) for slab_key in slab_keys)
+        yield self.redis.delete(index_key)
+
+    def _series_ranges(self, start, end, bucket_size=None):
+        """
+        Split the seconds from ``start`` up to (but not including) ``end``
+        into ``(resolution, first_bucket, last_bucket)`` ranges, using the
+        coarsest resolution that fits each part. If ``bucket_size`` is
+        given, only resolutions that divide it are used.
+        """
+        resolutions = [
+            bucket for bucket, _slab_size in self.SERIES_RESOLUTIONS
+            if bucket_size is None or bucket_size % bucket == 0]
+        ranges = []
+        for i, bucket in enumerate(resolutions):
+            coarser = resolutions[i + 1] if i + 1 < len(resolutions) else None
+            if coarser is not None:
+                head_end = min(end, -(-start // coarser) * coarser)
+                tail_start = max(head_end, end - end % coarser)
+            else:
+                head_end = tail_start = end
+            if start < head_end:
+                ranges.append((bucket, start, head_end - bucket))
+            if tail_start < end:
+                ranges.append((bucket, tail_start, end - bucket))
+            start, end = head_end, tail_start
+            if start >= end:
+                break
+        return ranges
+
+    @Manager.calls_manager
+    def _get_series_counts(self, batch_id, series, start, end,
+                           bucket_size=None):
+        slab_sizes = dict(self.SERIES_RESOLUTIONS)
+        ranges = self._series_ranges(int(start), int(end) + 1, bucket_size)
+        slab_keys = []
+        for bucket, first, last in ranges:
+            slab_size = slab_sizes[bucket]
+            slab_keys.extend(
+                (bucket, first, last,
+                 self.series_key(batch_id, series, bucket, slab_start))
+                for slab_start in range(
+                    first - first % slab_size, last + 1, slab_size))
+        slabs = yield gather_results(
+            self.redis.hgetall(slab_key) for _, _, _, slab_key in slab_keys)
+        counts = {}
+        for (_bucket, first, last, _slab_key), slab in zip(slab_keys, slabs):
+            for bucket_start, count in slab.iteritems():
+                bucket_start = int(bucket_start)
+                if first <= bucket_start <= last:
+                    counts[bucket_start] = (
+                        counts.get(bucket_start, 0) + int(count))
+        returnValue(counts)
+
+    @Manager.calls_manager
+    def count_time_series(self, batch_id, series, start, end):
+        """
+        Return the total of the time series called ``series`` for the given
+        batch_id between the ``start`` and ``end`` timestamps, inclusive.
+
+        The total is read from the coarsest counts that fit the range, so
+        this takes time proportional to the number of hours in it rather
+        than seconds.
+
+        Counts are only kept for ``SERIES_TTL`` seconds (a week). Older
+        ones may have expired and are then treated as 0, so ranges starting
+        before then may be undercounted.
+
+        See :meth:`increment_time_series` for the time series that are kept.
+        """
+        counts = yield self._get_series_counts(batch_id, series, start, end)
+        returnValue(sum(counts.itervalues()))
+
+    @Manager.calls_manager
+    def get_time_series(self, batch_id, series, start, end, bucket_size=60):
+        """
+        Return the time series called ``series`` for the given batch_id
+        between the ``start`` and ``end`` timestamps, inclusive.
+
+        The result is a list of ``(bucket_start, count)`` pairs, one for
+        every ``bucket_size`` seconds from the bucket containing ``start``
+        to the bucket containing ``end``. A ``start`` or ``end`` that isn't
+        on a bucket boundary only counts part of its bucket.
+
+        Counts are only kept for ``SERIES_TTL`` seconds (a week), so
+        older buckets may have expired and then have a count of 0.
+
+        See :meth:`increment_time_series` for the time series that are kept.
+        """
+        counts = yield self._get_series_counts(
+            batch_id, series, start, end, bucket_size)
+        first_bucket = int(start) - int(start) % bucket_size
+        buckets = dict((bucket_start, 0) for bucket_start in range(
+            first_bucket, int(end) + 1, bucket_size))
+        for second, count in counts.iteritems():
+            buckets[second - second % bucket_size] += count
+        returnValue(sorted(buckets.items()))
+
     def get_query_token(self, direction, query):
         """
         Return a token for the query.
@@ -597,9 +1176,15 @@ class MessageStoreCache(object):
         :param int ttl:
             How long to store the results for.
             Defaults to DEFAULT_SEARCH_RESULT_TTL.
+
+        The keys are processed in chunks of SEARCH_RESULT_CHUNK_SIZE. The
+        timestamps for a chunk are looked up concurrently and the chunk is
+        stored with a single ZADD, so the results can be counted while the
+        rest are still being stored. See also :meth:`get_query_progress`.
         """
         ttl = ttl or self.DEFAULT_SEARCH_RESULT_TTL
         result_key = self.search_result_key(batch_id, token)
+        progress_key = self.search_progress_key(batch_id, token)
         if direction == 'inbound':
             score_set_key = self.inbound_key(batch_id)
         elif direction == 'outbound':
@@ -607,18 +1192,42 @@ class MessageStoreCache(object):
         else:
             raise MessageStoreCacheException('Invalid direction')
 
+        keys = list(keys)
+        yield self.redis.hmset(progress_key, {'total': len(keys), 'stored': 0})
+        yield self.redis.expire(progress_key, ttl)
+
         # populate the results set weighted according to the timestamps
         # that are already known in the cache.
-        for key in keys:
-            timestamp = yield self.redis.zscore(score_set_key, key)
-            yield self.redis.zadd(result_key, **{
-                key.encode('utf-8'): timestamp,
-            })
+        for start in xrange(0, len(keys), self.SEARCH_RESULT_CHUNK_SIZE):
+            chunk = keys[start:start + self.SEARCH_RESULT_CHUNK_SIZE]
+            timestamps = yield gather_results(
+                self.redis.zscore(score_set_key, key) for key in chunk)
+            # Keys that have been truncated from the cache have no
+            # timestamp, so they're sorted as the oldest results.
+            yield self.redis.zadd(result_key, **dict(
+                (key.encode('utf-8'), timestamp or 0)
+                for key, timestamp in zip(chunk, timestamps)))
+            yield self.redis.hincrby(progress_key, 'stored', len(chunk))
 
         # Auto expire after TTL
         yield self.redis.expire(result_key, ttl)
         # Remove from the list of in progress search operations.
         yield self.redis.srem(self.search_token_key(batch_id), token)
+        yield self.redis.delete(progress_key)
+
+    @Manager.calls_manager
+    def get_query_progress(self, batch_id, token):
+        """
+        Return a dictionary containing the ``total`` number of results for
+        a query that is still being stored and the number of them that have
+        been ``stored`` so far, or ``None`` if the results aren't being
+        stored.
+        """
+        progress = yield self.redis.hgetall(
+            self.search_progress_key(batch_id, token))
+        if not progress:
+            returnValue(None)
+        returnValue(dict((k, int(v)) for k, v in progress.iteritems()))
 
     def is_query_in_progress(self, batch_id, token):
         """
@@ -1,12 +1,17 @@
 # -*- test-case-name: vumi.components.tests.test_message_store_resource -*-
 
+from collections import deque
+
 import iso8601
+from zope.interface import implements
 
 from twisted.application.internet import StreamServerEndpointService
-from twisted.internet.defer import DeferredList, inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.interfaces import IPushProducer
 from twisted.web.resource import NoResource, Resource
 from twisted.web.server import NOT_DONE_YET
 
+from vumi import log
 from vumi.components.message_store import MessageStore
 from vumi.components.message_formatters import JsonFormatter, CsvFormatter
 from vumi.config import (
@@ -20,14 +25,6 @@ from vumi.utils import build_web_site
 from vumi.worker import BaseWorker
 
 
-# NOTE: Thanks Ned http://stackoverflow.com/a/312464!
-def chunks(l, n):
-    """ Yield successive n-sized chunks from l.
-    """
-    for i in xrange(0, len(l), n):
-        yield l[i:i + n]
-
-
 class ParameterError(Exception):
     """
     Exception raised while trying to parse a parameter.
@@ -35,10 +32,139 @@ class ParameterError(Exception):
     pass
 
 
+class MessageExporter(object):
+    """
+    Fetch the messages for a series of pages of keys and write them to a
+    request.
+
+    Messages are fetched in bunches of up to ``bunch_size`` keys, with up to
+    ``concurrency`` bunches in flight at once. A new bunch is started as
+    soon as one finishes, whichever page its keys come from, and the next
+    page of keys is fetched once there are fewer keys waiting than would
+    fill the window. Messages are written in the order their bunches
+    finish.
+
+    The exporter is registered as a streaming producer for the request, so
+    no new bunches are started while the transport is paused, and nothing
+    more is done once the connection is lost.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, resource, request, concurrency, bunch_size):
+        self.resource = resource
+        self.request = request
+        self.concurrency = concurrency
+        self.bunch_size = bunch_size
+        self._keys = deque()
+        self._next_page = None
+        self._page_d = None
+        self._in_flight = 0
+        self._paused = False
+        self._stopped = False
+        self._finished = False
+        self._done = None
+
+    def start(self, keys_page_d):
+        """
+        Start exporting, beginning with the page of keys ``keys_page_d``
+        fires with.
+
+        Returns a deferred that fires once the request has been finished or
+        all outstanding work has stopped after the connection was lost.
+        """
+        self._done = Deferred()
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addBoth(lambda _: self.stopProducing())
+        self._fetch_page(keys_page_d)
+        return self._done
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._pump()
+
+    def stopProducing(self):
+        self._stopped = True
+        self._pump()
+
+    def _pump(self):
+        if self._done is None or self._finished:
+            return
+        if self._stopped:
+            if not (self._in_flight or self._page_d):
+                self._finish()
+            return
+
+        while (not self._paused and self._keys and
+               self._in_flight < self.concurrency):
+            self._fetch_bunch([
+                self._keys.popleft()
+                for _ in xrange(min(self.bunch_size, len(self._keys)))])
+
+        if (self._next_page is not None and self._page_d is None and
+                len(self._keys) < self.concurrency * self.bunch_size):
+            page, self._next_page = self._next_page, None
+            self._fetch_page(page.next_page())
+
+        if not (self._keys or self._in_flight or self._page_d or
+                self._next_page):
+            self._finish()
+
+    def _finish(self):
+        # Finishing the request stops us producing, which brings us back
+        # here, so we need to make sure we only finish once.
+        self._finished = True
+        self.request.unregisterProducer()
+        if not self._stopped:
+            self.request.finish()
+        self._done.callback(None)
+
+    def _fetch_page(self, keys_page_d):
+        self._page_d = keys_page_d
+        keys_page_d.addCallback(self._page_fetched)
+        keys_page_d.addErrback(self._page_failed)
+
+    def _page_fetched(self, keys_page):
+        self._page_d = None
+        self._keys.extend(keys_page)
+        if keys_page.has_next_page():
+            self._next_page = keys_page
+        self._pump()
+
+    def _page_failed(self, failure):
+        # We've already started the response, so all we can do is log the
+        # error and finish with what we have.
+        log.err(failure, 'Error fetching message keys for export')
+        self._page_d = None
+        self._pump()
+
+    def _fetch_bunch(self, keys):
+        self._in_flight += 1
+        d = self.resource.get_messages(self.resource.message_store, keys)
+        d.addCallback(self._write_messages)
+        d.addErrback(log.err, 'Error fetching messages for export')
+        d.addCallback(self._bunch_done)
+
+    def _write_messages(self, messages):
+        if self._stopped:
+            return
+        for message in messages:
+            self.resource.write_message(message, self.request)
+
+    def _bunch_done(self, _):
+        self._in_flight -= 1
+        self._pump()
+
+
 class MessageStoreProxyResource(Resource):
 
     isLeaf = True
     default_concurrency = 1
+    # If this is None, the message store's Riak manager's load_bunch_size
+    # is used.
+    default_bunch_size = None
 
     def __init__(self, message_store, batch_id, formatter):
         Resource.__init__(self)
@@ -65,6 +191,11 @@ class MessageStoreProxyResource(Resource):
             concurrency = int(request.args['concurrency'][0])
         else:
             concurrency = self.default_concurrency
+        if 'bunch_size' in request.args:
+            bunch_size = int(request.args['bunch_size'][0])
+        else:
+            bunch_size = (self.default_bunch_size or
+                          self.message_store.manager.load_bunch_size)
 
         try:
             start = self._extract_date_arg(request, 'start')
@@ -81,10 +212,8 @@ class MessageStoreProxyResource(Resource):
         else:
             d = self.get_keys_page_for_time(
                 self.message_store, self.batch_id, start, end)
-        request.connection_has_been_closed = False
-        request.notifyFinish().addBoth(
-            lambda _: setattr(request, 'connection_has_been_closed', True))
-        d.addCallback(self.fetch_pages, concurrency, request)
+        exporter = MessageExporter(self, request, concurrency, bunch_size)
+        exporter.start(d)
         return NOT_DONE_YET
 
     def get_keys_page(self, message_store, batch_id):
@@ -96,62 +225,8 @@ class MessageStoreProxyResource(Resource):
     def get_message(self, message_store, message_id):
         raise NotImplementedError('To be implemented by sub-class.')
 
-    def fetch_pages(self, keys_page, concurrency, request):
-        """
-        Process a page of keys and each subsequent page.
-
-        The keys for the current page are handed off to :meth:`fetch_page` for
-        processing. If there is another page, we fetch that while the current
-        page is being handled and add a callback to process it when the
-        current page is finished.
-
-        When there are no more pages, we add a callback to close the request.
-        """
-        if request.connection_has_been_closed:
-            # We're no longer connected, so stop doing work.
-            return
-        d = self.fetch_page(keys_page, concurrency, request)
-        if keys_page.has_next_page():
-            # We fetch the next page before waiting for the current page to be
-            # processed.
-            next_page_d = keys_page.next_page()
-            d.addCallback(lambda _: next_page_d)
-            # Add this method as a callback to operate on the next page. It's
-            # like recursion, but without worrying about stack size.
-            d.addCallback(self.fetch_pages, concurrency, request)
-        else:
-            # No more pages, so close the request.
-            d.addCallback(self.finish_request_cb, request)
-        return d
-
-    def finish_request_cb(self, _result, request):
-        if not request.connection_has_been_closed:
-            # We need to check for this here in case we lose the connection
-            # while delivering the last page.
-            return request.finish()
-
-    @inlineCallbacks
-    def fetch_page(self, keys_page, concurrency, request):
-        """
-        Process a page of keys in chunks of concurrently-fetched messages.
-        """
-        for keys in chunks(list(keys_page), concurrency):
-            if request.connection_has_been_closed:
-                # We're no longer connected, so stop doing work.
-                return
-            yield self.handle_chunk(keys, request)
-
-    def handle_chunk(self, message_keys, request):
-        """
-        Concurrently fetch a chunk of messages and write each to the response.
-        """
-        return DeferredList([
-            self.handle_message(key, request) for key in message_keys])
-
-    def handle_message(self, message_key, request):
-        d = self.get_message(self.message_store, message_key)
-        d.addCallback(self.write_message, request)
-        return d
+    def get_messages(self, message_store, message_ids):
+        raise NotImplementedError('To be implemented by sub-class.')
 
     def write_message(self, message, request):
         self.formatter.write_row(request, message)
@@ -170,6 +245,9 @@ class InboundResource(MessageStoreProxyResource):
     def get_message(self, message_store, message_id):
         return message_store.get_inbound_message(message_id)
 
+    def get_messages(self, message_store, message_ids):
+        return message_store.get_inbound_messages(message_ids)
+
 
 class OutboundResource(MessageStoreProxyResource):
 
@@ -184,6 +262,9 @@ class OutboundResource(MessageStoreProxyResource):
     def get_message(self, message_store, message_id):
         return message_store.get_outbound_message(message_id)
 
+    def get_messages(self, message_store, message_ids):
+        return message_store.get_outbound_messages(message_ids)
+
 
 class BatchResource(Resource):
 
@@ -16,6 +16,138 @@ class TagpoolError(VumiError):
     """An error occurred during an operation on a tag pool."""
 
 
+# The Lua scripts below each perform a tag pool operation atomically in a
+# single round trip. They're used when the Redis manager supports scripting.
+#
+# Members of an owner's tag set are JSON-encoded ``[pool, tag]`` lists. These
+# must match Python's ``json.dumps()`` output exactly so that they can be
+# removed again, so we build them ourselves rather than using ``cjson``.
+
+JSON_STRING_LUA = r"""
+local function json_string(s)
+    local out = {}
+    local i = 1
+    while i <= #s do
+        local c = s:byte(i)
+        local cp, len
+        if c < 0x80 then
+            cp, len = c, 1
+        elseif c < 0xE0 then
+            cp, len = (c % 0x20) * 0x40 + s:byte(i + 1) % 0x40, 2
+        elseif c < 0xF0 then
+            cp, len = ((c % 0x10) * 0x1000 + (s:byte(i + 1) % 0x40) * 0x40 +
+                       s:byte(i + 2) % 0x40), 3
+        else
+            cp, len = ((c % 0x08) * 0x40000 +
+                       (s:byte(i + 1) % 0x40) * 0x1000 +
+                       (s:byte(i + 2) % 0x40) * 0x40 +
+                       s:byte(i + 3) % 0x40), 4
+        end
+        i = i + len
+        if cp == 0x22 then
+            out[#out + 1] = '\\"'
+        elseif cp == 0x5C then
+            out[#out + 1] = '\\\\'
+        elseif cp == 0x08 then
+            out[#out + 1] = '\\b'
+        elseif cp == 0x09 then
+            out[#out + 1] = '\\t'
+        elseif cp == 0x0A then
+            out[#out + 1] = '\\n'
+        elseif cp == 0x0C then
+            out[#out + 1] = '\\f'
+        elseif cp == 0x0D then
+            out[#out + 1] = '\\r'
+        elseif cp >= 0x20 and cp < 0x7F then
+            out[#out + 1] = string.char(cp)
+        elseif cp < 0x10000 then
+            out[#out + 1] = string.format('\\u%04x', cp)
+        else
+            cp = cp - 0x10000
+            out[#out + 1] = string.format(
+                '\\u%04x\\u%04x', 0xD800 + math.floor(cp / 0x400),
+                0xDC00 + cp % 0x400)
+        end
+    end
+    return '"' .. table.concat(out) .. '"'
+end
+"""
+
+# KEYS: free list, free set, in-use set, reason hash, owner tag set
+# ARGV: number of tags, reason, JSON-encoded ``[pool`` prefix
+ACQUIRE_TAGS_LUA = JSON_STRING_LUA + """
+local tags = {}
+for i = 1, tonumber(ARGV[1]) do
+    local tag = redis.call('LPOP', KEYS[1])
+    if not tag then
+        break
+    end
+    redis.call('SMOVE', KEYS[2], KEYS[3], tag)
+    redis.call('HSET', KEYS[4], tag, ARGV[2])
+    redis.call('SADD', KEYS[5], ARGV[3] .. ', ' .. json_string(tag) .. ']')
+    tags[#tags + 1] = tag
+end
+return tags
+"""
+
+# KEYS: free list, free set, in-use set, reason hash, owner tag set
+# ARGV: reason, then a tag and its owner tag set member for each tag
+ACQUIRE_SPECIFIC_TAGS_LUA = """
+local tags = {}
+for i = 2, #ARGV, 2 do
+    local tag = ARGV[i]
+    if redis.call('LREM', KEYS[1], 1, tag) == 1 then
+        redis.call('SMOVE', KEYS[2], KEYS[3], tag)
+        redis.call('HSET', KEYS[4], tag, ARGV[1])
+        redis.call('SADD', KEYS[5], ARGV[i + 1])
+        tags[#tags + 1] = tag
+    end
+end
+return tags
+"""
+
+# KEYS: free list, free set, in-use set, reason hash, unowned tag set,
+#       owner tag set prefix
+# ARGV: a tag and its owner tag set member for each tag
+RELEASE_TAGS_LUA = """
+local tags = {}
+for i = 1, #ARGV, 2 do
+    local tag = ARGV[i]
+    if redis.call('SMOVE', KEYS[3], KEYS[2], tag) == 1 then
+        redis.call('RPUSH', KEYS[1], tag)
+        local reason = redis.call('HGET', KEYS[4], tag)
+        if reason then
+            local owner = cjson.decode(reason)['owner']
+            local owner_key = KEYS[5]
+            if type(owner) == 'string' then
+                owner_key = KEYS[6] .. owner .. ':tags'
+            end
+            redis.call('SREM', owner_key, ARGV[i + 1])
+        end
+        tags[#tags + 1] = tag
+    end
+end
+return tags
+"""
+
+# KEYS: free list, free set, in-use set, pool list
+# ARGV: pool, then the tags to declare
+DECLARE_TAGS_LUA = """
+redis.call('SADD', KEYS[4], ARGV[1])
+local added = 0
+for i = 2, #ARGV do
+    local tag = ARGV[i]
+    if redis.call('SISMEMBER', KEYS[2], tag) == 0 and
+            redis.call('SISMEMBER', KEYS[3], tag) == 0 then
+        redis.call('SADD', KEYS[2], tag)
+        redis.call('RPUSH', KEYS[1], tag)
+        added = added + 1
+    end
+end
+return added
+"""
+
+
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
@@ -29,6 +161,9 @@ class TagpoolManager(object):
         self.redis = redis
         self.manager = redis  # TODO: This is a bit of a hack to make the
                               #       the calls_manager decorator work
+        # If this is False, each operation is made up of several separate
+        # Redis commands instead of a single script.
+        self.use_scripts = redis.supports_scripting()
 
     def _encode(self, unicode_text):
         return unicode_text.encode(self.encoding)
@@ -38,31 +173,75 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def acquire_tag(self, pool, owner=None, reason=None):
-        local_tag = yield self._acquire_tag(pool, owner, reason)
-        returnValue((pool, local_tag) if local_tag is not None else None)
+        tags = yield self.acquire_tags(pool, 1, owner, reason)
+        returnValue(tags[0] if tags else None)
+
+    @Manager.calls_manager
+    def acquire_tags(self, pool, count, owner=None, reason=None):
+        """Acquire up to `count` free tags from a pool.
+
+        :returns:
+            A list of the tags acquired, which is shorter than `count` if
+            there weren't enough free tags.
+        """
+        if self.use_scripts:
+            local_tags = yield self._acquire_tags_script(
+                pool, count, owner, reason)
+        else:
+            local_tags = []
+            for _ in range(count):
+                acquired = yield self._acquire_tag(pool, owner, reason)
+                if acquired is None:
+                    break
+                local_tags.append(acquired)
+        returnValue([(pool, local_tag) for local_tag in local_tags])
 
     @Manager.calls_manager
     def acquire_specific_tag(self, tag, owner=None, reason=None):
-        pool, local_tag = tag
-        acquired = yield self._acquire_specific_tag(pool, local_tag,
-                                                    owner, reason)
-        if acquired:
-            returnValue(tag)
-        returnValue(None)
+        tags = yield self.acquire_specific_tags([tag], owner, reason)
+        returnValue(tags[0] if tags else None)
+
+    @Manager.calls_manager
+    def acquire_specific_tags(self, tags, owner=None, reason=None):
+        """Acquire each of the given tags that is free.
+
+        :returns:
+            A list of the tags acquired.
+        """
+        acquired = []
+        for pool, local_tags in self._group_by_pool(tags):
+            if self.use_scripts:
+                local_tags = yield self._acquire_specific_tags_script(
+                    pool, local_tags, owner, reason)
+            else:
+                local_tags = yield self._acquire_specific_tags(
+                    pool, local_tags, owner, reason)
+            acquired.extend((pool, local_tag) for local_tag in local_tags)
+        returnValue(acquired)
 
     @Manager.calls_manager
     def release_tag(self, tag):
-        pool, local_tag = tag
-        yield self._release_tag(pool, local_tag)
+        yield self.release_tags([tag])
+
+    @Manager.calls_manager
+    def release_tags(self, tags):
+        """Release the given tags. Tags that aren't in use are ignored.
+        """
+        for pool, local_tags in self._group_by_pool(tags):
+            if self.use_scripts:
+                yield self._release_tags_script(pool, local_tags)
+            else:
+                for local_tag in local_tags:
+                    yield self._release_tag(pool, local_tag)
 
     @Manager.calls_manager
     def declare_tags(self, tags):
-        pools = {}
-        for pool, local_tag in tags:
-            pools.setdefault(pool, []).append(local_tag)
-        for pool, local_tags in pools.items():
-            yield self._register_pool(pool)
-            yield self._declare_tags(pool, local_tags)
+        for pool, local_tags in self._group_by_pool(tags):
+            if self.use_scripts:
+                yield self._declare_tags_script(pool, local_tags)
+            else:
+                yield self._register_pool(pool)
+                yield self._declare_tags(pool, local_tags)
 
     @Manager.calls_manager
     def get_metadata(self, pool):
@@ -135,6 +314,62 @@ class TagpoolManager(object):
         owned_tags = yield self.redis.smembers(owner_tag_list_key)
         returnValue([json.loads(raw_tag) for raw_tag in owned_tags])
 
+    def _group_by_pool(self, tags):
+        pools = {}
+        for pool, local_tag in tags:
+            pools.setdefault(pool, []).append(local_tag)
+        return pools.items()
+
+    def _owner_tag_member(self, pool, local_tag):
+        return json.dumps([pool, local_tag])
+
+    def _reason_json(self, owner, reason):
+        if reason is None:
+            reason = {}
+        reason['timestamp'] = time.time()
+        reason['owner'] = owner
+        return json.dumps(reason)
+
+    @Manager.calls_manager
+    def _acquire_tags_script(self, pool, count, owner, reason):
+        keys = list(self._tag_pool_keys(pool)) + [
+            self._tag_pool_reason_key(pool), self._owner_tag_list_key(owner)]
+        # The script appends the JSON-encoded tag and a closing bracket.
+        member_prefix = json.dumps([pool])[:-1]
+        local_tags = yield self.redis.eval(
+            ACQUIRE_TAGS_LUA, keys,
+            [count, self._reason_json(owner, reason), member_prefix])
+        returnValue([self._decode(local_tag) for local_tag in local_tags])
+
+    @Manager.calls_manager
+    def _acquire_specific_tags_script(self, pool, local_tags, owner, reason):
+        keys = list(self._tag_pool_keys(pool)) + [
+            self._tag_pool_reason_key(pool), self._owner_tag_list_key(owner)]
+        args = [self._reason_json(owner, reason)]
+        for local_tag in local_tags:
+            args.extend([self._encode(local_tag),
+                         self._owner_tag_member(pool, local_tag)])
+        acquired = yield self.redis.eval(ACQUIRE_SPECIFIC_TAGS_LUA, keys, args)
+        returnValue([self._decode(local_tag) for local_tag in acquired])
+
+    @Manager.calls_manager
+    def _release_tags_script(self, pool, local_tags):
+        keys = list(self._tag_pool_keys(pool)) + [
+            self._tag_pool_reason_key(pool), self._owner_tag_list_key(None),
+            self._owner_tag_list_key_prefix()]
+        args = []
+        for local_tag in local_tags:
+            args.extend([self._encode(local_tag),
+                         self._owner_tag_member(pool, local_tag)])
+        yield self.redis.eval(RELEASE_TAGS_LUA, keys, args)
+
+    @Manager.calls_manager
+    def _declare_tags_script(self, pool, local_tags):
+        keys = list(self._tag_pool_keys(pool)) + [self._pool_list_key()]
+        new_tags = sorted(set(self._encode(tag) for tag in local_tags))
+        yield self.redis.eval(
+            DECLARE_TAGS_LUA, keys, [self._encode(pool)] + new_tags)
+
     def _pool_list_key(self):
         return ":".join(["tagpools", "list"])
 
@@ -180,6 +415,16 @@ class TagpoolManager(object):
             yield self._store_reason(pool, local_tag, owner, reason)
         returnValue(moved)
 
+    @Manager.calls_manager
+    def _acquire_specific_tags(self, pool, local_tags, owner, reason):
+        acquired = []
+        for local_tag in local_tags:
+            moved = yield self._acquire_specific_tag(
+                pool, local_tag, owner, reason)
+            if moved:
+                acquired.append(local_tag)
+        returnValue(acquired)
+
     @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
         local_tag = self._encode(local_tag)
@@ -209,17 +454,21 @@ class TagpoolManager(object):
         owner = self._encode(owner)
         return ":".join(["tagpools", "owners", owner, "tags"])
 
+    def _owner_tag_list_key_prefix(self):
+        # This is passed to the release script as a key so that it gets the
+        # manager's key prefix. The owner and ":tags" are added in the
+        # script.
+        return ":".join(["tagpools", "owners", ""])
+
     @Manager.calls_manager
     def _store_reason(self, pool, local_tag, owner, reason):
-        if reason is None:
-            reason = {}
-        reason['timestamp'] = time.time()
-        reason['owner'] = owner
         reason_hash_key = self._tag_pool_reason_key(pool)
-        yield self.redis.hset(reason_hash_key, local_tag, json.dumps(reason))
+        yield self.redis.hset(
+            reason_hash_key, local_tag, self._reason_json(owner, reason))
         owner_tag_list_key = self._owner_tag_list_key(owner)
         yield self.redis.sadd(owner_tag_list_key,
-                              json.dumps([pool, self._decode(local_tag)]))
+                              self._owner_tag_member(
+                                  pool, self._decode(local_tag)))
 
     @Manager.calls_manager
     def _remove_reason(self, pool, local_tag):
@@ -230,4 +479,5 @@ class TagpoolManager(object):
             owner = reason.get('owner')
             owner_tag_list_key = self._owner_tag_list_key(owner)
             self.redis.srem(owner_tag_list_key,
-                            json.dumps([pool, self._decode(local_tag)]))
+                            self._owner_tag_member(
+                                pool, self._decode(local_tag)))
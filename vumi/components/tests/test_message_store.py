@@ -1156,6 +1156,43 @@ class TestMessageStore(TestMessageStoreBase):
 
         self.assertEqual(outbound_stats_2, {"total": 2, "unique_addresses": 2})
 
+    @inlineCallbacks
+    def test_batch_stats_approximate(self):
+        """
+        batch_inbound_stats and batch_outbound_stats return counts from the
+        cache if approximate stats are requested and the batch uses unique
+        address counters.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+        # Addresses seen before the switch aren't counted.
+        yield self.create_inbound_messages(batch_id, 2, from_addr=u'00002')
+        yield self.store.cache.switch_to_unique_address_counters(batch_id)
+
+        yield self.create_inbound_messages(batch_id, 5, from_addr=u'00005')
+        yield self.create_inbound_messages(batch_id, 3, from_addr=u'00003')
+        yield self.create_outbound_messages(batch_id, 4, to_addr=u'00004')
+
+        inbound_stats = yield self.store.batch_inbound_stats(
+            batch_id, approximate=True)
+        self.assertEqual(inbound_stats, {"total": 10, "unique_addresses": 2})
+        outbound_stats = yield self.store.batch_outbound_stats(
+            batch_id, approximate=True)
+        self.assertEqual(outbound_stats, {"total": 4, "unique_addresses": 1})
+
+    @inlineCallbacks
+    def test_batch_stats_approximate_fallback(self):
+        """
+        batch_inbound_stats returns exact counts if approximate stats are
+        requested but the batch doesn't use unique address counters.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+        yield self.create_inbound_messages(batch_id, 5, from_addr=u'00005')
+        yield self.create_inbound_messages(batch_id, 3, from_addr=u'00003')
+
+        inbound_stats = yield self.store.batch_inbound_stats(
+            batch_id, approximate=True)
+        self.assertEqual(inbound_stats, {"total": 8, "unique_addresses": 2})
+
 
 class TestMessageStoreCache(TestMessageStoreBase):
 
@@ -1279,6 +1316,9 @@ class TestMessageStoreCache(TestMessageStoreBase):
         start_timestamp = format_vumi_date(inbound_messages[1]["timestamp"])
 
         yield self.store.reconcile_cache(batch_id, start_timestamp)
+        [warning] = [w for w in self.flushWarnings()
+                     if 'start_timestamp' in w['message']]
+        self.assertEqual(warning['category'], DeprecationWarning)
 
         inbound_count = yield cache.count_inbound_message_keys(batch_id)
         self.assertEqual(inbound_count, 10)
@@ -1330,6 +1370,93 @@ class TestMessageStoreCache(TestMessageStoreBase):
         events_zcard = yield cache.redis.zcard(cache.event_key(batch_id))
         self.assertEqual(events_zcard, 10)
 
+    @inlineCallbacks
+    def test_reconcile_cache_progress(self):
+        cache = self.store.cache
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+
+        # Store via message_store
+        yield self.create_inbound_messages(batch_id, 3)
+        outbound_messages = yield self.create_outbound_messages(batch_id, 5)
+        for msg in outbound_messages:
+            ack = self.msg_helper.make_ack(msg)
+            yield self.store.add_event(ack)
+
+        yield self.clear_cache(self.store)
+        progress = []
+        self.patch(self.store, 'DEFAULT_MAX_RESULTS', 2)
+        result = yield self.store.reconcile_cache(
+            batch_id, progress_callback=progress.append)
+
+        self.assertEqual(
+            [(p['direction'], p['outbound'], p['inbound'], p['event'])
+             for p in progress], [
+                ('outbound', 2, 0, 2),
+                ('outbound', 4, 0, 4),
+                ('outbound', 5, 0, 5),
+                ('inbound', 5, 2, 5),
+                ('inbound', 5, 3, 5),
+            ])
+        self.assertEqual(result, dict(progress[-1]))
+        self.assertEqual((yield self.store.reconcile_progress(batch_id)), None)
+        self.assertEqual(
+            (yield cache.count_outbound_message_keys(batch_id)), 5)
+        self.assertEqual((yield cache.count_inbound_message_keys(batch_id)), 3)
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['sent'], 5)
+        self.assertEqual(batch_status['ack'], 5)
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume(self):
+        cache = self.store.cache
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+
+        # Store via message_store
+        yield self.create_inbound_messages(batch_id, 3)
+        outbound_messages = yield self.create_outbound_messages(batch_id, 5)
+        for msg in outbound_messages:
+            ack = self.msg_helper.make_ack(msg)
+            yield self.store.add_event(ack)
+
+        yield self.clear_cache(self.store)
+        self.patch(self.store, 'DEFAULT_MAX_RESULTS', 2)
+
+        def interrupt(progress):
+            if progress['outbound'] == 4:
+                raise Exception("Interrupted")
+
+        d = self.store.reconcile_cache(
+            batch_id, progress_callback=interrupt)
+        yield self.assertFailure(d, Exception)
+        checkpoint = yield self.store.reconcile_progress(batch_id)
+        self.assertEqual(checkpoint['direction'], 'outbound')
+        self.assertEqual(checkpoint['outbound'], 4)
+        self.assertNotEqual(checkpoint['continuation'], None)
+
+        yield self.store.reconcile_cache(batch_id, resume=True)
+        self.assertEqual((yield self.store.reconcile_progress(batch_id)), None)
+        self.assertFalse(
+            (yield self.store.needs_reconciliation(batch_id, delta=0)))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['sent'], 5)
+        self.assertEqual(batch_status['ack'], 5)
+        self.assertEqual((yield cache.count_event_keys(batch_id)), 5)
+
+    @inlineCallbacks
+    def test_get_event_keys_with_statuses(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        ack = self.msg_helper.make_ack(msg)
+        dr = self.msg_helper.make_delivery_report(
+            msg, delivery_status="delivered")
+        yield self.store.add_event(ack)
+        yield self.store.add_event(dr)
+        events = yield self.store.get_event_keys_with_statuses(msg_id)
+        self.assertEqual(sorted(events), sorted([
+            (ack['event_id'], format_vumi_date(ack['timestamp']), 'ack'),
+            (dr['event_id'], format_vumi_date(dr['timestamp']),
+             'delivery_report.delivered'),
+        ]))
+
     @inlineCallbacks
     def test_find_inbound_keys_matching(self):
         batch_id = yield self.store.batch_start([("pool", "tag")])
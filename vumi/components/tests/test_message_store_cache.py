@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from vumi.components.message_store_cache import MessageStoreCacheException
 from vumi.tests.helpers import (
     VumiTestCase, MessageHelper, PersistenceHelper, import_skip,
 )
@@ -178,6 +179,120 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
         # self.assertEqual(count, 10)
         self.assertEqual(count, 0)
 
+    @inlineCallbacks
+    def test_count_addrs_with_unique_address_counters(self):
+        yield self.cache.switch_to_unique_address_counters(self.batch_id)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_outbound_message, count=4)
+        # Addresses we've already seen aren't counted again.
+        yield self.add_messages(
+            self.batch_id, self.cache.add_outbound_message, count=6)
+        self.assertEqual(
+            (yield self.cache.count_from_addrs(self.batch_id)), 10)
+        self.assertEqual(
+            (yield self.cache.count_to_addrs(self.batch_id)), 6)
+
+    @inlineCallbacks
+    def test_uses_unique_address_counters_remembered(self):
+        now = [1400000000]
+        self.patch(self.cache, '_now', lambda: now[0])
+        other_cache = type(self.cache)(self.cache.redis)
+        self.assertFalse(
+            (yield self.cache.uses_unique_address_counters(self.batch_id)))
+        yield other_cache.switch_to_unique_address_counters(self.batch_id)
+        self.assertTrue(
+            (yield other_cache.uses_unique_address_counters(self.batch_id)))
+
+        # We only check again once our answer is old enough.
+        exists = self.cache.redis.exists
+        self.patch(self.cache.redis, 'exists', None)
+        self.assertFalse(
+            (yield self.cache.uses_unique_address_counters(self.batch_id)))
+        self.patch(self.cache.redis, 'exists', exists)
+        now[0] += self.cache.UNIQUE_ADDR_FLAG_TTL + 1
+        self.assertTrue(
+            (yield self.cache.uses_unique_address_counters(self.batch_id)))
+
+    @inlineCallbacks
+    def test_switch_to_unique_address_counters_unsupported(self):
+        def pfadd(key, *values):
+            raise Exception("ERR unknown command 'PFADD'")
+
+        self.patch(self.cache.redis, 'pfadd', pfadd)
+        err = yield self.assertFailure(
+            self.cache.switch_to_unique_address_counters(self.batch_id),
+            MessageStoreCacheException)
+        self.assertTrue("unknown command 'PFADD'" in str(err))
+        self.assertFalse(
+            (yield self.cache.uses_unique_address_counters(self.batch_id)))
+
+    @inlineCallbacks
+    def test_count_addrs_in_range(self):
+        yield self.cache.batch_start(
+            self.batch_id, count_unique_addresses=True)
+        self.assertTrue(
+            (yield self.cache.uses_unique_address_counters(self.batch_id)))
+        now = datetime.utcnow().replace(minute=0, second=30)
+        timestamp = self.cache.get_timestamp(now)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message, now=now, count=5)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message,
+            now=now - timedelta(hours=2), count=3)
+
+        self.assertEqual((yield self.cache.count_from_addrs(
+            self.batch_id, timestamp - 60, timestamp)), 5)
+        self.assertEqual((yield self.cache.count_from_addrs(
+            self.batch_id, timestamp - 7200, timestamp - 3600)), 3)
+        self.assertEqual((yield self.cache.count_from_addrs(
+            self.batch_id, start=timestamp - 7200)), 5)
+        self.assertEqual((yield self.cache.count_from_addrs(
+            self.batch_id, end=timestamp - 3600)), 3)
+        self.assertEqual((yield self.cache.count_from_addrs(
+            self.batch_id, timestamp, timestamp - 7200)), 0)
+
+    @inlineCallbacks
+    def test_get_approximate_stats(self):
+        yield self.cache.switch_to_unique_address_counters(self.batch_id)
+        now = datetime.utcnow()
+        timestamp = self.cache.get_timestamp(now)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message, now=now, count=5)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message,
+            now=now - timedelta(days=10), count=3)
+        yield self.add_messages(
+            self.batch_id, self.cache.add_outbound_message, now=now, count=2)
+
+        self.assertEqual(
+            (yield self.cache.get_approximate_stats(
+                self.batch_id, 'inbound')),
+            {'total': 8, 'unique_addresses': 5})
+        self.assertEqual(
+            (yield self.cache.get_approximate_stats(
+                self.batch_id, 'outbound')),
+            {'total': 2, 'unique_addresses': 2})
+        self.assertEqual(
+            (yield self.cache.get_approximate_stats(
+                self.batch_id, 'inbound', start=timestamp - 60)),
+            {'total': 5, 'unique_addresses': 5})
+        # We don't keep counts this old.
+        self.assertEqual(
+            (yield self.cache.get_approximate_stats(
+                self.batch_id, 'inbound', start=timestamp - 86400 * 10)),
+            None)
+
+    @inlineCallbacks
+    def test_get_approximate_stats_without_unique_address_counters(self):
+        yield self.add_messages(
+            self.batch_id, self.cache.add_inbound_message)
+        self.assertEqual(
+            (yield self.cache.get_approximate_stats(
+                self.batch_id, 'inbound')),
+            None)
+
     @inlineCallbacks
     def test_add_event(self):
         msg = self.msg_helper.make_outbound("outbound")
@@ -249,6 +364,102 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
             (yield self.cache.get_inbound_message_keys(self.batch_id)),
             ['the-same-thing'])
 
+    @inlineCallbacks
+    def test_add_outbound_message_keys(self):
+        new_entries = yield self.cache.add_outbound_message_keys(
+            self.batch_id, [('key-%s' % i, 1000 + i) for i in range(3)])
+        self.assertEqual(new_entries, 3)
+        new_entries = yield self.cache.add_outbound_message_keys(
+            self.batch_id, [('key-2', 1002), ('key-3', 1003)])
+        self.assertEqual(new_entries, 1)
+        self.assertEqual(
+            (yield self.cache.get_outbound_message_keys(self.batch_id)),
+            ['key-3', 'key-2', 'key-1', 'key-0'])
+        self.assertEqual(
+            (yield self.cache.count_outbound_message_keys(self.batch_id)), 4)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['sent'], 4)
+
+    @inlineCallbacks
+    def test_add_inbound_message_keys(self):
+        new_entries = yield self.cache.add_inbound_message_keys(
+            self.batch_id, [('key-%s' % i, 1000 + i) for i in range(3)])
+        self.assertEqual(new_entries, 3)
+        new_entries = yield self.cache.add_inbound_message_keys(
+            self.batch_id, [('key-2', 1002), ('key-3', 1003)])
+        self.assertEqual(new_entries, 1)
+        self.assertEqual(
+            (yield self.cache.get_inbound_message_keys(self.batch_id)),
+            ['key-3', 'key-2', 'key-1', 'key-0'])
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(self.batch_id)), 4)
+
+    @inlineCallbacks
+    def test_add_event_keys_with_statuses(self):
+        new_entries = yield self.cache.add_event_keys_with_statuses(
+            self.batch_id, [
+                ('ack-1', 1000, 'ack'),
+                ('dr-1', 1001, 'delivery_report.delivered'),
+                ('ack-2', 1002, 'ack'),
+            ])
+        self.assertEqual(new_entries, 3)
+        # Events that are already in the cache aren't counted again.
+        new_entries = yield self.cache.add_event_keys_with_statuses(
+            self.batch_id, [
+                ('ack-2', 1002, 'ack'),
+                ('nack-3', 1003, 'nack'),
+            ])
+        self.assertEqual(new_entries, 1)
+        self.assertEqual((yield self.cache.count_event_keys(self.batch_id)), 4)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status, {
+            'delivery_report': 1,
+            'delivery_report.delivered': 1,
+            'delivery_report.failed': 0,
+            'delivery_report.pending': 0,
+            'ack': 2,
+            'nack': 1,
+            'sent': 0,
+        })
+
+    @inlineCallbacks
+    def test_recon_checkpoint(self):
+        self.assertEqual(
+            (yield self.cache.get_recon_checkpoint(self.batch_id)), None)
+        yield self.cache.set_recon_checkpoint(self.batch_id, {
+            'direction': 'outbound',
+            'continuation': None,
+            'outbound': 0,
+            'inbound': 0,
+            'event': 0,
+        })
+        self.assertEqual(
+            (yield self.cache.get_recon_checkpoint(self.batch_id)), {
+                'direction': 'outbound',
+                'continuation': None,
+                'outbound': 0,
+                'inbound': 0,
+                'event': 0,
+            })
+        yield self.cache.set_recon_checkpoint(self.batch_id, {
+            'direction': 'inbound',
+            'continuation': 'abc',
+            'outbound': 10,
+            'inbound': 5,
+            'event': 20,
+        })
+        self.assertEqual(
+            (yield self.cache.get_recon_checkpoint(self.batch_id)), {
+                'direction': 'inbound',
+                'continuation': 'abc',
+                'outbound': 10,
+                'inbound': 5,
+                'event': 20,
+            })
+        yield self.cache.clear_recon_checkpoint(self.batch_id)
+        self.assertEqual(
+            (yield self.cache.get_recon_checkpoint(self.batch_id)), None)
+
     @inlineCallbacks
     def test_clear_batch(self):
         msg_in = self.msg_helper.make_inbound("inbound")
@@ -336,6 +547,221 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
             (yield self.cache.count_outbound_throughput(
                 self.batch_id, sample_time=10)), 2)
 
+    @inlineCallbacks
+    def test_count_throughput_after_truncation(self):
+        self.patch(self.cache, 'TRUNCATE_MESSAGE_KEY_COUNT_AT', 3)
+        now = datetime.now()
+        for i in range(10):
+            msg_in = self.msg_helper.make_inbound("inbound")
+            msg_in['timestamp'] = now - timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+            msg_out = self.msg_helper.make_outbound("outbound")
+            msg_out['timestamp'] = now - timedelta(seconds=i * 10)
+            yield self.cache.add_outbound_message(self.batch_id, msg_out)
+
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(self.batch_id)), 10)
+        self.assertEqual(
+            (yield self.cache.count_outbound_throughput(self.batch_id)), 10)
+        self.assertEqual(
+            (yield self.cache.count_outbound_throughput(
+                self.batch_id, sample_time=35)), 4)
+
+    @inlineCallbacks
+    def test_count_throughput_without_time_series(self):
+        now = datetime.now()
+        for i in range(10):
+            msg_in = self.msg_helper.make_inbound("inbound")
+            msg_in['timestamp'] = now - timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message_key(
+                self.batch_id, msg_in['message_id'],
+                self.cache.get_timestamp(msg_in['timestamp']))
+
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(self.batch_id)), 10)
+        self.assertEqual(
+            (yield self.cache.count_inbound_throughput(
+                self.batch_id, sample_time=10)), 2)
+
+    @inlineCallbacks
+    def test_time_series(self):
+        self.patch(self.cache, 'SERIES_RESOLUTIONS', [(1, 100), (60, 600)])
+        start = 1400000000
+        for i in range(10):
+            msg_in = self.msg_helper.make_inbound("inbound")
+            msg_in['timestamp'] = datetime.fromtimestamp(start + i * 25)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+        # Duplicates aren't counted.
+        yield self.cache.add_inbound_message(self.batch_id, msg_in)
+
+        self.assertEqual(
+            (yield self.cache.count_time_series(
+                self.batch_id, 'inbound', start, start + 1000)), 10)
+        self.assertEqual(
+            (yield self.cache.count_time_series(
+                self.batch_id, 'inbound', start + 25, start + 75)), 3)
+        self.assertEqual(
+            (yield self.cache.get_time_series(
+                self.batch_id, 'inbound', start, start + 299,
+                bucket_size=60)), [
+                (start - 20, 2),
+                (start + 40, 2),
+                (start + 100, 3),
+                (start + 160, 2),
+                (start + 220, 1),
+                (start + 280, 0),
+            ])
+        self.assertEqual(
+            (yield self.cache.get_time_series(
+                self.batch_id, 'outbound', start, start + 119,
+                bucket_size=60)), [
+                (start - 20, 0),
+                (start + 40, 0),
+                (start + 100, 0),
+            ])
+
+    @inlineCallbacks
+    def test_event_time_series(self):
+        msg = self.msg_helper.make_outbound("outbound")
+        yield self.cache.add_outbound_message(self.batch_id, msg)
+        ack = self.msg_helper.make_ack(msg)
+        delivery = self.msg_helper.make_delivery_report(msg)
+        yield self.cache.add_event(self.batch_id, ack)
+        yield self.cache.add_event(self.batch_id, delivery)
+        yield self.cache.add_event(self.batch_id, delivery)
+
+        timestamp = self.cache.get_timestamp(msg['timestamp'])
+        counts = {}
+        for series in ['outbound', 'ack', 'nack', 'delivery_report',
+                       'delivery_report.delivered']:
+            counts[series] = yield self.cache.count_time_series(
+                self.batch_id, series, timestamp - 60, timestamp + 60)
+        self.assertEqual(counts, {
+            'outbound': 1,
+            'ack': 1,
+            'nack': 0,
+            'delivery_report': 1,
+            'delivery_report.delivered': 1,
+        })
+
+    @inlineCallbacks
+    def test_time_series_rollups(self):
+        start = 1400000000 - 1400000000 % 3600
+        yield self.cache.increment_time_series(
+            self.batch_id, 'inbound', start - 1)
+        for offset in [0, 59, 60, 3599, 3600, 3660, 7199, 7200, 7201]:
+            yield self.cache.increment_time_series(
+                self.batch_id, 'inbound', start + offset)
+
+        # Whole hours and minutes are read from the coarser counts.
+        self.assertEqual(self.cache._series_ranges(start - 1, start + 7202), [
+            (1, start - 1, start - 1),
+            (1, start + 7200, start + 7201),
+            (3600, start, start + 3600),
+        ])
+        self.assertEqual(self.cache._series_ranges(start + 59, start + 3661), [
+            (1, start + 59, start + 59),
+            (1, start + 3660, start + 3660),
+            (60, start + 60, start + 3540),
+            (60, start + 3600, start + 3600),
+        ])
+        self.assertEqual(
+            (yield self.cache.count_time_series(
+                self.batch_id, 'inbound', start - 1, start + 7201)), 10)
+        self.assertEqual(
+            (yield self.cache.count_time_series(
+                self.batch_id, 'inbound', start + 59, start + 3660)), 5)
+        self.assertEqual(
+            (yield self.cache.get_time_series(
+                self.batch_id, 'inbound', start - 1, start + 7201,
+                bucket_size=3600)), [
+                (start - 3600, 1),
+                (start, 4),
+                (start + 3600, 3),
+                (start + 7200, 2),
+            ])
+        self.assertEqual(
+            (yield self.cache.get_time_series(
+                self.batch_id, 'inbound', start + 3600, start + 3659,
+                bucket_size=30)), [
+                (start + 3600, 1),
+                (start + 3630, 0),
+            ])
+
+    @inlineCallbacks
+    def test_time_series_cleared_with_batch(self):
+        timestamp = self.cache.get_timestamp(datetime.now())
+        yield self.cache.increment_time_series(
+            self.batch_id, 'inbound', timestamp)
+        yield self.cache.increment_time_series(
+            'other-batch', 'inbound', timestamp)
+        yield self.cache.clear_batch(self.batch_id)
+        self.assertEqual(
+            (yield self.cache.count_time_series(
+                self.batch_id, 'inbound', timestamp - 60, timestamp)), 0)
+        self.assertEqual(
+            (yield self.cache.count_time_series(
+                'other-batch', 'inbound', timestamp - 60, timestamp)), 1)
+        self.assertEqual(
+            (yield self.cache.redis.keys(
+                self.cache.series_key(self.batch_id, '*'))), [])
+
+    @inlineCallbacks
+    def test_time_series_slabs_expire(self):
+        self.patch(self.cache, '_now', lambda: 1400000000)
+        timestamp = 1400000000
+        yield self.cache.increment_time_series(
+            self.batch_id, 'inbound', timestamp)
+        yield self.cache.increment_time_series(
+            self.batch_id, 'inbound', timestamp)
+        index_key = self.cache.series_key(self.batch_id)
+        slab_keys = yield self.cache.redis.zrange(index_key, 0, -1)
+        self.assertEqual(len(slab_keys), 3)
+        for slab_key in slab_keys:
+            ttl = yield self.cache.redis.ttl(slab_key)
+            self.assertTrue(0 < ttl <= self.cache.SERIES_TTL)
+
+        # Slabs that have expired are pruned from the index when a new hour
+        # starts.
+        self.patch(self.cache, '_now',
+                   lambda: 1400000000 + self.cache.SERIES_TTL + 1)
+        yield self.cache.increment_time_series(
+            self.batch_id, 'inbound', timestamp + 3600)
+        self.assertEqual(
+            len((yield self.cache.redis.zrange(index_key, 0, -1))), 3)
+
+    @inlineCallbacks
+    def test_time_series_rebuilt_from_keys(self):
+        now = self.cache._now()
+        yield self.cache.add_outbound_message_keys(self.batch_id, [
+            ('out1', now - 10), ('out2', now - 20),
+            ('expired', now - self.cache.SERIES_TTL - 1),
+        ])
+        yield self.cache.add_inbound_message_keys(self.batch_id, [
+            ('in1', now - 10),
+        ])
+        yield self.cache.add_event_keys_with_statuses(self.batch_id, [
+            ('ack1', now - 5, 'ack'),
+            ('dr1', now - 5, 'delivery_report.delivered'),
+        ])
+        # Events that are already in the cache aren't counted again.
+        yield self.cache.add_event_keys_with_statuses(self.batch_id, [
+            ('ack1', now - 5, 'ack'),
+        ])
+
+        counts = {}
+        for series in ['outbound', 'inbound', 'ack', 'delivery_report',
+                       'delivery_report.delivered']:
+            counts[series] = yield self.cache.count_time_series(
+                self.batch_id, series, now - self.cache.SERIES_TTL - 60, now)
+        self.assertEqual(counts, {
+            'outbound': 2,
+            'inbound': 1,
+            'ack': 1,
+            'delivery_report': 1,
+            'delivery_report.delivered': 1,
+        })
+
     def test_get_query_token(self):
         cache = self.store.cache
         # different ordering in the dict should result in the same token.
@@ -376,6 +802,59 @@ class TestMessageStoreCache(MessageStoreCacheTestCase):
             (yield self.cache.count_query_results(self.batch_id, token)),
             10)
 
+    @inlineCallbacks
+    def test_store_query_results_in_chunks(self):
+        self.patch(self.cache, 'SEARCH_RESULT_CHUNK_SIZE', 3)
+        now = datetime.now()
+        message_ids = []
+        for i in range(10):
+            msg_in = self.msg_helper.make_inbound('hello-%s' % (i,))
+            msg_in['timestamp'] = now + timedelta(seconds=i * 10)
+            yield self.cache.add_inbound_message(self.batch_id, msg_in)
+            message_ids.append(msg_in['message_id'])
+
+        token = yield self.cache.start_query(self.batch_id, 'inbound', [
+            {'key': 'msg.content', 'pattern': 'hello', 'flags': ''}])
+
+        progress = []
+        orig_hincrby = self.cache.redis.hincrby
+
+        def hincrby(key, field, amount=1):
+            d = orig_hincrby(key, field, amount)
+            d.addCallback(lambda r: self.cache.get_query_progress(
+                self.batch_id, token))
+            d.addCallback(progress.append)
+            return d
+
+        self.patch(self.cache.redis, 'hincrby', hincrby)
+        yield self.cache.store_query_results(
+            self.batch_id, token, message_ids, 'inbound', 120)
+        self.assertEqual(progress, [
+            {'total': 10, 'stored': 3},
+            {'total': 10, 'stored': 6},
+            {'total': 10, 'stored': 9},
+            {'total': 10, 'stored': 10},
+        ])
+        self.assertEqual(
+            (yield self.cache.get_query_progress(self.batch_id, token)), None)
+        self.assertEqual(
+            (yield self.cache.get_query_results(self.batch_id, token)),
+            list(reversed(message_ids)))
+
+    @inlineCallbacks
+    def test_store_query_results_missing_timestamps(self):
+        msg_in = self.msg_helper.make_inbound('hello')
+        yield self.cache.add_inbound_message(self.batch_id, msg_in)
+
+        token = yield self.cache.start_query(self.batch_id, 'inbound', [
+            {'key': 'msg.content', 'pattern': 'hello', 'flags': ''}])
+        yield self.cache.store_query_results(
+            self.batch_id, token, ['truncated', msg_in['message_id']],
+            'inbound', 120)
+        self.assertEqual(
+            (yield self.cache.get_query_results(self.batch_id, token)),
+            [msg_in['message_id'], 'truncated'])
+
 
 class TestMessageStoreCacheWithCounters(MessageStoreCacheTestCase):
 
@@ -7,6 +7,7 @@ from urllib import urlencode
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, Deferred, succeed
 from twisted.web.server import Site
+from twisted.web.test.test_web import DummyRequest
 
 from vumi.components.message_formatters import JsonFormatter
 
@@ -184,16 +185,16 @@ class TestMessageStoreResource(VumiTestCase):
         class PausingInboundResource(InboundResource):
             def __init__(self, *args, **kw):
                 InboundResource.__init__(self, *args, **kw)
-                self.pause_after = 2
+                self.pause_after = 1
                 self.pause_d = Deferred()
                 self.resume_d = Deferred()
                 self.fetched = set()
 
-            def add_fetched(self, msg):
-                self.fetched.add(msg['message_id'])
-                return msg
+            def add_fetched(self, msgs):
+                self.fetched.update(msg['message_id'] for msg in msgs)
+                return msgs
 
-            def get_message(self, message_store, message_id):
+            def get_messages(self, message_store, message_ids):
                 d = succeed(None)
                 if self.pause_after > 0:
                     self.pause_after -= 1
@@ -201,8 +202,8 @@ class TestMessageStoreResource(VumiTestCase):
                     if not self.pause_d.called:
                         self.pause_d.callback(None)
                     d.addCallback(lambda _: self.resume_d)
-                d.addCallback(lambda _: InboundResource.get_message(
-                    self, message_store, message_id))
+                d.addCallback(lambda _: InboundResource.get_messages(
+                    self, message_store, message_ids))
                 d.addCallback(self.add_fetched)
                 return d
 
@@ -211,7 +212,8 @@ class TestMessageStoreResource(VumiTestCase):
         server = yield reactor.listenTCP(0, site, interface='127.0.0.1')
         self.add_cleanup(server.loseConnection)
         addr = server.getHost()
-        url = 'http://%s:%s?concurrency=2' % (addr.host, addr.port)
+        url = 'http://%s:%s?concurrency=1&bunch_size=2' % (
+            addr.host, addr.port)
 
         resp_d = http_request_full(method='GET', url=url)
         # Wait until we've processed some messages.
@@ -430,3 +432,142 @@ class TestMessageStoreResource(VumiTestCase):
             ("%(ts)s,%(id)s,+41791234567,9292,,,føø,", msg2),
             ("%(ts)s,%(id)s,+41791234567,9292,,,føø,", msg3),
         ])
+
+
+class FakeKeysPage(object):
+    def __init__(self, pages):
+        self.keys = pages[0]
+        self.pages = pages[1:]
+        self.next_page_ds = []
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def has_next_page(self):
+        return bool(self.pages)
+
+    def next_page(self):
+        d = Deferred()
+        d.addCallback(lambda _: FakeKeysPage(self.pages))
+        self.next_page_ds.append(d)
+        return d
+
+
+class FakeExportResource(object):
+    message_store = object()
+
+    def __init__(self):
+        self.fetches = []
+
+    def get_messages(self, message_store, message_ids):
+        d = Deferred()
+        self.fetches.append((message_ids, d))
+        return d
+
+    def write_message(self, message, request):
+        request.write(message)
+
+    def finish_fetch(self, message_ids):
+        [d] = [d for keys, d in self.fetches if keys == message_ids]
+        d.callback(message_ids)
+
+
+class ProducerRequest(DummyRequest):
+    # Like a real request, DummyRequest fires the notifyFinish() deferreds
+    # when finish() is called.
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class TestMessageExporter(VumiTestCase):
+
+    def mk_exporter(self, concurrency, bunch_size):
+        from vumi.components.message_store_resource import MessageExporter
+        self.resource = FakeExportResource()
+        self.request = ProducerRequest([''])
+        return MessageExporter(
+            self.resource, self.request, concurrency, bunch_size)
+
+    def fetched_keys(self):
+        return [keys for keys, d in self.resource.fetches]
+
+    def assert_no_errors(self):
+        # Errors raised while handling a finished fetch end up on the
+        # fetch's deferred and would otherwise only be logged when it's
+        # garbage collected.
+        for keys, d in self.resource.fetches:
+            self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_window_spans_pages(self):
+        exporter = self.mk_exporter(concurrency=2, bunch_size=2)
+        page = FakeKeysPage([['a', 'b', 'c'], ['d', 'e', 'f']])
+        done = exporter.start(succeed(page))
+        self.assertEqual(self.request.producer, exporter)
+        self.assertEqual(self.fetched_keys(), [['a', 'b'], ['c']])
+        # The next page is fetched while the window is full.
+        [next_page_d] = page.next_page_ds
+        next_page_d.callback(None)
+        self.assertEqual(self.fetched_keys(), [['a', 'b'], ['c']])
+
+        self.resource.finish_fetch(['c'])
+        self.assertEqual(self.request.written, ['c'])
+        self.assertEqual(
+            self.fetched_keys(), [['a', 'b'], ['c'], ['d', 'e']])
+        self.resource.finish_fetch(['a', 'b'])
+        self.assertEqual(
+            self.fetched_keys(), [['a', 'b'], ['c'], ['d', 'e'], ['f']])
+
+        self.resource.finish_fetch(['f'])
+        self.assertNoResult(done)
+        self.resource.finish_fetch(['d', 'e'])
+        self.successResultOf(done)
+        self.assertEqual(self.request.written, ['c', 'a', 'b', 'f', 'd', 'e'])
+        self.assertEqual(self.request.finished, 1)
+        self.assertEqual(self.request.producer, None)
+        self.assert_no_errors()
+
+    def test_pause_and_resume(self):
+        exporter = self.mk_exporter(concurrency=1, bunch_size=1)
+        done = exporter.start(succeed(FakeKeysPage([['a', 'b']])))
+        exporter.pauseProducing()
+        self.resource.finish_fetch(['a'])
+        self.assertEqual(self.fetched_keys(), [['a']])
+
+        exporter.resumeProducing()
+        self.assertEqual(self.fetched_keys(), [['a'], ['b']])
+        self.resource.finish_fetch(['b'])
+        self.successResultOf(done)
+        self.assertEqual(self.request.written, ['a', 'b'])
+        self.assertEqual(self.request.finished, 1)
+        self.assert_no_errors()
+
+    def test_stop(self):
+        exporter = self.mk_exporter(concurrency=1, bunch_size=1)
+        done = exporter.start(succeed(FakeKeysPage([['a', 'b']])))
+        exporter.stopProducing()
+        self.assertNoResult(done)
+        self.resource.finish_fetch(['a'])
+        self.successResultOf(done)
+        self.assertEqual(self.fetched_keys(), [['a']])
+        self.assertEqual(self.request.written, [])
+        self.assertEqual(self.request.finished, 0)
+        self.assertEqual(self.request.producer, None)
+        self.assert_no_errors()
+
+    def test_fetch_error(self):
+        exporter = self.mk_exporter(concurrency=1, bunch_size=1)
+        done = exporter.start(succeed(FakeKeysPage([['a', 'b']])))
+        [(keys, d)] = self.resource.fetches
+        d.errback(Exception("Riak is sad."))
+        [err] = self.flushLoggedErrors(Exception)
+        self.resource.finish_fetch(['b'])
+        self.successResultOf(done)
+        self.assertEqual(self.request.written, ['b'])
+        self.assertEqual(self.request.finished, 1)
+        self.assert_no_errors()
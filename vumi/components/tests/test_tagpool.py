@@ -152,6 +152,71 @@ class TestTxTagpoolManager(VumiTestCase):
         yield self.tpm.release_tag(tag)
         self.assertEqual((yield self.tpm.acquire_tag(tag[0])), tag)
 
+    def test_use_scripts(self):
+        # Scripts aren't supported by the fake Redis, so we only test them
+        # when we have a real Redis server.
+        self.assertEqual(self.tpm.use_scripts, self.redis.supports_scripting())
+
+    @inlineCallbacks
+    def test_acquire_tags(self):
+        tags = [("poolA", "tag%d" % i) for i in range(3)]
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 2)), tags[:2])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 2)), tags[2:])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 2)), [])
+        self.assertEqual((yield self.tpm.acquire_tags("poolB", 2)), [])
+
+    @inlineCallbacks
+    def test_acquire_tags_with_owner(self):
+        tags = [(u"poöl", u"tág%d" % i) for i in range(3)]
+        yield self.tpm.declare_tags(tags)
+        acquired = yield self.tpm.acquire_tags(
+            u"poöl", 2, owner=u"mé", reason={"foo": "bar"})
+        self.assertEqual(acquired, tags[:2])
+        my_tags = yield self.tpm.owned_tags(u"mé")
+        self.assertEqual(sorted(my_tags), [list(tag) for tag in tags[:2]])
+        owner, reason = yield self.tpm.acquired_by(tags[1])
+        self.assertEqual(owner, u"mé")
+        self.assertEqual(reason["foo"], "bar")
+
+    @inlineCallbacks
+    def test_acquire_specific_tags(self):
+        tags = [("poolA", "tag1"), ("poolA", "tag2"), ("poolB", "tag3")]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_specific_tag(tags[0])
+        acquired = yield self.tpm.acquire_specific_tags(
+            tags + [("poolC", "tag4")], owner="me")
+        self.assertEqual(sorted(acquired), tags[1:])
+        my_tags = yield self.tpm.owned_tags("me")
+        self.assertEqual(sorted(my_tags), [list(tag) for tag in tags[1:]])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+        self.assertEqual((yield self.tpm.acquire_tag("poolB")), None)
+
+    @inlineCallbacks
+    def test_release_tags(self):
+        tkey = self.pool_key_generator("poolA")
+        tags = [("poolA", "tag%d" % i) for i in range(4)]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_tags("poolA", 3, owner="me")
+        yield self.tpm.release_tags([tags[2], tags[0], tags[3]])
+        redis = self.redis
+        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag3", "tag2", "tag0"])
+        self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
+                         set(["tag1"]))
+        self.assertEqual(
+            (yield self.tpm.owned_tags("me")), [["poolA", "tag1"]])
+
+    @inlineCallbacks
+    def test_release_tags_unowned(self):
+        tags = [(u"poöl", u"tág%d" % i) for i in range(2)]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_tags(u"poöl", 2)
+        self.assertEqual(len((yield self.tpm.owned_tags(None))), 2)
+        yield self.tpm.release_tags(tags)
+        self.assertEqual((yield self.tpm.owned_tags(None)), [])
+        self.assertEqual((yield self.tpm.acquire_tags(u"poöl", 3)), tags)
+
     @inlineCallbacks
     def test_metadata(self):
         mkey = self.pool_key_generator("poolA")("metadata")
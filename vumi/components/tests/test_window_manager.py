@@ -1,4 +1,4 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, succeed
 from twisted.internet.task import Clock
 
 from vumi.components.window_manager import WindowManager, WindowException
@@ -22,6 +22,11 @@ class TestWindowManager(VumiTestCase):
         yield self.wm.create_window(self.window_id)
         self.redis = self.wm.redis
 
+    def test_use_scripts(self):
+        # Scripts aren't supported by the fake Redis, so we only test them
+        # when we have a real Redis server.
+        self.assertEqual(self.wm.use_scripts, self.redis.supports_scripting())
+
     @inlineCallbacks
     def test_windows(self):
         windows = yield self.wm.get_windows()
@@ -80,6 +85,43 @@ class TestWindowManager(VumiTestCase):
         next_flight_key = yield self.wm.get_next_key(self.window_id)
         self.assertTrue(next_flight_key)
 
+    @inlineCallbacks
+    def test_get_next_keys(self):
+        for i in range(15):
+            yield self.wm.add(self.window_id, i)
+
+        flight_keys = yield self.wm.get_next_keys(self.window_id, 4)
+        self.assertEqual(len(flight_keys), 4)
+        self.assertEqual(
+            [(yield self.wm.get_data(self.window_id, key))
+             for key in flight_keys],
+            [0, 1, 2, 3])
+        yield self.assert_count_waiting(self.window_id, 11)
+        yield self.assert_in_flight(self.window_id, 4)
+
+        stats = yield self.redis.zrange(
+            self.wm.stats_key(self.window_id), 0, -1)
+        self.assertEqual(sorted(stats), sorted(flight_keys))
+
+    @inlineCallbacks
+    def test_get_next_keys_fills_window(self):
+        for i in range(15):
+            yield self.wm.add(self.window_id, i)
+        yield self.wm.get_next_key(self.window_id)
+
+        flight_keys = yield self.wm.get_next_keys(self.window_id)
+        self.assertEqual(len(flight_keys), 9)
+        yield self.assert_count_waiting(self.window_id, 5)
+        yield self.assert_in_flight(self.window_id, 10)
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+
+    @inlineCallbacks
+    def test_get_next_keys_empty_window(self):
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+        yield self.wm.add(self.window_id, 1)
+        flight_keys = yield self.wm.get_next_keys(self.window_id, 5)
+        self.assertEqual(len(flight_keys), 1)
+
     @inlineCallbacks
     def test_set_and_external_id(self):
         yield self.wm.set_external_id(self.window_id, "flight_key",
@@ -210,6 +252,85 @@ class TestWindowManager(VumiTestCase):
         self.assertEqual((yield self.wm.get_windows()), [])
         self.assertEqual(set(cleanup_callbacks), set(window_ids))
 
+    def wait_for_drain(self):
+        return self.wm._drain_d or succeed(None)
+
+    @inlineCallbacks
+    def test_monitor_drain(self):
+        key_callbacks = []
+
+        def callback(window_id, key):
+            key_callbacks.append((window_id, key))
+
+        self.wm.monitor(callback, cleanup=False, drain=True)
+        yield self.wait_for_drain()
+        self.assertEqual(key_callbacks, [])
+
+        for i in range(12):
+            yield self.wm.add(self.window_id, i)
+        yield self.wait_for_drain()
+        self.assertEqual(len(key_callbacks), 10)
+        yield self.assert_count_waiting(self.window_id, 2)
+
+        # Removing a key frees a slot, which wakes the drain.
+        yield self.wm.remove_key(self.window_id, key_callbacks[0][1])
+        yield self.wait_for_drain()
+        self.assertEqual(len(key_callbacks), 11)
+        yield self.assert_count_waiting(self.window_id, 1)
+
+    @inlineCallbacks
+    def test_monitor_drain_existing_work(self):
+        for i in range(3):
+            yield self.wm.add(self.window_id, i)
+
+        key_callbacks = []
+        cleanup_callbacks = []
+
+        @inlineCallbacks
+        def callback(window_id, key):
+            key_callbacks.append(key)
+            yield self.wm.remove_key(window_id, key)
+
+        self.wm.monitor(callback, cleanup=True,
+                        cleanup_callback=cleanup_callbacks.append, drain=True)
+        yield self.wait_for_drain()
+        self.assertEqual(len(key_callbacks), 3)
+        self.assertEqual(cleanup_callbacks, [self.window_id])
+        self.assertEqual((yield self.wm.get_windows()), [])
+
+    @inlineCallbacks
+    def test_monitor_drain_does_not_poll(self):
+        self.wm.monitor(lambda *a: None, drain=True)
+        yield self.wait_for_drain()
+        self.assertEqual(self.wm._monitor, None)
+        # Only the flight garbage collection is scheduled.
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    @inlineCallbacks
+    def test_monitor_drain_expired_flights(self):
+        self.patch(WindowManager, 'get_clocktime', lambda _: self._clocktime)
+        self._clocktime = 0
+
+        key_callbacks = []
+        self.wm.monitor(
+            lambda window_id, key: key_callbacks.append(key), cleanup=False,
+            drain=True)
+        for i in range(15):
+            yield self.wm.add(self.window_id, i)
+        yield self.wait_for_drain()
+        self.assertEqual(len(key_callbacks), 10)
+
+        self._clocktime = 10
+        yield self.wm.clear_expired_flight_keys()
+        yield self.wait_for_drain()
+        self.assertEqual(len(key_callbacks), 15)
+
+    def test_monitor_drain_already_started(self):
+        self.wm.monitor(lambda *a: None, drain=True)
+        self.assertRaises(
+            WindowException, self.wm.monitor, lambda *a: None)
+        return self.wait_for_drain()
+
 
 class TestConcurrentWindowManager(VumiTestCase):
 
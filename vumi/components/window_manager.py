@@ -7,6 +7,52 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 
 from vumi import log
+from vumi.utils import gather_results
+
+
+# The Lua scripts below each perform a window operation atomically in a
+# single round trip. They're used when the Redis manager supports scripting.
+
+# KEYS: data key, waiting list
+# ARGV: JSON-encoded data, flight key
+ADD_LUA = """
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('LPUSH', KEYS[2], ARGV[2])
+"""
+
+# KEYS: waiting list, in-flight list, flight timestamp zset
+# ARGV: window size, maximum number of keys (negative for no maximum),
+#       clock time
+GET_NEXT_KEYS_LUA = """
+local count = math.min(redis.call('LLEN', KEYS[1]),
+                       tonumber(ARGV[1]) - redis.call('LLEN', KEYS[2]))
+if tonumber(ARGV[2]) >= 0 then
+    count = math.min(count, tonumber(ARGV[2]))
+end
+local keys = {}
+for i = 1, count do
+    local key = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+    if not key then
+        break
+    end
+    redis.call('ZADD', KEYS[3], ARGV[3], key)
+    keys[#keys + 1] = key
+end
+return keys
+"""
+
+# KEYS: in-flight list, data key, flight stats key, flight timestamp zset,
+#       external id map key, internal id map key prefix
+# ARGV: flight key
+REMOVE_KEY_LUA = """
+redis.call('LREM', KEYS[1], 1, ARGV[1])
+redis.call('DEL', KEYS[2], KEYS[3])
+redis.call('ZREM', KEYS[4], ARGV[1])
+local external_id = redis.call('GET', KEYS[5])
+if external_id then
+    redis.call('DEL', KEYS[5], KEYS[6] .. external_id)
+end
+"""
 
 
 class WindowException(Exception):
@@ -25,11 +71,17 @@ class WindowManager(object):
         self.window_size = window_size
         self.flight_lifetime = flight_lifetime or (gc_interval * window_size)
         self.redis = redis
+        # If this is False, each operation is made up of several separate
+        # Redis commands instead of a single script.
+        self.use_scripts = redis.supports_scripting()
         self.clock = self.get_clock()
         self.gc = LoopingCall(self.clear_expired_flight_keys)
         self.gc.clock = self.clock
         self.gc.start(gc_interval)
         self._monitor = None
+        self._drainer = None
+        self._drain_d = None
+        self._pending_windows = set()
 
     def noop(self, *args, **kwargs):
         pass
@@ -37,6 +89,8 @@ class WindowManager(object):
     def stop(self):
         if self._monitor and self._monitor.running:
             self._monitor.stop()
+        self._drainer = None
+        self._pending_windows.clear()
 
         if self.gc.running:
             self.gc.stop()
@@ -89,39 +143,79 @@ class WindowManager(object):
     @inlineCallbacks
     def add(self, window_id, data, key=None):
         key = key or uuid.uuid4().get_hex()
-        # The redis.set() has to complete before redis.lpush(),
-        # otherwise the key can be popped from the window before the
-        # data is available.
-        yield self.redis.set(self.window_key(window_id, key),
-                             json.dumps(data))
-        yield self.redis.lpush(self.window_key(window_id), key)
+        data_key = self.window_key(window_id, key)
+        if self.use_scripts:
+            yield self.redis.eval(
+                ADD_LUA, [data_key, self.window_key(window_id)],
+                [json.dumps(data), key])
+        else:
+            # The redis.set() has to be processed before redis.lpush(),
+            # otherwise the key can be popped from the window before the
+            # data is available. Redis processes commands from a connection
+            # in the order they're sent, so we don't need to wait for the
+            # first reply before sending the second command.
+            yield gather_results([
+                self.redis.set(data_key, json.dumps(data)),
+                self.redis.lpush(self.window_key(window_id), key),
+            ])
+        self._schedule_drain(window_id)
         returnValue(key)
 
     @inlineCallbacks
     def get_next_key(self, window_id):
+        keys = yield self.get_next_keys(window_id, 1)
+        if keys:
+            returnValue(keys[0])
 
+    @inlineCallbacks
+    def get_next_keys(self, window_id, n=None):
+        """
+        Move up to ``n`` keys from the waiting list into flight, limited by
+        the room available in the window, and return them.
+
+        If ``n`` is ``None``, all the available room is filled.
+
+        With scripting this is a single atomic round trip to Redis.
+        Otherwise the commands for each step are pipelined, so this takes
+        three round trips however many keys are moved.
+        """
         window_key = self.window_key(window_id)
         inflight_key = self.flight_key(window_id)
 
-        waiting_list = yield self.count_waiting(window_id)
-        if waiting_list == 0:
-            return
-
-        flight_size = yield self.count_in_flight(window_id)
+        if self.use_scripts:
+            next_keys = yield self.redis.eval(
+                GET_NEXT_KEYS_LUA,
+                [window_key, inflight_key, self.stats_key(window_id)],
+                [self.window_size, -1 if n is None else n,
+                 self.get_clocktime()])
+            returnValue(next_keys)
+
+        waiting_list, flight_size = yield gather_results([
+            self.count_waiting(window_id),
+            self.count_in_flight(window_id),
+        ])
         room_available = self.window_size - flight_size
-
-        if room_available > 0:
-            log.debug('Window %s has space for %s' % (window_key,
-                                                        room_available))
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
-            if next_key:
-                yield self._set_timestamp(window_id, next_key)
-                returnValue(next_key)
-
-    def _set_timestamp(self, window_id, flight_key):
-        return self.redis.zadd(self.stats_key(window_id), **{
-                flight_key: self.get_clocktime(),
-        })
+        count = min(waiting_list, room_available)
+        if n is not None:
+            count = min(count, n)
+        if count <= 0:
+            returnValue([])
+
+        log.debug('Window %s has space for %s' % (window_key,
+                                                    room_available))
+        next_keys = yield gather_results([
+            self.redis.rpoplpush(window_key, inflight_key)
+            for _ in range(count)])
+        # Something else may have emptied the waiting list in the meantime.
+        next_keys = [key for key in next_keys if key]
+        if next_keys:
+            yield self._set_timestamps(window_id, next_keys)
+        returnValue(next_keys)
+
+    def _set_timestamps(self, window_id, flight_keys):
+        clock_time = self.get_clocktime()
+        return self.redis.zadd(self.stats_key(window_id), **dict(
+            (flight_key, clock_time) for flight_key in flight_keys))
 
     def _clear_timestamp(self, window_id, flight_key):
         return self.redis.zrem(self.stats_key(window_id), flight_key)
@@ -145,6 +239,8 @@ class WindowManager(object):
             expired_keys = yield self.get_expired_flight_keys(window_id)
             for key in expired_keys:
                 yield self.redis.lrem(self.flight_key(window_id), key, 1)
+            if expired_keys:
+                self._schedule_drain(window_id)
 
     @inlineCallbacks
     def get_data(self, window_id, key):
@@ -153,18 +249,33 @@ class WindowManager(object):
 
     @inlineCallbacks
     def remove_key(self, window_id, key):
-        yield self.redis.lrem(self.flight_key(window_id), key, 1)
-        yield self.redis.delete(self.window_key(window_id, key))
-        yield self.redis.delete(self.stats_key(window_id, key))
-        yield self.clear_external_id(window_id, key)
-        yield self._clear_timestamp(window_id, key)
+        if self.use_scripts:
+            yield self.redis.eval(REMOVE_KEY_LUA, [
+                self.flight_key(window_id),
+                self.window_key(window_id, key),
+                self.stats_key(window_id, key),
+                self.stats_key(window_id),
+                self.map_key(window_id, 'external', key),
+                self.map_key(window_id, 'internal', ''),
+            ], [key])
+        else:
+            yield gather_results([
+                self.redis.lrem(self.flight_key(window_id), key, 1),
+                self.redis.delete(self.window_key(window_id, key)),
+                self.redis.delete(self.stats_key(window_id, key)),
+                self.clear_external_id(window_id, key),
+                self._clear_timestamp(window_id, key),
+            ])
+        self._schedule_drain(window_id)
 
     @inlineCallbacks
     def set_external_id(self, window_id, flight_key, external_id):
-        yield self.redis.set(self.map_key(window_id, 'internal', external_id),
-            flight_key)
-        yield self.redis.set(self.map_key(window_id, 'external', flight_key),
-            external_id)
+        yield gather_results([
+            self.redis.set(
+                self.map_key(window_id, 'internal', external_id), flight_key),
+            self.redis.set(
+                self.map_key(window_id, 'external', flight_key), external_id),
+        ])
 
     def get_internal_id(self, window_id, external_id):
         return self.redis.get(self.map_key(window_id, 'internal', external_id))
@@ -174,19 +285,42 @@ class WindowManager(object):
 
     @inlineCallbacks
     def clear_external_id(self, window_id, flight_key):
-        external_id = yield self.get_external_id(window_id, flight_key)
+        # The GET is processed before the DELETE of the same key, so we can
+        # send both without waiting for the external id.
+        external_id, _ = yield gather_results([
+            self.get_external_id(window_id, flight_key),
+            self.redis.delete(self.map_key(window_id, 'external', flight_key)),
+        ])
         if external_id:
-            yield self.redis.delete(self.map_key(window_id, 'external',
-                                                 flight_key))
             yield self.redis.delete(self.map_key(window_id, 'internal',
                                                  external_id))
 
     def monitor(self, key_callback, interval=10, cleanup=True,
-                cleanup_callback=None):
-
-        if self._monitor is not None:
+                cleanup_callback=None, drain=False):
+        """
+        Pass keys that enter flight to ``key_callback``.
+
+        By default all windows are polled every ``interval`` seconds. If
+        ``drain`` is ``True``, windows are instead drained as soon as
+        :meth:`add` or :meth:`remove_key` give them work to do, and
+        ``interval`` is ignored. Keys added or removed through another
+        window manager don't wake a draining monitor, but expired flights
+        cleared by the periodic garbage collection do.
+        """
+
+        if self._monitor is not None or self._drainer is not None:
             raise WindowException('Monitor already started')
 
+        if drain:
+            self._drainer = (key_callback, cleanup, cleanup_callback)
+            # Start with a full pass to pick up any existing work.
+            d = self._monitor_windows(key_callback, cleanup, cleanup_callback)
+            d.addErrback(log.err)
+            d.addCallback(lambda _: self._drain_windows())
+            self._drain_d = d
+            d.addBoth(self._drain_done)
+            return
+
         self._monitor = LoopingCall(lambda: self._monitor_windows(
             key_callback, cleanup, cleanup_callback))
         self._monitor.clock = self.get_clock()
@@ -197,14 +331,47 @@ class WindowManager(object):
                          cleanup_callback=None):
         windows = yield self.get_windows()
         for window_id in windows:
-            key = (yield self.get_next_key(window_id))
-            while key:
+            yield self._drain_window(
+                window_id, key_callback, cleanup, cleanup_callback)
+
+    @inlineCallbacks
+    def _drain_window(self, window_id, key_callback, cleanup=True,
+                      cleanup_callback=None):
+        keys = yield self.get_next_keys(window_id)
+        while keys:
+            for key in keys:
                 yield key_callback(window_id, key)
-                key = (yield self.get_next_key(window_id))
-
-            # Remove empty windows if required
-            if cleanup and not ((yield self.count_waiting(window_id)) or
-                                (yield self.count_in_flight(window_id))):
-                if cleanup_callback:
-                    cleanup_callback(window_id)
-                yield self.remove_window(window_id)
+            keys = yield self.get_next_keys(window_id)
+
+        # Remove empty windows if required
+        if cleanup and not ((yield self.count_waiting(window_id)) or
+                            (yield self.count_in_flight(window_id))):
+            if cleanup_callback:
+                cleanup_callback(window_id)
+            yield self.remove_window(window_id)
+
+    def _schedule_drain(self, window_id):
+        if self._drainer is None:
+            return
+        self._pending_windows.add(window_id)
+        if self._drain_d is None:
+            self._drain_d = self._drain_windows()
+            self._drain_d.addBoth(self._drain_done)
+
+    def _drain_done(self, r):
+        self._drain_d = None
+        return r
+
+    @inlineCallbacks
+    def _drain_windows(self):
+        while self._drainer is not None and self._pending_windows:
+            window_id = self._pending_windows.pop()
+            key_callback, cleanup, cleanup_callback = self._drainer
+            try:
+                # Windows that have already been cleaned up don't need to be
+                # cleaned up again.
+                cleanup = cleanup and (yield self.window_exists(window_id))
+                yield self._drain_window(
+                    window_id, key_callback, cleanup, cleanup_callback)
+            except Exception:
+                log.err(None, 'Error draining window %s' % (window_id,))
@@ -17,7 +17,8 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, max_in_flight=None,
+                 publisher_confirms=False, max_unconfirmed_publishes=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -25,6 +26,9 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._max_in_flight = max_in_flight
+        self._publisher_confirms = publisher_confirms
+        self._max_unconfirmed_publishes = max_unconfirmed_publishes
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -36,9 +40,26 @@ class BaseConnector(object):
 
     def teardown(self):
         d = gatherResults([c.stop() for c in self._consumers.values()])
+        d.addCallback(lambda r: self.flush_publishers())
         d.addCallback(lambda r: self._middlewares.teardown())
         return d
 
+    def flush_publishers(self):
+        """
+        Wait for the broker to confirm any outstanding outbound messages.
+        """
+        return gatherResults([
+            publisher.flush() for publisher in self._publishers.values()])
+
+    def wait_for_publish_capacity(self):
+        """
+        Return a deferred that fires once none of our publishers have too many
+        unconfirmed messages.
+        """
+        return gatherResults([
+            publisher.wait_for_capacity()
+            for publisher in self._publishers.values()])
+
     @property
     def paused(self):
         return all(consumer.paused
@@ -55,7 +76,9 @@ class BaseConnector(object):
 
     @inlineCallbacks
     def _setup_publisher(self, mtype):
-        publisher = yield self.worker.publish_to(self._rkey(mtype))
+        publisher = yield self.worker.publish_to(
+            self._rkey(mtype), confirm=self._publisher_confirms,
+            max_unconfirmed=self._max_unconfirmed_publishes)
         self._publishers[mtype] = publisher
         returnValue(publisher)
 
@@ -66,7 +89,8 @@ class BaseConnector(object):
 
         consumer = yield self.worker.consume(
             self._rkey(mtype), handler, message_class=msg_class, paused=True,
-            prefetch_count=self._prefetch_count)
+            prefetch_count=self._prefetch_count,
+            max_in_flight=self._max_in_flight)
         self._consumers[mtype] = consumer
         self._set_default_endpoint_handler(mtype, default_handler)
         returnValue(consumer)
@@ -8,6 +8,13 @@ from errors import MissingMessageField, InvalidMessageField
 
 from vumi.utils import to_kwargs
 
+try:
+    # ujson decodes considerably faster than the stdlib json module. It
+    # doesn't support object hooks, so we parse timestamps in a separate pass.
+    import ujson
+except ImportError:
+    ujson = None
+
 
 # This is the date format we work with internally
 VUMI_DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
@@ -44,17 +51,47 @@ def parse_vumi_date(value):
     return datetime.strptime(value, date_format)
 
 
+def _looks_like_vumi_date(value):
+    """
+    Cheaply check whether a value has the shape of a serialised timestamp.
+
+    Most values in a message aren't timestamps, so this saves us from calling
+    :func:`parse_vumi_date` (and catching the exception it raises) for each of
+    them. Timestamps may have anywhere from no microsecond digits to six.
+    """
+    if not isinstance(value, basestring) or not 19 <= len(value) <= 26:
+        return False
+    return value[4] == '-' and value[10] == ' '
+
+
 def date_time_decoder(json_object):
     for key, value in json_object.items():
+        if not _looks_like_vumi_date(value):
+            continue
         try:
             json_object[key] = parse_vumi_date(value)
         except ValueError:
             continue
-        except TypeError:
-            continue
     return json_object
 
 
+def _decode_date_times(obj):
+    """
+    Apply :func:`date_time_decoder` to every object nested in an already
+    decoded JSON value.
+    """
+    if isinstance(obj, dict):
+        for value in obj.itervalues():
+            if isinstance(value, (dict, list)):
+                _decode_date_times(value)
+        date_time_decoder(obj)
+    elif isinstance(obj, list):
+        for value in obj:
+            if isinstance(value, (dict, list)):
+                _decode_date_times(value)
+    return obj
+
+
 class JSONMessageEncoder(json.JSONEncoder):
     """A JSON encoder that is able to serialize datetime"""
     def default(self, obj):
@@ -64,6 +101,8 @@ class JSONMessageEncoder(json.JSONEncoder):
 
 
 def from_json(json_string):
+    if ujson is not None:
+        return _decode_date_times(ujson.loads(json_string, precise_float=True))
     return json.loads(json_string, object_hook=date_time_decoder)
 
 
@@ -71,6 +110,21 @@ def to_json(obj):
     return json.dumps(obj, cls=JSONMessageEncoder)
 
 
+def _copy_payload_value(value):
+    """
+    Copy a payload value without a JSON round trip.
+
+    Dicts and lists are copied recursively and tuples become lists (as they
+    would when serialised). Everything else is assumed to be immutable.
+    """
+    if isinstance(value, dict):
+        return dict(
+            (k, _copy_payload_value(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_copy_payload_value(v) for v in value]
+    return value
+
+
 class Message(object):
     """
     A unified message object used by Vumi when transmitting messages over AMQP
@@ -79,17 +133,61 @@ class Message(object):
     The special ``.cache`` property stores a dictionary of data that is not
     stored by the :class:`vumi.fields.VumiMessage` field and hence not stored
     by Vumi's message store.
+
+    Copies of a message share the values of :attr:`COPY_ON_WRITE_FIELDS` with
+    the original until either of them hands the value out (through item access
+    or :attr:`payload`), at which point that message gets a private copy.
     """
 
+    __slots__ = ('_payload', '_shared_fields', '_exposed_fields')
+
     # name of the special attribute that isn't stored by the message store
     _CACHE_ATTRIBUTE = "__cache__"
 
+    # fields whose values may be shared between a message and its copies
+    COPY_ON_WRITE_FIELDS = frozenset([
+        'helper_metadata', 'transport_metadata', 'routing_metadata'])
+
     def __init__(self, _process_fields=True, **kwargs):
         if _process_fields:
             kwargs = self.process_fields(kwargs)
-        self.payload = kwargs
+        self._payload = kwargs
+        # Copy-on-write fields whose values are shared with other messages.
+        self._shared_fields = None
+        # Copy-on-write fields whose values may be referenced from outside
+        # and therefore can't be shared. Our caller has references to
+        # everything we're constructed with.
+        self._exposed_fields = self.COPY_ON_WRITE_FIELDS
         self.validate_fields()
 
+    @property
+    def payload(self):
+        for field in self._shared_fields or ():
+            self._expose_field(field)
+        self._exposed_fields = self.COPY_ON_WRITE_FIELDS
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload = payload
+        self._shared_fields = None
+        self._exposed_fields = self.COPY_ON_WRITE_FIELDS
+
+    def _expose_field(self, field):
+        """
+        Prepare a copy-on-write field to be handed out, copying its value if
+        it is shared with another message.
+        """
+        shared = self._shared_fields
+        if shared is not None and field in shared:
+            self._payload[field] = _copy_payload_value(self._payload[field])
+            self._shared_fields = (shared - frozenset([field])) or None
+        exposed = self._exposed_fields
+        if exposed is None:
+            self._exposed_fields = frozenset([field])
+        elif field not in exposed:
+            self._exposed_fields = exposed | frozenset([field])
+
     def process_fields(self, fields):
         return fields
 
@@ -98,61 +196,99 @@ class Message(object):
 
     def assert_field_present(self, *fields):
         for field in fields:
-            if field not in self.payload:
+            if field not in self._payload:
                 raise MissingMessageField(field)
 
     def assert_field_value(self, field, *values):
         self.assert_field_present(field)
-        if self.payload[field] not in values:
+        if self._payload[field] not in values:
             raise InvalidMessageField(field)
 
     def to_json(self):
-        return to_json(self.payload)
+        return to_json(self._payload)
 
     @classmethod
     def from_json(cls, json_string):
-        return cls(_process_fields=False, **to_kwargs(from_json(json_string)))
+        msg = cls(_process_fields=False, **to_kwargs(from_json(json_string)))
+        # Nothing else has references to the values we've just decoded.
+        msg._exposed_fields = None
+        return msg
 
     def __str__(self):
-        return u"<Message payload=\"%s\">" % repr(self.payload)
+        return u"<Message payload=\"%s\">" % repr(self._payload)
 
     def __repr__(self):
         return str(self)
 
     def __eq__(self, other):
         if isinstance(other, Message):
-            return self.payload == other.payload
+            return self._payload == other._payload
         return False
 
     def __contains__(self, key):
-        return key in self.payload
+        return key in self._payload
 
     def __getitem__(self, key):
-        return self.payload[key]
+        if key in self.COPY_ON_WRITE_FIELDS:
+            self._expose_field(key)
+        return self._payload[key]
 
     def __setitem__(self, key, value):
-        self.payload[key] = value
+        if key in self.COPY_ON_WRITE_FIELDS:
+            self._expose_field(key)
+        self._payload[key] = value
 
     def get(self, key, default=None):
-        return self.payload.get(key, default)
+        if key in self.COPY_ON_WRITE_FIELDS:
+            self._expose_field(key)
+        return self._payload.get(key, default)
 
     def items(self):
         return self.payload.items()
 
     def copy(self):
-        return self.from_json(self.to_json())
+        """
+        Return a copy of this message.
+
+        The payload is copied structurally rather than through JSON, and
+        copy-on-write fields are shared with the copy unless their values have
+        already been handed out.
+        """
+        cls = type(self)
+        if cls.__init__.im_func is not Message.__init__.im_func:
+            # Subclasses with their own constructors may need them to run.
+            return self.from_json(self.to_json())
+        exposed = self._exposed_fields or ()
+        payload = {}
+        shared = []
+        for key, value in self._payload.iteritems():
+            if key in self.COPY_ON_WRITE_FIELDS and key not in exposed:
+                payload[key] = value
+                shared.append(key)
+            else:
+                payload[key] = _copy_payload_value(value)
+        msg = cls.__new__(cls)
+        msg._payload = payload
+        msg._exposed_fields = None
+        msg._shared_fields = frozenset(shared) or None
+        if shared:
+            self._shared_fields = msg._shared_fields.union(
+                self._shared_fields or ())
+        return msg
 
     @property
     def cache(self):
         """
         A special payload attribute that isn't stored by the message store.
         """
-        return self.payload.setdefault(self._CACHE_ATTRIBUTE, {})
+        return self._payload.setdefault(self._CACHE_ATTRIBUTE, {})
 
 
 class TransportMessage(Message):
     """Common base class for messages sent to or from a transport."""
 
+    __slots__ = ()
+
     # sub-classes should set the message type
     MESSAGE_TYPE = None
     MESSAGE_VERSION = '20110921'
@@ -181,18 +317,19 @@ class TransportMessage(Message):
         self.assert_field_value('message_version', self.MESSAGE_VERSION)
         # We might get older event messages without the `helper_metadata`
         # field.
-        self.payload.setdefault('helper_metadata', {})
+        self._payload.setdefault('helper_metadata', {})
         self.assert_field_present(
             'message_type',
             'timestamp',
             'helper_metadata',
             )
-        if self['message_type'] is None:
+        if self._payload['message_type'] is None:
             raise InvalidMessageField('message_type')
 
     @property
     def routing_metadata(self):
-        return self.payload.setdefault('routing_metadata', {})
+        self._expose_field('routing_metadata')
+        return self._payload.setdefault('routing_metadata', {})
 
     @classmethod
     def check_routing_endpoint(cls, endpoint_name):
@@ -218,6 +355,8 @@ class TransportUserMessage(TransportMessage):
                       by transports or message workers).
     """
 
+    __slots__ = ()
+
     MESSAGE_TYPE = 'user_message'
 
     # session event constants
@@ -278,8 +417,8 @@ class TransportUserMessage(TransportMessage):
         super(TransportUserMessage, self).validate_fields()
         # We might get older message versions without the `group` or `provider`
         # fields.
-        self.payload.setdefault('group', None)
-        self.payload.setdefault('provider', None)
+        self._payload.setdefault('group', None)
+        self._payload.setdefault('provider', None)
         self.assert_field_present(
             'message_id',
             'to_addr',
@@ -293,9 +432,10 @@ class TransportUserMessage(TransportMessage):
             'group',
             'provider',
             )
-        if self['session_event'] not in self.SESSION_EVENTS:
+        session_event = self._payload['session_event']
+        if session_event not in self.SESSION_EVENTS:
             raise InvalidMessageField("Invalid session_event %r"
-                                      % (self['session_event'],))
+                                      % (session_event,))
 
     def user(self):
         return self['from_addr']
@@ -394,6 +534,9 @@ class TransportUserMessage(TransportMessage):
 class TransportEvent(TransportMessage):
     """Message about a TransportUserMessage.
     """
+
+    __slots__ = ()
+
     MESSAGE_TYPE = 'event'
 
     # list of valid delivery statuses
@@ -422,10 +565,10 @@ class TransportEvent(TransportMessage):
             'event_id',
             'event_type',
             )
-        event_type = self.payload['event_type']
+        event_type = self._payload['event_type']
         if event_type not in self.EVENT_TYPES:
             raise InvalidMessageField("Unknown event_type %r" % (event_type,))
         for extra_field, check in self.EVENT_TYPES[event_type].items():
             self.assert_field_present(extra_field)
-            if not check(self[extra_field]):
+            if not check(self._payload[extra_field]):
                 raise InvalidMessageField(extra_field)
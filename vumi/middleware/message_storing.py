@@ -1,9 +1,15 @@
 # -*- test-case-name: vumi.middleware.tests.test_message_storing -*-
 
-from confmodel.fields import ConfigBool, ConfigDict, ConfigText
+from confmodel.fields import (
+    ConfigBool, ConfigDict, ConfigText, ConfigInt, ConfigFloat)
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred, DeferredLock)
+from twisted.internet.task import LoopingCall
 
+from vumi import log
+from vumi.message import TransportEvent
 from vumi.middleware.base import BaseMiddleware, BaseMiddlewareConfig
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.components.message_store import MessageStore
@@ -28,6 +34,21 @@ class StoringMiddlewareConfig(BaseMiddlewareConfig):
         "``True`` to store consumed messages as well as published ones, "
         "``False`` to store only published messages.", default=True,
         static=True)
+    write_behind = ConfigBool(
+        "``True`` to pass messages on without waiting for them to be stored. "
+        "Messages are buffered and stored in batches instead, so messages "
+        "received up to ``write_behind_flush_interval`` seconds before the "
+        "worker stops unexpectedly may be lost.", default=False, static=True)
+    write_behind_buffer_size = ConfigInt(
+        "The maximum number of messages to buffer when ``write_behind`` is "
+        "set. Once the buffer is full, messages are stored before they're "
+        "passed on.", default=1000, static=True)
+    write_behind_flush_interval = ConfigFloat(
+        "Seconds between flushes of the write-behind buffer.", default=1.0,
+        static=True)
+    write_behind_concurrency = ConfigInt(
+        "The maximum number of buffered messages stored concurrently when "
+        "the write-behind buffer is flushed.", default=10, static=True)
 
 
 class StoringMiddleware(BaseMiddleware):
@@ -59,6 +80,22 @@ class StoringMiddleware(BaseMiddleware):
         ``True`` to store consumed messages as well as published ones,
         ``False`` to store only published messages.
         Default is ``True``.
+    :param bool write_behind:
+        ``True`` to buffer messages and store them in batches in the
+        background instead of waiting for each one to be stored before
+        passing it on. Default is ``False``.
+    :param int write_behind_buffer_size:
+        The maximum number of buffered messages. Once the buffer is full,
+        it's flushed and further messages are stored before being passed
+        on. Default is 1000.
+    :param float write_behind_flush_interval:
+        Seconds between flushes of the write-behind buffer. This bounds how
+        many messages may be lost if the worker stops unexpectedly.
+        Default is 1.0.
+    :param int write_behind_concurrency:
+        The maximum number of buffered messages stored concurrently when the
+        buffer is flushed. Buffered writes for the same message are always
+        stored one after the other. Default is 10.
     """
 
     CONFIG_CLASS = StoringMiddlewareConfig
@@ -73,38 +110,117 @@ class StoringMiddleware(BaseMiddleware):
                                   self.redis.sub_manager(store_prefix))
         self.store_on_consume = self.config.store_on_consume
 
+        self._write_buffer = []
+        self._flush_lock = DeferredLock()
+        self._flusher = None
+        if self.config.write_behind:
+            self._flusher = LoopingCall(self.flush_writes)
+            self._flusher.clock = self.get_clock()
+            self._flusher.start(
+                self.config.write_behind_flush_interval, now=False)
+
     @inlineCallbacks
     def teardown_middleware(self):
+        if self._flusher is not None and self._flusher.running:
+            self._flusher.stop()
+        yield self.flush_writes()
         yield self.redis.close_manager()
 
+    def get_clock(self):
+        return reactor
+
+    @inlineCallbacks
+    def _write(self, add_func, message, **kw):
+        if not self.config.write_behind:
+            yield add_func(message, **kw)
+        elif len(self._write_buffer) < self.config.write_behind_buffer_size:
+            self._write_buffer.append((add_func, message.copy(), kw))
+        else:
+            # The buffer is full, so we wait for it to be flushed and store
+            # this message directly. Flushing first keeps messages in order,
+            # which matters for events.
+            yield self.flush_writes()
+            yield add_func(message, **kw)
+        returnValue(message)
+
+    def flush_writes(self):
+        """
+        Store all buffered messages.
+
+        Returns a deferred that fires once they've been stored. Errors are
+        logged rather than raised.
+        """
+        return self._flush_lock.run(self._flush_writes)
+
+    @inlineCallbacks
+    def _flush_writes(self):
+        writes, self._write_buffer = self._write_buffer, []
+        # Storing an event looks up the outbound message it refers to, so we
+        # store the messages before the events.
+        messages = [w for w in writes if not isinstance(w[1], TransportEvent)]
+        events = [w for w in writes if isinstance(w[1], TransportEvent)]
+        yield self._store_writes(messages, 'message_id')
+        yield self._store_writes(events, 'event_id')
+
+    def _store_writes(self, writes, id_field):
+        """
+        Store buffered writes, at most ``write_behind_concurrency`` at a time.
+
+        Storing a message loads, modifies and saves it, so writes for the
+        same message (such as the consume and publish of an outbound message)
+        would race if run together. We store those one after the other in the
+        order they were buffered.
+        """
+        grouped = {}
+        ids = []
+        for write in writes:
+            write_id = write[1][id_field]
+            if write_id not in grouped:
+                grouped[write_id] = []
+                ids.append(write_id)
+            grouped[write_id].append(write)
+        groups = (grouped[write_id] for write_id in ids)
+        return gatherResults([
+            self._store_write_groups(groups)
+            for _ in range(self.config.write_behind_concurrency)])
+
+    @inlineCallbacks
+    def _store_write_groups(self, groups):
+        # The groups iterator is shared, so each call of this takes the next
+        # unclaimed group whenever it's done with its current one.
+        for group in groups:
+            for write in group:
+                yield self._buffered_write(*write)
+
+    def _buffered_write(self, add_func, message, kw):
+        d = maybeDeferred(add_func, message, **kw)
+        d.addErrback(log.err, "Error storing buffered message: %r" % (
+            message,))
+        return d
+
     def handle_consume_inbound(self, message, connector_name):
         if not self.store_on_consume:
             return message
         return self.handle_inbound(message, connector_name)
 
-    @inlineCallbacks
     def handle_inbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_inbound_message(message, tag=tag)
-        returnValue(message)
+        return self._write(self.store.add_inbound_message, message, tag=tag)
 
     def handle_consume_outbound(self, message, connector_name):
         if not self.store_on_consume:
             return message
         return self.handle_outbound(message, connector_name)
 
-    @inlineCallbacks
     def handle_outbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_outbound_message(message, tag=tag)
-        returnValue(message)
+        return self._write(self.store.add_outbound_message, message, tag=tag)
 
     def handle_consume_event(self, event, connector_name):
         if not self.store_on_consume:
             return event
         return self.handle_event(event, connector_name)
 
-    @inlineCallbacks
     def handle_event(self, event, connector_name):
         transport_metadata = event.get('transport_metadata', {})
         # FIXME: The SMPP transport writes a 'datetime' object
@@ -114,5 +230,4 @@ class StoringMiddleware(BaseMiddleware):
             date = transport_metadata['date']
             if not isinstance(date, basestring):
                 transport_metadata['date'] = date.isoformat()
-        yield self.store.add_event(event)
-        returnValue(event)
+        return self._write(self.store.add_event, event)
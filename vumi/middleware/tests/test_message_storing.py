@@ -1,6 +1,7 @@
 """Tests for vumi.middleware.message_storing."""
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.task import Clock
 
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.message import TransportUserMessage, TransportEvent
@@ -23,6 +24,8 @@ class TestStoringMiddleware(VumiTestCase):
         # so it's safe to import stuff that pulls it in without guards.
         from vumi.middleware.message_storing import StoringMiddleware
 
+        self.clock = Clock()
+        self.patch(StoringMiddleware, 'get_clock', lambda mw: self.clock)
         config = self.persistence_helper.mk_config(config)
         dummy_worker = object()
         mw = StoringMiddleware("dummy_storer", config, dummy_worker)
@@ -45,6 +48,12 @@ class TestStoringMiddleware(VumiTestCase):
                              sent_message_id="1")
         return ack
 
+    def wait_for_flush(self, mw):
+        """
+        Wait for a flush started by the middleware's flush timer to finish.
+        """
+        return mw._flush_lock.run(lambda: None)
+
     @inlineCallbacks
     def assert_batch_keys(self, batch_id, outbound=[], inbound=[]):
         outbound_keys = yield self.store.batch_outbound_keys(batch_id)
@@ -200,3 +209,124 @@ class TestStoringMiddleware(VumiTestCase):
         resp2 = yield mw.handle_publish_event(ack2, "dummy_connector")
         self.assertEqual(resp2, ack2)
         yield self.assert_outbound_stored(msg, events=[event_id2])
+
+    @inlineCallbacks
+    def test_write_behind(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        msg = self.mk_msg()
+        response = yield mw.handle_outbound(msg, "dummy_connector")
+        self.assertEqual(response, msg)
+        yield self.assert_outbound_not_stored(msg)
+
+        self.clock.advance(mw.config.write_behind_flush_interval)
+        self.assertEqual(mw._write_buffer, [])
+        yield self.wait_for_flush(mw)
+        yield self.assert_outbound_stored(msg)
+
+    @inlineCallbacks
+    def test_write_behind_consumed_and_published(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msg = self.mk_msg()
+        TaggingMiddleware.add_tag_to_msg(msg, ["pool", "tag"])
+        yield mw.handle_consume_outbound(msg, "dummy_connector")
+        yield mw.handle_publish_outbound(msg, "dummy_connector")
+        self.assertEqual(len(mw._write_buffer), 2)
+
+        self.clock.advance(mw.config.write_behind_flush_interval)
+        yield self.wait_for_flush(mw)
+        yield self.assert_outbound_stored(msg, batch_id)
+
+    @inlineCallbacks
+    def test_write_behind_ordering_and_concurrency(self):
+        mw = yield self.setup_middleware({
+            'write_behind': True,
+            'write_behind_concurrency': 2,
+        })
+        stores = []
+
+        def add_func(message, tag):
+            d = Deferred()
+            stores.append((message['message_id'], tag, d))
+            return d
+
+        msg1, msg2, msg3 = self.mk_msg(), self.mk_msg(), self.mk_msg()
+        for msg, tag in [(msg1, "a"), (msg2, "a"), (msg1, "b"), (msg3, "a")]:
+            yield mw._write(add_func, msg, tag=tag)
+        flush_d = mw.flush_writes()
+
+        def started():
+            return [(msg_id, tag) for msg_id, tag, _ in stores]
+
+        # Only two messages are stored at once and the second write for msg1
+        # waits for the first.
+        self.assertEqual(started(), [
+            (msg1['message_id'], "a"), (msg2['message_id'], "a")])
+        stores[0][2].callback(None)
+        self.assertEqual(started()[2:], [(msg1['message_id'], "b")])
+        stores[1][2].callback(None)
+        self.assertEqual(started()[3:], [(msg3['message_id'], "a")])
+        self.assertNoResult(flush_d)
+        for _, _, d in stores[2:]:
+            d.callback(None)
+        yield flush_d
+
+    @inlineCallbacks
+    def test_write_behind_flushed_on_teardown(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        msg = self.mk_msg()
+        yield mw.handle_outbound(msg, "dummy_connector")
+        yield self.assert_outbound_not_stored(msg)
+
+        # Keep the redis manager open for the rest of the test. The patch is
+        # undone before the middleware is torn down again during cleanup.
+        self.patch(mw.redis, 'close_manager', lambda: None)
+        yield mw.teardown_middleware()
+        self.assertFalse(mw._flusher.running)
+        yield self.assert_outbound_stored(msg)
+
+    @inlineCallbacks
+    def test_write_behind_stores_copies(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        msg = self.mk_msg()
+        yield mw.handle_inbound(msg, "dummy_connector")
+        stored = msg.copy()
+        msg['content'] = u'changed after passing through'
+
+        yield mw.flush_writes()
+        yield self.assert_inbound_stored(stored)
+
+    @inlineCallbacks
+    def test_write_behind_with_tags_and_events(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msg = self.mk_msg()
+        TaggingMiddleware.add_tag_to_msg(msg, ["pool", "tag"])
+        ack = self.mk_ack(user_message_id=msg["message_id"])
+        # The event is buffered before the message it refers to.
+        yield mw.handle_event(ack, "dummy_connector")
+        yield mw.handle_outbound(msg, "dummy_connector")
+        yield self.assert_outbound_not_stored(msg)
+
+        yield mw.flush_writes()
+        yield self.assert_outbound_stored(
+            msg, batch_id, events=[ack["event_id"]])
+        event_count = yield self.store.cache.count_event_keys(batch_id)
+        self.assertEqual(event_count, 1)
+
+    @inlineCallbacks
+    def test_write_behind_buffer_full(self):
+        mw = yield self.setup_middleware({
+            'write_behind': True,
+            'write_behind_buffer_size': 1,
+        })
+        msg1 = self.mk_msg()
+        msg2 = self.mk_msg()
+        yield mw.handle_outbound(msg1, "dummy_connector")
+        yield self.assert_outbound_not_stored(msg1)
+
+        # The buffer is full, so the buffered message is flushed and the new
+        # one is stored before it's passed on.
+        yield mw.handle_outbound(msg2, "dummy_connector")
+        yield self.assert_outbound_stored(msg1)
+        yield self.assert_outbound_stored(msg2)
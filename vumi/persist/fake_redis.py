@@ -54,6 +54,7 @@ class FakeRedis(object):
         self._charset = charset
         self._charset_errors = errors
         self._delayed_calls = []
+        self._pending_operations = []
 
     def teardown(self):
         self._clean_up_expires()
@@ -80,12 +81,18 @@ class FakeRedis(object):
         for delayed in self._delayed_calls:
             if not (delayed.cancelled or delayed.called):
                 delayed.cancel()
+        self._pending_operations = []
 
     def _delay_operation(self, func, args, kw):
         """
         Return the result with some fake delay. If we're in async mode, add
         some real delay to catch code that doesn't properly wait for the
         deferred to fire.
+
+        Delayed operations are run in the order they were issued, as they
+        would be over a single Redis connection, so that commands sent
+        without waiting for earlier replies behave as they do against a real
+        server.
         """
         self.clock.advance(0.1)
         if self._is_async:
@@ -93,13 +100,21 @@ class FakeRedis(object):
             # can't use deferLater() here because we want to keep track of the
             # delayed call object.
             d = Deferred()
-            delayed = reactor.callLater(
-                FAKE_REDIS_WAIT, call_to_deferred, d, func, self, *args, **kw)
-            self._delayed_calls.append(delayed)
+            if not self._pending_operations:
+                delayed = reactor.callLater(
+                    FAKE_REDIS_WAIT, self._run_pending_operations)
+                self._delayed_calls.append(delayed)
+            self._pending_operations.append((d, func, args, kw))
             return d
         else:
             return func(self, *args, **kw)
 
+    def _run_pending_operations(self):
+        # Operations issued while these ones run are delayed again.
+        operations, self._pending_operations = self._pending_operations, []
+        for d, func, args, kw in operations:
+            call_to_deferred(d, func, self, *args, **kw)
+
     def _set_key(self, key, value):
         self._known_key_existence[key] = True
         self._data[key] = value
@@ -124,7 +139,7 @@ class FakeRedis(object):
         value = self._data.get(key)
         if value is None:
             return 'none'
-        if isinstance(value, basestring):
+        if isinstance(value, (basestring, HyperLogLog)):
             return 'string'
         if isinstance(value, list):
             return 'list'
@@ -487,6 +502,28 @@ class FakeRedis(object):
         del lval[:start]
         return True
 
+    # HyperLogLog operations
+
+    @maybe_async
+    def pfadd(self, key, *values):
+        created = key not in self._data
+        hval = self._setdefault_key(key, HyperLogLog())
+        return int(hval.pfadd(*map(self._encode, values)) or created)
+
+    @maybe_async
+    def pfcount(self, key, *keys):
+        union = HyperLogLog()
+        for rkey in (key,) + keys:
+            union.pfmerge(self._data.get(rkey, HyperLogLog()))
+        return union.pfcount()
+
+    @maybe_async
+    def pfmerge(self, dst, *keys):
+        hval = self._setdefault_key(dst, HyperLogLog())
+        for rkey in keys:
+            hval.pfmerge(self._data.get(rkey, HyperLogLog()))
+        return True
+
     # Expiry operations
 
     @maybe_async
@@ -601,3 +638,26 @@ class Zset(object):
         deleted_keys = self._zval[start:stop]
         del self._zval[start:stop]
         return len(deleted_keys)
+
+
+class HyperLogLog(object):
+    """
+    A Redis-like HyperLogLog implementation.
+
+    This keeps the values added to it, so the counts are exact. Real
+    HyperLogLog counts have a standard error of 0.81%.
+    """
+
+    def __init__(self):
+        self._values = set()
+
+    def pfadd(self, *values):
+        old_count = len(self._values)
+        self._values.update(values)
+        return int(len(self._values) != old_count)
+
+    def pfcount(self):
+        return len(self._values)
+
+    def pfmerge(self, other):
+        self._values.update(other._values)
@@ -2,9 +2,14 @@
 
 """Base classes for Vumi persistence models."""
 
+from collections import deque
+from copy import deepcopy
 from functools import wraps
+import time
 import urllib
 
+from twisted.internet.defer import Deferred, fail
+
 from vumi.errors import VumiError
 from vumi.persist.fields import Field, FieldDescriptor, ValidationError
 
@@ -191,6 +196,210 @@ class MigrationData(object):
                 self.add_index(index, index_value)
 
 
+class IndexPager(object):
+    """Walk the pages of an index query, fetching pages ahead of the one
+    being processed.
+
+    :param first_page:
+        The first page of results, or a deferred that fires with it, as
+        returned by :meth:`Model.index_keys_page` or
+        :meth:`Model.all_keys_page`. Any object with ``has_next_page()`` and
+        ``next_page()`` methods may be used, including the index page
+        wrappers in :mod:`vumi.components.message_store`.
+
+    :param int read_ahead:
+        The maximum number of pages to fetch before they're asked for. Index
+        pages can only be fetched one after another, so this limits how many
+        pages are held in memory rather than how many queries are in flight.
+        If ``0``, each page is fetched when it's asked for.
+
+    Both :meth:`next_page` and :meth:`next_results` return their result
+    directly if it's available and a deferred otherwise, so they must be
+    called from a generator decorated with ``@Manager.calls_manager`` or
+    ``@inlineCallbacks`` and the result yielded::
+
+        pager = model_proxy.index_keys_pages('field', 'value')
+        while True:
+            keys = yield pager.next_results()
+            if keys is None:
+                break
+            ...
+
+    With a synchronous manager no deferreds are involved and pages are
+    fetched as soon as there's room for them.
+    """
+
+    def __init__(self, first_page, read_ahead=1):
+        self.read_ahead = read_ahead
+        self._pages = deque()
+        self._last_page = None
+        self._fetching = None
+        self._waiting = None
+        self._failure = None
+        self._got_result(first_page)
+
+    def _got_result(self, result):
+        if isinstance(result, Deferred):
+            self._fetching = result
+            result.addCallbacks(self._page_fetched, self._page_failed)
+        else:
+            self._page_fetched(result)
+
+    def _page_fetched(self, page):
+        self._fetching = None
+        if page is not None:
+            self._pages.append(page)
+            if page.has_next_page():
+                self._last_page = page
+        if self._waiting is not None:
+            waiting, self._waiting = self._waiting, None
+            waiting.callback(self._pages.popleft() if self._pages else None)
+        self._fetch_ahead()
+
+    def _page_failed(self, failure):
+        self._fetching = None
+        if self._waiting is not None:
+            waiting, self._waiting = self._waiting, None
+            waiting.errback(failure)
+        else:
+            self._failure = failure
+
+    def _fetch_ahead(self, force=False):
+        if self._fetching is not None or self._last_page is None:
+            return
+        if force or len(self._pages) < self.read_ahead:
+            page, self._last_page = self._last_page, None
+            self._got_result(page.next_page())
+
+    def next_page(self):
+        """Return the next page of results, or ``None`` if there are no more.
+        """
+        if not self._pages:
+            self._fetch_ahead(force=True)
+        if self._pages:
+            page = self._pages.popleft()
+            self._fetch_ahead()
+            return page
+        if self._failure is not None:
+            failure, self._failure = self._failure, None
+            return fail(failure)
+        if self._fetching is None:
+            return None
+        self._waiting = Deferred()
+        return self._waiting
+
+    def next_results(self):
+        """Return a list of the results in the next page, or ``None`` if
+        there are no more pages.
+        """
+        page = self.next_page()
+        if isinstance(page, Deferred):
+            return page.addCallback(
+                lambda page: list(page) if page is not None else None)
+        return list(page) if page is not None else None
+
+
+class LoadCache(object):
+    """An in-process LRU cache of Riak objects loaded by a :class:`Manager`.
+
+    Entries are keyed by bucket name and key and hold a copy of the raw
+    object as it was read from Riak, including its vclock so that objects
+    stored after a cache hit replace the stored version rather than
+    creating siblings. Migrators are run on each hit as they would be for
+    a fresh load.
+
+    :param int max_size:
+        The maximum number of objects to cache. The least recently used
+        object is evicted to make room for a new one.
+
+    :param float ttl:
+        The number of seconds to keep an object for, or ``None`` to keep it
+        until it's evicted. Writes through other managers (or processes)
+        aren't seen until the cached object expires, so the ttl bounds how
+        stale a cached object may be. Storing a stale object replaces the
+        newer stored version rather than creating a sibling, so only models
+        that rarely change should use the cache and managers shared with
+        other writers should set a ttl.
+    """
+
+    def __init__(self, max_size, ttl=None, get_time=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.get_time = get_time
+        # Entries are (last_use, expires, state) tuples. Keys are appended to
+        # _uses with their last_use each time they're used, so older uses of
+        # a key are stale and skipped when looking for the least recently
+        # used key.
+        self._entries = {}
+        self._uses = deque()
+        self._use_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, bucket, key):
+        """Return the cached state for a bucket and key, or ``None``.
+        """
+        entry = self._entries.pop((bucket, key), None)
+        if entry is not None:
+            _last_use, expires, state = entry
+            if expires is None or expires > self.get_time():
+                self._entries[(bucket, key)] = (
+                    self._use((bucket, key)), expires, state)
+                self.hits += 1
+                return deepcopy(state)
+        self.misses += 1
+        return None
+
+    def put(self, bucket, key, state):
+        """Cache the state of the object for a bucket and key.
+        """
+        expires = None
+        if self.ttl is not None:
+            expires = self.get_time() + self.ttl
+        self._entries[(bucket, key)] = (
+            self._use((bucket, key)), expires, deepcopy(state))
+        while len(self._entries) > self.max_size:
+            last_use, cache_key = self._uses.popleft()
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] == last_use:
+                del self._entries[cache_key]
+                self.evictions += 1
+
+    def _use(self, cache_key):
+        self._use_count += 1
+        self._uses.append((self._use_count, cache_key))
+        if len(self._uses) > 2 * self.max_size:
+            # Drop the stale uses so that hits don't grow _uses forever.
+            self._uses = deque(sorted(
+                (last_use, k)
+                for k, (last_use, _, _) in self._entries.iteritems()))
+            self._uses.append((self._use_count, cache_key))
+        return self._use_count
+
+    def invalidate(self, bucket, key):
+        """Remove the object for a bucket and key from the cache.
+        """
+        self._entries.pop((bucket, key), None)
+
+    def clear(self):
+        self._entries.clear()
+        self._uses.clear()
+
+    def stats(self):
+        """Return a dict of cache hit, miss and eviction counts.
+        """
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
 class Model(object):
     """A model is a description of an entity persisted in a data store."""
 
@@ -199,6 +408,11 @@ class Model(object):
     VERSION = None
     MIGRATOR = ModelMigrator
 
+    # If this is True and the manager has a load cache, loaded objects are
+    # cached in memory. Only models that rarely change should set this. See
+    # :class:`LoadCache`.
+    CACHE_LOADS = False
+
     bucket = None
 
     # TODO: maybe replace .backlinks with a class-level .query
@@ -285,6 +499,16 @@ class Model(object):
         """
         return manager.load_all_bunches(cls, keys)
 
+    @classmethod
+    def load_stream(cls, manager, keys, callback, concurrency=None):
+        """Load objects for the given list of keys, passing each one to
+        `callback` as it arrives.
+
+        See :meth:`Manager.load_stream` for details.
+        """
+        return manager.load_stream(
+            cls, keys, callback, concurrency=concurrency)
+
     @classmethod
     def all_keys(cls, manager):
         """Return all keys in this model's bucket.
@@ -364,6 +588,22 @@ class Model(object):
             cls, '$bucket', manager.bucket_name(cls), None,
             max_results=max_results, continuation=continuation)
 
+    @classmethod
+    def all_keys_pages(cls, manager, max_results=None, continuation=None,
+                       read_ahead=1):
+        """Return all keys in this model's bucket, a page at a time.
+
+        This takes the same parameters as :meth:`all_keys_page`, and
+        ``read_ahead`` as described for :class:`IndexPager`.
+
+        :returns:
+            :class:`IndexPager` object for the pages of keys.
+        """
+        return IndexPager(
+            cls.all_keys_page(
+                manager, max_results=max_results, continuation=continuation),
+            read_ahead=read_ahead)
+
     @classmethod
     def index_keys_page(cls, manager, field_name, value, end_value=None,
                         return_terms=None, max_results=None,
@@ -417,6 +657,25 @@ class Model(object):
             cls, index_name, start_value, end_value, return_terms=return_terms,
             max_results=max_results, continuation=continuation)
 
+    @classmethod
+    def index_keys_pages(cls, manager, field_name, value, end_value=None,
+                         return_terms=None, max_results=None,
+                         continuation=None, read_ahead=1):
+        """Find object keys by index, a page at a time.
+
+        This takes the same parameters as :meth:`index_keys_page`, and
+        ``read_ahead`` as described for :class:`IndexPager`.
+
+        :returns:
+            :class:`IndexPager` object for the pages of results.
+        """
+        return IndexPager(
+            cls.index_keys_page(
+                manager, field_name, value, end_value,
+                return_terms=return_terms, max_results=max_results,
+                continuation=continuation),
+            read_ahead=read_ahead)
+
     @classmethod
     def index_lookup(cls, manager, field_name, value):
         """Find objects by index.
@@ -644,20 +903,28 @@ class Manager(object):
     """A wrapper around a Riak client."""
 
     DEFAULT_LOAD_BUNCH_SIZE = 100
+    DEFAULT_LOAD_CONCURRENCY = 10
     DEFAULT_MAPREDUCE_TIMEOUT = 4 * 60 * 1000  # in milliseconds
     # This is a temporary measure to give us an easy way to switch back to the
     # old mechanism if the new one causes problems.
     USE_MAPREDUCE_BUNCH_LOADING = False
 
     def __init__(self, client, bucket_prefix, load_bunch_size=None,
-                 mapreduce_timeout=None, store_versions=None):
+                 mapreduce_timeout=None, store_versions=None,
+                 load_concurrency=None, load_cache_size=None,
+                 load_cache_ttl=None):
         self.client = client
         self.bucket_prefix = bucket_prefix
         self.load_bunch_size = load_bunch_size or self.DEFAULT_LOAD_BUNCH_SIZE
+        self.load_concurrency = (load_concurrency or
+                                 self.DEFAULT_LOAD_CONCURRENCY)
         self.mapreduce_timeout = (mapreduce_timeout or
                                   self.DEFAULT_MAPREDUCE_TIMEOUT)
         self._bucket_cache = {}
         self.store_versions = store_versions or {}
+        self.load_cache = None
+        if load_cache_size:
+            self.load_cache = LoadCache(load_cache_size, ttl=load_cache_ttl)
 
     def proxy(self, modelcls):
         return ModelProxy(self, modelcls)
@@ -738,6 +1005,55 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .load(...)")
 
+    def _load_cached(self, modelcls, riak_object):
+        """Fill in `riak_object` from the load cache, if possible.
+
+        :returns:
+            ``True`` if the object was found in the cache, ``False`` if it
+            needs to be loaded from Riak.
+        """
+        if self.load_cache is None or not modelcls.CACHE_LOADS:
+            return False
+        state = self.load_cache.get(
+            self.bucket_name(modelcls), riak_object.get_key())
+        if state is None:
+            return False
+        vclock, content_type, data, indexes, usermeta = state
+        riak_object.set_vclock(vclock)
+        riak_object.set_content_type(content_type)
+        riak_object.set_data(data)
+        riak_object.set_indexes(indexes)
+        riak_object.set_user_metadata(usermeta)
+        return True
+
+    def _cache_loaded(self, modelcls, riak_object):
+        """Add a freshly loaded `riak_object` to the load cache, if
+        `modelcls` uses it.
+
+        This must be called before any migrators are run. Missing objects
+        and tombstones aren't cached.
+        """
+        if self.load_cache is None or not modelcls.CACHE_LOADS:
+            return
+        data = riak_object.get_data()
+        if data is None:
+            return
+        self.load_cache.put(
+            self.bucket_name(modelcls), riak_object.get_key(), (
+                riak_object.get_vclock(), riak_object.get_content_type(),
+                data, set(riak_object.get_indexes()),
+                dict(riak_object.get_user_metadata())))
+
+    def _uncache(self, modelobj):
+        """Remove `modelobj` from the load cache.
+
+        This is called when the object is stored or deleted, whether or not
+        its model uses the cache, because other models may share its bucket.
+        """
+        if self.load_cache is not None:
+            self.load_cache.invalidate(
+                self.bucket_name(modelobj), modelobj.key)
+
     def _load_multiple(self, cls, keys):
         """Load the model instances for a batch of keys from Riak.
 
@@ -790,6 +1106,24 @@ class Manager(object):
             keys = keys[self.load_bunch_size:]
             yield self._load_bunch(model, batch_keys)
 
+    def load_stream(self, model, keys, callback, concurrency=None):
+        """Load model instances for a list of keys from Riak, passing each
+        one to `callback` as it arrives.
+
+        Keys that don't exist or have been deleted are skipped. The order in
+        which instances are passed to `callback` isn't guaranteed.
+
+        :param int concurrency:
+            The maximum number of concurrent requests. Defaults to the
+            manager's ``load_concurrency``.
+
+        :returns:
+            ``None`` (or a deferred that fires with ``None``) once all the
+            instances have been passed to `callback`.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .load_stream(...)")
+
     def riak_map_reduce(self):
         """Construct a RiakMapReduce object for this client."""
         raise NotImplementedError("Sub-classes of Manager should implement"
@@ -886,6 +1220,9 @@ class ModelProxy(object):
     def load_all_bunches(self, *args, **kw):
         return self._modelcls.load_all_bunches(self._manager, *args, **kw)
 
+    def load_stream(self, *args, **kw):
+        return self._modelcls.load_stream(self._manager, *args, **kw)
+
     def all_keys(self):
         return self._modelcls.all_keys(self._manager)
 
@@ -906,6 +1243,20 @@ class ModelProxy(object):
             return_terms=return_terms, max_results=max_results,
             continuation=continuation)
 
+    def all_keys_pages(self, max_results=None, continuation=None,
+                       read_ahead=1):
+        return self._modelcls.all_keys_pages(
+            self._manager, max_results=max_results, continuation=continuation,
+            read_ahead=read_ahead)
+
+    def index_keys_pages(self, field_name, value, end_value=None,
+                         return_terms=None, max_results=None,
+                         continuation=None, read_ahead=1):
+        return self._modelcls.index_keys_pages(
+            self._manager, field_name, value, end_value,
+            return_terms=return_terms, max_results=max_results,
+            continuation=continuation, read_ahead=read_ahead)
+
     def index_lookup(self, field_name, value):
         return self._modelcls.index_lookup(self._manager, field_name, value)
 
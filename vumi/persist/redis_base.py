@@ -13,6 +13,8 @@ def make_callfunc(name, redis_call):
 
         def _f(k, v):
             if k in redis_call.key_args:
+                if isinstance(v, (list, tuple)):
+                    return [self._key(key) for key in v]
                 return self._key(v)
             return v
 
@@ -182,6 +184,13 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    def supports_scripting(self):
+        """
+        Indicate whether :meth:`eval` can be used. The fake Redis used in
+        tests can't run Lua scripts.
+        """
+        return not isinstance(self._client, FakeRedis)
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
@@ -280,6 +289,16 @@ class Manager(object):
         ['source'], vararg='destination', key_args=['source', 'destination'])
     ltrim = RedisCall(['key', 'start', 'stop'])
 
+    # HyperLogLog operations
+
+    pfadd = RedisCall(['key'], vararg='values')
+    pfcount = RedisCall(['key'], vararg='keys', key_args=['key', 'keys'])
+    pfmerge = RedisCall(['dst'], vararg='keys', key_args=['dst', 'keys'])
+
+    # Scripting operations
+
+    eval = RedisCall(['source', 'keys', 'args'], key_args=['keys'])
+
     # Expiry operations
 
     expire = RedisCall(['key', 'seconds'])
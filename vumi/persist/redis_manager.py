@@ -20,6 +20,15 @@ class VumiRedis(redis.Redis):
         """
         return super(VumiRedis, self).setex(key, value, seconds)
 
+    def eval(self, source, keys, args):
+        """
+        The underlying .eval() takes the number of keys followed by the keys
+        and arguments. This wrapper takes separate lists of keys and
+        arguments to match our implementation in the txredis manager.
+        """
+        return super(VumiRedis, self).eval(
+            source, len(keys), *(list(keys) + list(args)))
+
     def scan(self, cursor, match=None, count=None):
         """
         Scan through all the keys in the database returning those that
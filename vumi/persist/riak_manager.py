@@ -108,6 +108,12 @@ class VumiRiakObject(object):
     def get_key(self):
         return self.key
 
+    def get_vclock(self):
+        return self._riak_obj.vclock
+
+    def set_vclock(self, vclock):
+        self._riak_obj.vclock = vclock
+
     def get_content_type(self):
         return self._riak_obj.content_type
 
@@ -175,6 +181,10 @@ class RiakManager(Manager):
             'load_bunch_size', cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop(
             'mapreduce_timeout', cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_concurrency = config.pop(
+            'load_concurrency', cls.DEFAULT_LOAD_CONCURRENCY)
+        load_cache_size = config.pop('load_cache_size', None)
+        load_cache_ttl = config.pop('load_cache_ttl', None)
         transport_type = config.pop('transport_type', 'http')
         store_versions = config.pop('store_versions', None)
 
@@ -204,7 +214,9 @@ class RiakManager(Manager):
         client.set_decoder('text/json', json.loads)
         return cls(
             client, bucket_prefix, load_bunch_size=load_bunch_size,
-            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions)
+            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions,
+            load_concurrency=load_concurrency, load_cache_size=load_cache_size,
+            load_cache_ttl=load_cache_ttl)
 
     def close_manager(self):
         self.client.close()
@@ -249,15 +261,18 @@ class RiakManager(Manager):
             riak_object = migrator(riak_object).get_riak_object()
             data_version = riak_object.get_data().get('$VERSION', None)
         riak_object.store()
+        self._uncache(modelobj)
         return modelobj
 
     def delete(self, modelobj):
         modelobj._riak_object.delete()
+        self._uncache(modelobj)
 
     def load(self, modelcls, key, result=None):
         riak_object = self.riak_object(modelcls, key, result)
-        if not result:
+        if not result and not self._load_cached(modelcls, riak_object):
             riak_object.reload()
+            self._cache_loaded(modelcls, riak_object)
         was_migrated = False
 
         # Run migrators until we have the correct version of the data.
@@ -276,6 +291,12 @@ class RiakManager(Manager):
         objs = (self.load(modelcls, key) for key in keys)
         return [obj for obj in objs if obj is not None]
 
+    def load_stream(self, modelcls, keys, callback, concurrency=None):
+        for key in keys:
+            obj = self.load(modelcls, key)
+            if obj is not None:
+                callback(obj)
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
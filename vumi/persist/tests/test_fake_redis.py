@@ -333,6 +333,35 @@ class FakeRedisTestMixin(object):
             redis, set(['1', '2']), 'sunion', 'set1', 'set2')
         yield self.assert_redis_op(redis, set(), 'sunion', 'other')
 
+    @inlineCallbacks
+    def test_pfadd(self):
+        redis = yield self.get_redis()
+        yield self.assert_redis_op(redis, 1, 'pfadd', 'hll', 'a', 'b')
+        yield self.assert_redis_op(redis, 0, 'pfadd', 'hll', 'a')
+        yield self.assert_redis_op(redis, 1, 'pfadd', 'hll', 'a', 'c')
+        yield self.assert_redis_op(redis, 0, 'pfadd', 'hll')
+        yield self.assert_redis_op(redis, 1, 'pfadd', 'empty')
+        yield self.assert_redis_op(redis, 'string', 'type', 'empty')
+
+    @inlineCallbacks
+    def test_pfcount(self):
+        redis = yield self.get_redis()
+        yield redis.pfadd('hll1', 'a', 'b', 'c')
+        yield redis.pfadd('hll2', 'c', 'd')
+        yield self.assert_redis_op(redis, 3, 'pfcount', 'hll1')
+        yield self.assert_redis_op(redis, 4, 'pfcount', 'hll1', 'hll2')
+        yield self.assert_redis_op(redis, 0, 'pfcount', 'other')
+
+    @inlineCallbacks
+    def test_pfmerge(self):
+        redis = yield self.get_redis()
+        yield redis.pfadd('hll1', 'a', 'b')
+        yield redis.pfadd('hll2', 'b', 'c')
+        yield self.assert_redis_op(redis, True, 'pfmerge', 'hll', 'hll1',
+                                   'hll2')
+        yield self.assert_redis_op(redis, 3, 'pfcount', 'hll')
+        yield self.assert_redis_op(redis, 2, 'pfcount', 'hll1')
+
     @inlineCallbacks
     def test_lpush(self):
         redis = yield self.get_redis()
@@ -4,10 +4,12 @@
 
 from datetime import datetime
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed)
 
 from vumi.persist.model import (
-    Model, Manager, ModelMigrator, ModelMigrationError, VumiRiakError)
+    Model, Manager, ModelMigrator, ModelMigrationError, VumiRiakError,
+    IndexPager, LoadCache)
 from vumi.persist.fields import (
     ValidationError, Integer, Unicode, VumiMessage, Dynamic, ListOf, SetOf,
     ForeignKey, ManyToMany, Timestamp)
@@ -521,6 +523,179 @@ class ModelTestMixin(object):
             objs.extend((yield obj_bunch))
         self.assertEqual(["one", "two"], sorted(obj.key for obj in objs))
 
+    @Manager.calls_manager
+    def test_load_stream(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+        yield simple_model("two", a=2, b=u'def').save()
+        yield simple_model("three", a=2, b=u'ghi').save()
+        tombstone = yield simple_model("tombstone", a=2, b=u'jkl').save()
+        yield tombstone.delete()
+
+        objs = []
+        yield simple_model.load_stream(
+            ['one', 'two', 'bad', 'tombstone'], objs.append)
+        self.assertEqual(["one", "two"], sorted(obj.key for obj in objs))
+
+    @Manager.calls_manager
+    def test_load_cache(self):
+        self.manager.load_cache = LoadCache(10)
+        self.patch(SimpleModel, 'CACHE_LOADS', True)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+
+        s1 = yield simple_model.load("one")
+        self.assertEqual(self.manager.load_cache.stats(), {
+            'size': 1, 'hits': 0, 'misses': 1, 'evictions': 0})
+        # Changes that aren't saved don't touch the cached copy.
+        s1.a = 2
+        s2 = yield simple_model.load("one")
+        self.assertEqual(self.manager.load_cache.stats(), {
+            'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+        self.assertEqual((s2.a, s2.b), (1, u'abc'))
+
+    @Manager.calls_manager
+    def test_load_cache_opt_in(self):
+        self.manager.load_cache = LoadCache(10)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+        yield simple_model.load("one")
+        yield simple_model.load("one")
+        self.assertEqual(self.manager.load_cache.stats(), {
+            'size': 0, 'hits': 0, 'misses': 0, 'evictions': 0})
+
+    @Manager.calls_manager
+    def test_load_cache_skips_missing_and_tombstones(self):
+        self.manager.load_cache = LoadCache(10)
+        self.patch(SimpleModel, 'CACHE_LOADS', True)
+        simple_model = self.manager.proxy(SimpleModel)
+        tombstone = yield simple_model("tombstone", a=1, b=u'abc').save()
+        yield tombstone.delete()
+
+        self.assertEqual((yield simple_model.load("missing")), None)
+        self.assertEqual((yield simple_model.load("tombstone")), None)
+        self.assertEqual(len(self.manager.load_cache), 0)
+
+    @Manager.calls_manager
+    def test_load_cache_invalidated_on_store(self):
+        self.manager.load_cache = LoadCache(10)
+        self.patch(SimpleModel, 'CACHE_LOADS', True)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+        yield simple_model.load("one")
+
+        yield simple_model("one", a=2, b=u'def').save()
+        self.assertEqual(len(self.manager.load_cache), 0)
+        s1 = yield simple_model.load("one")
+        self.assertEqual((s1.a, s1.b), (2, u'def'))
+
+    @Manager.calls_manager
+    def test_load_cache_invalidated_on_delete(self):
+        self.manager.load_cache = LoadCache(10)
+        self.patch(SimpleModel, 'CACHE_LOADS', True)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+        s1 = yield simple_model.load("one")
+
+        yield s1.delete()
+        self.assertEqual(len(self.manager.load_cache), 0)
+        self.assertEqual((yield simple_model.load("one")), None)
+
+    @Manager.calls_manager
+    def test_load_cache_keeps_vclock(self):
+        """
+        Objects loaded from the cache have the vclock of the stored object
+        so that saving them replaces it instead of creating a sibling.
+        """
+        self.manager.load_cache = LoadCache(10)
+        self.patch(SimpleModel, 'CACHE_LOADS', True)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+        s1 = yield simple_model.load("one")
+        s2 = yield simple_model.load("one")
+        self.assertEqual(self.manager.load_cache.hits, 1)
+        self.assertNotEqual(s2._riak_object.get_vclock(), None)
+        self.assertEqual(
+            s2._riak_object.get_vclock(), s1._riak_object.get_vclock())
+
+        s2.a = 2
+        yield s2.save()
+        self.manager.load_cache.clear()
+        s3 = yield simple_model.load("one")
+        self.assertEqual(s3.a, 2)
+
+    @Manager.calls_manager
+    def test_load_cache_writes_from_other_managers(self):
+        """
+        Writes through other managers aren't seen until the cached object
+        expires. Storing the stale object replaces the other write rather
+        than creating a sibling, and storing or deleting it invalidates the
+        cached copy.
+        """
+        now = [0]
+        self.manager.load_cache = LoadCache(
+            10, ttl=10, get_time=lambda: now[0])
+        self.patch(VersionedModel, 'CACHE_LOADS', True)
+        other_manager = type(self.manager)(
+            self.manager.client, self.manager.bucket_prefix)
+        old_model = self.manager.proxy(OldVersionedModel)
+        new_model = self.manager.proxy(VersionedModel)
+        other_model = other_manager.proxy(VersionedModel)
+        yield old_model("foo", b=1).save()
+        yield new_model.load("foo")
+
+        foo_other = yield other_model.load("foo")
+        foo_other.c = 2
+        yield foo_other.save()
+
+        # The cached copy is from before the other write and is migrated on
+        # load, as it was the first time.
+        foo = yield new_model.load("foo")
+        self.assertEqual(self.manager.load_cache.hits, 1)
+        self.assertEqual((foo.c, foo.was_migrated), (1, True))
+
+        foo.text = u"stale"
+        yield foo.save()
+        self.assertEqual(len(self.manager.load_cache), 0)
+        foo_other = yield other_model.load("foo")
+        self.assertEqual((foo_other.c, foo_other.text), (1, u"stale"))
+        self.assertEqual(foo_other.was_migrated, False)
+
+        # Once the cached copy expires, we see other writes again.
+        yield new_model.load("foo")
+        foo_other.c = 3
+        yield foo_other.save()
+        now[0] = 10
+        foo = yield new_model.load("foo")
+        self.assertEqual(foo.c, 3)
+
+        yield foo.delete()
+        self.assertEqual(len(self.manager.load_cache), 0)
+        self.assertEqual((yield other_model.load("foo")), None)
+        self.assertEqual((yield new_model.load("foo")), None)
+
+    @Manager.calls_manager
+    def test_load_cache_migration(self):
+        self.manager.load_cache = LoadCache(10)
+        self.patch(VersionedModel, 'CACHE_LOADS', True)
+        old_model = self.manager.proxy(OldVersionedModel)
+        new_model = self.manager.proxy(VersionedModel)
+        yield old_model("foo", b=1).save()
+
+        # The object is cached as it was stored, so it's migrated on every
+        # load until the migrated version is saved.
+        for _ in range(2):
+            foo_new = yield new_model.load("foo")
+            self.assertEqual(foo_new.c, 1)
+            self.assertEqual(foo_new.text, "hello")
+            self.assertEqual(foo_new.was_migrated, True)
+        self.assertEqual(self.manager.load_cache.hits, 1)
+
+        yield foo_new.save()
+        foo_new = yield new_model.load("foo")
+        self.assertEqual(foo_new.c, 1)
+        self.assertEqual(foo_new.was_migrated, False)
+
     @Manager.calls_manager
     def test_load_all_bunches_performance(self):
         """
@@ -730,6 +905,40 @@ class ModelTestMixin(object):
         no_keys = yield keys3.next_page()
         self.assertEqual(no_keys, None)
 
+    @Manager.calls_manager
+    def test_all_keys_pages(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo-1", a=5, b=u'1').save()
+        yield simple_model("foo-2", a=5, b=u'2').save()
+
+        keys = []
+        pager = simple_model.all_keys_pages(max_results=1)
+        while True:
+            page_keys = yield pager.next_results()
+            if page_keys is None:
+                break
+            keys.extend(page_keys)
+
+        keys = yield self.filter_tombstones(simple_model, keys)
+        self.assertEqual(sorted(keys), [u"foo-1", u"foo-2"])
+
+    @Manager.calls_manager
+    def test_index_keys_pages(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=1, b=u"one").save()
+        yield indexed_model("foo3", a=1, b=None).save()
+        yield indexed_model("foo4", a=1, b=None).save()
+
+        pager = indexed_model.index_keys_pages(
+            'a', 1, max_results=2, read_ahead=2)
+        keys1 = yield pager.next_page()
+        self.assertEqual(sorted(keys1), ["foo1", "foo2"])
+        self.assertEqual(sorted((yield pager.next_results())),
+                         ["foo3", "foo4"])
+        self.assertEqual((yield pager.next_results()), [])
+        self.assertEqual((yield pager.next_page()), None)
+
     @Manager.calls_manager
     def test_index_keys_page_explicit_continuation(self):
         indexed_model = self.manager.proxy(IndexedModel)
@@ -1525,6 +1734,161 @@ class ModelTestMixin(object):
         self.assertFalse("bar" in new.drop)
 
 
+class FakeIndexPage(object):
+    def __init__(self, pages, fetches=None):
+        self.results = pages[0]
+        self.pages = pages[1:]
+        self.fetches = fetches
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def has_next_page(self):
+        return bool(self.pages)
+
+    def next_page(self):
+        page = type(self)(self.pages, self.fetches)
+        if self.fetches is None:
+            return page
+        d = Deferred()
+        self.fetches.append((d, page))
+        return d
+
+
+class TestIndexPager(VumiTestCase):
+
+    def test_sync(self):
+        pager = IndexPager(FakeIndexPage([[1, 2], [3], [4, 5]]))
+        self.assertEqual(pager.next_results(), [1, 2])
+        self.assertEqual(list(pager.next_page()), [3])
+        self.assertEqual(pager.next_results(), [4, 5])
+        self.assertEqual(pager.next_results(), None)
+        self.assertEqual(pager.next_page(), None)
+
+    def test_async_read_ahead(self):
+        fetches = []
+        pager = IndexPager(succeed(FakeIndexPage([[1], [2], [3]], fetches)))
+        # The second page is fetched while we process the first.
+        self.assertEqual(pager.next_results(), [1])
+        [(d2, page2)] = fetches
+        d = pager.next_results()
+        self.assertNoResult(d)
+        d2.callback(page2)
+        self.assertEqual(self.successResultOf(d), [2])
+        [_, (d3, page3)] = fetches
+        d3.callback(page3)
+        self.assertEqual(pager.next_results(), [3])
+        self.assertEqual(pager.next_results(), None)
+
+    def test_async_read_ahead_bound(self):
+        fetches = []
+        pager = IndexPager(
+            succeed(FakeIndexPage([[1], [2], [3], [4]], fetches)),
+            read_ahead=2)
+        [(d2, page2)] = fetches
+        d2.callback(page2)
+        # We have two pages waiting, so we don't fetch any more.
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(pager.next_results(), [1])
+        [_, (d3, page3)] = fetches
+        d3.callback(page3)
+        self.assertEqual(pager.next_results(), [2])
+        self.assertEqual(len(fetches), 3)
+
+    def test_async_no_read_ahead(self):
+        fetches = []
+        pager = IndexPager(
+            succeed(FakeIndexPage([[1], [2]], fetches)), read_ahead=0)
+        self.assertEqual(pager.next_results(), [1])
+        self.assertEqual(fetches, [])
+        d = pager.next_results()
+        [(d2, page2)] = fetches
+        d2.callback(page2)
+        self.assertEqual(self.successResultOf(d), [2])
+        self.assertEqual(pager.next_results(), None)
+
+    def test_async_error(self):
+        fetches = []
+        pager = IndexPager(succeed(FakeIndexPage([[1], [2]], fetches)))
+        self.assertEqual(pager.next_results(), [1])
+        [(d2, page2)] = fetches
+        d2.errback(VumiRiakError("Riak is sad."))
+        self.failureResultOf(pager.next_results(), VumiRiakError)
+
+
+class TestLoadCache(VumiTestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = LoadCache(2, get_time=lambda: self.now)
+
+    def test_get_missing(self):
+        self.assertEqual(self.cache.get("bucket", "key"), None)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_put_and_get(self):
+        self.cache.put("bucket", "key", {"a": 1})
+        self.assertEqual(self.cache.get("bucket", "key"), {"a": 1})
+        self.assertEqual(self.cache.get("other", "key"), None)
+        self.assertEqual(self.cache.stats(), {
+            'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_copies(self):
+        state = {"a": [1]}
+        self.cache.put("bucket", "key", state)
+        state["a"].append(2)
+        cached = self.cache.get("bucket", "key")
+        self.assertEqual(cached, {"a": [1]})
+        cached["a"].append(3)
+        self.assertEqual(self.cache.get("bucket", "key"), {"a": [1]})
+
+    def test_lru_eviction(self):
+        self.cache.put("bucket", "one", 1)
+        self.cache.put("bucket", "two", 2)
+        self.cache.get("bucket", "one")
+        self.cache.put("bucket", "three", 3)
+        self.assertEqual(self.cache.get("bucket", "two"), None)
+        self.assertEqual(self.cache.get("bucket", "one"), 1)
+        self.assertEqual(self.cache.get("bucket", "three"), 3)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_lru_eviction_after_many_hits(self):
+        self.cache.put("bucket", "one", 1)
+        self.cache.put("bucket", "two", 2)
+        for _ in range(10):
+            self.cache.get("bucket", "two")
+            self.cache.get("bucket", "one")
+        self.assertTrue(len(self.cache._uses) <= 4)
+        self.cache.put("bucket", "three", 3)
+        self.assertEqual(self.cache.get("bucket", "two"), None)
+        self.assertEqual(self.cache.get("bucket", "one"), 1)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_ttl(self):
+        cache = LoadCache(2, ttl=10, get_time=lambda: self.now)
+        cache.put("bucket", "key", 1)
+        self.now += 9
+        self.assertEqual(cache.get("bucket", "key"), 1)
+        self.now += 1
+        self.assertEqual(cache.get("bucket", "key"), None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats(), {
+            'size': 0, 'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_invalidate(self):
+        self.cache.put("bucket", "key", 1)
+        self.cache.invalidate("bucket", "key")
+        self.cache.invalidate("bucket", "missing")
+        self.assertEqual(self.cache.get("bucket", "key"), None)
+
+    def test_clear(self):
+        self.cache.put("bucket", "one", 1)
+        self.cache.put("bucket", "two", 2)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
 class TestModelOnTxRiak(VumiTestCase, ModelTestMixin):
 
     @inlineCallbacks
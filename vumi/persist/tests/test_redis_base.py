@@ -1,9 +1,18 @@
 """Tests for vumi.persist.redis_base."""
 
+from vumi.persist.fake_redis import FakeRedis
 from vumi.persist.redis_base import Manager
 from vumi.tests.helpers import VumiTestCase
 
 
+class RecordingManager(Manager):
+    """A manager that records the redis calls made instead of making them.
+    """
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._client.append((call, args, kw))
+
+
 class TestBaseRedisManager(VumiTestCase):
     def mk_manager(self, key_prefix='test', client=None, config=None):
         if client is None:
@@ -33,3 +42,18 @@ class TestBaseRedisManager(VumiTestCase):
         self.assertEqual(sub_manager._key_prefix, "foo")
         self.assertEqual(sub_manager._client, manager._client)
         self.assertEqual(sub_manager._key_separator, manager._key_separator)
+
+    def test_eval_prefixes_keys(self):
+        calls = []
+        manager = RecordingManager(calls, config=None, key_prefix='test')
+        manager.eval("return 1", ["foo", "bar"], ["baz"])
+        self.assertEqual(calls, [
+            ("eval", ("return 1", ["test:foo", "test:bar"], ["baz"]), {}),
+        ])
+
+    def test_supports_scripting(self):
+        self.assertEqual(self.mk_manager().supports_scripting(), True)
+        fake_redis = FakeRedis(async=False)
+        self.add_cleanup(fake_redis.teardown)
+        manager = self.mk_manager(client=fake_redis)
+        self.assertEqual(manager.supports_scripting(), False)
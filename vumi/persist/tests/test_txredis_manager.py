@@ -107,6 +107,18 @@ class TestTxRedisManager(VumiTestCase):
         ttl = yield manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
 
+    @inlineCallbacks
+    def test_zadd_multiple(self):
+        manager = yield self.get_manager()
+        added = yield manager.zadd('zset', foo=1, bar=2)
+        self.assertEqual(added, 2)
+        added = yield manager.zadd('zset', bar=3, baz=4)
+        self.assertEqual(added, 1)
+        self.assertEqual(
+            (yield manager.zrange('zset', 0, -1, withscores=True)),
+            [('foo', 1), ('bar', 3), ('baz', 4)])
+        self.assertEqual((yield manager.zadd('zset')), 0)
+
     @skip_fake_redis
     @inlineCallbacks
     def test_reconnect_sub_managers(self):
@@ -1,6 +1,6 @@
 """Tests for vumi.persist.txriak_manager."""
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
 
 from vumi.persist.model import Manager
 from vumi.tests.helpers import VumiTestCase, import_skip
@@ -175,6 +175,47 @@ class CommonRiakManagerTests(object):
         result_data.sort(key=lambda d: d["a"])
         self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
 
+    @Manager.calls_manager
+    def test_load_stream(self):
+        yield self.manager.store(self.mkdummy("foo", {"a": 0}))
+        yield self.manager.store(self.mkdummy("bar", {"a": 1}))
+        yield self.manager.store(self.mkdummy("baz", {"a": 2}))
+        tombstone = yield self.manager.store(
+            self.mkdummy("tombstone", {"a": 3}))
+        yield self.manager.delete(tombstone)
+
+        keys = ["foo", "unknown", "bar", "tombstone", "baz"]
+
+        result_data = []
+        yield self.manager.load_stream(
+            DummyModel, keys, lambda obj: result_data.append(obj.get_data()),
+            concurrency=2)
+        result_data.sort(key=lambda d: d["a"])
+        self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
+
+    def test_load_concurrency_config(self):
+        manager_class = type(self.manager)
+        manager = manager_class.from_config({'bucket_prefix': 'test.'})
+        self.assertEqual(
+            manager.load_concurrency, manager_class.DEFAULT_LOAD_CONCURRENCY)
+        manager = manager_class.from_config({
+            'bucket_prefix': 'test.',
+            'load_concurrency': 3,
+            })
+        self.assertEqual(manager.load_concurrency, 3)
+
+    def test_load_cache_config(self):
+        manager_class = type(self.manager)
+        manager = manager_class.from_config({'bucket_prefix': 'test.'})
+        self.assertEqual(manager.load_cache, None)
+        manager = manager_class.from_config({
+            'bucket_prefix': 'test.',
+            'load_cache_size': 100,
+            'load_cache_ttl': 60,
+            })
+        self.assertEqual(manager.load_cache.max_size, 100)
+        self.assertEqual(manager.load_cache.ttl, 60)
+
     @Manager.calls_manager
     def test_run_riak_map_reduce(self):
         dummies = [self.mkdummy(str(i), {"a": i}) for i in range(4)]
@@ -323,3 +364,88 @@ class TestTxRiakManager(CommonRiakManagerTests, VumiTestCase):
             'bucket_prefix': 'test.',
             })
         self.assertEqual(manager.client.protocol, 'http')
+
+
+class TestTxRiakManagerLoadStream(VumiTestCase):
+    """Tests for TxRiakManager.load_stream() that don't need Riak.
+
+    The manager's load() is replaced so that we can control when each get
+    completes.
+    """
+
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import TxRiakManager
+        except ImportError, e:
+            import_skip(e, 'riak', 'riak')
+        self.manager = TxRiakManager(None, 'test.', load_concurrency=2)
+        self.loads = {}
+        self.manager.load = self.load
+
+    def load(self, modelcls, key):
+        self.loads[key] = d = Deferred()
+        return d
+
+    def finish_load(self, key, missing=False):
+        obj = None if missing else DummyModel(self.manager, key)
+        self.loads.pop(key).callback(obj)
+
+    def test_concurrency_limit(self):
+        loaded = []
+        d = self.manager.load_stream(
+            DummyModel, ["a", "b", "c", "d"],
+            lambda obj: loaded.append(obj.key))
+        self.assertEqual(sorted(self.loads), ["a", "b"])
+
+        self.finish_load("b")
+        self.assertEqual(loaded, ["b"])
+        self.assertEqual(sorted(self.loads), ["a", "c"])
+
+        self.finish_load("c", missing=True)
+        self.assertEqual(loaded, ["b"])
+        self.assertEqual(sorted(self.loads), ["a", "d"])
+
+        self.finish_load("d")
+        self.finish_load("a")
+        self.assertEqual(loaded, ["b", "d", "a"])
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_concurrency_override(self):
+        d = self.manager.load_stream(
+            DummyModel, ["a", "b", "c"], lambda obj: None, concurrency=3)
+        self.assertEqual(sorted(self.loads), ["a", "b", "c"])
+        for key in ["a", "b", "c"]:
+            self.finish_load(key)
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_callback_backpressure(self):
+        callback_ds = {}
+
+        def callback(obj):
+            callback_ds[obj.key] = d = Deferred()
+            return d
+
+        d = self.manager.load_stream(
+            DummyModel, ["a", "b", "c"], callback, concurrency=1)
+        self.finish_load("a")
+        # We don't fetch another key until the callback is done.
+        self.assertEqual(self.loads, {})
+        callback_ds.pop("a").callback(None)
+        self.assertEqual(self.loads.keys(), ["b"])
+        self.finish_load("b")
+        callback_ds.pop("b").callback(None)
+        self.finish_load("c")
+        self.assertNoResult(d)
+        callback_ds.pop("c").callback(None)
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_load_error(self):
+        d = self.manager.load_stream(
+            DummyModel, ["a", "b", "c", "d"], lambda obj: succeed(None))
+        self.loads.pop("a").errback(ValueError("Riak is sad"))
+        # The failed worker stops and the other one doesn't fetch any more
+        # keys once its current get is done.
+        self.assertEqual(self.loads.keys(), ["b"])
+        self.finish_load("b")
+        self.assertEqual(self.loads, {})
+        self.failureResultOf(d, ValueError)
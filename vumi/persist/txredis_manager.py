@@ -115,17 +115,18 @@ class VumiRedis(txr.Redis):
                                  "values and scores")
         pieces = zip(args[::2], args[1::2])
         pieces.extend(kwargs.iteritems())
-        orig_zadd = super(VumiRedis, self).zadd
-        d = succeed(0)
-
-        def do_zadd(s, key, member, score):
-            d = orig_zadd(key, member, score)
-            d.addCallback(lambda r: r + s)
-            return d
-
+        if not pieces:
+            return succeed(0)
+        # Add all the members with a single command. Our pieces are
+        # (member, score) pairs, but txredis.Redis.zadd() expects
+        # (score, member) pairs (except for a single pair, which it guesses
+        # the order of) and doesn't take members as keyword arguments, so we
+        # build the command ourselves.
+        command_args = []
         for member, score in pieces:
-            d.addCallback(do_zadd, key, member, score)
-        return d
+            command_args.extend([score, member])
+        self._send('ZADD', key, *command_args)
+        return self.getResponse()
 
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
@@ -182,6 +183,21 @@ class VumiRedis(txr.Redis):
         self._send('PERSIST', key)
         return self.getResponse()
 
+    # txredis doesn't implement these.
+    def pfadd(self, key, *values):
+        self._send('PFADD', key, *values)
+        return self.getResponse()
+
+    def pfcount(self, key, *keys):
+        self._send('PFCOUNT', key, *keys)
+        return self.getResponse()
+
+    def pfmerge(self, dst, *keys):
+        self._send('PFMERGE', dst, *keys)
+        d = self.getResponse()
+        d.addCallback(self._ok_to_true)
+        return d
+
     def type(self, key):
         d = self.get_type(key)
         # txredis turns 'none' into None, so we reverse that for consistency.
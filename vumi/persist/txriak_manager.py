@@ -115,6 +115,12 @@ class VumiTxRiakObject(object):
     def get_key(self):
         return self.key
 
+    def get_vclock(self):
+        return self._riak_obj.vclock
+
+    def set_vclock(self, vclock):
+        self._riak_obj.vclock = vclock
+
     def get_content_type(self):
         return self._riak_obj.content_type
 
@@ -188,6 +194,10 @@ class TxRiakManager(Manager):
             'load_bunch_size', cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop(
             'mapreduce_timeout', cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_concurrency = config.pop(
+            'load_concurrency', cls.DEFAULT_LOAD_CONCURRENCY)
+        load_cache_size = config.pop('load_cache_size', None)
+        load_cache_ttl = config.pop('load_cache_ttl', None)
         transport_type = config.pop('transport_type', 'http')
         store_versions = config.pop('store_versions', None)
 
@@ -217,7 +227,9 @@ class TxRiakManager(Manager):
         client.set_decoder('text/json', json.loads)
         return cls(
             client, bucket_prefix, load_bunch_size=load_bunch_size,
-            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions)
+            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions,
+            load_concurrency=load_concurrency, load_cache_size=load_cache_size,
+            load_cache_ttl=load_cache_ttl)
 
     def close_manager(self):
         return deferToThread(self.client.close)
@@ -261,20 +273,27 @@ class TxRiakManager(Manager):
                 modelcls, self, data_version, reverse=True)
             riak_object = migrator(riak_object).get_riak_object()
             data_version = riak_object.get_data().get('$VERSION', None)
+        # We invalidate the cache again once the store is done in case a
+        # load has cached the old version in the meantime.
+        self._uncache(modelobj)
         d = riak_object.store()
+        d.addCallback(lambda _: self._uncache(modelobj))
         d.addCallback(lambda _: modelobj)
         return d
 
     def delete(self, modelobj):
+        self._uncache(modelobj)
         d = modelobj._riak_object.delete()
+        d.addCallback(lambda _: self._uncache(modelobj))
         d.addCallback(lambda _: None)
         return d
 
     @inlineCallbacks
     def load(self, modelcls, key, result=None):
         riak_object = self.riak_object(modelcls, key, result)
-        if not result:
+        if not result and not self._load_cached(modelcls, riak_object):
             yield riak_object.reload()
+            self._cache_loaded(modelcls, riak_object)
         was_migrated = False
 
         # Run migrators until we have the correct version of the data.
@@ -294,6 +313,40 @@ class TxRiakManager(Manager):
         d.addCallback(lambda objs: [obj for obj in objs if obj is not None])
         return d
 
+    def load_stream(self, modelcls, keys, callback, concurrency=None):
+        """Load model instances with up to `concurrency` gets in flight at
+        once, passing each one to `callback` as it arrives.
+
+        If `callback` returns a deferred, the worker that loaded the
+        instance waits for it before fetching another key. The Riak client
+        uses one connection for each concurrent request, so this also
+        bounds the number of connections used. The gets run in the reactor
+        thread pool, which must be at least as large as `concurrency` for
+        them all to run at once.
+        """
+        keys_iter = iter(keys)
+        failed = []
+
+        @inlineCallbacks
+        def load_keys():
+            for key in keys_iter:
+                if failed:
+                    return
+                try:
+                    obj = yield self.load(modelcls, key)
+                    if obj is not None:
+                        yield callback(obj)
+                except Exception:
+                    failed.append(key)
+                    raise
+
+        concurrency = concurrency or self.load_concurrency
+        d = gatherResults(
+            [load_keys() for _ in range(concurrency)], consumeErrors=True)
+        d.addCallbacks(
+            lambda _: None, lambda f: f.value.subFailure)
+        return d
+
     def riak_map_reduce(self):
         mapreduce = RiakMapReduce(self.client)
         # Hack: We replace the two methods that hit the network with
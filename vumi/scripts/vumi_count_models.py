@@ -4,7 +4,7 @@
 import re
 import sys
 
-from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import react
 from twisted.python import usage
 
@@ -95,20 +95,18 @@ class ModelCounter(object):
         return len(keys)
 
     @inlineCallbacks
-    def count_pages(self, index_page, filter_regex):
+    def count_pages(self, pager, filter_regex):
         emit_progress = lambda t: self.emit(
             "%s object%s counted." % (t, "" if t == 1 else "s"))
         progress = ProgressEmitter(
             emit_progress, self.options["index-page-size"])
         counted = 0
-        while index_page is not None:
-            if index_page.has_next_page():
-                next_page_d = index_page.next_page()
-            else:
-                next_page_d = succeed(None)
-            counted += self.count_keys(list(index_page), filter_regex)
+        while True:
+            keys = yield pager.next_results()
+            if keys is None:
+                break
+            counted += self.count_keys(keys, filter_regex)
             progress.update(counted)
-            index_page = yield next_page_d
         self.emit("Done, %s object%s found." % (
             counted, "" if counted == 1 else "s"))
 
@@ -118,9 +116,9 @@ class ModelCounter(object):
         Perform an index query to get all keys and count them.
         """
         self.emit("Counting all keys ...")
-        index_page = yield self.model.all_keys_page(
+        pager = self.model.all_keys_pages(
             max_results=self.options["index-page-size"])
-        yield self.count_pages(index_page, filter_regex=None)
+        yield self.count_pages(pager, filter_regex=None)
 
     @inlineCallbacks
     def count_index_keys(self):
@@ -131,13 +129,13 @@ class ModelCounter(object):
         if filter_regex is not None:
             filter_regex = re.compile(filter_regex)
         self.emit("Counting ...")
-        index_page = yield self.model.index_keys_page(
+        pager = self.model.index_keys_pages(
             field_name=self.options["index-field"],
             value=self.options["index-value"],
             end_value=self.options["index-value-end"],
             max_results=self.options["index-page-size"],
             return_terms=True)
-        yield self.count_pages(index_page, filter_regex=filter_regex)
+        yield self.count_pages(pager, filter_regex=filter_regex)
 
     def run(self):
         if self.options["index-field"] is None:
@@ -8,6 +8,7 @@ from twisted.internet.task import react
 from twisted.python import usage
 
 from vumi.components.message_store import MessageStore
+from vumi.persist.model import IndexPager
 from vumi.persist.txriak_manager import TxRiakManager
 
 
@@ -54,12 +55,13 @@ class MessageLister(object):
         print s
 
     @inlineCallbacks
-    def list_pages(self, index_page):
-        while index_page is not None:
-            next_page_d = index_page.next_page()
-            for message_id, timestamp, addr in index_page:
+    def list_pages(self, pager):
+        while True:
+            results = yield pager.next_results()
+            if results is None:
+                break
+            for message_id, timestamp, addr in results:
                 self.emit(",".join([timestamp, addr, message_id]))
-            index_page = yield next_page_d
 
     @inlineCallbacks
     def run(self):
@@ -67,9 +69,9 @@ class MessageLister(object):
             "inbound": self.mdb.batch_inbound_keys_with_addresses,
             "outbound": self.mdb.batch_outbound_keys_with_addresses,
         }[self.options["direction"]]
-        index_page = yield index_func(
+        index_page_d = index_func(
             self.options["batch"], max_results=self.options["index-page-size"])
-        yield self.list_pages(index_page)
+        yield self.list_pages(IndexPager(index_page_d))
 
 
 def main(_reactor, name, *args):
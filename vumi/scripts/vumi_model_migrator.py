@@ -7,6 +7,7 @@ from twisted.internet.task import react
 from twisted.python import usage
 
 from vumi.utils import load_class_by_string
+from vumi.persist.model import IndexPager
 from vumi.persist.txriak_manager import TxRiakManager
 
 
@@ -127,16 +128,15 @@ class ModelMigrator(object):
             for _ in xrange(self.options["concurrent-migrations"])])
 
     @inlineCallbacks
-    def migrate_pages(self, index_page, emit_progress):
+    def migrate_pages(self, pager, emit_progress):
         dry_run = self.options["dry-run"]
         progress = ProgressEmitter(
             emit_progress, self.options["index-page-size"])
         processed = 0
-        while index_page is not None:
-            if index_page.has_next_page():
-                next_page_d = index_page.next_page()
-            else:
-                next_page_d = succeed(None)
+        while True:
+            index_page = yield pager.next_page()
+            if index_page is None:
+                break
             keys = list(index_page)
             yield self.migrate_page(keys, dry_run)
             processed += len(keys)
@@ -144,7 +144,6 @@ class ModelMigrator(object):
             continuation = getattr(index_page, 'continuation', None)
             if continuation is not None:
                 self.emit("Continuation token: '%s'" % (continuation,))
-            index_page = yield next_page_d
         self.emit("Done, %s object%s migrated." % (
             processed, "" if processed == 1 else "s"))
 
@@ -155,8 +154,9 @@ class ModelMigrator(object):
         self.emit("Migrating %d specified keys ..." % len(keys))
         emit_progress = lambda t: self.emit(
             "%s of %s objects migrated." % (t, len(keys)))
-        index_page = FakeIndexPage(keys, self.options["index-page-size"])
-        return self.migrate_pages(index_page, emit_progress)
+        pager = IndexPager(
+            FakeIndexPage(keys, self.options["index-page-size"]))
+        return self.migrate_pages(pager, emit_progress)
 
     @inlineCallbacks
     def migrate_all_keys(self, continuation=None):
@@ -169,10 +169,10 @@ class ModelMigrator(object):
         self.emit("Migrating ...")
         emit_progress = lambda t: self.emit(
             "%s object%s migrated." % (t, "" if t == 1 else "s"))
-        index_page = yield self.model.all_keys_page(
+        pager = self.model.all_keys_pages(
             max_results=self.options["index-page-size"],
             continuation=continuation)
-        yield self.migrate_pages(index_page, emit_progress)
+        yield self.migrate_pages(pager, emit_progress)
 
     def run(self):
         if self.options["keys"] is not None:
@@ -1,15 +1,19 @@
 # -*- test-case-name: vumi.tests.test_service -*-
 
 import json
+from collections import deque
 from copy import deepcopy
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredList, maybeDeferred,
+    gatherResults, succeed)
 from twisted.internet import protocol, reactor
 import txamqp
-from txamqp.client import TwistedDelegate
+from txamqp.client import TwistedDelegate, Closed
 from txamqp.content import Content
 from txamqp.protocol import AMQClient
 
@@ -40,7 +44,7 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
         self.options = worker.options
         self.config = worker.config
         self.spec = get_spec(vumi_resource_path(worker.options['specfile']))
-        self.delegate = TwistedDelegate()
+        self.delegate = WorkerAMQDelegate()
         self.worker = worker
         self.amqp_client = None
 
@@ -74,6 +78,43 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class WorkerAMQDelegate(TwistedDelegate):
+    """
+    Delegate that hands publisher confirms from the broker to the publisher
+    that owns the channel they arrive on.
+    """
+
+    def basic_ack(self, ch, msg):
+        self._handle_confirm(ch, msg, True)
+
+    def basic_nack(self, ch, msg):
+        self._handle_confirm(ch, msg, False)
+
+    def _handle_confirm(self, ch, msg, ack):
+        publisher = getattr(ch, 'confirming_publisher', None)
+        if publisher is None:
+            log.msg("Ignoring publisher confirm on %r without a confirming "
+                    "publisher." % (ch,))
+            return
+        publisher.handle_confirm(msg.delivery_tag, msg.multiple, ack)
+
+    def _fail_unconfirmed(self, ch, reason):
+        publisher = getattr(ch, 'confirming_publisher', None)
+        if publisher is not None:
+            if not isinstance(reason, (Failure, Exception)):
+                reason = Closed(reason)
+            publisher.fail_unconfirmed(reason)
+
+    def channel_close(self, ch, msg):
+        TwistedDelegate.channel_close(self, ch, msg)
+        self._fail_unconfirmed(ch, msg)
+
+    def close(self, reason):
+        for ch in self.client.channels.values():
+            self._fail_unconfirmed(ch, reason)
+        TwistedDelegate.close(self, reason)
+
+
 class WorkerAMQClient(AMQClient):
     @inlineCallbacks
     def connectionMade(self):
@@ -197,7 +238,8 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False, prefetch_count=None):
+                message_class=None, paused=False, prefetch_count=None,
+                max_in_flight=None):
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -211,6 +253,7 @@ class Worker(MultiService, object):
             'durable': durable,
             'start_paused': paused,
             'prefetch_count': prefetch_count,
+            'max_in_flight': max_in_flight or 1,
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
@@ -223,7 +266,7 @@ class Worker(MultiService, object):
 
     def publish_to(self, routing_key,
                    exchange_name='vumi', exchange_type='direct', durable=True,
-                   delivery_mode=2):
+                   delivery_mode=2, confirm=False, max_unconfirmed=None):
         class_name = self.routing_key_to_class_name(routing_key)
         publisher_class = type(
             "%sDynamicPublisher" % class_name, (Publisher,), {
@@ -232,6 +275,8 @@ class Worker(MultiService, object):
                 "exchange_type": exchange_type,
                 "durable": durable,
                 "delivery_mode": delivery_mode,
+                "confirm": confirm,
+                "max_unconfirmed": max_unconfirmed,
             })
         return self.start_publisher(publisher_class)
 
@@ -260,6 +305,9 @@ class Consumer(object):
     message_class = Message
     start_paused = False
     prefetch_count = None
+    # The maximum number of messages handled concurrently. If this is greater
+    # than one, messages may complete out of order and acks are batched.
+    max_in_flight = 1
 
     def __init__(self, channel):
         self.channel = channel
@@ -268,6 +316,12 @@ class Consumer(object):
         self._testing = hasattr(self.channel, 'message_processed')
         self.queue = None
         self._consumer_tag = None
+        self._slot_d = None
+        # Delivery tags in the order they arrived, each paired with `None`
+        # while the message is being handled and then `True` or `False`
+        # depending on whether it should be acked.
+        self._pending_acks = []
+        self._holding_unacked = False
 
     @inlineCallbacks
     def start(self):
@@ -288,12 +342,30 @@ class Consumer(object):
                 message = yield self.queue.get()
                 if isinstance(message, QueueCloseMarker):
                     break
+                if self.max_in_flight > 1:
+                    yield self._wait_for_slot()
+                    self._consume_concurrently(message)
+                    continue
                 if self.paused:
                     yield self._unpause_d
                 yield self.consume(message)
         except txamqp.queue.Closed as e:
             log.err("Queue has closed", e)
 
+    @inlineCallbacks
+    def _wait_for_slot(self):
+        while self.paused or self._in_progress >= self.max_in_flight:
+            if self.paused:
+                yield self._unpause_d
+            else:
+                self._slot_d = Deferred()
+                yield self._slot_d
+
+    def _release_slot(self):
+        d, self._slot_d = self._slot_d, None
+        if d is not None:
+            d.callback(None)
+
     @inlineCallbacks
     def _channel_consume(self):
         if self._consumer_tag is not None:
@@ -331,7 +403,7 @@ class Consumer(object):
                 self._notify_paused_and_quiet.pop(0).callback(None)
 
     @inlineCallbacks
-    def consume(self, message):
+    def _process_message(self, message):
         self._in_progress += 1
         try:
             result = yield self.consume_message(
@@ -343,6 +415,11 @@ class Consumer(object):
             self._in_progress -= 1
             if self._testing:
                 self.channel.message_processed()
+        returnValue(result)
+
+    @inlineCallbacks
+    def consume(self, message):
+        result = yield self._process_message(message)
         if result is not False:
             yield self.channel.basic_ack(message.delivery_tag, False)
         else:
@@ -350,6 +427,68 @@ class Consumer(object):
                     'Not acknowledging AMQ message' % result)
         self._check_notify()
 
+    def _consume_concurrently(self, message):
+        """
+        Handle a message without waiting for it to complete.
+
+        The message's ack is deferred until all messages delivered before it
+        have been handled, so that a single ack with `multiple=True` can cover
+        all of them.
+        """
+        entry = [message.delivery_tag, None]
+        self._pending_acks.append(entry)
+        d = self._process_message(message)
+        d.addCallbacks(
+            self._concurrent_message_handled, self._concurrent_message_failed,
+            callbackArgs=(entry,), errbackArgs=(entry,))
+        d.addCallback(lambda _: self._flush_acks())
+        d.addErrback(lambda f: log.err(f, "Error acking AMQ messages"))
+        d.addBoth(lambda _: self._check_notify())
+        return d
+
+    def _concurrent_message_handled(self, result, entry):
+        if result is False:
+            log.msg('Received %s as a return value consume_message. '
+                    'Not acknowledging AMQ message' % result)
+        entry[1] = result is not False
+        self._release_slot()
+
+    def _concurrent_message_failed(self, failure, entry):
+        # We don't ack messages we failed to handle, so they will be
+        # redelivered when the channel closes.
+        log.err(failure)
+        entry[1] = False
+        self._release_slot()
+
+    def _flush_acks(self):
+        """
+        Ack every handled message at the front of the pending list.
+
+        Messages we've chosen not to ack remain outstanding on the channel and
+        would be covered by any later `multiple=True` ack, so once we have one
+        of those we fall back to acking messages individually.
+        """
+        ack_ds = []
+        tags = []
+        while self._pending_acks and self._pending_acks[0][1] is not None:
+            delivery_tag, ack = self._pending_acks.pop(0)
+            if ack:
+                tags.append(delivery_tag)
+            else:
+                ack_ds.extend(self._ack_delivery_tags(tags))
+                tags = []
+                self._holding_unacked = True
+        ack_ds.extend(self._ack_delivery_tags(tags))
+        return gatherResults(ack_ds)
+
+    def _ack_delivery_tags(self, tags):
+        if not tags:
+            return []
+        if self._holding_unacked:
+            return [maybeDeferred(self.channel.basic_ack, tag, False)
+                    for tag in tags]
+        return [maybeDeferred(self.channel.basic_ack, tags[-1], True)]
+
     def consume_message(self, message):
         """helper method, override in implementation"""
         log.msg("Received message: %s" % message)
@@ -383,6 +522,13 @@ class RoutingKeyError(Exception):
         return repr(self.value)
 
 
+class PublishNackedError(VumiError):
+    """
+    Raised when the broker refuses to take responsibility for a message
+    published in confirm mode.
+    """
+
+
 class Publisher(object):
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -390,16 +536,38 @@ class Publisher(object):
     durable = False
     auto_delete = False
     delivery_mode = 2  # save to disk
+    # If set, the channel is put into confirm mode and publish deferreds only
+    # fire once the broker has acked the message. This needs a broker that
+    # supports the RabbitMQ publisher confirms extension.
+    confirm = False
+    # If set along with `confirm`, `wait_for_capacity()` waits until fewer
+    # than this many publishes are waiting for broker acks.
+    max_unconfirmed = None
 
     def start(self, channel):
         log.msg("Started the publisher")
         self.channel = channel
         self.bound_routing_keys = {}
+        # Deferreds for publishes the broker hasn't acked yet, keyed on the
+        # sequence number the broker will use as the delivery tag, and the
+        # pending tags in ascending order for acks that cover several.
+        self._unconfirmed = {}
+        self._unconfirmed_tags = deque()
+        self._next_delivery_tag = 1
+        self._capacity_waiters = []
 
         # There's probably a better way to do this.
         if not hasattr(self, 'vumi_options'):
             self.vumi_options = {}
 
+        if self.confirm:
+            channel.confirming_publisher = self
+            return channel.confirm_select()
+
+    @property
+    def unconfirmed(self):
+        return len(self._unconfirmed)
+
     def check_routing_key(self, routing_key):
         if(routing_key != routing_key.lower()):
             raise RoutingKeyError("The routing_key: %s is not all lower case!"
@@ -410,9 +578,42 @@ class Publisher(object):
         exchange_name = kwargs.get('exchange_name') or self.exchange_name
         routing_key = kwargs.get('routing_key') or self.routing_key
         self.check_routing_key(routing_key)
-        yield self.channel.basic_publish(exchange=exchange_name,
-                                         content=message,
-                                         routing_key=routing_key)
+        confirm_d = self._expect_confirm()
+        try:
+            yield self.channel.basic_publish(exchange=exchange_name,
+                                             content=message,
+                                             routing_key=routing_key)
+        except Exception:
+            if confirm_d is not None:
+                self._discard_confirm(confirm_d)
+            raise
+        if confirm_d is not None:
+            yield confirm_d
+
+    def _expect_confirm(self):
+        if not self.confirm:
+            return None
+        d = Deferred()
+        self._unconfirmed[self._next_delivery_tag] = d
+        self._unconfirmed_tags.append(self._next_delivery_tag)
+        self._next_delivery_tag += 1
+        return d
+
+    def _discard_confirm(self, confirm_d):
+        """
+        Forget a publish that never reached the broker. The broker didn't
+        give it a sequence number, so we give it back and move any later
+        publishes down one to keep our delivery tags in step.
+        """
+        [delivery_tag] = [tag for tag, d in self._unconfirmed.iteritems()
+                          if d is confirm_d]
+        del self._unconfirmed[delivery_tag]
+        self._unconfirmed = dict(
+            (tag - 1 if tag > delivery_tag else tag, d)
+            for tag, d in self._unconfirmed.iteritems())
+        self._unconfirmed_tags = deque(sorted(self._unconfirmed))
+        self._next_delivery_tag -= 1
+        self._check_capacity()
 
     def publish_message(self, message, **kwargs):
         d = self.publish_raw(message.to_json(), **kwargs)
@@ -424,11 +625,94 @@ class Publisher(object):
         return self.publish_raw(json.dumps(data, cls=json.JSONEncoder), **kw)
 
     def publish_raw(self, data, **kwargs):
+        """
+        Publish a raw message body.
+
+        Returns a deferred that fires once the message has been written to
+        the AMQP channel or, if :attr:`confirm` is set, once the broker has
+        acked it. A broker nack fails the deferred with
+        :class:`PublishNackedError`.
+        """
         amq_message = Content(data)
         amq_message['delivery mode'] = kwargs.pop(
             'delivery_mode', self.delivery_mode)
         return self.publish(amq_message, **kwargs)
 
+    def handle_confirm(self, delivery_tag, multiple, ack):
+        """
+        Fire the deferreds for publishes acked or nacked by the broker.
+        """
+        confirmed = []
+        tags = self._unconfirmed_tags
+        if multiple:
+            while tags and tags[0] <= delivery_tag:
+                tag = tags.popleft()
+                if tag in self._unconfirmed:
+                    confirmed.append(tag)
+        elif delivery_tag in self._unconfirmed:
+            confirmed.append(delivery_tag)
+        for tag in confirmed:
+            d = self._unconfirmed.pop(tag)
+            if ack:
+                d.callback(None)
+            else:
+                d.errback(PublishNackedError(
+                    "Broker nacked publish %s on %r." % (
+                        tag, self.routing_key)))
+        # Tags confirmed out of order are left in the queue until they reach
+        # the front.
+        while tags and tags[0] not in self._unconfirmed:
+            tags.popleft()
+        self._check_capacity()
+
+    def fail_unconfirmed(self, reason):
+        """
+        Fail all publishes still waiting for broker acks. This is called when
+        the connection is lost, since the acks will never arrive.
+        """
+        unconfirmed, self._unconfirmed = self._unconfirmed, {}
+        self._unconfirmed_tags = deque()
+        for tag in sorted(unconfirmed):
+            unconfirmed[tag].errback(reason)
+        self._check_capacity()
+
+    def flush(self):
+        """
+        Return a deferred that fires once all current publishes have been
+        acked or nacked by the broker.
+        """
+        # The individual publish deferreds report their own failures to
+        # whoever published them, so we don't want them here.
+        return DeferredList(
+            [self._unconfirmed[tag] for tag in sorted(self._unconfirmed)],
+            consumeErrors=False)
+
+    def _check_capacity(self):
+        if not self.is_saturated():
+            waiters, self._capacity_waiters = self._capacity_waiters, []
+            for d in waiters:
+                d.callback(None)
+
+    def is_saturated(self):
+        """
+        Check whether we have too many publishes waiting for broker acks.
+        """
+        if self.max_unconfirmed is None:
+            return False
+        return self.unconfirmed >= self.max_unconfirmed
+
+    def wait_for_capacity(self):
+        """
+        Return a deferred that fires when we have room for more unconfirmed
+        publishes. Bulk senders should wait on this to avoid publishing faster
+        than the broker can take responsibility for messages.
+        """
+        if not self.is_saturated():
+            return succeed(None)
+        d = Deferred()
+        self._capacity_waiters.append(d)
+        return d
+
 
 class WorkerCreator(object):
     """
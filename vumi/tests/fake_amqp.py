@@ -5,10 +5,9 @@ import re
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from txamqp.client import TwistedDelegate
 from txamqp.content import Content
 
-from vumi.service import WorkerAMQClient
+from vumi.service import WorkerAMQClient, WorkerAMQDelegate
 from vumi.message import Message as VumiMessage
 
 
@@ -93,6 +92,9 @@ class FakeAMQPBroker(object):
         self.channels = []
         self.dispatched = {}
         self._delivering = None
+        # If set, publishes on channels in confirm mode are acked during the
+        # next delivery run.
+        self.auto_confirm = True
 
     def _get_queue(self, queue):
         assert queue in self.queues
@@ -172,6 +174,8 @@ class FakeAMQPBroker(object):
         assert self._delivering is not None
 
         for channel in self.channels:
+            if self.auto_confirm:
+                channel.send_publisher_confirms()
             self.try_deliver_to_channel(channel)
 
         # Process the sentinel "message" we added in kick_delivery().
@@ -290,6 +294,10 @@ class FakeAMQPChannel(object):
         self.delegate = client.delegate
         self.unacked = []
         self._consumer_prefetch = {}
+        # Sequence numbers of publishes the broker hasn't confirmed yet, or
+        # `None` if the channel isn't in confirm mode.
+        self.unconfirmed_publishes = None
+        self._publish_seq = 0
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s>' % (self.channel_id,)
@@ -336,8 +344,33 @@ class FakeAMQPChannel(object):
         self._consumer_prefetch.pop(tag, None)
         return Message(mkMethod("cancel-ok", 31))
 
+    def confirm_select(self):
+        if self.unconfirmed_publishes is None:
+            self.unconfirmed_publishes = []
+        return Message(mkMethod("select-ok", 11))
+
     def basic_publish(self, exchange, routing_key, content):
-        return self.broker.basic_publish(exchange, routing_key, content)
+        resp = self.broker.basic_publish(exchange, routing_key, content)
+        if self.unconfirmed_publishes is not None:
+            self._publish_seq += 1
+            self.unconfirmed_publishes.append(self._publish_seq)
+            self.broker.kick_delivery()
+        return resp
+
+    def send_publisher_confirms(self, ack=True):
+        """
+        Ack (or nack) all unconfirmed publishes with a single confirm.
+        """
+        if not self.unconfirmed_publishes:
+            return
+        delivery_tag = self.unconfirmed_publishes[-1]
+        del self.unconfirmed_publishes[:]
+        fields = [('delivery_tag', delivery_tag), ('multiple', True)]
+        if ack:
+            self.delegate.basic_ack(self, Message(mkMethod("ack", 80), fields))
+        else:
+            self.delegate.basic_nack(
+                self, Message(mkMethod("nack", 120), fields))
 
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [dtag for dtag, _ctag, _queue in self.unacked]
@@ -474,7 +507,7 @@ class FakeAMQPQueue(object):
 
 class FakeAMQClient(WorkerAMQClient):
     def __init__(self, spec, vumi_options=None, broker=None):
-        WorkerAMQClient.__init__(self, TwistedDelegate(), '', spec)
+        WorkerAMQClient.__init__(self, WorkerAMQDelegate(), '', spec)
         if vumi_options is not None:
             self.vumi_options = vumi_options
         if broker is None:
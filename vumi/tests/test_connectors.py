@@ -31,14 +31,15 @@ class BaseConnectorTestCase(VumiTestCase):
 
     @inlineCallbacks
     def mk_connector(self, worker=None, connector_name=None,
-                     prefetch_count=None, middlewares=None, setup=False):
+                     prefetch_count=None, middlewares=None, setup=False,
+                     **kw):
         if worker is None:
             worker = yield self.worker_helper.get_worker(DummyWorker, {})
         if connector_name is None:
             connector_name = "dummy_connector"
         connector = self.connector_class(worker, connector_name,
                                          prefetch_count=prefetch_count,
-                                         middlewares=middlewares)
+                                         middlewares=middlewares, **kw)
         if setup:
             yield connector.setup()
         returnValue(connector)
@@ -101,6 +102,32 @@ class TestBaseConnector(BaseConnectorTestCase):
         conn, consumer = yield self.mk_consumer(prefetch_count=10)
         self.assertEqual(consumer.channel.qos_prefetch_count, 10)
 
+    @inlineCallbacks
+    def test_max_in_flight(self):
+        conn, consumer = yield self.mk_consumer(max_in_flight=5)
+        self.assertEqual(consumer.max_in_flight, 5)
+
+    @inlineCallbacks
+    def test_confirming_publisher(self):
+        conn = yield self.mk_connector(
+            connector_name='foo', publisher_confirms=True,
+            max_unconfirmed_publishes=1)
+        publisher = yield conn._setup_publisher('outbound')
+        self.assertEqual(publisher.confirm, True)
+        self.assertEqual(publisher.max_unconfirmed, 1)
+
+        msg = self.msg_helper.make_outbound("outbound")
+        conn._publish_message('outbound', msg, 'dummy_endpoint')
+        capacity_d = conn.wait_for_publish_capacity()
+        self.assertNoResult(capacity_d)
+        self.assertEqual(
+            self.worker_helper.get_dispatched_outbound('foo'), [msg])
+
+        # The fake broker acks the publish during its next delivery run.
+        yield conn.flush_publishers()
+        self.assertEqual(publisher.unconfirmed, 0)
+        yield capacity_d
+
     @inlineCallbacks
     def test_setup_raises(self):
         conn = yield self.mk_connector()
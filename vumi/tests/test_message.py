@@ -2,6 +2,7 @@ from datetime import datetime
 import json
 
 from vumi.tests.utils import RegexMatcher, UTCNearNow
+from vumi import message
 from vumi.message import (
     Message, TransportMessage, TransportEvent, TransportUserMessage,
     format_vumi_date, parse_vumi_date, from_json, to_json)
@@ -71,6 +72,62 @@ class ModuleUtilityTest(VumiTestCase):
             'foo': timestamp,
         })
 
+    def test_from_json_short_microseconds(self):
+        """
+        Timestamps with fewer than six microsecond digits are still parsed.
+        """
+        data = {
+            'foo': '2015-01-02 12:01:02.1',
+            'bar': '2015-01-02 12:01:02.13400',
+        }
+        self.assertEqual(from_json(json.dumps(data)), {
+            'foo': datetime(2015, 1, 2, 12, 01, 02, microsecond=100000),
+            'bar': datetime(2015, 1, 2, 12, 01, 02, microsecond=134000),
+        })
+
+    def assert_from_json_nested_vumi_dates(self):
+        timestamp = datetime(
+            2015, 1, 2, 12, 01, 02, microsecond=134002)
+        data = {
+            'foo': '2015-01-02 12:01:02.134002',
+            'bar': {'baz': ['2015-01-02 12:01:02.134002']},
+            'quux': [{'a': '2015-01-02 12:01:02'}],
+            'not_dates': ['2015-01-02 1', 'abcd-efghij klmnopq', 19, None],
+        }
+        self.assertEqual(from_json(json.dumps(data)), {
+            'foo': timestamp,
+            'bar': {'baz': ['2015-01-02 12:01:02.134002']},
+            'quux': [{'a': timestamp.replace(microsecond=0)}],
+            'not_dates': ['2015-01-02 1', 'abcd-efghij klmnopq', 19, None],
+        })
+
+    def test_from_json_nested_vumi_dates(self):
+        self.assert_from_json_nested_vumi_dates()
+
+    def test_from_json_nested_vumi_dates_stdlib_json(self):
+        """
+        We decode dates the same way when we don't have a faster JSON backend.
+        """
+        self.patch(message, 'ujson', None)
+        self.assert_from_json_nested_vumi_dates()
+
+    def test_from_json_nested_vumi_dates_ujson(self):
+        """
+        We decode dates the same way with the faster JSON backend, which
+        doesn't support object hooks.
+        """
+        loads_calls = []
+
+        class StubUJSON(object):
+            @staticmethod
+            def loads(json_string, precise_float=False):
+                loads_calls.append(precise_float)
+                return json.loads(json_string)
+
+        self.patch(message, 'ujson', StubUJSON)
+        self.assert_from_json_nested_vumi_dates()
+        self.assertEqual(loads_calls, [True])
+
 
 class MessageTest(VumiTestCase):
 
@@ -95,6 +152,72 @@ class MessageTest(VumiTestCase):
             "thing": "dont_store_me",
         })
 
+    def test_message_slots(self):
+        """
+        Messages don't carry a per-instance attribute dict.
+        """
+        self.assertFalse(hasattr(Message(a=5), '__dict__'))
+
+    def test_message_copy(self):
+        msg = Message(a=5, b={'c': [1, (2, 3)]})
+        msg_copy = msg.copy()
+        self.assertEqual(type(msg_copy), Message)
+        self.assertEqual(msg_copy.payload, {'a': 5, 'b': {'c': [1, [2, 3]]}})
+        msg_copy['b']['c'].append(4)
+        self.assertEqual(msg['b'], {'c': [1, (2, 3)]})
+
+    def test_message_copy_on_write_fields_shared(self):
+        """
+        A copy of a decoded message shares copy-on-write fields with the
+        original until either of them hands the field out.
+        """
+        msg = Message.from_json(to_json({
+            'helper_metadata': {'foo': {'bar': 1}},
+            'transport_metadata': {'baz': 2},
+        }))
+        msg_copy = msg.copy()
+        self.assertTrue(
+            msg_copy._payload['helper_metadata'] is
+            msg._payload['helper_metadata'])
+
+        msg_copy['helper_metadata']['foo']['bar'] = 3
+        self.assertEqual(msg['helper_metadata'], {'foo': {'bar': 1}})
+        self.assertEqual(msg_copy['helper_metadata'], {'foo': {'bar': 3}})
+
+        msg.payload['transport_metadata']['baz'] = 4
+        self.assertEqual(msg_copy['transport_metadata'], {'baz': 2})
+        self.assertEqual(msg['transport_metadata'], {'baz': 4})
+
+    def test_message_copy_on_write_fields_exposed(self):
+        """
+        Fields that have been handed out aren't shared with copies, because
+        something may still modify them.
+        """
+        msg = Message.from_json(to_json({'helper_metadata': {'foo': 1}}))
+        helper_metadata = msg['helper_metadata']
+        msg_copy = msg.copy()
+        helper_metadata['foo'] = 2
+        self.assertEqual(msg_copy['helper_metadata'], {'foo': 1})
+        self.assertEqual(msg['helper_metadata'], {'foo': 2})
+
+    def test_message_copy_on_write_fields_constructed(self):
+        """
+        Fields a message was constructed with aren't shared with copies,
+        because the caller may still modify them.
+        """
+        helper_metadata = {'foo': 1}
+        msg = Message(helper_metadata=helper_metadata)
+        msg_copy = msg.copy()
+        helper_metadata['foo'] = 2
+        self.assertEqual(msg_copy['helper_metadata'], {'foo': 1})
+
+    def test_message_copy_on_write_fields_set(self):
+        msg = Message.from_json(to_json({'helper_metadata': {'foo': 1}}))
+        msg_copy = msg.copy()
+        msg_copy['helper_metadata'] = {'foo': 2}
+        self.assertEqual(msg['helper_metadata'], {'foo': 1})
+        self.assertEqual(msg_copy['helper_metadata'], {'foo': 2})
+
 
 class TransportMessageTestMixin(object):
     def make_message(self, **fields):
@@ -129,6 +252,23 @@ class TransportMessageTestMixin(object):
         msg.routing_metadata['endpoint_name'] = 'foo'
         self.assertEqual('foo', msg.get_routing_endpoint())
 
+    def test_copy(self):
+        msg = self.make_message(helper_metadata={'foo': {'bar': 'baz'}})
+        msg_copy = msg.copy()
+        self.assertEqual(msg_copy, msg)
+        self.assertEqual(type(msg_copy), type(msg))
+        self.assertFalse(msg_copy.payload is msg.payload)
+        msg_copy['helper_metadata']['foo']['bar'] = 'quux'
+        self.assertEqual(msg['helper_metadata'], {'foo': {'bar': 'baz'}})
+
+    def test_copy_routing_metadata(self):
+        msg = self.make_message()
+        msg = type(msg).from_json(msg.to_json())
+        msg_copy = msg.copy()
+        msg_copy.set_routing_endpoint('foo')
+        self.assertEqual(msg.get_routing_endpoint(), 'default')
+        self.assertEqual(msg_copy.get_routing_endpoint(), 'foo')
+
     def test_set_routing_endpoint(self):
         msg = self.make_message()
         self.assertEqual({}, msg.routing_metadata)
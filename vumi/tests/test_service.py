@@ -1,11 +1,18 @@
 import json
 from collections import namedtuple
 
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, Deferred, returnValue
+from twisted.internet.error import ConnectionLost
+from twisted.internet.task import deferLater
+from twisted.test.proto_helpers import StringTransport
 
 from vumi.message import Message
-from vumi.service import Worker, WorkerCreator
+from vumi.service import (
+    Worker, WorkerCreator, RoutingKeyError, PublishNackedError)
+from vumi.tests.fake_amqp import Message as AMQMessage, mkMethod
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
+from vumi.tests.utils import LogCatcher
 
 
 def fake_amq_message(dictionary, delivery_tag='delivery_tag'):
@@ -90,6 +97,160 @@ class TestService(VumiTestCase):
         [failure] = self.flushLoggedErrors()
         self.assertEqual(failure.getErrorMessage(), "oops")
 
+    @inlineCallbacks
+    def start_concurrent_consumer(self, max_in_flight, prefetch_count=10):
+        """
+        Start a consumer that handles messages concurrently. Each handled
+        message is paired with a deferred that completes its handling.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        handled = []
+
+        def consume_func(msg):
+            d = Deferred()
+            handled.append((msg, d))
+            return d
+
+        consumer = yield worker.consume(
+            'test.routing.key', consume_func, prefetch_count=prefetch_count,
+            max_in_flight=max_in_flight)
+        acks = []
+        orig_basic_ack = consumer.channel.basic_ack
+
+        def basic_ack(delivery_tag, multiple):
+            acks.append((delivery_tag, multiple))
+            return orig_basic_ack(delivery_tag, multiple)
+
+        self.patch(consumer.channel, 'basic_ack', basic_ack)
+        returnValue((consumer, handled, acks))
+
+    def publish_msgs(self, count):
+        for i in range(count):
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": i}).content)
+
+    @inlineCallbacks
+    def wait_for_handled(self, handled, count):
+        while len(handled) < count:
+            yield deferLater(reactor, 0, lambda: None)
+        # Give the consumer a chance to start anything else it might start.
+        yield deferLater(reactor, 0, lambda: None)
+
+    def unacked_tags(self, consumer):
+        return [dtag for dtag, _ctag, _queue in consumer.channel.unacked]
+
+    @inlineCallbacks
+    def test_consume_concurrently(self):
+        """
+        A consumer with `max_in_flight` set handles up to that many messages
+        at once.
+        """
+        consumer, handled, acks = yield self.start_concurrent_consumer(3)
+        self.publish_msgs(5)
+        yield self.wait_for_handled(handled, 3)
+        self.assertEqual(
+            [msg['key'] for msg, _ in handled], [0, 1, 2])
+        self.assertEqual(consumer._in_progress, 3)
+
+        handled[0][1].callback(None)
+        yield self.wait_for_handled(handled, 4)
+        self.assertEqual(consumer._in_progress, 3)
+        for _, d in handled[1:]:
+            d.callback(None)
+        yield self.wait_for_handled(handled, 5)
+        handled[4][1].callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(consumer._in_progress, 0)
+        self.assertEqual(self.unacked_tags(consumer), [])
+
+    @inlineCallbacks
+    def test_consume_concurrently_batches_acks(self):
+        """
+        Acks are only sent for the contiguous run of completed messages at
+        the front of the delivery order, with a single `multiple` ack.
+        """
+        consumer, handled, acks = yield self.start_concurrent_consumer(4)
+        self.publish_msgs(4)
+        yield self.wait_for_handled(handled, 4)
+        tags = self.unacked_tags(consumer)
+
+        handled[1][1].callback(None)
+        handled[2][1].callback(None)
+        self.assertEqual(acks, [])
+        handled[0][1].callback(None)
+        self.assertEqual(acks, [(tags[2], True)])
+        self.assertEqual(self.unacked_tags(consumer), tags[3:])
+        handled[3][1].callback(None)
+        self.assertEqual(acks, [(tags[2], True), (tags[3], True)])
+        self.assertEqual(self.unacked_tags(consumer), [])
+
+    @inlineCallbacks
+    def test_consume_concurrently_not_acked(self):
+        """
+        If a message is not acked, later messages are acked individually so
+        that a `multiple` ack doesn't cover the unacked message.
+        """
+        consumer, handled, acks = yield self.start_concurrent_consumer(4)
+        self.publish_msgs(4)
+        yield self.wait_for_handled(handled, 4)
+        tags = self.unacked_tags(consumer)
+
+        handled[3][1].callback(None)
+        handled[2][1].callback(None)
+        handled[1][1].callback(False)
+        handled[0][1].callback(None)
+        self.assertEqual(acks, [
+            (tags[0], True), (tags[2], False), (tags[3], False)])
+        self.assertEqual(self.unacked_tags(consumer), [tags[1]])
+
+    @inlineCallbacks
+    def test_consume_concurrently_broken(self):
+        """
+        If a handler fails, its message is not acked but the consumer keeps
+        going.
+        """
+        consumer, handled, acks = yield self.start_concurrent_consumer(2)
+        self.publish_msgs(3)
+        yield self.wait_for_handled(handled, 2)
+        tags = self.unacked_tags(consumer)
+
+        handled[0][1].errback(Exception("oops"))
+        yield self.wait_for_handled(handled, 3)
+        handled[1][1].callback(None)
+        handled[2][1].callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(consumer._in_progress, 0)
+        self.assertEqual(acks, [(tags[1], False), (tags[2], False)])
+        [failure] = self.flushLoggedErrors()
+        self.assertEqual(failure.getErrorMessage(), "oops")
+
+    @inlineCallbacks
+    def test_consume_concurrently_paused_and_quiet(self):
+        """
+        Pausing a concurrent consumer waits for all in-flight messages and
+        stops new messages from being handled until we unpause.
+        """
+        consumer, handled, acks = yield self.start_concurrent_consumer(2)
+        self.publish_msgs(3)
+        yield self.wait_for_handled(handled, 2)
+
+        pause_d = consumer.pause()
+        self.assertNoResult(pause_d)
+        handled[0][1].callback(None)
+        self.assertNoResult(pause_d)
+        handled[1][1].callback(None)
+        yield pause_d
+        self.assertEqual(consumer._in_progress, 0)
+        yield deferLater(reactor, 0, lambda: None)
+        self.assertEqual(len(handled), 2)
+
+        consumer.unpause()
+        yield self.wait_for_handled(handled, 3)
+        handled[2][1].callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(self.unacked_tags(consumer), [])
+
     @inlineCallbacks
     def test_start_publisher(self):
         """The publisher should publish"""
@@ -103,6 +264,205 @@ class TestService(VumiTestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_publisher_unconfirmed(self):
+        """
+        Without publisher confirms, publishes are done once they have been
+        written to the channel.
+        """
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to('test.routing.key')
+        self.assertEqual(publisher.unconfirmed, 0)
+        self.assertFalse(publisher.is_saturated())
+        msg = yield publisher.publish_message(Message(key="value"))
+        self.assertEqual(msg, Message(key="value"))
+        self.assertEqual(publisher.unconfirmed, 0)
+        self.assertEqual(publisher.channel.unconfirmed_publishes, None)
+
+    @inlineCallbacks
+    def get_confirming_publisher(self, **kw):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to(
+            'test.routing.key', confirm=True, **kw)
+        publisher.channel.broker.auto_confirm = False
+        returnValue(publisher)
+
+    @inlineCallbacks
+    def test_confirming_publisher(self):
+        """
+        A publisher with `confirm` set puts its channel in confirm mode and
+        its publishes are only done once the broker has acked them.
+        """
+        publisher = yield self.get_confirming_publisher()
+        channel = publisher.channel
+        self.assertEqual(channel.unconfirmed_publishes, [])
+        d1 = publisher.publish_message(Message(key="value1"))
+        d2 = publisher.publish_message(Message(key="value2"))
+        self.assertEqual(
+            len(channel.broker.get_dispatched('vumi', 'test.routing.key')), 2)
+        self.assertEqual(publisher.unconfirmed, 2)
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+
+        channel.send_publisher_confirms()
+        self.assertEqual(publisher.unconfirmed, 0)
+        self.assertEqual(self.successResultOf(d1), Message(key="value1"))
+        self.assertEqual(self.successResultOf(d2), Message(key="value2"))
+
+    @inlineCallbacks
+    def test_confirming_publisher_broker_acks(self):
+        """
+        The fake broker acks publishes in confirm mode on its next delivery
+        run.
+        """
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        publisher = yield worker.publish_to('test.routing.key', confirm=True)
+        msg = yield publisher.publish_message(Message(key="value"))
+        self.assertEqual(msg, Message(key="value"))
+        self.assertEqual(publisher.unconfirmed, 0)
+
+    @inlineCallbacks
+    def test_confirming_publisher_single_ack(self):
+        """
+        A broker ack without `multiple` set only confirms the publish with
+        that delivery tag.
+        """
+        publisher = yield self.get_confirming_publisher()
+        d1 = publisher.publish_raw('{}')
+        d2 = publisher.publish_raw('{}')
+        d3 = publisher.publish_raw('{}')
+        channel = publisher.channel
+        channel.delegate.basic_ack(channel, AMQMessage(
+            mkMethod("ack", 80), [('delivery_tag', 2), ('multiple', False)]))
+        self.assertNoResult(d1)
+        self.successResultOf(d2)
+        self.assertNoResult(d3)
+        self.assertEqual(publisher.unconfirmed, 2)
+
+        channel.delegate.basic_ack(channel, AMQMessage(
+            mkMethod("ack", 80), [('delivery_tag', 3), ('multiple', True)]))
+        self.successResultOf(d1)
+        self.successResultOf(d3)
+        self.assertEqual(publisher.unconfirmed, 0)
+
+    @inlineCallbacks
+    def test_confirming_publisher_nack(self):
+        """
+        A broker nack fails the publishes it covers.
+        """
+        publisher = yield self.get_confirming_publisher()
+        d = publisher.publish_raw('{}')
+        publisher.channel.send_publisher_confirms(ack=False)
+        self.failureResultOf(d, PublishNackedError)
+        self.assertEqual(publisher.unconfirmed, 0)
+
+    @inlineCallbacks
+    def test_confirming_publisher_failure(self):
+        """
+        A publish that fails before reaching the broker doesn't use up a
+        delivery tag and is reported to its publisher only.
+        """
+        publisher = yield self.get_confirming_publisher()
+        bad_d = publisher.publish_raw('{}', routing_key='BAD.KEY')
+        good_d = publisher.publish_raw('{}')
+        self.failureResultOf(bad_d, RoutingKeyError)
+        self.assertEqual(publisher.unconfirmed, 1)
+        self.assertEqual(publisher.channel.unconfirmed_publishes, [1])
+        publisher.channel.send_publisher_confirms()
+        self.successResultOf(good_d)
+
+    @inlineCallbacks
+    def test_confirming_publisher_publish_error(self):
+        """
+        A publish that fails in the channel gives its delivery tag back, and
+        publishes made while it was in progress move down to fill the gap.
+        """
+        publisher = yield self.get_confirming_publisher()
+        channel = publisher.channel
+        orig_basic_publish = channel.basic_publish
+        publish_d = Deferred()
+        self.patch(channel, 'basic_publish', lambda **kw: publish_d)
+        d1 = publisher.publish_raw('{}')
+        self.patch(channel, 'basic_publish', orig_basic_publish)
+        d2 = publisher.publish_raw('{}')
+        publish_d.errback(ConnectionLost("Bye."))
+        self.failureResultOf(d1, ConnectionLost)
+        self.assertEqual(publisher.unconfirmed, 1)
+
+        d3 = publisher.publish_raw('{}')
+        channel.delegate.basic_ack(channel, AMQMessage(
+            mkMethod("ack", 80), [('delivery_tag', 1), ('multiple', False)]))
+        self.successResultOf(d2)
+        self.assertNoResult(d3)
+        channel.delegate.basic_ack(channel, AMQMessage(
+            mkMethod("ack", 80), [('delivery_tag', 2), ('multiple', False)]))
+        self.successResultOf(d3)
+        self.assertEqual(publisher.unconfirmed, 0)
+
+    @inlineCallbacks
+    def test_confirming_publisher_connection_lost(self):
+        """
+        Publishes waiting for broker acks fail when the connection is lost.
+        """
+        publisher = yield self.get_confirming_publisher(max_unconfirmed=1)
+        d = publisher.publish_raw('{}')
+        capacity_d = publisher.wait_for_capacity()
+        client = publisher.channel.client
+        client.transport = StringTransport()
+        client.close(ConnectionLost("Bye."))
+        self.failureResultOf(d, ConnectionLost)
+        self.assertEqual(publisher.unconfirmed, 0)
+        self.successResultOf(capacity_d)
+
+    @inlineCallbacks
+    def test_publisher_flush(self):
+        """
+        Flushing a publisher waits for its outstanding publishes to be acked
+        or nacked.
+        """
+        publisher = yield self.get_confirming_publisher()
+        d1 = publisher.publish_raw('{}')
+        d2 = publisher.publish_raw('{}')
+        flush_d = publisher.flush()
+        self.assertNoResult(flush_d)
+        publisher.channel.send_publisher_confirms(ack=False)
+        self.successResultOf(flush_d)
+        self.failureResultOf(d1, PublishNackedError)
+        self.failureResultOf(d2, PublishNackedError)
+
+    @inlineCallbacks
+    def test_publisher_wait_for_capacity(self):
+        """
+        When too many publishes are waiting for broker acks,
+        `wait_for_capacity()` waits for some of them to be acked.
+        """
+        publisher = yield self.get_confirming_publisher(max_unconfirmed=2)
+        yield publisher.wait_for_capacity()
+        publisher.publish_message(Message(key="value1"))
+        self.assertFalse(publisher.is_saturated())
+        publisher.publish_message(Message(key="value2"))
+        self.assertTrue(publisher.is_saturated())
+        capacity_d = publisher.wait_for_capacity()
+        self.assertNoResult(capacity_d)
+        publisher.channel.send_publisher_confirms()
+        self.assertFalse(publisher.is_saturated())
+        self.successResultOf(capacity_d)
+
+    @inlineCallbacks
+    def test_unexpected_publisher_confirm(self):
+        """
+        Confirms on a channel without a confirming publisher are ignored.
+        """
+        publisher = yield WorkerHelper.get_worker_raw(
+            Worker, {}).publish_to('test.routing.key')
+        channel = publisher.channel
+        lc = LogCatcher()
+        with lc:
+            channel.delegate.basic_ack(channel, Message(
+                delivery_tag=1, multiple=False))
+        [log_msg] = lc.messages()
+        self.assertTrue(log_msg.startswith("Ignoring publisher confirm"))
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
@@ -1,7 +1,7 @@
 import os.path
 
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed, fail
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web import http
@@ -11,7 +11,7 @@ from twisted.internet.protocol import Protocol, Factory
 from vumi.utils import (normalize_msisdn, vumi_resource_path, cleanup_msisdn,
                         get_operator_name, http_request, http_request_full,
                         get_first_word, redis_from_config, build_web_site,
-                        LogFilterSite, PkgResources)
+                        LogFilterSite, PkgResources, gather_results)
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.helpers import VumiTestCase, import_skip
 
@@ -96,6 +96,20 @@ class TestUtils(VumiTestCase):
         except ImportError, e:
             import_skip(e, 'redis')
 
+    def test_gather_results_sync(self):
+        self.assertEqual(gather_results(iter([1, 2, 3])), [1, 2, 3])
+
+    def test_gather_results_async(self):
+        d = Deferred()
+        result_d = gather_results([succeed(1), 2, d])
+        self.assertNoResult(result_d)
+        d.callback(3)
+        self.assertEqual(self.successResultOf(result_d), [1, 2, 3])
+
+    def test_gather_results_failure(self):
+        d = gather_results([succeed(1), fail(ValueError("bad"))])
+        self.failureResultOf(d, ValueError)
+
     def get_resource(self, path, site):
         request = DummyRequest(postpath=path.split('/'), prepath=[])
         return site.getResourceFor(request)
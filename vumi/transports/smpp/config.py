@@ -27,6 +27,17 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
         'How long (in seconds) to wait for the SMSC to return with a '
         '`submit_sm_resp`. Defaults to 24 hours.',
         default=(60 * 60 * 24), static=True)
+    submit_sm_window_size = ConfigInt(
+        'The maximum number of `submit_sm` PDUs waiting for a '
+        '`submit_sm_resp` on each bind. When the window is full, outbound '
+        'messages wait for a response before being sent, which holds back '
+        'the AMQP consumer. Sequence numbers are matched to messages in '
+        'memory, with Redis only used as a fallback. Defaults to 0, which '
+        'disables the window.', default=0, static=True)
+    submit_sm_window_timeout = ConfigInt(
+        'How long (in seconds) a `submit_sm` PDU may hold its slot in the '
+        'window while waiting for a `submit_sm_resp`. Defaults to 30.',
+        default=30, static=True)
     third_party_id_expiry = ConfigInt(
         'How long (in seconds) to keep 3rd party message IDs around to allow '
         'for matching submit_sm_resp and delivery report messages. Defaults '
@@ -100,6 +111,10 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
     registered_delivery = ConfigBool(
         'Whether or not to request delivery reports. Default True.',
         default=True, static=True)
+    smpp_bind_count = ConfigInt(
+        'How many concurrent binds to the SMSC to use. Outbound messages are '
+        'sent over the bind with the fewest unacknowledged `submit_sm` PDUs. '
+        'Default 1.', default=1, static=True)
     smpp_bind_timeout = ConfigInt(
         'How long (in seconds) to wait for a succesful bind. Default 30.',
         default=30, static=True)
@@ -115,6 +130,23 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
         'Defaults to 0 which means no throttling is applied. '
         '(NOTE: 1 Vumi message may result in multiple PDUs)',
         default=0, static=True, required=False)
+    mt_tps_smoothing = ConfigBool(
+        'If true, `mt_tps` is enforced by a token bucket that refills '
+        'continuously, spacing outbound messages evenly instead of sending '
+        'up to `mt_tps` messages at the start of each second. '
+        'Defaults to false.', default=False, static=True)
+    mt_tps_burst = ConfigInt(
+        'The number of outbound messages that may be sent back to back when '
+        '`mt_tps_smoothing` is enabled. Defaults to 1, which spaces all '
+        'messages evenly.', default=1, static=True)
+    mt_tps_shared_key = ConfigText(
+        'If set, the `mt_tps_smoothing` limit is shared through Redis by all '
+        'transports configured with the same key, e.g. several transports '
+        'bound to the same SMPP account. Their clocks should be in sync.',
+        default=None, static=True)
+    mt_tps_metrics_prefix = ConfigText(
+        'If set, throttling metrics are published with this prefix.',
+        default=None, static=True)
 
     # TODO: Deprecate these fields when confmodel#5 is done.
     host = ConfigText(
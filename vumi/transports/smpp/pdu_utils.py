@@ -1,4 +1,5 @@
 import binascii
+import struct
 
 from vumi.transports.smpp.smpp_utils import unpacked_pdu_opts
 
@@ -46,3 +47,50 @@ def chop_pdu_stream(data):
     pdu, data = (data[0:cmd_length],
                  data[cmd_length:])
     return pdu, data
+
+
+class PduStreamFramer(object):
+    """
+    Split a stream of bytes into SMPP PDUs.
+
+    Data is collected in a ``bytearray`` and PDUs are read from an offset
+    into it, so a burst of PDUs is framed in a single pass instead of
+    copying the rest of the stream for each PDU. The ``command_length`` of
+    each PDU is read in place and only the PDU itself is copied out of the
+    buffer.
+    """
+
+    HEADER_LENGTH = 16
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def feed(self, data):
+        """
+        Add data received from the wire.
+        """
+        if self._offset:
+            del self._buffer[:self._offset]
+            self._offset = 0
+        self._buffer.extend(data)
+
+    def next_pdu(self):
+        """
+        Return the next complete PDU, or ``None`` if we don't have one yet.
+        """
+        available = len(self._buffer) - self._offset
+        if available < self.HEADER_LENGTH:
+            return None
+        [command_length] = struct.unpack_from('!I', self._buffer, self._offset)
+        if command_length < self.HEADER_LENGTH:
+            raise ValueError(
+                'Invalid PDU command_length: %s' % (command_length,))
+        if available < command_length:
+            return None
+        start = self._offset
+        self._offset += command_length
+        return str(self._buffer[start:self._offset])
@@ -6,7 +6,8 @@ from twisted.internet import reactor
 from twisted.internet.protocol import Protocol, ClientFactory
 from twisted.internet.task import LoopingCall
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, maybeDeferred, DeferredQueue, succeed)
+    inlineCallbacks, returnValue, maybeDeferred, DeferredQueue, Deferred,
+    succeed)
 
 from smpp.pdu import unpack_pdu
 from smpp.pdu_builder import (
@@ -18,7 +19,7 @@ from smpp.pdu_builder import (
 
 from vumi import log
 from vumi.transports.smpp.pdu_utils import (
-    pdu_ok, seq_no, command_status, command_id, message_id, chop_pdu_stream)
+    pdu_ok, seq_no, command_status, command_id, message_id, PduStreamFramer)
 
 GSM_MAX_SMS_BYTES = 140
 GSM_MAX_SMS_7BIT_CHARS = 160
@@ -66,7 +67,7 @@ class EsmeTransceiver(Protocol):
         self.vumi_transport = vumi_transport
         self.config = self.vumi_transport.get_static_config()
 
-        self.buffer = b''
+        self.framer = PduStreamFramer()
         self.state = self.CLOSED_STATE
 
         self.deliver_sm_processor = self.vumi_transport.deliver_sm_processor
@@ -80,6 +81,15 @@ class EsmeTransceiver(Protocol):
             'Disconnecting, no response from SMSC for longer '
             'than %s seconds' % (self.idle_timeout,))
         self.unbind_resp_queue = DeferredQueue()
+        # Sequence numbers of submit_sm PDUs waiting for a response, mapped
+        # to the delayed call that frees their window slot if the response
+        # takes too long.
+        self.outstanding_submits = {}
+        # Vumi message ids for outstanding submit_sm PDUs, if the window is
+        # enabled. Otherwise these are only stored in Redis.
+        self.submit_sm_message_ids = {}
+        self._reserved_submits = 0
+        self._window_waiters = []
 
     def emit(self, msg):
         if self.noisy:
@@ -169,6 +179,12 @@ class EsmeTransceiver(Protocol):
             ``ConnectionDone``
         """
         self.state = self.CLOSED_STATE
+        for timeout_call in self.outstanding_submits.values():
+            if timeout_call is not None and timeout_call.active():
+                timeout_call.cancel()
+        self.outstanding_submits.clear()
+        self.submit_sm_message_ids.clear()
+        self._wake_window_waiters()
         if self.enquire_link_call.running:
             self.enquire_link_call.stop()
         if self.drop_link_call is not None and self.drop_link_call.active():
@@ -204,19 +220,11 @@ class EsmeTransceiver(Protocol):
         return self.transport.write(pdu.get_bin())
 
     def dataReceived(self, data):
-        self.buffer += data
-        data = self.handle_buffer()
-        while data is not None:
-            self.on_pdu(unpack_pdu(data))
-            data = self.handle_buffer()
-
-    def handle_buffer(self):
-        pdu_found = chop_pdu_stream(self.buffer)
-        if pdu_found is None:
-            return
-
-        data, self.buffer = pdu_found
-        return data
+        self.framer.feed(data)
+        pdu_data = self.framer.next_pdu()
+        while pdu_data is not None:
+            self.on_pdu(unpack_pdu(pdu_data))
+            pdu_data = self.framer.next_pdu()
 
     def on_pdu(self, pdu):
         """
@@ -278,7 +286,74 @@ class EsmeTransceiver(Protocol):
     def handle_unbind(self, pdu):
         return self.send_pdu(UnbindResp(seq_no(pdu)))
 
+    def window_enabled(self):
+        return self.config.submit_sm_window_size > 0
+
+    def window_full(self):
+        """
+        Returns ``True`` if we have as many ``submit_sm`` PDUs waiting for a
+        response as ``submit_sm_window_size`` allows.
+        """
+        if not self.window_enabled():
+            return False
+        in_flight = len(self.outstanding_submits) + self._reserved_submits
+        return in_flight >= self.config.submit_sm_window_size
+
+    @inlineCallbacks
+    def _reserve_window_slot(self):
+        while self.window_full():
+            d = Deferred()
+            self._window_waiters.append(d)
+            yield d
+            if not self.is_bound():
+                raise EsmeProtocolError(
+                    'Connection lost while waiting for the submit_sm window.')
+        self._reserved_submits += 1
+
+    def _wake_window_waiters(self, limit=None):
+        waiters = self._window_waiters[:limit]
+        del self._window_waiters[:limit]
+        for d in waiters:
+            d.callback(None)
+
+    def _track_submit_sm(self, sequence_number, vumi_message_id):
+        timeout_call = None
+        if self.window_enabled():
+            self.submit_sm_message_ids[sequence_number] = vumi_message_id
+            timeout_call = self.clock.callLater(
+                self.config.submit_sm_window_timeout,
+                self._submit_sm_timed_out, sequence_number)
+        self.outstanding_submits[sequence_number] = timeout_call
+
+    def _release_submit_sm(self, sequence_number):
+        timeout_call = self.outstanding_submits.pop(sequence_number, None)
+        if timeout_call is not None and timeout_call.active():
+            timeout_call.cancel()
+        self._wake_window_waiters(1)
+
+    def _submit_sm_timed_out(self, sequence_number):
+        log.warning(
+            'No submit_sm_resp received for sequence number %s after %s '
+            'seconds.' % (
+                sequence_number, self.config.submit_sm_window_timeout))
+        self.submit_sm_message_ids.pop(sequence_number, None)
+        self._release_submit_sm(sequence_number)
+
+    def get_submit_sm_message_id(self, sequence_number):
+        """
+        Return a deferred that fires with the vumi message id for the
+        ``submit_sm`` PDU with the given sequence number.
+
+        If we still have the message id in memory, we use that and forget
+        it. Otherwise we fall back to the copy in Redis.
+        """
+        if sequence_number in self.submit_sm_message_ids:
+            return succeed(self.submit_sm_message_ids.pop(sequence_number))
+        message_stash = self.vumi_transport.message_stash
+        return message_stash.get_sequence_number_message_id(sequence_number)
+
     def handle_submit_sm_resp(self, pdu):
+        self._release_submit_sm(seq_no(pdu))
         return self.on_submit_sm_resp(
             seq_no(pdu), message_id(pdu), command_status(pdu))
 
@@ -454,7 +529,14 @@ class EsmeTransceiver(Protocol):
             'registered_delivery': self.config.registered_delivery,
         }
         configured_param_values.update(configured_parameters)
-        sequence_number = yield self.sequence_generator.next()
+        yield self._reserve_window_slot()
+        try:
+            sequence_number = yield self.sequence_generator.next()
+        except:
+            self._reserved_submits -= 1
+            self._wake_window_waiters(1)
+            raise
+        self._reserved_submits -= 1
         pdu = SubmitSM(
             sequence_number=sequence_number,
             source_addr=source_addr,
@@ -475,8 +557,17 @@ class EsmeTransceiver(Protocol):
             for key, value in optional_parameters.items():
                 pdu.add_optional_parameter(key, value)
 
-        yield self.vumi_transport.message_stash.set_sequence_number_message_id(
-            sequence_number, vumi_message_id)
+        message_stash = self.vumi_transport.message_stash
+        if self.window_enabled():
+            # We keep the message id in memory for matching the response, so
+            # the durable copy in Redis doesn't need to hold up the PDU.
+            d = message_stash.set_sequence_number_message_id(
+                sequence_number, vumi_message_id)
+            d.addErrback(log.err)
+        else:
+            yield message_stash.set_sequence_number_message_id(
+                sequence_number, vumi_message_id)
+        self._track_submit_sm(sequence_number, vumi_message_id)
         self.send_pdu(pdu)
         returnValue([sequence_number])
 
@@ -3,9 +3,11 @@
 import warnings
 from uuid import uuid4
 
+from twisted.application.service import MultiService
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, maybeDeferred, returnValue, Deferred, succeed)
+    inlineCallbacks, maybeDeferred, returnValue, Deferred, DeferredList,
+    succeed)
 from twisted.internet.task import LoopingCall
 
 from vumi.reconnecting_client import ReconnectingClientService
@@ -19,9 +21,11 @@ from vumi.transports.smpp.deprecated.transport import (
 from vumi.transports.smpp.deprecated.utils import convert_to_new_config
 from vumi.transports.smpp.protocol import EsmeTransceiverFactory
 from vumi.transports.smpp.sequence import RedisSequence
+from vumi.transports.smpp.throttle import TokenBucket, RedisTokenBucket
 from vumi.transports.failures import FailureMessage
 
 from vumi.persist.txredis_manager import TxRedisManager
+from vumi.blinkenlights.metrics import MetricManager, Metric, Count
 
 from smpp.pdu_builder import BindTransceiver, BindReceiver, BindTransmitter
 
@@ -63,7 +67,7 @@ class SmppTransceiverProtocol(EsmeTransceiverFactory.protocol):
             address_range=config.address_range)
 
     def connectionLost(self, reason):
-        d = maybeDeferred(self.vumi_transport.pause_connectors)
+        d = maybeDeferred(self.vumi_transport.on_smpp_connection_lost, self)
         d.addCallback(
             lambda _: EsmeTransceiverFactory.protocol.connectionLost(
                 self, reason))
@@ -72,7 +76,7 @@ class SmppTransceiverProtocol(EsmeTransceiverFactory.protocol):
     def on_smpp_bind(self, sequence_number):
         d = maybeDeferred(EsmeTransceiverFactory.protocol.on_smpp_bind,
                           self, sequence_number)
-        d.addCallback(lambda _: self.vumi_transport.unpause_connectors())
+        d.addCallback(lambda _: self.vumi_transport.on_smpp_bound(self))
         return d
 
     def on_submit_sm_resp(self, sequence_number, smpp_message_id,
@@ -83,7 +87,7 @@ class SmppTransceiverProtocol(EsmeTransceiverFactory.protocol):
             'ESME_RMSGQFUL': self.vumi_transport.handle_submit_sm_throttled,
         }.get(command_status, self.vumi_transport.handle_submit_sm_failure)
         message_stash = self.vumi_transport.message_stash
-        d = message_stash.get_sequence_number_message_id(sequence_number)
+        d = self.get_submit_sm_message_id(sequence_number)
         d.addCallback(
             message_stash.set_remote_message_id, smpp_message_id)
         d.addCallback(
@@ -149,6 +153,38 @@ class SmppService(ReconnectingClientService):
         return ReconnectingClientService.stopService(self)
 
 
+class SmppServicePool(MultiService):
+    """
+    A pool of SMPP services, each managing its own bind to the SMSC.
+
+    This presents the same interface as :class:`SmppService`, so a transport
+    can use it in place of a single service.
+    """
+
+    def __init__(self, services):
+        MultiService.__init__(self)
+        for service in services:
+            service.setServiceParent(self)
+
+    def get_protocol(self):
+        """
+        Return a deferred that fires with the protocol of one of our
+        services, preferring a bound one.
+        """
+        services = list(self)
+        for service in services:
+            if service.is_bound():
+                return service.get_protocol()
+        d = DeferredList(
+            [service.get_protocol() for service in services],
+            fireOnOneCallback=True)
+        d.addCallback(lambda result: result[0])
+        return d
+
+    def is_bound(self):
+        return any(service.is_bound() for service in self)
+
+
 class SmppMessageDataStash(object):
     """
     Stash message data in Redis.
@@ -311,8 +347,8 @@ class SmppTransceiverTransport(Transport):
         default_prefix = '%s@%s' % (config.system_id,
                                     config.transport_name)
         redis_prefix = config.split_bind_prefix or default_prefix
-        self.redis = (yield TxRedisManager.from_config(
-            config.redis_manager)).sub_manager(redis_prefix)
+        redis = yield TxRedisManager.from_config(config.redis_manager)
+        self.redis = redis.sub_manager(redis_prefix)
 
         self.dr_processor = config.delivery_report_processor(
             self, config.delivery_report_processor_config)
@@ -327,32 +363,109 @@ class SmppTransceiverTransport(Transport):
         self._throttled_message_ids = []
         self._unthrottle_delayedCall = None
         self.factory = self.factory_class(self)
+        self.bound_protocols = []
+
+        self.metrics = None
+        if config.mt_tps_metrics_prefix is not None:
+            self.metrics = yield self.start_publisher(
+                MetricManager, config.mt_tps_metrics_prefix)
+            self.metrics.register(Count('mt_throttle.delayed'))
+            self.metrics.register(Metric('mt_throttle.delay'))
+            self.metrics.register(Count('mt_throttle.smsc_throttled'))
 
         self.service = self.start_service(self.factory)
 
         self.tps_counter = 0
         self.tps_limit = config.mt_tps
-        if config.mt_tps > 0:
+        self.mt_tps_lc = None
+        self.mt_rate_limiter = None
+        if config.mt_tps > 0 and config.mt_tps_smoothing:
+            self.mt_rate_limiter = self.make_mt_rate_limiter(redis)
+        elif config.mt_tps > 0:
             self.mt_tps_lc = LoopingCall(self.reset_mt_tps)
             self.mt_tps_lc.clock = self.clock
             self.mt_tps_lc.start(1, now=True)
-        else:
-            self.mt_tps_lc = None
 
     def start_service(self, factory):
         config = self.get_static_config()
-        service = self.service_class(config.twisted_endpoint, factory)
+        if config.smpp_bind_count > 1:
+            service = SmppServicePool([
+                self.service_class(config.twisted_endpoint, factory)
+                for _ in range(config.smpp_bind_count)])
+        else:
+            service = self.service_class(config.twisted_endpoint, factory)
         service.startService()
         return service
 
+    def on_smpp_bound(self, protocol):
+        """
+        Called by our protocols once they're bound. We can send messages, so
+        we unpause the connectors.
+        """
+        if protocol not in self.bound_protocols:
+            self.bound_protocols.append(protocol)
+        return self.unpause_connectors()
+
+    def on_smpp_connection_lost(self, protocol):
+        """
+        Called by our protocols when their connection is lost. We pause the
+        connectors unless another bind can carry on sending messages.
+        """
+        if protocol in self.bound_protocols:
+            self.bound_protocols.remove(protocol)
+        if not self.bound_protocols:
+            return self.pause_connectors()
+
+    def get_submit_protocol(self):
+        """
+        Return a deferred that fires with the protocol to send the next
+        message over.
+
+        If we have several binds, this is the one with the fewest
+        outstanding ``submit_sm`` PDUs.
+        """
+        if self.bound_protocols:
+            return succeed(min(
+                self.bound_protocols,
+                key=lambda protocol: len(protocol.outstanding_submits)))
+        return self.service.get_protocol()
+
     @inlineCallbacks
     def teardown_transport(self):
         if self.service:
             yield self.service.stopService()
         if self.mt_tps_lc and self.mt_tps_lc.running:
             self.mt_tps_lc.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
         yield self.redis._close()
 
+    def make_mt_rate_limiter(self, redis):
+        """
+        Build the rate limiter used when `mt_tps_smoothing` is enabled.
+
+        :param redis:
+            The Redis manager to share the limit through, if
+            `mt_tps_shared_key` is set. This isn't given our usual key
+            prefix, because the limit may be shared by transports with
+            different prefixes.
+        """
+        config = self.get_static_config()
+        if config.mt_tps_shared_key:
+            return RedisTokenBucket(
+                redis, config.mt_tps_shared_key, config.mt_tps,
+                burst=config.mt_tps_burst, clock=self.clock)
+        return TokenBucket(
+            config.mt_tps, burst=config.mt_tps_burst, clock=self.clock)
+
+    @inlineCallbacks
+    def wait_for_mt_token(self):
+        delay = yield self.mt_rate_limiter.acquire()
+        if self.metrics is not None:
+            self.metrics['mt_throttle.delay'].set(delay)
+            if delay > 0:
+                self.metrics['mt_throttle.delayed'].inc()
+
     def reset_mt_tps(self):
         if self.throttled and self.need_mt_throttling():
             if not self.service.is_bound():
@@ -395,9 +508,11 @@ class SmppTransceiverTransport(Transport):
 
     @inlineCallbacks
     def handle_outbound_message(self, message):
-        if self.bind_requires_throttling():
+        if self.mt_rate_limiter is not None:
+            yield self.wait_for_mt_token()
+        elif self.bind_requires_throttling():
             yield self.check_mt_throttling()
-        protocol = yield self.service.get_protocol()
+        protocol = yield self.get_submit_protocol()
         if not self._check_address_valid(message, 'to_addr'):
             yield self._reject_for_invalid_address(message, 'to_addr')
             return
@@ -467,6 +582,8 @@ class SmppTransceiverTransport(Transport):
     @inlineCallbacks
     def handle_submit_sm_throttled(self, message_id, smpp_message_id,
                                    command_status):
+        if self.metrics is not None:
+            self.metrics['mt_throttle.smsc_throttled'].inc()
         yield self.start_throttling()
         config = self.get_static_config()
         self._append_throttle_retry(message_id)
@@ -0,0 +1,78 @@
+from smpp.pdu import unpack_pdu
+from smpp.pdu_builder import DeliverSM, EnquireLink
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.smpp.pdu_utils import (
+    PduStreamFramer, command_id, seq_no)
+
+
+class TestPduStreamFramer(VumiTestCase):
+
+    def test_empty(self):
+        framer = PduStreamFramer()
+        self.assertEqual(framer.next_pdu(), None)
+        self.assertEqual(len(framer), 0)
+
+    def test_single_pdu(self):
+        framer = PduStreamFramer()
+        data = EnquireLink(sequence_number=5).get_bin()
+        framer.feed(data)
+        pdu_data = framer.next_pdu()
+        self.assertEqual(pdu_data, data)
+        self.assertEqual(seq_no(unpack_pdu(pdu_data)), 5)
+        self.assertEqual(framer.next_pdu(), None)
+        self.assertEqual(len(framer), 0)
+
+    def test_partial_header(self):
+        framer = PduStreamFramer()
+        data = EnquireLink(sequence_number=1).get_bin()
+        framer.feed(data[:3])
+        self.assertEqual(framer.next_pdu(), None)
+        framer.feed(data[3:])
+        self.assertEqual(framer.next_pdu(), data)
+
+    def test_partial_body(self):
+        framer = PduStreamFramer()
+        data = DeliverSM(sequence_number=1, short_message='foo').get_bin()
+        framer.feed(data[:20])
+        self.assertEqual(framer.next_pdu(), None)
+        self.assertEqual(len(framer), 20)
+        framer.feed(data[20:])
+        self.assertEqual(framer.next_pdu(), data)
+
+    def test_multiple_pdus(self):
+        framer = PduStreamFramer()
+        pdus = [
+            DeliverSM(sequence_number=1, short_message='foo').get_bin(),
+            EnquireLink(sequence_number=2).get_bin(),
+            DeliverSM(sequence_number=3, short_message='bar').get_bin(),
+        ]
+        data = ''.join(pdus)
+        framer.feed(data[:-1])
+        found = []
+        pdu_data = framer.next_pdu()
+        while pdu_data is not None:
+            found.append(unpack_pdu(pdu_data))
+            pdu_data = framer.next_pdu()
+        self.assertEqual(
+            [(1, 'deliver_sm'), (2, 'enquire_link')],
+            [(seq_no(pdu), command_id(pdu)) for pdu in found])
+
+        framer.feed(data[-1:])
+        self.assertEqual(framer.next_pdu(), pdus[2])
+        self.assertEqual(framer.next_pdu(), None)
+
+    def test_feed_while_pdu_held(self):
+        framer = PduStreamFramer()
+        data1 = EnquireLink(sequence_number=1).get_bin()
+        data2 = EnquireLink(sequence_number=2).get_bin()
+        framer.feed(data1)
+        pdu_data = framer.next_pdu()
+        framer.feed(data2)
+        self.assertEqual(pdu_data, data1)
+        self.assertEqual(framer.next_pdu(), data2)
+
+    def test_invalid_command_length(self):
+        framer = PduStreamFramer()
+        framer.feed('\x00\x00\x00\x08' + '\x00' * 12)
+        self.assertRaises(ValueError, framer.next_pdu)
@@ -8,10 +8,11 @@ from twisted.internet.task import Clock
 
 
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+from vumi.tests.utils import LogCatcher
 from vumi.transports.smpp.smpp_transport import SmppTransceiverTransport
 from vumi.transports.smpp.protocol import (
     EsmeTransceiver, EsmeTransceiverFactory,
-    EsmeTransmitterFactory, EsmeReceiverFactory)
+    EsmeTransmitterFactory, EsmeReceiverFactory, EsmeProtocolError)
 from vumi.transports.smpp.processors import DeliverShortMessageProcessor
 from vumi.transports.smpp.pdu_utils import (
     seq_no, command_status, command_id, chop_pdu_stream, short_message)
@@ -326,6 +327,93 @@ class EsmeTestCase(VumiTestCase):
         stored_ids = yield self.lookup_message_ids(protocol, seq_nums)
         self.assertEqual(['abc123'], stored_ids)
 
+    @inlineCallbacks
+    def test_submit_sm_outstanding(self):
+        transport, protocol = yield self.setup_bind()
+        [seq_num] = yield protocol.submit_sm(
+            'abc123', 'dest_addr', short_message='foo')
+        self.assertEqual(protocol.outstanding_submits, {seq_num: None})
+        # Without a window we only store the message id in Redis.
+        self.assertEqual(protocol.submit_sm_message_ids, {})
+
+        yield protocol.on_pdu(unpack_pdu(SubmitSMResp(
+            sequence_number=seq_num, message_id='foo').get_bin()))
+        self.assertEqual(protocol.outstanding_submits, {})
+
+    @inlineCallbacks
+    def test_submit_sm_window(self):
+        transport, protocol = yield self.setup_bind({
+            'submit_sm_window_size': 2,
+        })
+        seq_nums = yield protocol.submit_sm(
+            'abc1', 'dest_addr', short_message='foo')
+        seq_nums += yield protocol.submit_sm(
+            'abc2', 'dest_addr', short_message='foo')
+        self.assertTrue(protocol.window_full())
+        submit_d = protocol.submit_sm('abc3', 'dest_addr', short_message='foo')
+        yield wait_for_pdus(transport, 2)
+        self.assertNoResult(submit_d)
+
+        # A response frees a slot in the window.
+        yield protocol.on_pdu(unpack_pdu(SubmitSMResp(
+            sequence_number=seq_nums[0], message_id='foo').get_bin()))
+        seq_nums += yield submit_d
+        [submit_sm] = yield wait_for_pdus(transport, 1)
+        self.assertEqual(seq_no(submit_sm), seq_nums[2])
+        self.assertEqual(sorted(protocol.outstanding_submits), seq_nums[1:])
+
+    @inlineCallbacks
+    def test_submit_sm_window_message_ids(self):
+        transport, protocol = yield self.setup_bind({
+            'submit_sm_window_size': 2,
+        })
+        [seq_num] = yield protocol.submit_sm(
+            'abc123', 'dest_addr', short_message='foo')
+        self.assertEqual(protocol.submit_sm_message_ids, {seq_num: 'abc123'})
+        # The message id is looked up in memory and then forgotten.
+        self.assertEqual(
+            (yield protocol.get_submit_sm_message_id(seq_num)), 'abc123')
+        self.assertEqual(protocol.submit_sm_message_ids, {})
+        # Redis still has a copy to fall back to.
+        self.assertEqual(
+            (yield protocol.get_submit_sm_message_id(seq_num)), 'abc123')
+
+    @inlineCallbacks
+    def test_submit_sm_window_timeout(self):
+        transport, protocol = yield self.setup_bind({
+            'submit_sm_window_size': 1,
+            'submit_sm_window_timeout': 10,
+        })
+        [seq_num] = yield protocol.submit_sm(
+            'abc1', 'dest_addr', short_message='foo')
+        submit_d = protocol.submit_sm('abc2', 'dest_addr', short_message='foo')
+        yield wait_for_pdus(transport, 1)
+        self.assertNoResult(submit_d)
+
+        with LogCatcher(message='No submit_sm_resp') as lc:
+            self.clock.advance(10)
+        self.assertEqual(len(lc.messages()), 1)
+        yield submit_d
+        self.assertEqual(protocol.submit_sm_message_ids.values(), ['abc2'])
+        # A late response is matched using Redis.
+        self.assertEqual(
+            (yield protocol.get_submit_sm_message_id(seq_num)), 'abc1')
+
+    @inlineCallbacks
+    def test_submit_sm_window_connection_lost(self):
+        transport, protocol = yield self.setup_bind({
+            'submit_sm_window_size': 1,
+        })
+        yield protocol.submit_sm('abc1', 'dest_addr', short_message='foo')
+        submit_d = protocol.submit_sm('abc2', 'dest_addr', short_message='foo')
+        yield wait_for_pdus(transport, 1)
+        self.assertNoResult(submit_d)
+
+        protocol.connectionLost(ConnectionDone)
+        self.assertEqual(protocol.outstanding_submits, {})
+        self.assertEqual(protocol.submit_sm_message_ids, {})
+        self.failureResultOf(submit_d, EsmeProtocolError)
+
     @inlineCallbacks
     def test_submit_sm_configured_parameters(self):
         transport, protocol = yield self.setup_bind({
@@ -544,6 +632,23 @@ class EsmeTestCase(VumiTestCase):
         self.assertEqual(seq_no(handled_pdu), 1)
         self.assertEqual(short_message(handled_pdu), 'foo')
 
+    @inlineCallbacks
+    def test_multiple_pdus_data_received(self):
+        calls = []
+        self.patch(EsmeTransceiver, 'handle_deliver_sm',
+                   lambda p, pdu: calls.append(pdu))
+        transport, protocol = yield self.setup_bind()
+        data = ''.join(
+            DeliverSM(sequence_number=i, short_message='foo%s' % i).get_bin()
+            for i in range(1, 4))
+        # The last PDU is split across two chunks.
+        protocol.dataReceived(data[:-5])
+        self.assertEqual([1, 2], [seq_no(pdu) for pdu in calls])
+        protocol.dataReceived(data[-5:])
+        self.assertEqual([1, 2, 3], [seq_no(pdu) for pdu in calls])
+        self.assertEqual(
+            ['foo1', 'foo2', 'foo3'], [short_message(pdu) for pdu in calls])
+
     @inlineCallbacks
     def test_unsupported_command_id(self):
         calls = []
@@ -152,6 +152,24 @@ class SmppTransportTestCase(VumiTestCase):
         protocol = yield transport.service.get_protocol()
         returnValue(SMPPHelper(self.string_transport, transport, protocol))
 
+    def wait_for_mt_rate_limiter(self, transport):
+        """
+        Return a deferred that fires when the next outbound message asks the
+        transport's rate limiter for a token.
+        """
+        d = Deferred()
+        limiter = transport.mt_rate_limiter
+        orig_acquire = limiter.acquire
+
+        def acquire():
+            result = orig_acquire()
+            if not d.called:
+                d.callback(None)
+            return result
+
+        self.patch(limiter, 'acquire', acquire)
+        return d
+
 
 class SmppTransceiverTransportTestCase(SmppTransportTestCase):
 
@@ -1028,6 +1046,84 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         [submit_sm_pdu2] = yield smpp_helper.wait_for_pdus(1)
         self.assertEqual(short_message(submit_sm_pdu2), 'hello world 3')
 
+    @inlineCallbacks
+    def test_mt_sms_tps_smoothing(self):
+        smpp_helper = yield self.get_smpp_helper(config={
+            'mt_tps': 4,
+            'mt_tps_smoothing': True,
+        })
+        transport = smpp_helper.transport
+        self.assertEqual(transport.mt_tps_lc, None)
+
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        limiter_d = self.wait_for_mt_rate_limiter(transport)
+        msg2_d = self.tx_helper.make_dispatch_outbound('hello world 2')
+        yield limiter_d
+        [submit_sm_pdu1] = yield smpp_helper.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm_pdu1), 'hello world 1')
+        self.assertNoResult(msg2_d)
+        # We don't pause the connectors, we just space the messages out.
+        self.assertFalse(transport.throttled)
+
+        self.clock.advance(0.25)
+        yield msg2_d
+        [submit_sm_pdu2] = yield smpp_helper.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm_pdu2), 'hello world 2')
+
+    @inlineCallbacks
+    def test_mt_sms_tps_smoothing_shared(self):
+        config = {
+            'mt_tps': 4,
+            'mt_tps_smoothing': True,
+            'mt_tps_shared_key': 'account',
+        }
+        smpp_helper = yield self.get_smpp_helper(config=config)
+        # Someone else sharing our limit has used this slot's token.
+        limiter = smpp_helper.transport.mt_rate_limiter
+        yield limiter.acquire()
+
+        limiter_d = self.wait_for_mt_rate_limiter(smpp_helper.transport)
+        msg_d = self.tx_helper.make_dispatch_outbound('hello world')
+        yield limiter_d
+        # Wait for the Redis call to tell us we have to wait.
+        yield limiter.redis.get('ping')
+        self.assertNoResult(msg_d)
+        self.clock.advance(0.25)
+        yield msg_d
+        [submit_sm_pdu] = yield smpp_helper.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm_pdu), 'hello world')
+
+    @inlineCallbacks
+    def test_mt_sms_tps_smoothing_metrics(self):
+        smpp_helper = yield self.get_smpp_helper(config={
+            'mt_tps': 4,
+            'mt_tps_smoothing': True,
+            'mt_tps_metrics_prefix': 'smpp.',
+        })
+        transport = smpp_helper.transport
+
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        limiter_d = self.wait_for_mt_rate_limiter(transport)
+        msg2_d = self.tx_helper.make_dispatch_outbound('hello world 2')
+        yield limiter_d
+        self.clock.advance(0.25)
+        yield msg2_d
+        [submit_sm_pdu1, _] = yield smpp_helper.wait_for_pdus(2)
+        yield smpp_helper.handle_pdu(
+            SubmitSMResp(sequence_number=seq_no(submit_sm_pdu1),
+                         message_id='foo',
+                         command_status='ESME_RTHROTTLED'))
+
+        transport.metrics.publish_metrics()
+        [datapoints] = self.tx_helper.get_dispatched_metrics()
+        values = dict((name, [v for _, v in points])
+                      for name, _, points in datapoints)
+        self.assertEqual(values, {
+            'smpp.mt_throttle.delay': [0, 0.25],
+            'smpp.mt_throttle.delayed': [1],
+            'smpp.mt_throttle.smsc_throttled': [1],
+        })
+
     @inlineCallbacks
     def test_mt_sms_queue_full(self):
         smpp_helper = yield self.get_smpp_helper()
@@ -1442,6 +1538,103 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         self.assertEqual(short_message(submit_sm1), 'hello world 0')
         self.assertEqual(short_message(submit_sm2), 'hello world 1')
 
+    @inlineCallbacks
+    def test_mt_sms_submit_sm_window(self):
+        smpp_helper = yield self.get_smpp_helper(config={
+            'submit_sm_window_size': 1,
+        })
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        msg2_d = self.tx_helper.make_dispatch_outbound('hello world 2')
+        [submit_sm1] = yield smpp_helper.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm1), 'hello world 1')
+        # The window is full, so the second message waits.
+        self.assertNoResult(msg2_d)
+
+        yield smpp_helper.handle_pdu(
+            SubmitSMResp(sequence_number=seq_no(submit_sm1),
+                         message_id='foo'))
+        [event] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(event['event_type'], 'ack')
+        self.assertEqual(event['sent_message_id'], 'foo')
+
+        yield msg2_d
+        [submit_sm2] = yield smpp_helper.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm2), 'hello world 2')
+
+    @inlineCallbacks
+    def bind_pool(self, transport):
+        """
+        Connect and bind each service in a multi-bind transport's pool, each
+        over its own string transport.
+        """
+        helpers = []
+        for service in transport.service:
+            string_transport = proto_helpers.StringTransport()
+            service.protocol.makeConnection(string_transport)
+            yield bind_protocol(string_transport, service.protocol)
+            helpers.append(SMPPHelper(
+                string_transport, transport, service.protocol))
+        returnValue(helpers)
+
+    @inlineCallbacks
+    def test_multi_bind(self):
+        transport = yield self.get_transport(
+            bind=False, config={'smpp_bind_count': 2})
+        connector = transport.connectors[transport.transport_name]
+        self.assertEqual(len(list(transport.service)), 2)
+        self.assertTrue(connector._consumers['outbound'].paused)
+
+        [helper1, helper2] = yield self.bind_pool(transport)
+        self.assertFalse(connector._consumers['outbound'].paused)
+        self.assertEqual(
+            transport.bound_protocols, [helper1.protocol, helper2.protocol])
+
+    @inlineCallbacks
+    def test_multi_bind_least_loaded(self):
+        transport = yield self.get_transport(
+            bind=False, config={'smpp_bind_count': 2})
+        [helper1, helper2] = yield self.bind_pool(transport)
+
+        yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        yield self.tx_helper.make_dispatch_outbound('hello world 2')
+        [submit_sm1] = yield helper1.wait_for_pdus(1)
+        [submit_sm2] = yield helper2.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm1), 'hello world 1')
+        self.assertEqual(short_message(submit_sm2), 'hello world 2')
+
+        # The second bind is now less loaded, so it gets the next message.
+        yield helper2.handle_pdu(
+            SubmitSMResp(sequence_number=seq_no(submit_sm2),
+                         message_id='foo'))
+        yield self.tx_helper.make_dispatch_outbound('hello world 3')
+        [submit_sm3] = yield helper2.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm3), 'hello world 3')
+        self.assertTrue(helper1.no_pdus())
+
+        [event] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(event['event_type'], 'ack')
+        self.assertEqual(event['sent_message_id'], 'foo')
+
+    @inlineCallbacks
+    def test_multi_bind_connection_lost(self):
+        transport = yield self.get_transport(
+            bind=False, config={'smpp_bind_count': 2})
+        connector = transport.connectors[transport.transport_name]
+        [helper1, helper2] = yield self.bind_pool(transport)
+        [service1, service2] = list(transport.service)
+
+        # We can still send messages over the other bind.
+        service1.stopService()
+        self.assertFalse(connector._consumers['outbound'].paused)
+        self.assertEqual(transport.bound_protocols, [helper2.protocol])
+        yield self.tx_helper.make_dispatch_outbound('hello world')
+        [submit_sm] = yield helper2.wait_for_pdus(1)
+        self.assertEqual(short_message(submit_sm), 'hello world')
+
+        service2.stopService()
+        self.assertTrue(connector._consumers['outbound'].paused)
+        self.assertEqual(transport.bound_protocols, [])
+
 
 class SmppTransmitterTransportTestCase(SmppTransceiverTransportTestCase):
     transport_class = SmppTransmitterTransport
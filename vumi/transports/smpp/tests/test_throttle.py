@@ -0,0 +1,106 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+from vumi.transports.smpp.throttle import TokenBucket, RedisTokenBucket
+
+
+class TestTokenBucket(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+
+    def test_first_token_immediate(self):
+        bucket = TokenBucket(10, clock=self.clock)
+        self.assertEqual(self.successResultOf(bucket.acquire()), 0)
+
+    def test_tokens_spaced_evenly(self):
+        bucket = TokenBucket(4, clock=self.clock)
+        ds = [bucket.acquire() for _ in range(3)]
+        self.assertEqual(self.successResultOf(ds[0]), 0)
+        self.assertNoResult(ds[1])
+        self.assertNoResult(ds[2])
+
+        self.clock.advance(0.25)
+        self.assertEqual(self.successResultOf(ds[1]), 0.25)
+        self.assertNoResult(ds[2])
+
+        self.clock.advance(0.25)
+        self.assertEqual(self.successResultOf(ds[2]), 0.5)
+
+    def test_refill(self):
+        bucket = TokenBucket(4, clock=self.clock)
+        self.successResultOf(bucket.acquire())
+        self.clock.advance(0.3)
+        self.assertEqual(self.successResultOf(bucket.acquire()), 0)
+        d = bucket.acquire()
+        self.assertNoResult(d)
+        self.clock.advance(0.25)
+        self.assertAlmostEqual(self.successResultOf(d), 0.25)
+
+    def test_burst(self):
+        bucket = TokenBucket(4, burst=3, clock=self.clock)
+        for _ in range(3):
+            self.assertEqual(self.successResultOf(bucket.acquire()), 0)
+        d = bucket.acquire()
+        self.assertNoResult(d)
+        self.clock.advance(0.25)
+        self.assertEqual(self.successResultOf(d), 0.25)
+
+        # Idle time only refills up to the burst size.
+        self.clock.advance(10)
+        for _ in range(3):
+            self.assertEqual(self.successResultOf(bucket.acquire()), 0)
+        self.assertNoResult(bucket.acquire())
+
+
+class TestRedisTokenBucket(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.clock.advance(1000)
+
+    def mk_bucket(self, rate, **kw):
+        return RedisTokenBucket(self.redis, 'account', rate, clock=self.clock,
+                                **kw)
+
+    @inlineCallbacks
+    def test_first_token_immediate(self):
+        bucket = self.mk_bucket(10)
+        self.assertEqual((yield bucket.acquire()), 0)
+
+    @inlineCallbacks
+    def test_slot_full(self):
+        bucket = self.mk_bucket(4)
+        self.assertEqual((yield bucket.acquire()), 0)
+        d = bucket.acquire()
+        # Wait for the Redis call to tell us we have to wait.
+        yield self.redis.get('ping')
+        self.assertNoResult(d)
+        self.clock.advance(0.25)
+        self.assertEqual((yield d), 0.25)
+
+    @inlineCallbacks
+    def test_shared(self):
+        bucket1 = self.mk_bucket(4, burst=2)
+        bucket2 = self.mk_bucket(4, burst=2)
+        self.assertEqual((yield bucket1.acquire()), 0)
+        self.assertEqual((yield bucket2.acquire()), 0)
+        d = bucket1.acquire()
+        yield self.redis.get('ping')
+        self.assertNoResult(d)
+        self.clock.advance(0.5)
+        self.assertEqual((yield d), 0.5)
+
+    @inlineCallbacks
+    def test_slot_keys_expire(self):
+        bucket = self.mk_bucket(4)
+        yield bucket.acquire()
+        [key] = yield self.redis.keys()
+        self.assertEqual(key, bucket.slot_key(4000))
+        ttl = yield self.redis.ttl(key)
+        self.assertTrue(0 < ttl <= 2)
@@ -0,0 +1,91 @@
+# -*- test-case-name: vumi.transports.smpp.tests.test_throttle -*-
+import math
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.internet.task import deferLater
+
+
+class TokenBucket(object):
+
+    """
+    Limit the rate of some operation to `rate` per second, allowing bursts
+    of up to `burst` operations.
+
+    Tokens are refilled continuously rather than once a second, so with the
+    default `burst` of 1 operations are spaced evenly `1 / rate` seconds
+    apart.
+
+    This is implemented as a virtual scheduling algorithm (GCRA). Each call
+    to :meth:`acquire` reserves the next free slot, so concurrent callers
+    are released in the order they asked.
+    """
+
+    def __init__(self, rate, burst=1, clock=reactor):
+        self.interval = 1.0 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.clock = clock
+        self._theoretical_arrival = 0
+
+    def acquire(self):
+        """
+        Wait for a token.
+
+        Returns a deferred that fires with the number of seconds we had to
+        wait once the operation may proceed.
+        """
+        now = self.clock.seconds()
+        arrival = max(self._theoretical_arrival, now)
+        delay = max(0, arrival - self.tolerance - now)
+        self._theoretical_arrival = arrival + self.interval
+        if delay <= 0:
+            return succeed(0)
+        return deferLater(self.clock, delay, lambda: delay)
+
+
+class RedisTokenBucket(object):
+
+    """
+    A rate limiter like :class:`TokenBucket` that is shared through Redis by
+    everything using the same `key`, for example several transports bound
+    to the same SMPP account.
+
+    Time is divided into slots `burst / rate` seconds long and each slot
+    holds `burst` tokens, counted with an atomic INCR. Callers that don't
+    get a token wait for the next slot and try again. The slots are based
+    on each process's clock, so these should be kept in sync.
+    """
+
+    def __init__(self, redis, key, rate, burst=1, clock=reactor):
+        self.redis = redis
+        self.key = key
+        self.burst = burst
+        self.slot_length = float(burst) / rate
+        self.key_expiry = int(math.ceil(self.slot_length)) + 1
+        self.clock = clock
+
+    def slot_key(self, slot):
+        return 'mt_tps:%s:%s' % (self.key, slot)
+
+    @inlineCallbacks
+    def acquire(self):
+        """
+        Wait for a token.
+
+        Returns a deferred that fires with the number of seconds we had to
+        wait once the operation may proceed.
+        """
+        start = self.clock.seconds()
+        slot = int(start / self.slot_length)
+        while True:
+            key = self.slot_key(slot)
+            count = yield self.redis.incr(key)
+            if count == 1:
+                yield self.redis.expire(key, self.key_expiry)
+            if count <= self.burst:
+                returnValue(self.clock.seconds() - start)
+            # This slot is full, so wait for the next one.
+            slot = max(slot + 1, int(self.clock.seconds() / self.slot_length))
+            delay = slot * self.slot_length - self.clock.seconds()
+            if delay > 0:
+                yield deferLater(self.clock, delay, lambda: None)
@@ -103,6 +103,24 @@ class TestBaseTransport(VumiTestCase):
         for consumer in consumers:
             self.assertEqual(consumer.channel.qos_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_transport_max_in_flight_custom(self):
+        transport = yield self.tx_helper.get_transport({
+            'amqp_max_in_flight': 5,
+            })
+        consumers = list(self.get_tx_consumers(transport))
+        self.assertEqual(1, len(consumers))
+        for consumer in consumers:
+            self.assertEqual(consumer.max_in_flight, 5)
+
+    @inlineCallbacks
+    def test_transport_max_in_flight_default(self):
+        transport = yield self.tx_helper.get_transport({})
+        consumers = list(self.get_tx_consumers(transport))
+        self.assertEqual(1, len(consumers))
+        for consumer in consumers:
+            self.assertEqual(consumer.max_in_flight, 1)
+
     @inlineCallbacks
     def test_add_outbound_handler(self):
         transport = yield self.tx_helper.get_transport({})
@@ -377,6 +377,24 @@ def flatten_generator(generator_func):
     return wrapped
 
 
+def gather_results(results):
+    """
+    Wait for a list of results from a sync or async manager.
+
+    Async managers return Deferreds, which are gathered so that the
+    operations they represent can run concurrently. If any of them fail, the
+    first failure is passed on. Sync managers return plain values, which are
+    returned unchanged.
+    """
+    results = list(results)
+    if not any(isinstance(r, defer.Deferred) for r in results):
+        return results
+    d = defer.gatherResults([defer.maybeDeferred(lambda r: r, r)
+                             for r in results], consumeErrors=True)
+    d.addErrback(lambda f: f.value.subFailure)
+    return d
+
+
 def filter_options_on_prefix(options, prefix, delimiter='-'):
     """
     splits an options dict based on key prefixes
@@ -13,7 +13,7 @@ from twisted.python import log
 from vumi.service import Worker
 from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
-from vumi.config import Config, ConfigInt
+from vumi.config import Config, ConfigBool, ConfigInt
 from vumi.errors import DuplicateConnectorError
 from vumi.utils import generate_worker_id
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
@@ -34,6 +34,24 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_max_in_flight = ConfigInt(
+        "The maximum number of messages from each AMQP queue handled"
+        " concurrently by each worker instance. If this is greater than one,"
+        " messages may be handled out of order and acks are batched. This"
+        " should not be larger than `amqp_prefetch_count`.",
+        default=1, static=True)
+    amqp_publisher_confirms = ConfigBool(
+        "If set, AMQP publishers use publisher confirms and outbound messages"
+        " are only considered published once the broker has acked them. This"
+        " needs a broker that supports the RabbitMQ confirms extension.",
+        default=False, static=True)
+    amqp_max_unconfirmed_publishes = ConfigInt(
+        "If set along with `amqp_publisher_confirms`, the number of outbound"
+        " AMQP messages waiting for broker acks above which publishers report"
+        " themselves as saturated. Bulk senders should wait on"
+        " `wait_for_publish_capacity()` on their connector. This has no"
+        " effect without publisher confirms.",
+        default=None, static=True)
 
 
 class BaseWorker(Worker):
@@ -177,12 +195,17 @@ class BaseWorker(Worker):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
-        prefetch_count = self.get_static_config().amqp_prefetch_count
+        static_config = self.get_static_config()
         middlewares = self.middlewares if middleware else None
 
-        connector = connector_cls(self, connector_name,
-                                  prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+        connector = connector_cls(
+            self, connector_name,
+            prefetch_count=static_config.amqp_prefetch_count,
+            max_in_flight=static_config.amqp_max_in_flight,
+            publisher_confirms=static_config.amqp_publisher_confirms,
+            max_unconfirmed_publishes=(
+                static_config.amqp_max_unconfirmed_publishes),
+            middlewares=middlewares)
         self.connectors[connector_name] = connector
 
         d = connector.setup()